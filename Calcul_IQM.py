@@ -24,10 +24,14 @@
 """
 
 
-import processing
+import re
+import sys
 import time
-from qgis.PyQt.QtCore import QCoreApplication
+import processing
+from pathlib import Path
+from qgis.PyQt.QtCore import QCoreApplication, QMetaType
 from qgis.core import (
+	QgsField,
 	QgsProject,
 	QgsUnitTypes,
 	QgsProcessing,
@@ -36,11 +40,51 @@ from qgis.core import (
 	QgsProcessingMultiStepFeedback,
 	QgsProcessingParameterVectorLayer,
 	QgsProcessingParameterRasterLayer,
+	QgsProcessingParameterMultipleLayers,
 	QgsProcessingParameterString,
 	QgsProcessingParameterBoolean,
-	QgsProcessingParameterFeatureSink
+	QgsProcessingParameterEnum,
+	QgsProcessingParameterNumber,
+	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterFileDestination
 )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parent)
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, scoring, index_results, fingerprints, incremental, instrumentation, partition, profiling
+from IQM_Utils import corridor_prefilter, extract_sub_watershed_landuse
+from Indicateurs_IQM import calcul_a1, calcul_a2, calcul_a3, calcul_a4, calcul_f1, calcul_f2, calcul_f3, calcul_f4, calcul_f5
+
+# Indices of the IQM9, in the order of their fields in the output layer
+INDEX_MODULES = [
+	['A1', calcul_a1],
+	['A2', calcul_a2],
+	['A3', calcul_a3],
+	['A4', calcul_a4],
+	['F1', calcul_f1],
+	['F2', calcul_f2],
+	['F3', calcul_f3],
+	['F4', calcul_f4],
+	['F5', calcul_f5]
+]
+IQM_FIELDS = [QgsField('Score IQM9', QMetaType.Double, len=4, prec=2)]
+# Input layers needed by each index (on top of the river network and the PtRef)
+INDEX_LAYERS = {
+	'A1': ['dem', 'dams', 'landuse'],
+	'A2': ['dem', 'dams', 'landuse'],
+	'A3': ['dams', 'landuse'],
+	'A4': [],
+	'F1': ['routes', 'structures'],
+	'F2': ['routes', 'landuse'],
+	'F3': ['routes', 'landuse'],
+	'F4': [],
+	'F5': ['bande_riv']
+}
+# Indices depending on the land use, computed for each raster of a land use time series
+LANDUSE_INDICES = ['A1', 'A3', 'F2', 'F3']
+
 
 class compute_iqm(QgsProcessingAlgorithm):
 	DEFAULT_SEG_ID_FIELD = 'Id_UEA'
@@ -48,18 +92,29 @@ class compute_iqm(QgsProcessingAlgorithm):
 	DEFAULT_WIDTH_FIELD = 'Largeur_mod'
 
 	def initAlgorithm(self, config=None):
-		self.addParameter(QgsProcessingParameterVectorLayer('bande_riv', self.tr('Bande riveraine (peuplement forestier; MELCCFP)'), types=[QgsProcessing.TypeVectorPolygon], defaultValue=None))
-		self.addParameter(QgsProcessingParameterVectorLayer('dams', self.tr('Barrages (CEHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+		self.addParameter(QgsProcessingParameterVectorLayer('bande_riv', self.tr('Bande riveraine (peuplement forestier; MELCCFP)'), types=[QgsProcessing.TypeVectorPolygon], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterVectorLayer('dams', self.tr('Barrages (CEHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None, optional=True))
 		self.addParameter(QgsProcessingParameterVectorLayer('stream_network', self.tr('Réseau hydrographique (CRHQ)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None))
 		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
 		self.addParameter(QgsProcessingParameterString('segment_id_down_field', self.tr("Nom du champ identifiant le segment d'aval"), defaultValue=self.DEFAULT_DOWN_SEG_ID_FIELD))
-		self.addParameter(QgsProcessingParameterRasterLayer('dem', self.tr('MNT LiDAR (10 m)'), defaultValue=None))
+		self.addParameter(QgsProcessingParameterRasterLayer('dem', self.tr('MNT LiDAR (10 m)'), defaultValue=None, optional=True))
 		self.addParameter(QgsProcessingParameterVectorLayer('ptref_widths', self.tr('PtRef largeur (CRHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
 		self.addParameter(QgsProcessingParameterString('ptref_width_field', self.tr('Nom du champ de largeur dans PtRef'), defaultValue=self.DEFAULT_WIDTH_FIELD))
-		self.addParameter(QgsProcessingParameterVectorLayer('routes', self.tr('Réseau routier (OSM ou AQréseau+)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None))
-		self.addParameter(QgsProcessingParameterVectorLayer('structures', self.tr('Structures (MTMD)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
-		self.addParameter(QgsProcessingParameterRasterLayer('landuse', self.tr('Utilisation du territoire (MELCCFP)'), defaultValue=None))
+		self.addParameter(QgsProcessingParameterVectorLayer('routes', self.tr('Réseau routier (OSM ou AQréseau+)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterVectorLayer('structures', self.tr('Structures (MTMD)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterRasterLayer('landuse', self.tr('Utilisation du territoire (MELCCFP)'), defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterMultipleLayers('landuse_series', self.tr('Série temporelle d\'utilisation du territoire (une couche par année)'), layerType=QgsProcessing.TypeRaster, defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterEnum('indices', self.tr('Indices à calculer'), options=[key for key, _ in INDEX_MODULES], defaultValue=[key for key, _ in INDEX_MODULES], allowMultiple=True, usesStaticStrings=True))
 		self.addParameter(QgsProcessingParameterBoolean('use_agri', self.tr('Utiliser milieux agricoles (pour F2 et F3)?'), defaultValue=True, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('workers', self.tr('Nombre de processus pour les segments de F2, F3 et F5 (0 : tous les coeurs)'), type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1, optional=True))
+		self.addParameter(QgsProcessingParameterEnum('sampler', self.tr('Placement des transects de F2, F3 et F5'), options=compute.SAMPLER_LABELS, defaultValue=0))
+		self.addParameter(QgsProcessingParameterNumber('early_stop', self.tr("Niveau de confiance de l'arrêt anticipé des transects de F2, F3 et F5 (0 : tous les transects)"), type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('use_service', self.tr('Utiliser le service de calcul local pour F2, F3 et F5 (IQM_Core.service) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('partition_size', self.tr('Taille maximale des partitions du réseau (nb de segments, 0 : aucune partition)'), type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterVectorLayer('previous_iqm', self.tr('Couche IQM précédente (mode incrémental)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler chaque étape (cProfile) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) de chaque indice ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterFileDestination('fingerprints', self.tr("Empreintes des données d'entrée (mode incrémental)"), fileFilter='JSON (*.json)', defaultValue=None, optional=True, createByDefault=False))
 		self.addParameter(QgsProcessingParameterFeatureSink('Iqm', self.tr('Couche de sortie'), type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, supportsAppend=True, defaultValue=None))
 
 
@@ -73,26 +128,44 @@ class compute_iqm(QgsProcessingAlgorithm):
 		road_layer = self.parameterAsVectorLayer(parameters, "routes", context)
 		struct_layer = self.parameterAsVectorLayer(parameters, "structures", context)
 		landuse_layer = self.parameterAsRasterLayer(parameters, 'landuse', context)
+		landuse_series = self.parameterAsLayerList(parameters, 'landuse_series', context)
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 		seg_id_down_field = self.parameterAsString(parameters, 'segment_id_down_field', context)
 		width_field  = self.parameterAsString(parameters, 'ptref_width_field', context)
+		selected = self.parameterAsEnumStrings(parameters, 'indices', context)
+		# The rasters of a land use time series replace the land use layer
+		if landuse_series :
+			landuse_layer = landuse_series[0]
+		if not selected :
+			return False, self.tr("Aucun indice à calculer! Veuillez sélectionner au moins un indice.")
+		# Layers needed by the selected indices
+		needed = {name for key in selected for name in INDEX_LAYERS[key]}
 		# Dictionnary to iterate over the layers
 		lyr_dict = {"bande riv.":br_layer, "barrages":dams_layer, "res. hydro.":rivnet_layer, "DEM":dem_layer,"PtRef largeur":ptref_layer,"routes":road_layer, "structures":struct_layer, "util. terr.":landuse_layer}
+		lyr_params = {"bande riv.":'bande_riv', "barrages":'dams', "DEM":'dem', "routes":'routes', "structures":'structures', "util. terr.":'landuse'}
 		# Get project CRS to verify they are all in the project CRS
 		project_crs = QgsProject.instance().crs().authid()
 		# Verify lyrs CRS and unit types
 		for name, lyr in lyr_dict.items():
+			if name in lyr_params and lyr_params[name] not in needed :
+				# Layer not used by the selected indices
+				continue
+			if lyr is None :
+				return False, self.tr(f"La couche de {name} est nécessaire pour les indices sélectionnés! Veuillez fournir la couche et réessayer.")
 			if lyr.crs().authid() != project_crs :
 				return False, self.tr(f"La couche de {name} ne correspond pas au CRS du projet! Veuillez vérifier le CRS de la couche et réessayer.")
 			if not is_metric_crs(lyr.crs()) :
 				return False, self.tr(f"La couche de {name} n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
+		for lyr in landuse_series[1:] :
+			if lyr.crs().authid() != project_crs :
+				return False, self.tr(f"La couche {lyr.name()} de la série d'utilisation du territoire ne correspond pas au CRS du projet! Veuillez vérifier le CRS de la couche et réessayer.")
 		# Verify that PtRef layer as passed through the UEA_PtRef_join script and that
 		if "Largeur_mod" not in [f.name() for f in ptref_layer.fields()]:
 			return False, self.tr(f"Le champ Largeur_mod est absent de la couche PtRef largeur! Veuillez vous assurer que la couche de points de références a préalablement passé par le script UEA_PtRef_join")
 		if width_field not in [f.name() for f in ptref_layer.fields()]:
 			return False, self.tr(f"Le champ '{width_field}' est absent de la couche PtRef largeur! Veuillez fournir un champ identifiant la largeur du segment qui se trouve dans cette couche.")
 		# Verify that the road layer passed through one of the preprocessing scripts
-		if "demi_emp" not in [f.name() for f in road_layer.fields()]:
+		if 'routes' in needed and "demi_emp" not in [f.name() for f in road_layer.fields()]:
 			return False, self.tr("Le champ 'demi_emp' est absent de la couche du réseau routier! Veuillez vous assurer que la couche de réseau routier a préalablement passé par le script Extraction routes d'OSM ou d'Extraction routes AQréseau+ (IQM utils).")
 		# Verify that seg_id_field is in the two lyrs (stream_network and PtRef)
 		if seg_id_field not in [f.name() for f in rivnet_layer.fields()] :
@@ -105,296 +178,458 @@ class compute_iqm(QgsProcessingAlgorithm):
 
 
 	def processAlgorithm(self, parameters, context, model_feedback):
+		results = {}
+		outputs = {}
+		# Initialising needed parameters
+		selected = self.parameterAsEnumStrings(parameters, 'indices', context)
+		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
+		seg_id_down_field = self.parameterAsString(parameters, 'segment_id_down_field', context)
+		width_field  = self.parameterAsString(parameters, 'ptref_width_field', context)
+		use_agri = self.parameterAsBool(parameters, 'use_agri', context)
+		rivnet_layer = self.parameterAsVectorLayer(parameters, 'stream_network', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		# Land use rasters of each year (the land use layer alone without time series) and label of each year in the output fields
+		landuse_series = self.parameterAsLayerList(parameters, 'landuse_series', context)
+		landuses = landuse_series or [self.parameterAsRasterLayer(parameters, 'landuse', context)]
+		labels = series_labels(landuse_series) if landuse_series else [None]
+		# Maximal width of the river and size of the land use cells (reach of the A3 corridor between neighbouring segments)
+		max_width = float(ptref_layer.maximumValue(ptref_layer.fields().indexFromName(width_field)) or 0.0)
+		cell_size = max([landuse.rasterUnitsPerPixelX() for landuse in landuses if landuse is not None] or [0.0])
+
+		# Profile of each step (child algorithms, indices and IQM), written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, 'Iqm', context), self.name(), model_feedback)
+
+		# ======================$|  Incremental mode  |$=====================
+		# The fingerprints of the inputs are compared with those of the previous run to only recompute the affected segments
+		fingerprints_path = self.parameterAsFileOutput(parameters, 'fingerprints', context)
+		previous_layer = self.parameterAsVectorLayer(parameters, 'previous_iqm', context)
+		if landuse_series and (fingerprints_path or previous_layer is not None):
+			# The fingerprints only cover one land use raster
+			model_feedback.pushInfo(self.tr("Mode incrémental ignoré avec une série temporelle d'utilisation du territoire : calcul complet."))
+			fingerprints_path = None
+		if landuse_series:
+			model_feedback.pushInfo(self.tr(f"Série temporelle d'utilisation du territoire : {', '.join(labels)} (indices {', '.join(key for key in LANDUSE_INDICES if key in selected)} calculés pour chaque année)"))
+		# Sampling options of F2, F3 and F5 (they change the values of the indices, so they are part of the run parameters)
+		confidence = self.parameterAsDouble(parameters, 'early_stop', context)
+		sampler = compute.SAMPLERS[self.parameterAsEnum(parameters, 'sampler', context)]
+		run_parameters = {'segment_id_field': seg_id_field, 'segment_id_down_field': seg_id_down_field, 'ptref_width_field': width_field, 'use_agri': use_agri, 'early_stop': confidence, 'sampler': sampler}
+		input_fingerprints = {}
+		# Segments to recompute for each index (None for a complete run)
+		affected = None
+		previous_maps = {}
+		network = None
+		if fingerprints_path:
+			model_feedback.setProgressText(self.tr("Calcul des empreintes des données d'entrée..."))
+			start_time = time.perf_counter()
+			try :
+				# Inputs used by the selected indices
+				input_names = ['stream_network', 'ptref_widths'] + sorted({name for key in selected for name in INDEX_LAYERS[key]})
+				for name in input_names:
+					if name in ['dem', 'landuse']:
+						layer = self.parameterAsRasterLayer(parameters, name, context)
+					else:
+						layer = self.parameterAsVectorLayer(parameters, name, context)
+					input_fingerprints[name] = fingerprints.layer_fingerprint(layer, seg_id_field if name == 'stream_network' else None)
+				previous_fingerprints = fingerprints.load_fingerprints(fingerprints_path)
+				if previous_layer is None or previous_fingerprints is None or previous_fingerprints['parameters'] != run_parameters:
+					model_feedback.pushInfo(self.tr("Aucune exécution précédente comparable (couche IQM et empreintes) : calcul complet."))
+				else:
+					changes = {name: fingerprints.diff_fingerprints(previous_fingerprints['layers'].get(name), fp) for name, fp in input_fingerprints.items()}
+					network = incremental.RiverNetwork(rivnet_layer, seg_id_field, seg_id_down_field)
+					road_layer = self.parameterAsVectorLayer(parameters, 'routes', context)
+					road_half_width = road_layer.maximumValue(road_layer.fields().indexFromName('demi_emp')) if road_layer is not None and 'routes' in input_names else 0.0
+					affected = incremental.affected_segments(network, changes, selected, max_width, cell_size, float(road_half_width or 0.0))
+					previous_maps = incremental.previous_results(previous_layer, seg_id_field, {key: module.OUTPUT_FIELDS for key, module in INDEX_MODULES if key in selected})
+					for key in selected:
+						if previous_maps[key] is None:
+							# Fields missing from the previous output : the index is computed for every segment
+							affected[key] = None
+						n_segments = self.tr('tous les') if affected[key] is None else len(affected[key])
+						model_feedback.pushInfo(self.tr(f"\t{key} : {n_segments} segments à recalculer"))
+			except Exception as e :
+				model_feedback.reportError(self.tr(f"Erreur dans la comparaison des empreintes, calcul complet : {str(e)}"))
+				affected = None
+			model_feedback.pushInfo(self.tr(f"--> Temps écoulé pour l'étape empreintes : {time.perf_counter() - start_time:.2f} secondes"))
+			if model_feedback.isCanceled():
+				return {}
+		# Segments to compute for each index (None for all) and indices with segments to compute
+		to_compute = {key: (None if affected is None else affected[key]) for key in selected}
+		computed = [key for key in selected if to_compute[key] is None or to_compute[key]]
+
+		# Number of processes evaluating the segments of F2, F3 and F5
+		workers = self.parameterAsInt(parameters, 'workers', context)
+		# Prepared data of F2, F3 and F5 kept by the local compute service between runs
+		use_service = self.parameterAsBool(parameters, 'use_service', context)
+
+		# =======================$|  Partitioning  |$========================
+		# The per-segment indices are computed by sub-basins of at most partition_size segments
+		partition_size = self.parameterAsInt(parameters, 'partition_size', context)
+		partitions = None
+		if partition_size > 0:
+			if network is None:
+				network = incremental.RiverNetwork(rivnet_layer, seg_id_field, seg_id_down_field)
+			partitions = partition.partition_network(network, partition_size)
+			model_feedback.pushInfo(self.tr(f"Réseau divisé en {len(partitions)} partitions d'au plus {partition_size} segments."))
+		# Segments within 1000 m upstream needed to count the structures and dams of F1 and A3, and for A3
+		# the segments whose corridor overlaps the corridor of the computed ones (land use cells of the nearest segment)
+		upstream_halo = None
+		a3_halo = None
+		if network is not None:
+			upstream_halo = lambda sids: network.upstream(sids, incremental.DOWNSTREAM_DISTANCE)
+			a3_halo = lambda sids: upstream_halo(sids) | network.around(sids, incremental.a3_neighbour_distance(max_width, cell_size))
+
+		# Preprocessing steps needed by the computed indices
+		need_watersheds = any(key in computed for key in ['A1', 'A2'])
+		need_structures = 'F1' in computed
+		# (with partitions, each partition gathers the roads and riparian polygons of its own corridor)
+		need_corridor = partitions is None and any(key in computed for key in ['F2', 'F3', 'F5'])
+		n_steps = len(computed) + 1 + 2*need_watersheds + need_structures + need_corridor
 		# Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
 		# overall progress through the model
-		feedback = QgsProcessingMultiStepFeedback(13, model_feedback)
+		feedback = QgsProcessingMultiStepFeedback(n_steps, model_feedback)
 		current_step = 0
-		results = {}
-		outputs = {}
 
 		# =======================$|  Preprocessing  |$=======================
 		# (intermediate results required for calculating indices)
 		feedback.setProgressText(self.tr(f"Initialisation des étapes de prétraitement..."))
-		# Initialising needed parameters
-		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 
-		# 	Compute D8 pointer
-		feedback.setProgressText(self.tr(f"- Création du WBT D8 pointer"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'dem': parameters['dem'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'stream_network': parameters['stream_network'],
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT 
-			}
-			outputs['CalculePointeurD8'] = processing.run('script:computed8', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul du WBT D8 pointer : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul WBT D8 pointer", feedback)
-		if feedback.isCanceled():
-			return {}
-
-		# 	Filter structures
-		feedback.setProgressText(self.tr(f"- Extraction des structures filtrées"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'cours_eau': parameters['stream_network'],
-				'routes': parameters['routes'],
-				'structures': parameters['structures'],
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['FiltrerStructures'] = processing.run('script:filterstructures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le filtre des structures : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "filtre struct", feedback)
-		if feedback.isCanceled():
-			return {}
-
-		# 	Extract sub watersheds
-		feedback.setProgressText(self.tr(f"- Extraction de la couche de sous-BV"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'stream_network' : parameters['stream_network'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'D8' : outputs['CalculePointeurD8']['OUTPUT'],
-				'dams' : parameters['dams'],
-				'landuse' : parameters['landuse'],
-				'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
-			}
-			watersheds_data = processing.run('script:extract_subwatershed', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
-			watersheds = QgsProcessingUtils.mapLayerFromString(watersheds_data, context)
-			if not watersheds or not watersheds.isValid() :
-					# Verifies if the created layer is valid
-					feedback.reportError(self.tr("La couche watersheds est invalide."))
-					return {}
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans l'extraction des sous-BV : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "extract sous-BV", feedback)
-		if feedback.isCanceled():
-			return {}
+		# D8 pointer and sub watersheds only for A1 and A2
+		if need_watersheds:
+			# 	Compute D8 pointer
+			feedback.setProgressText(self.tr(f"- Création du WBT D8 pointer"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "calcul WBT D8 pointer"):
+				try :
+					alg_params = {
+						'dem': parameters['dem'],
+						'segment_id_field' : seg_id_field, # default : Id_UEA
+						'stream_network': parameters['stream_network'],
+						'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT 
+					}
+					outputs['CalculePointeurD8'] = processing.run('script:computed8', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul du WBT D8 pointer : {str(e)}"))
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul WBT D8 pointer", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		# Filtered structures only for F1
+		if need_structures:
+			# 	Filter structures
+			feedback.setProgressText(self.tr(f"- Extraction des structures filtrées"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "filtre struct"):
+				try :
+					alg_params = {
+						'cours_eau': parameters['stream_network'],
+						'routes': parameters['routes'],
+						'structures': parameters['structures'],
+						'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+					}
+					outputs['FiltrerStructures'] = processing.run('script:filterstructures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le filtre des structures : {str(e)}"))
+			current_step = self.get_ET_and_current_step(start_time, current_step, "filtre struct", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		watersheds = None
+		# Sub watersheds only for A1 and A2
+		if need_watersheds:
+			# 	Extract sub watersheds
+			feedback.setProgressText(self.tr(f"- Extraction de la couche de sous-BV"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "extract sous-BV"):
+				try :
+					alg_params = {
+						'stream_network' : parameters['stream_network'],
+						'segment_id_field' : seg_id_field, # default : Id_UEA
+						'D8' : outputs['CalculePointeurD8']['OUTPUT'],
+						'dams' : parameters['dams'],
+						'landuse' : landuses[0],
+						'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
+					}
+					watersheds_data = processing.run('script:extract_subwatershed', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+					watersheds = QgsProcessingUtils.mapLayerFromString(watersheds_data, context)
+					if not watersheds or not watersheds.isValid() :
+							# Verifies if the created layer is valid
+							feedback.reportError(self.tr("La couche watersheds est invalide."))
+							return {}
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans l'extraction des sous-BV : {str(e)}"))
+			current_step = self.get_ET_and_current_step(start_time, current_step, "extract sous-BV", feedback)
+			if feedback.isCanceled():
+				return {}
 
 		# =====================$|  Index calculation  |$=====================
 
+		# Geometry operations of each index, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = self.parameterAsBool(parameters, 'geos_counts', context)
 		feedback.setProgressText(self.tr(f"Calcul des indices..."))
-		# Initialising needed parameters
-		width_field  = self.parameterAsString(parameters, 'ptref_width_field', context)
-		seg_id_down_field = self.parameterAsString(parameters, 'segment_id_down_field', context)
-
-		# 	Index A1
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice A1"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'SUB_WATERSHED_GIVEN' : True,
-				'watersheds' : watersheds,
-				'stream_network' : parameters['stream_network'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceA1'] = processing.run('script:indicea1', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de A1 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A1", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index A2
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice A2"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'SUB_WATERSHED_GIVEN' : True,
-				'watersheds' : watersheds,
-				'stream_network' : outputs['IndiceA1']['OUTPUT'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceA2'] = processing.run('script:indicea2', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de A2 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A2", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index A3
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice A3"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'dam_distance' : 5, # default value : 5m
-				'stream_network' : outputs['IndiceA2']['OUTPUT'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'segment_id_down_field' : seg_id_down_field, # default : Id_UEA_aval
-				'dams' : parameters['dams'],
-				'landuse' : parameters['landuse'],
-				'ptref_widths' : parameters['ptref_widths'],
-				'ptref_width_field' : width_field, # default : Largeur_mod
-				'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceA3'] = processing.run('script:indicea3', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de A3 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A3", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index A4
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice A4"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'INPUT': outputs['IndiceA3']['OUTPUT'],
-				'segment_id_field' :  seg_id_field, # default : Id_UEA
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceA4'] = processing.run('script:indicea4', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de A4 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A4", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index F1
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice F1"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'structs_are_filtered': True,
-				'INPUT': outputs['IndiceA4']['OUTPUT'],
-				'segment_id_field' : seg_id_field, # default : Id_UEA
-				'segment_id_down_field' : seg_id_down_field, # default : Id_UEA_aval
-				'structs' : outputs['FiltrerStructures']['OUTPUT'],
-				'OUTPUT' : QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceF1'] = processing.run('script:indicef1', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de F1 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F1", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index F2
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice F2"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'roads': parameters['routes'],
-				'ptref_widths': parameters['ptref_widths'],
-				'ptref_width_field': width_field,  # default : Largeur_mod
-				'rivnet': outputs['IndiceF1']['OUTPUT'],
-				'segment_id_field': seg_id_field, # default : Id_UEA
-				'target_pts': 50, # default : 50
-				'step_min': 10, # default : 10m
-				'landuse': parameters['landuse'],
-				'use_agri': parameters['use_agri'], # default : True
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceF2'] = processing.run('script:indicef2', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de F2 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F2", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# Index F3
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice F3"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'roads': parameters['routes'],
-				'ptref_widths': parameters['ptref_widths'],
-				'ptref_width_field': width_field,  # default : Largeur_mod
-				'rivnet': outputs['IndiceF2']['OUTPUT'],
-				'segment_id_field': seg_id_field, # default : Id_UEA
-				'target_pts': 50, # default : 50
-				'step_min': 10, # default : 10m
-				'landuse': parameters['landuse'],
-				'use_agri': parameters['use_agri'], # default : True
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceF3'] = processing.run('script:indicef3', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de F3 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F3", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# Index F4
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice F4"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'ptref_widths': parameters['ptref_widths'],
-				'ptref_widths': parameters['ptref_widths'],
-				'ptref_width_field': width_field,  # default : Largeur_mod
-				'rivnet': outputs['IndiceF3']['OUTPUT'],
-				'segment_id_field': seg_id_field, # default : Id_UEA
-				'target_pts': 50, # default : 50
-				'step_min': 10, # default : 10m
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceF4'] = processing.run('script:indicef4', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de F4 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F4", feedback)
-		if feedback.isCanceled():
-			return {}
-
-
-		# 	Index F5
-		feedback.setProgressText(self.tr(f"- Calcul de l'indice F5"))
-		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'bande_riveraine_polly': parameters['bande_riv'],
-				'ptref_widths': parameters['ptref_widths'],
-				'ptref_width_field': width_field,  # default : Largeur_mod
-				'rivnet': outputs['IndiceF4']['OUTPUT'],
-				'segment_id_field': seg_id_field, # default : Id_UEA
-				'target_pts': 50, # default : 50
-				'step_min': 10, # default : 10m
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			outputs['IndiceF5'] = processing.run('script:indicef5', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de F5 : {str(e)}"))
-		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F5", feedback)
-		if feedback.isCanceled():
-			return {}
-
+		# Initialising needed layers (loaded once and shared by all the indices)
+		dams_layer = self.parameterAsVectorLayer(parameters, 'dams', context)
+		roads_corridor = self.parameterAsVectorLayer(parameters, 'routes', context)
+		bande_corridor = self.parameterAsVectorLayer(parameters, 'bande_riv', context)
+		struct_layer = None
+		if 'FiltrerStructures' in outputs:
+			struct_layer = QgsProcessingUtils.mapLayerFromString(outputs['FiltrerStructures']['OUTPUT'], context)
+		# Results of each index {sid: [values]}
+		index_maps = {}
+		# Indices whose computation failed (their fields are NULL, or those of the previous output in incremental mode)
+		failed = []
+
+		# Corridor only for F2, F3 and F5
+		if need_corridor:
+			# 	Prefilter roads and riparian polygons within the network corridor (once for F2, F3 and F5)
+			feedback.setProgressText(self.tr(f"- Préfiltrage des routes et de la bande riveraine par corridor"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "préfiltrage corridor"):
+				try :
+					# Reach of the F2 transects, the longest ones
+					roads_corridor, bande_corridor = corridor_prefilter.prefilter_layers(incremental.segments_to_compute(rivnet_layer, seg_id_field, affected, ['F2', 'F3', 'F5']), seg_id_field, ptref_layer, width_field, 50, roads_layer=roads_corridor if any(key in computed for key in ['F2', 'F3']) else None, bande_layer=bande_corridor if 'F5' in computed else None, feedback=feedback)
+				except Exception as e :
+					# The indices are still computed with the whole layers
+					feedback.reportError(self.tr(f"Erreur dans le préfiltrage par corridor : {str(e)}"))
+			current_step = self.get_ET_and_current_step(start_time, current_step, "préfiltrage corridor", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'A1' in computed:
+			# 	Index A1
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice A1"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "calcul A1"):
+				try :
+					# Sub-watersheds with the land use areas of each year (those of the first year are already computed)
+					a1_maps = [calcul_a1.compute_a1(watersheds, seg_id_field)]
+					for landuse in landuses[1:]:
+						a1_maps.append(calcul_a1.compute_a1(extract_sub_watershed_landuse.update_landuse_areas(landuse, watersheds, context, feedback=None), seg_id_field))
+					index_maps['A1'] = index_results.join_series(a1_maps, len(calcul_a1.OUTPUT_FIELDS))
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de A1 : {str(e)}"))
+					failed.append('A1')
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A1", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'A2' in computed:
+			# 	Index A2
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice A2"))
+			start_time = time.perf_counter()
+			with profiling.step(profiler, "calcul A2"):
+				try :
+					index_maps['A2'] = calcul_a2.compute_a2(watersheds, seg_id_field)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de A2 : {str(e)}"))
+					failed.append('A2')
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A2", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'A3' in computed:
+			# 	Index A3
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice A3"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul A3"):
+				try :
+					index_maps['A3'] = partition.run_partitioned(
+						lambda layer: calcul_a3.compute_a3_series(layer, dams_layer, landuses, ptref_layer, seg_id_field, seg_id_down_field, width_field, 5, context=context, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['A3'], halo=a3_halo, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de A3 : {str(e)}"))
+					failed.append('A3')
+			instrumentation.report_geos_counts(index_counts, 'A3', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A3", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'A4' in computed:
+			# 	Index A4
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice A4"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul A4"):
+				try :
+					index_maps['A4'] = partition.run_partitioned(
+						lambda layer: calcul_a4.compute_a4(layer, seg_id_field, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['A4'], halo=None, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de A4 : {str(e)}"))
+					failed.append('A4')
+			instrumentation.report_geos_counts(index_counts, 'A4', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul A4", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'F1' in computed:
+			# 	Index F1
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice F1"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul F1"):
+				try :
+					index_maps['F1'] = partition.run_partitioned(
+						lambda layer: calcul_f1.compute_f1(layer, struct_layer, seg_id_field, seg_id_down_field, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['F1'], halo=upstream_halo, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de F1 : {str(e)}"))
+					failed.append('F1')
+			instrumentation.report_geos_counts(index_counts, 'F1', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F1", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'F2' in computed:
+			# 	Index F2
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice F2"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul F2"):
+				try :
+					index_maps['F2'] = partition.run_partitioned(
+						lambda layer: calcul_f2.compute_f2_series(layer, roads_corridor, ptref_layer, landuses, seg_id_field, width_field, 50, 10, use_agri, partitions is not None, workers, use_service, confidence, sampler=sampler, context=context, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['F2'], halo=None, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de F2 : {str(e)}"))
+					failed.append('F2')
+			instrumentation.report_geos_counts(index_counts, 'F2', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F2", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'F3' in computed:
+			# 	Index F3
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice F3"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul F3"):
+				try :
+					index_maps['F3'] = partition.run_partitioned(
+						lambda layer: calcul_f3.compute_f3_series(layer, roads_corridor, ptref_layer, landuses, seg_id_field, width_field, 50, 10, use_agri, partitions is not None, workers, use_service, confidence, sampler=sampler, context=context, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['F3'], halo=None, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de F3 : {str(e)}"))
+					failed.append('F3')
+			instrumentation.report_geos_counts(index_counts, 'F3', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F3", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'F4' in computed:
+			# 	Index F4
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice F4"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul F4"):
+				try :
+					index_maps['F4'] = partition.run_partitioned(
+						lambda layer: calcul_f4.compute_f4(layer, ptref_layer, seg_id_field, width_field, 50, 10, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['F4'], halo=None, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de F4 : {str(e)}"))
+					failed.append('F4')
+			instrumentation.report_geos_counts(index_counts, 'F4', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F4", feedback)
+			if feedback.isCanceled():
+				return {}
+
+		if 'F5' in computed:
+			# 	Index F5
+			feedback.setProgressText(self.tr(f"- Calcul de l'indice F5"))
+			start_time = time.perf_counter()
+			index_counts = instrumentation.start_geos_counts(geos_counts)
+			with profiling.step(profiler, "calcul F5"):
+				try :
+					index_maps['F5'] = partition.run_partitioned(
+						lambda layer: calcul_f5.compute_f5(layer, bande_corridor, ptref_layer, seg_id_field, width_field, 50, 10, partitions is not None, workers, use_service, confidence, sampler=sampler, context=context, feedback=feedback),
+						rivnet_layer, seg_id_field, partitions, to_compute['F5'], halo=None, feedback=feedback
+					)
+				except Exception as e :
+					feedback.reportError(self.tr(f"Erreur dans le calcul de F5 : {str(e)}"))
+					failed.append('F5')
+			instrumentation.report_geos_counts(index_counts, 'F5', feedback)
+			current_step = self.get_ET_and_current_step(start_time, current_step, "calcul F5", feedback)
+			if feedback.isCanceled():
+				return {}
 
 		# ======================$|  IQM calculation  |$======================
 
-		feedback.setProgressText(self.tr(f"Calcul de l'IQM total des segments..."))
-
-		# Field calculator for total IQM calculation of each segments
+		# Incremental mode : the recomputed segments replace those of the previous output
+		if affected is not None:
+			for key in selected:
+				merged_map = dict(previous_maps.get(key) or {})
+				merged_map.update(index_maps.get(key) or {})
+				index_maps[key] = merged_map
+
+		# The IQM9 score is only computed when all the indices are
+		compute_score = len(selected) == len(INDEX_MODULES)
+		if compute_score and failed:
+			# The sum would ignore the scores of the failed indices and overrate the segments
+			feedback.reportError(self.tr(f"Score IQM9 non calculé (NULL) : erreur dans le calcul de {', '.join(failed)}."))
+		elif compute_score:
+			feedback.setProgressText(self.tr(f"Calcul de l'IQM total des segments..."))
+		else:
+			feedback.setProgressText(self.tr(f"Sortie des indices calculés (score IQM9 non calculé, tous les indices n'étant pas sélectionnés)..."))
+
+		# Total IQM of each segment computed at once from the index scores and written with all the index values to the output
 		start_time = time.perf_counter()
-		try :
-			alg_params = {
-				'FIELD_LENGTH': 2,
-				'FIELD_NAME': 'Score IQM9',
-				'FIELD_PRECISION': 2,
-				'FIELD_TYPE': 0,  # Decimal (double)
-				'FORMULA': '1 - (array_sum(array( "Indice A1",  "Indice A2" ,  "Indice A3" ,  "Indice A4" ,  "Indice F1" ,  "Indice F2" ,  "Indice F3" ,  "Indice F4" ,  "Indice F5"))) / 40', # for each river segment : IQM = 1 - (total score/max score)
-				'INPUT': outputs['IndiceF5']['OUTPUT'],
-				'OUTPUT': parameters['Iqm']
-			}
-			outputs['FieldCalculator'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-			results['Iqm'] = outputs['FieldCalculator']['OUTPUT']
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de l'IQM : {str(e)}"))
+		with profiling.step(profiler, "calcul IQM"):
+			try :
+				selected_modules = [[key, module] for key, module in INDEX_MODULES if key in selected]
+				# Results of each year, the indices not depending on the land use having the same results every year
+				year_maps = [{key: (index_maps.get(key) or {}) for key in selected} for _ in labels]
+				for key, module in selected_modules:
+					if key in LANDUSE_INDICES:
+						for year, year_map in enumerate(index_results.split_series(index_maps.get(key) or {}, len(module.OUTPUT_FIELDS), len(labels))):
+							year_maps[year][key] = year_map
+				# With a time series, the indices depending on the land use and the IQM9 score are written for each year
+				yearly_keys = [key for key, _ in selected_modules if landuse_series and key in LANDUSE_INDICES]
+				output_results = [(year_maps[0][key], len(module.OUTPUT_FIELDS)) for key, module in selected_modules if key not in yearly_keys]
+				field_lists = [module.OUTPUT_FIELDS for key, module in selected_modules if key not in yearly_keys]
+				sids = [f[seg_id_field] for f in rivnet_layer.getFeatures()] if compute_score else []
+				for year, label in enumerate(labels):
+					for key, module in selected_modules:
+						if key in yearly_keys:
+							output_results.append((year_maps[year][key], len(module.OUTPUT_FIELDS)))
+							field_lists.append(index_results.series_fields(module.OUTPUT_FIELDS, label))
+					if compute_score:
+						# The score of an index is the last of its values
+						index_scores = [[year_maps[year][key].get(sid, [None])[-1] for key, _ in INDEX_MODULES] for sid in sids]
+						# NULL scores are ignored in the sum
+						index_scores = scoring.as_array([v for row in index_scores for v in row]).reshape(-1, len(INDEX_MODULES))
+						iqm_scores = scoring.score_iqm(index_scores) # for each river segment : IQM = 1 - (total score/max score)
+						output_results.append(({sid: [None if failed else float(score)] for sid, score in zip(sids, iqm_scores)}, len(IQM_FIELDS)))
+						field_lists.append(index_results.series_fields(IQM_FIELDS, label) if landuse_series else IQM_FIELDS)
+				sink_fields = index_results.output_fields(rivnet_layer.fields(), *field_lists)
+				(sink, dest_id) = self.parameterAsSink(parameters, 'Iqm', context, sink_fields, rivnet_layer.wkbType(), rivnet_layer.crs())
+				index_results.write_results(sink, rivnet_layer.getFeatures(), seg_id_field, *output_results)
+				results['Iqm'] = dest_id
+			except Exception as e :
+				feedback.reportError(self.tr(f"Erreur dans le calcul de l'IQM : {str(e)}"))
 		current_step = self.get_ET_and_current_step(start_time, current_step, "calcul IQM", feedback)
 
+		# Fingerprints of the inputs for the next incremental run
+		if fingerprints_path and 'Iqm' in results and failed:
+			# The segments of the failed indices were not recomputed : the next run must be complete
+			try :
+				Path(fingerprints_path).unlink(missing_ok=True)
+			except OSError as e :
+				feedback.reportError(self.tr(f"Erreur dans la suppression des empreintes : {str(e)}"))
+			feedback.pushWarning(self.tr(f"Empreintes non enregistrées (erreur dans le calcul de {', '.join(failed)}) : la prochaine exécution sera un calcul complet."))
+		elif fingerprints_path and 'Iqm' in results:
+			try :
+				fingerprints.save_fingerprints(fingerprints_path, input_fingerprints, run_parameters)
+				results['fingerprints'] = fingerprints_path
+			except Exception as e :
+				feedback.reportError(self.tr(f"Erreur dans l'écriture des empreintes : {str(e)}"))
+
 		# Ending message
 		feedback.setProgressText(self.tr('Processus terminé !'))
 
@@ -442,12 +677,36 @@ class compute_iqm(QgsProcessingAlgorithm):
 			"-> Ensemble de données vectorielles ponctuelles des structures sous la gestion du Ministère des Transports et de la Mobilité durable du Québec (MTMD) (pont, ponceau, portique, mur et tunnel). Source des données : MTMD. Structure, [Jeu de données], dans Données Québec.\n" \
 			"Utilisation du territoire : Matriciel\n" \
 			"-> Classes d'utilisation du territoire pour le bassin versant donné sous forme matriciel (résolution 10 m) qui sera reclassé pour les classes forestière, agricole et anthropique, selon le guide d'utilisation du jeu de données. Source des données : MELCCFP. Utilisation du territoire, [Jeu de données], dans Données Québec.\n" \
+			"Série temporelle d'utilisation du territoire : Matriciels multiples (optionnel)\n" \
+			"-> Rasters d'utilisation du territoire de plusieurs années, qui remplacent la couche d'utilisation du territoire. Les prétraitements et les indices qui ne dépendent pas de l'utilisation du territoire (pointeur D8, sous-BV, structures, A2, A4, F1, F4, F5) sont calculés une seule fois, et seuls A1, A3, F2 et F3 sont calculés pour chaque année (les routes tamponnées de F2 et F3, les barrages et les largeurs de A3 sont réutilisés). Les champs de ces indices et le score IQM9 sont ajoutés pour chaque année avec l'année en suffixe (p. ex. 'Indice F2_2020'), l'année étant tirée du nom de la couche (sinon sa position dans la série). Le mode incrémental n'est pas utilisé avec une série temporelle.\n" \
+			"Indices à calculer : Liste (valeur par défaut : tous les indices)\n" \
+			"-> Indices de l'IQM9* à calculer. Seuls les prétraitements nécessaires aux indices sélectionnés sont effectués (pointeur D8 et sous-BV pour A1 et A2, filtre des structures pour F1, préfiltrage par corridor pour F2, F3 et F5) et seules les couches utilisées par ces indices sont obligatoires. Le score IQM9 n'est calculé que lorsque les neuf indices sont sélectionnés, et il est NULL si le calcul d'un indice a échoué.\n" \
 			"Utiliser milieux agricoles : Booléen (optionnel; valeur par défaut : Vrai) \n" \
 			"-> Détermine si l'algorithme doit considérer les milieux agricoles comme obstacles supplémentaires dans la plaine alluviale (pour calcul de F2 et F3) pour la reclassification des classes d'utilisation du territoire.\n" \
+			"Nombre de processus : Entier (optionnel; valeur par défaut : 1)\n" \
+			"-> Nombre de processus évaluant en parallèle les transects des segments pour F2, F3 et F5 (0 : un par coeur). Les obstacles et la bande riveraine préparés ainsi que les largeurs des PtRef sont placés en mémoire partagée avec les segments, lus sans copie par chaque processus, puis les segments leur sont attribués par groupes et les résultats sont repris dans l'ordre du réseau.\n" \
+			"Placement des transects : Liste (valeur par défaut : Uniforme)\n" \
+			"-> Placement des transects de F2, F3 et F5 le long des segments : à intervalles réguliers (Uniforme) ou selon l'angle de virage cumulé (Courbure), avec le même nombre de transects. Avec la courbure, chaque transect compte pour la longueur de segment qu'il représente.\n" \
+			"Niveau de confiance de l'arrêt anticipé : Double (optionnel; valeur par défaut : 0)\n" \
+			"-> Les transects de chaque segment de F2, F3 et F5 sont évalués du plus grossier au plus fin et l'évaluation s'arrête dès que la classe de l'indice ne peut plus changer au niveau de confiance donné (p. ex. 0.95). À 1, seulement lorsque la classe est certaine (scores identiques à l'évaluation complète). À 0, tous les transects sont évalués.\n" \
+			"Utiliser le service de calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> F2, F3 et F5 sont évalués dans le service de calcul local (python -m IQM_Core.service), qui conserve en mémoire les obstacles et la bande riveraine préparés ainsi que les largeurs des PtRef d'une exécution à l'autre pour les mêmes données. Si le service est injoignable, ces indices sont calculés dans QGIS.\n" \
+			"Taille maximale des partitions : Entier (optionnel; valeur par défaut : 0)\n" \
+			"-> Nombre maximal de segments par partition. Lorsque supérieur à 0, le réseau est divisé en sous-bassins (selon les liens Id_UEA_aval) et les indices A3, A4, F1 à F5 sont calculés partition par partition, chacune avec son propre corridor d'obstacles (F2, F3, F5) les segments situés jusqu'à 1000 m en amont (F1, A3) et, pour A3, les segments voisins dont le corridor chevauche celui de la partition. Réduit la mémoire requise pour les très grands réseaux. A1 et A2 sont toujours calculés sur l'ensemble du réseau.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) de A3, A4 et F1 à F5, et affiche après chacun de ces indices leur total par opération et par fonction appelante. La variable d'environnement IQM_GEOS_COUNTS=1 les active aussi.\n" \
+			"Profiler chaque étape : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute chaque étape (algorithmes enfants de prétraitement, chaque indice et le calcul de l'IQM) sous cProfile et sous un échantillonneur de la pile d'appels, et écrit pour chacune dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
+			"Couche IQM précédente : Vectoriel (lignes) (optionnel)\n" \
+			"-> Couche de sortie d'une exécution précédente de Calcul IQM sur le même bassin versant. Avec le fichier d'empreintes de cette exécution, active le mode incrémental : seuls les segments touchés par les modifications des données d'entrée sont recalculés (segments à proximité des changements pour F2, F3, F4, F5 et A3, 1000 m en aval pour F1 et A3, tout l'aval pour A1 et A2), les autres reprennent les valeurs de la couche précédente.\n" \
+			"Empreintes des données d'entrée : Fichier JSON (optionnel)\n" \
+			"-> Fichier des empreintes (hachage des entités et des blocs de pixels) des données d'entrée. Lu au début du calcul s'il existe (mode incrémental), puis remplacé par les empreintes des données actuelles pour la prochaine exécution. Un changement des champs identifiants, du champ de largeur ou de l'option des milieux agricoles entraîne un calcul complet.\n" \
 			"Retourne\n" \
 			"----------\n" \
 			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec les scores de chaque indice de l'IQM9* calculés pour chaque UEA."
+			"-> Réseau hydrographique du bassin versant avec les scores de chaque indice de l'IQM9* calculés pour chaque UEA.\n" \
+			"Empreintes des données d'entrée : Fichier JSON (si demandé)\n" \
+			"-> Empreintes des données de cette exécution, à fournir lors de la prochaine exécution incrémentale."
 		)
 
 
@@ -476,6 +735,16 @@ class compute_iqm(QgsProcessingAlgorithm):
 	def createInstance(self):
 		return compute_iqm()
 
+def series_labels(layers):
+	# Label of each raster of a land use time series : the last year in its name (e.g. utilisation_territoire_2020), or its position
+	labels = []
+	for position, layer in enumerate(layers, start=1):
+		years = re.findall(r'(?<!\d)(?:19|20)\d{2}(?!\d)', layer.name())
+		label = years[-1] if years else str(position)
+		labels.append(label if label not in labels else f"{label}_{position}")
+	return labels
+
+
 def is_metric_crs(crs):
 	# True if the distance unit of the CRS is the meter
 	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
\ No newline at end of file
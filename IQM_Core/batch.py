@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Batch execution of Calcul IQM over many basins, outside of the QGIS interface.
+
+	python -m IQM_Core.batch config.json [--workers N]
+
+The basins are computed in a pool of worker processes, each running its own
+QGIS application (headless) with Processing, the WhiteboxTools provider and
+the scripts of the tool. Each worker opens the province-wide inputs once and
+reuses them (and the spatial indexes of their providers) for all its basins.
+
+The JSON configuration holds:
+	- "inputs" : province-wide inputs of Calcul IQM {parameter: path}, cut for
+	  each basin of the "basins" layer ({"layer": path, "id_field": name});
+	- or "bundles" : list of per-basin inputs {"id": ..., parameter: path};
+	- "parameters" : other parameters of Calcul IQM (indices, use_agri, ...);
+	- "output" : consolidated output layer (GeoPackage), "work_dir" : folder of
+	  the per-basin outputs, "workers" : number of processes (number of cores
+	  by default), "qgis_prefix" : QGIS install prefix and "plugins" : folders
+	  holding the QGIS plugins (wbt_for_qgis) if not the default ones.
+A status file (<output>_status.csv) reports the result of every basin.
+"""
+
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from pathlib import Path
+
+# Root of the repository (Calcul_IQM and the script folders)
+ROOT = str(Path(__file__).resolve().parents[1])
+# Folders of the Processing scripts of the tool
+SCRIPT_FOLDERS = [ROOT, os.path.join(ROOT, 'IQM_Utils'), os.path.join(ROOT, 'Indicateurs_IQM')]
+# Layer inputs of Calcul IQM
+VECTOR_INPUTS = ['stream_network', 'ptref_widths', 'routes', 'structures', 'dams', 'bande_riv']
+RASTER_INPUTS = ['dem', 'landuse']
+# Distance (m) added around a basin when cutting the province inputs (reach of the transects and corridors)
+BASIN_HALO = 100.0
+
+# State of a worker process (QGIS application, configuration and opened province inputs)
+_worker = {}
+
+
+def start_qgis(qgis_prefix=None, plugin_folders=None):
+	"""
+	Starts a headless QGIS application with Processing, the WhiteboxTools provider and the scripts of the tool.
+	"""
+	from qgis.core import QgsApplication
+	if qgis_prefix:
+		QgsApplication.setPrefixPath(qgis_prefix, True)
+	qgs = QgsApplication([], False)
+	qgs.initQgis()
+	for folder in (plugin_folders or [os.path.join(QgsApplication.qgisSettingsDirPath(), 'python', 'plugins')]):
+		if folder not in sys.path:
+			sys.path.append(folder)
+	from processing.core.Processing import Processing
+	from processing.core.ProcessingConfig import ProcessingConfig
+	from processing.script import ScriptUtils
+	Processing.initialize()
+	# WhiteboxTools provider (wbt_for_qgis plugin), not loaded without the interface
+	try:
+		from wbt_for_qgis.whiteboxProvider import WhiteboxProvider
+		if QgsApplication.processingRegistry().providerById('wbt') is None:
+			QgsApplication.processingRegistry().addProvider(WhiteboxProvider())
+	except ImportError:
+		print("ATTENTION : extension wbt_for_qgis introuvable, les indices A1 et A2 ne pourront être calculés.", file=sys.stderr)
+	# Scripts of the tool, added for this process only (the setting is not saved)
+	folders = ScriptUtils.scriptsFolders()
+	setting = ProcessingConfig.settings[ScriptUtils.SCRIPTS_FOLDERS]
+	setting.value = ';'.join(folders + [folder for folder in SCRIPT_FOLDERS if folder not in folders])
+	QgsApplication.processingRegistry().providerById('script').refreshAlgorithms()
+	return qgs
+
+
+def init_worker(config):
+	"""
+	Initializer of the worker processes : QGIS and the province inputs, opened once per process.
+	"""
+	_worker['qgs'] = start_qgis(config.get('qgis_prefix'), config.get('plugins'))
+	open_inputs(config)
+
+
+def open_inputs(config):
+	"""
+	Opens the province inputs and the basin layer of a configuration in the current process.
+	"""
+	from qgis.core import QgsVectorLayer, QgsRasterLayer
+	_worker['config'] = config
+	layers = {}
+	for name, path in config.get('inputs', {}).items():
+		layer = QgsRasterLayer(path, name) if name in RASTER_INPUTS else QgsVectorLayer(path, name, 'ogr')
+		if not layer.isValid():
+			raise RuntimeError(f"Couche {name} invalide : {path}")
+		layers[name] = layer
+	_worker['inputs'] = layers
+	if 'basins' in config:
+		_worker['basins'] = QgsVectorLayer(config['basins']['layer'], 'basins', 'ogr')
+
+
+def basin_inputs(basin_id, basin_dir, context):
+	"""
+	Inputs of a basin cut from the province inputs : segments whose point on surface is in the basin
+	(each segment belongs to a single basin), other layers within the basin and its halo.
+	"""
+	import processing
+	from qgis.core import QgsFeature, QgsFeatureRequest, QgsExpression, QgsGeometry, QgsMemoryProviderUtils
+	config = _worker['config']
+	basins = _worker['basins']
+	id_field = config['basins']['id_field']
+	request = QgsFeatureRequest(QgsExpression(f"{QgsExpression.quotedColumnRef(id_field)} = {QgsExpression.quotedValue(basin_id)}"))
+	basin = next(basins.getFeatures(request), None)
+	if basin is None:
+		raise RuntimeError(f"Bassin {basin_id} absent de la couche des bassins")
+	basin_geom = basin.geometry()
+	halo_geom = basin_geom.buffer(BASIN_HALO, 8)
+	halo_engine = QgsGeometry.createGeometryEngine(halo_geom.constGet())
+	halo_engine.prepareGeometry()
+	basin_engine = QgsGeometry.createGeometryEngine(basin_geom.constGet())
+	basin_engine.prepareGeometry()
+	inputs = {}
+	for name, layer in _worker['inputs'].items():
+		if name in RASTER_INPUTS:
+			mask = QgsMemoryProviderUtils.createMemoryLayer('mask', basins.fields(), basins.wkbType(), basins.crs())
+			halo_feat = QgsFeature(basin)
+			halo_feat.setGeometry(halo_geom)
+			mask.dataProvider().addFeatures([halo_feat])
+			inputs[name] = processing.run('gdal:cliprasterbymasklayer', {
+				'INPUT': layer,
+				'MASK': mask,
+				'CROP_TO_CUTLINE': True,
+				'KEEP_RESOLUTION': True,
+				'OUTPUT': os.path.join(basin_dir, f"{name}.tif")
+			}, context=context)['OUTPUT']
+			continue
+		# Candidates by the spatial index of the provider, then exact test
+		request = QgsFeatureRequest().setFilterRect(halo_geom.boundingBox())
+		if name == 'stream_network':
+			features = [f for f in layer.getFeatures(request) if basin_engine.intersects(f.geometry().pointOnSurface().constGet())]
+		else:
+			features = [f for f in layer.getFeatures(request) if halo_engine.intersects(f.geometry().constGet())]
+		subset = QgsMemoryProviderUtils.createMemoryLayer(name, layer.fields(), layer.wkbType(), layer.crs())
+		subset.dataProvider().addFeatures(features)
+		inputs[name] = subset
+	return inputs
+
+
+def run_basin(task):
+	"""
+	Runs Calcul IQM on one basin (in a worker process).
+
+	Parameters
+	----------
+	task : list
+		[basin id, bundle of per-basin inputs or None to cut the province inputs(, output path)]
+
+	Returns
+	----------
+	status : dict
+		Identifier, status ('ok' or 'erreur'), output path, duration and messages of the basin
+	"""
+	import processing
+	from qgis.core import QgsProject, QgsVectorLayer, QgsProcessingContext, QgsProcessingFeedback
+	from Calcul_IQM import compute_iqm
+
+	class BasinFeedback(QgsProcessingFeedback):
+		# Keeps the errors reported by the algorithm (Calcul IQM reports them without stopping)
+		def __init__(self):
+			super().__init__()
+			self.errors = []
+
+		def reportError(self, error, fatalError=False):
+			self.errors.append(error)
+
+	basin_id, bundle = task[:2]
+	config = _worker['config']
+	basin_dir = os.path.join(config['work_dir'], str(basin_id))
+	os.makedirs(basin_dir, exist_ok=True)
+	output = task[2] if len(task) > 2 else os.path.join(basin_dir, 'iqm.gpkg')
+	start_time = time.perf_counter()
+	feedback = BasinFeedback()
+	try:
+		context = QgsProcessingContext()
+		if bundle is not None:
+			inputs = {name: bundle[name] for name in VECTOR_INPUTS + RASTER_INPUTS if name in bundle}
+		else:
+			inputs = basin_inputs(basin_id, basin_dir, context)
+		# Calcul IQM checks the layers against the CRS of the project
+		network = inputs['stream_network']
+		if isinstance(network, str):
+			network = QgsVectorLayer(network, 'stream_network', 'ogr')
+		QgsProject.instance().setCrs(network.crs())
+		parameters = dict(config.get('parameters', {}))
+		parameters.update(inputs)
+		parameters['Iqm'] = output
+		processing.run(compute_iqm(), parameters, context=context, feedback=feedback)
+		status = 'ok' if not feedback.errors and os.path.exists(output) else 'erreur'
+	except Exception as e:
+		feedback.errors.append(f"{e}\n{traceback.format_exc()}")
+		status = 'erreur'
+	return {
+		'id': basin_id,
+		'status': status,
+		'output': output if status == 'ok' else '',
+		'seconds': round(time.perf_counter() - start_time, 2),
+		'messages': ' | '.join(str(error) for error in feedback.errors)
+	}
+
+
+def basin_tasks(config):
+	"""
+	Tasks of the run : one per bundle, or one per feature of the basin layer (in the order of their identifiers).
+	"""
+	if 'bundles' in config:
+		return [[bundle['id'], bundle] for bundle in config['bundles']]
+	from qgis.core import QgsVectorLayer
+	basins = QgsVectorLayer(config['basins']['layer'], 'basins', 'ogr')
+	if not basins.isValid():
+		raise RuntimeError(f"Couche des bassins invalide : {config['basins']['layer']}")
+	ids = [f[config['basins']['id_field']] for f in basins.getFeatures()]
+	return [[basin_id, None] for basin_id in sorted(ids, key=str)]
+
+
+def merge_outputs(statuses, output):
+	"""
+	Consolidated output : the outputs of the basins computed without error, merged in the order of the tasks.
+	"""
+	import processing
+	from qgis.core import QgsProcessingContext
+	paths = [status['output'] for status in statuses if status['status'] == 'ok']
+	if not paths:
+		return None
+	return processing.run('native:mergevectorlayers', {
+		'LAYERS': paths,
+		'OUTPUT': output
+	}, context=QgsProcessingContext())['OUTPUT']
+
+
+def write_status(statuses, path):
+	with open(path, 'w', newline='', encoding='utf-8') as f:
+		writer = csv.DictWriter(f, fieldnames=['id', 'status', 'output', 'seconds', 'messages'])
+		writer.writeheader()
+		writer.writerows(statuses)
+
+
+def run_batch(config):
+	"""
+	Runs all the basins of a configuration and writes the consolidated output and the status file.
+
+	Returns
+	----------
+	statuses : list of dict
+		Status of each basin, in the order of the tasks
+	"""
+	config = dict(config)
+	output = config['output']
+	config.setdefault('work_dir', str(Path(output).with_suffix('')) + '_bassins')
+	os.makedirs(config['work_dir'], exist_ok=True)
+	workers = int(config.get('workers') or os.cpu_count() or 1)
+	# QGIS of the main process, for the basin list and the merge
+	qgs = start_qgis(config.get('qgis_prefix'), config.get('plugins'))
+	tasks = basin_tasks(config)
+	print(f"{len(tasks)} bassins à traiter avec {workers} processus")
+	statuses = {}
+	# 'spawn' so that each worker starts its own QGIS application
+	pool_context = multiprocessing.get_context('spawn')
+	with pool_context.Pool(processes=workers, initializer=init_worker, initargs=(config,)) as pool:
+		for status in pool.imap_unordered(run_basin, tasks):
+			statuses[status['id']] = status
+			print(f"[{len(statuses)}/{len(tasks)}] Bassin {status['id']} : {status['status']} ({status['seconds']} s)")
+	statuses = [statuses[basin_id] for basin_id, _ in tasks]
+	merge_outputs(statuses, output)
+	write_status(statuses, str(Path(output).with_suffix('')) + '_status.csv')
+	qgs.exitQgis()
+	return statuses
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Calcul de l'IQM9 sur plusieurs bassins versants en parallèle.")
+	parser.add_argument('config', help="Fichier de configuration JSON")
+	parser.add_argument('--workers', type=int, default=None, help="Nombre de processus (nombre de coeurs par défaut)")
+	args = parser.parse_args(argv)
+	with open(args.config, 'r', encoding='utf-8') as f:
+		config = json.load(f)
+	if args.workers:
+		config['workers'] = args.workers
+	statuses = run_batch(config)
+	n_errors = sum(status['status'] != 'ok' for status in statuses)
+	print(f"Terminé : {len(statuses) - n_errors} bassins calculés, {n_errors} en erreur.")
+	return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,1101 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Compute core of the IQM indices, independent of QGIS.
+
+The kernels work on NumPy arrays : a line is a list of parts, each an (n, 2)
+array of vertices, and the PtRef widths of a segment are the [x, y, width]
+arrays of IQM_Core.ptref. The polygons met by the transects (obstacles of F2
+and F3, riparian strip of F5) are tested with Shapely 2 when it is installed.
+The Processing algorithms call into these kernels, the worker processes of
+IQM_Core.parallel only import NumPy and Shapely (they start without a QGIS
+application) and the kernels can be benchmarked without QGIS. Without Shapely,
+F2, F3 and F5 keep their GEOS predicates through QGIS.
+"""
+
+
+import math
+import time
+import numpy as np
+from statistics import NormalDist
+
+from IQM_Core import instrumentation, ptref, scoring, transport
+
+try:
+	import shapely
+	HAS_SHAPELY = int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+	HAS_SHAPELY = False
+
+
+# ------------------------------------------------------------------------------
+# Lines
+# ------------------------------------------------------------------------------
+
+def line_segments(parts):
+	"""
+	Vertex-to-vertex segments of a line, the parts taken one after the other.
+
+	Returns
+	----------
+	a, b : numpy.ndarray
+		(m, 2) start and end of each segment
+	start : numpy.ndarray
+		(m,) distance along the line of the start of each segment
+	"""
+	parts = [np.asarray(part, dtype=float) for part in parts if len(part) >= 2]
+	if not parts:
+		return np.empty((0, 2)), np.empty((0, 2)), np.empty(0)
+	a = np.concatenate([part[:-1] for part in parts])
+	b = np.concatenate([part[1:] for part in parts])
+	lengths = np.hypot(*(b - a).T)
+	start = np.concatenate([[0.0], np.cumsum(lengths)[:-1]])
+	return a, b, start
+
+
+def line_length(parts):
+	return float(sum(np.hypot(*np.diff(np.asarray(part, dtype=float), axis=0).T).sum() for part in parts if len(part) >= 2))
+
+
+def interpolate(parts, distances):
+	# Points at the given distances along the line (as QgsGeometry.interpolate)
+	a, b, start = line_segments(parts)
+	distances = np.asarray(distances, dtype=float)
+	if not len(a):
+		return np.empty((0, 2))
+	lengths = np.hypot(*(b - a).T)
+	i = np.clip(np.searchsorted(start + lengths, distances, side='left'), 0, len(a) - 1)
+	t = np.zeros(len(distances))
+	np.divide(distances - start[i], lengths[i], out=t, where=lengths[i] > 0)
+	t = np.clip(t, 0.0, 1.0)
+	return a[i] + t[:, None] * (b[i] - a[i])
+
+
+def sample_distances(length, step):
+	"""
+	Distances along a line of length meters of the points sampled every step meters
+	(from its start), or of its midpoint if it is shorter than the step. The distances
+	are clamped within [0, length[ to stay on the line.
+	"""
+	if not np.isfinite(length) or length <= 0.0:
+		return np.empty(0)
+	# Tiny epsilon to stay strictly inside [0, length)
+	eps = max(1e-6, min(0.001, 1e-3 * length))
+	if length < step:
+		return np.array([max(0.0, min(length - eps, length * 0.5))])
+	return np.minimum(length - eps, np.maximum(0.0, np.arange(0.0, length, step)))
+
+
+def points_along_line(parts, step):
+	"""
+	Points sampled every step meters along a line (see sample_distances).
+
+	Returns
+	----------
+	points : numpy.ndarray
+		(n, 2) sampled points
+	"""
+	return interpolate(parts, sample_distances(line_length(parts), step))
+
+
+# Placements of the transect points along a segment (state['sampler']) and their labels in the Processing scripts
+SAMPLERS = ['uniform', 'curvature']
+SAMPLER_LABELS = ['Uniforme', 'Courbure (angle de virage cumulé)']
+
+
+def curvature_distances(parts, n, share=0.5):
+	"""
+	Distances along a line of n points placed by cumulative turning angle, with the
+	length of line each point stands for.
+
+	The line is cut into n stretches of equal effort, the effort of a stretch being
+	(1 - share) times its share of the length plus share times its share of the
+	turning angle (the turn at each vertex is spread over the two vertex-to-vertex
+	segments around it) : meanders get more points than straight reaches. Each
+	point is at the middle (in effort) of its stretch.
+
+	Returns
+	----------
+	distances : numpy.ndarray
+		(n,) distances of the points along the line
+	weights : numpy.ndarray
+		(n,) length of the stretch of each point (m)
+	"""
+	lengths = []
+	turns = []
+	for part in parts:
+		delta = np.diff(np.asarray(part, dtype=float), axis=0)
+		part_lengths = np.hypot(*delta.T) if len(delta) else np.empty(0)
+		# Degenerate segments have no direction (and no length)
+		delta, part_lengths = delta[part_lengths > 0], part_lengths[part_lengths > 0]
+		if not len(part_lengths):
+			continue
+		angles = np.arctan2(delta[:, 1], delta[:, 0])
+		turn = np.abs((np.diff(angles) + math.pi) % (2 * math.pi) - math.pi)
+		part_turns = np.zeros(len(part_lengths))
+		part_turns[:-1] += turn / 2.0
+		part_turns[1:] += turn / 2.0
+		lengths.append(part_lengths)
+		turns.append(part_turns)
+	if not lengths or n <= 0:
+		return np.empty(0), np.empty(0)
+	lengths = np.concatenate(lengths)
+	turns = np.concatenate(turns)
+	total = lengths.sum()
+	effort = (1 - share) * lengths / total + share * (turns / turns.sum() if turns.sum() > 0 else lengths / total)
+	cum_effort = np.concatenate([[0.0], np.cumsum(effort)])
+	cum_effort /= cum_effort[-1]
+	cum_length = np.concatenate([[0.0], np.cumsum(lengths)])
+	bounds = np.interp(np.arange(n + 1) / n, cum_effort, cum_length)
+	distances = np.interp((np.arange(n) + 0.5) / n, cum_effort, cum_length)
+	# Tiny epsilon to stay strictly inside [0, length) as sample_distances
+	eps = max(1e-6, min(0.001, 1e-3 * total))
+	return np.minimum(total - eps, distances), np.diff(bounds)
+
+
+def segment_point_distances(points, a, b):
+	# (n, m) distances from each point to each segment [a, b], with the position t of the projection on the segment
+	ab = b - a
+	len2 = (ab ** 2).sum(axis=1)
+	ap = points[:, None, :] - a[None, :, :]
+	t = np.zeros((len(points), len(a)))
+	np.divide((ap * ab[None, :, :]).sum(axis=2), len2[None, :], out=t, where=len2[None, :] > 0)
+	t = np.clip(t, 0.0, 1.0)
+	diff = ap - t[:, :, None] * ab[None, :, :]
+	return np.hypot(diff[:, :, 0], diff[:, :, 1]), t
+
+
+def tangent_angles(parts, points):
+	"""
+	Angle (radians) of the closest vertex-to-vertex segment of the line to each point,
+	0.0 if that segment is degenerate.
+	"""
+	a, b, _ = line_segments(parts)
+	points = np.asarray(points, dtype=float).reshape(-1, 2)
+	if not len(a) or not len(points):
+		return np.zeros(len(points))
+	d, _ = segment_point_distances(points, a, b)
+	closest = np.argmin(d, axis=1)
+	delta = b[closest] - a[closest]
+	return np.arctan2(delta[:, 1], delta[:, 0])
+
+
+def point_line_distance(point, parts):
+	a, b, _ = line_segments(parts)
+	if not len(a):
+		return math.inf
+	d, _ = segment_point_distances(np.asarray(point, dtype=float).reshape(1, 2), a, b)
+	return float(d.min())
+
+
+def distance_to_polyline(xs, ys, coords):
+	# Exact distance from every cell center of the (ys, xs) grid to the polyline given by its vertices
+	X, Y = np.meshgrid(xs, ys)
+	P = np.stack([X.ravel(), Y.ravel()], axis=1)[:, None, :]
+	a = coords[:-1][None, :, :]
+	ab = (coords[1:] - coords[:-1])[None, :, :]
+	len2 = (ab ** 2).sum(axis=2)
+	len2 = np.where(len2 > 0, len2, 1.0)
+	t = np.clip(((P - a) * ab).sum(axis=2) / len2, 0.0, 1.0)
+	diff = P - (a + t[:, :, None] * ab)
+	d = np.sqrt((diff ** 2).sum(axis=2)).min(axis=1)
+	return d.reshape(X.shape)
+
+
+def line_endpoints(parts):
+	# First and last vertices of the line (of its longest part if multipart)
+	parts = [np.asarray(part, dtype=float) for part in parts if len(part)]
+	if not parts:
+		return None, None
+	line = max(parts, key=lambda part: line_length([part])) if len(parts) > 1 else parts[0]
+	return line[0], line[-1]
+
+
+def chord_length(parts):
+	"""
+	Straight distance between the two extremities of a (multi)line segment.
+
+	For the parts that are disjoint, each part endpoint gets the distance to the
+	closest endpoint of another part (junction gaps are small, extremities are
+	isolated) and a single sort of these distances gives the two extremities of
+	the chained segment. The parts sharing an endpoint are expected to be merged
+	beforehand.
+	"""
+	parts = [np.asarray(part, dtype=float) for part in parts if len(part) >= 2]
+	if not parts:
+		return 0.0
+	if len(parts) == 1:
+		return float(np.hypot(*(parts[0][-1] - parts[0][0])))
+	# Endpoints of every part and the part they belong to
+	ends = np.array([p for part in parts for p in (part[0], part[-1])])
+	part_of = np.repeat(np.arange(len(parts)), 2)
+	d = np.hypot(ends[:, None, 0] - ends[None, :, 0], ends[:, None, 1] - ends[None, :, 1])
+	d[part_of[:, None] == part_of[None, :]] = np.inf
+	isolation = d.min(axis=1)
+	e1, e2 = np.argsort(isolation)[-2:]
+	return float(np.hypot(*(ends[e1] - ends[e2])))
+
+
+def sinuosity_index(lengths, distances):
+	# Ratio between the length of the segments and the straight distance between their extremities (1 if degenerate)
+	lengths = np.asarray(lengths, dtype=float)
+	distances = np.asarray(distances, dtype=float)
+	sinuosity = np.ones_like(lengths)
+	np.divide(lengths, distances, out=sinuosity, where=distances > 0)
+	return sinuosity
+
+
+def segment_intersections(a1, b1, a2, b2, eps=1e-9):
+	"""
+	Intersections between the segments of two lines.
+
+	Returns
+	----------
+	points : numpy.ndarray
+		(k, 2) crossing or touching points, ordered along the first line
+	overlap : bool
+		True if collinear segments of the two lines overlap over a length
+	"""
+	r = b1 - a1
+	s = b2 - a2
+	qp = a2[None, :, :] - a1[:, None, :]
+	denom = r[:, None, 0] * s[None, :, 1] - r[:, None, 1] * s[None, :, 0]
+	cross_qr = qp[:, :, 0] * r[:, None, 1] - qp[:, :, 1] * r[:, None, 0]
+	cross_qs = qp[:, :, 0] * s[None, :, 1] - qp[:, :, 1] * s[None, :, 0]
+	scale = np.maximum(np.hypot(*r.T)[:, None] * np.hypot(*s.T)[None, :], eps)
+	crossing = np.abs(denom) > eps * scale
+	with np.errstate(divide='ignore', invalid='ignore'):
+		t = np.where(crossing, cross_qs / denom, np.nan)
+		u = np.where(crossing, cross_qr / denom, np.nan)
+	hit = crossing & (t >= -eps) & (t <= 1 + eps) & (u >= -eps) & (u <= 1 + eps)
+	i, j = np.nonzero(hit)
+	order = np.lexsort((t[i, j], i))
+	points = a1[i[order]] + np.clip(t[i[order], j[order]], 0.0, 1.0)[:, None] * r[i[order]]
+	# Collinear segments : overlap if their projections on the first segment share a length
+	collinear = ~crossing & (np.abs(cross_qr) <= eps * np.maximum(np.hypot(*r.T)[:, None], eps) * np.maximum(np.hypot(*s.T)[None, :], 1.0))
+	overlap = False
+	touching = []
+	for ci, cj in zip(*np.nonzero(collinear)):
+		len2 = float((r[ci] ** 2).sum())
+		if len2 <= 0:
+			continue
+		t0 = float(np.dot(a2[cj] - a1[ci], r[ci]) / len2)
+		t1 = float(np.dot(b2[cj] - a1[ci], r[ci]) / len2)
+		lo, hi = max(0.0, min(t0, t1)), min(1.0, max(t0, t1))
+		if hi - lo > eps:
+			overlap = True
+		elif hi - lo >= -eps:
+			touching.append([ci, lo])
+	if touching:
+		touching.sort()
+		extra = np.array([a1[ci] + t * r[ci] for ci, t in touching])
+		points = np.vstack([points, extra]) if len(points) else extra
+	return points, overlap
+
+
+def junction_point(up_parts, down_parts, tol=1.0):
+	"""
+	Point of the upstream segment at its junction with the downstream segment.
+
+	Cases
+	1) explicit intersection -> first intersection point along the upstream segment
+	2) overlap, or close endpoints -> upstream endpoint closest to the downstream segment (within tol)
+	3) fallback -> upstream endpoint closest to the downstream segment, unless it is much
+	   farther than the nearest points of the two segments (parallel segments)
+
+	Returns
+	----------
+	point : numpy.ndarray or None
+		(2,) junction point
+	"""
+	a1, b1, _ = line_segments(up_parts)
+	a2, b2, _ = line_segments(down_parts)
+	if not len(a1) or not len(a2):
+		return None
+	p0, p1 = line_endpoints(up_parts)
+	d0 = point_line_distance(p0, down_parts)
+	d1 = point_line_distance(p1, down_parts)
+	cand, distc = (p0, d0) if d0 <= d1 else (p1, d1)
+	# 1) Explicit intersection (segments whose boxes overlap only)
+	box2 = np.concatenate([np.minimum(a2, b2).min(axis=0), np.maximum(a2, b2).max(axis=0)])
+	near = (np.maximum(a1, b1)[:, 0] >= box2[0]) & (np.minimum(a1, b1)[:, 0] <= box2[2]) & (np.maximum(a1, b1)[:, 1] >= box2[1]) & (np.minimum(a1, b1)[:, 1] <= box2[3])
+	if near.any():
+		points, overlap = segment_intersections(a1[near], b1[near], a2, b2)
+		if not overlap and len(points):
+			return points[0]
+		if overlap and distc <= tol:
+			return cand
+	# 2) Proximal endpoints
+	if distc <= tol:
+		return cand
+	# 3) Fallback on the nearest points of the two segments
+	d_np = min(
+		min(point_line_distance(p, down_parts) for p in np.vstack([a1, b1[-1:]])),
+		min(point_line_distance(p, up_parts) for p in np.vstack([a2, b2[-1:]]))
+	)
+	# Parallelism safeguard: if dist endpoint >> dist nearest points (on interior point), we doubt
+	if d_np > 0 and distc > 3.0 * d_np:
+		return None
+	return cand
+
+
+# ------------------------------------------------------------------------------
+# Transects
+# ------------------------------------------------------------------------------
+
+def nearest_widths(points, seg_widths):
+	# Width of the nearest PtRef of the segment to each point (NaN if none)
+	return np.array([np.nan if w is None else w for w in (ptref.nearest_width(x, y, seg_widths) for x, y in points)], dtype=float)
+
+
+def transects(points, angles, offsets, length):
+	"""
+	Transects perpendicular to the line at each point, from offset to offset + length
+	meters of the point : the left transects of all the points, then the right ones.
+
+	Returns
+	----------
+	starts, units : numpy.ndarray
+		(2n, 2) start and unit direction of each transect
+	"""
+	normals = np.concatenate([angles + math.pi / 2.0, angles - math.pi / 2.0])
+	units = np.column_stack([np.cos(normals), np.sin(normals)])
+	starts = np.vstack([points, points]) + np.concatenate([offsets, offsets])[:, None] * units
+	return starts, units
+
+
+class Polygons:
+	"""
+	Polygons (obstacles, riparian strip) tested against transects with Shapely.
+
+	The packed polygons (IQM_Core.transport) are split into their parts, which
+	are prepared and held in a STRtree : a transect is only tested against the
+	parts whose bounding box it crosses. The polygons are expected to be
+	dissolved (the intersection lengths of overlapping parts add up). The tests
+	can be restricted to some of the packed geometries (geometries : boolean
+	mask of the packed geometries), e.g. the obstacles without the agricultural
+	land.
+	"""
+	def __init__(self, packed):
+		geoms = shapely.from_ragged_array(
+			shapely.GeometryType.MULTIPOLYGON,
+			np.asarray(packed['coords'], dtype=float),
+			(np.asarray(packed['ring_offsets']), np.asarray(packed['part_offsets']), np.asarray(packed['geom_offsets']))
+		) if transport.geometry_count(packed) else np.empty(0, dtype=object)
+		parts, geometry_index = shapely.get_parts(geoms, return_index=True)
+		kept = ~shapely.is_empty(parts)
+		self.parts = parts[kept]
+		# Packed geometry of each part, to test a subset of the geometries only
+		self.geometry_index = geometry_index[kept]
+		shapely.prepare(self.parts)
+		self.tree = shapely.STRtree(self.parts)
+
+	def __len__(self):
+		return len(self.parts)
+
+	def candidates(self, starts, ends, geometries=None):
+		# Pairs [transect, part] whose bounding boxes cross
+		lines = shapely.linestrings(np.stack([starts, ends], axis=1))
+		i, j = self.tree.query(lines)
+		if geometries is not None:
+			kept = np.asarray(geometries, dtype=bool)[self.geometry_index[j]]
+			i, j = i[kept], j[kept]
+		return lines, i, j
+
+	def intersects(self, starts, ends, geometries=None):
+		# True for each transect [start, end] crossing a polygon
+		out = np.zeros(len(starts), dtype=bool)
+		if not len(starts) or not len(self.parts):
+			return out
+		lines, i, j = self.candidates(starts, ends, geometries)
+		instrumentation.count_geos('intersects', len(j))
+		hit = shapely.intersects(self.parts[j], lines[i])
+		out[i[hit]] = True
+		return out
+
+	def intersection_lengths(self, starts, ends, geometries=None):
+		# Length of each transect [start, end] within the polygons
+		out = np.zeros(len(starts))
+		if not len(starts) or not len(self.parts):
+			return out
+		lines, i, j = self.candidates(starts, ends, geometries)
+		instrumentation.count_geos('intersection', len(j))
+		np.add.at(out, i, shapely.length(shapely.intersection(lines[i], self.parts[j])))
+		return out
+
+	def sampled_lengths(self, starts, ends, spacing, geometries=None):
+		# Approximate length of each transect [start, end] within the polygons : the transect is cut in pieces of at most spacing, counted when their middle is in a polygon (prepared point tests only)
+		out = np.zeros(len(starts))
+		if not len(starts) or not len(self.parts):
+			return out
+		lengths = np.hypot(*(ends - starts).T)
+		pieces = np.maximum(1, np.ceil(lengths / spacing).astype(int))
+		transect = np.repeat(np.arange(len(starts)), pieces)
+		rank = np.arange(len(transect)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+		t = (rank + 0.5) / pieces[transect]
+		points = shapely.points(starts[transect] + t[:, None] * (ends - starts)[transect])
+		i, j = self.tree.query(points)
+		if geometries is not None:
+			kept = np.asarray(geometries, dtype=bool)[self.geometry_index[j]]
+			i, j = i[kept], j[kept]
+		instrumentation.count_geos('intersects', len(j))
+		inside = np.zeros(len(points), dtype=bool)
+		inside[i[shapely.intersects(self.parts[j], points[i])]] = True
+		np.add.at(out, transect[inside], (lengths / pieces)[transect[inside]])
+		return out
+
+	def vertex_count(self, starts, ends):
+		# Vertices of the parts whose bounding box crosses one of the transects [start, end] (cost report)
+		if not len(starts) or not len(self.parts):
+			return 0
+		_, _, j = self.candidates(starts, ends)
+		return int(shapely.get_num_coordinates(self.parts[np.unique(j)]).sum())
+
+
+def first_hit_distances(polygons, starts, units, no_hit_value=51.0, max_probe=50.0, tol=0.5, b1=5.0, b2=15.0, start_epsilon=0.05, geometries=None):
+	"""
+	Distance from the start of each transect to the first polygon it meets, found
+	for all the transects at once with prepared 'intersects' tests only.
+
+	For each transect:
+	1) If no intersection up to max_probe -> no_hit_value
+	2) Otherwise, bracket the hit in [0, b1], [b1, b2], or [b2, max_probe]
+	3) Binary search within the bracket down to 'tol'
+	"""
+	n = len(starts)
+	distances = np.full(n, float(no_hit_value))
+	if polygons is None or not len(polygons) or not n:
+		return distances
+
+	def hit(idx, t):
+		# Subsegments [start+epsilon, start+t] (a tiny epsilon avoids touching at t=0)
+		return polygons.intersects(starts[idx] + start_epsilon * units[idx], starts[idx] + np.asarray(t)[:, None] * units[idx], geometries)
+
+	idx = np.arange(n)
+	idx = idx[hit(idx, np.full(n, max_probe))]
+	lo = np.full(len(idx), b2)
+	hi = np.full(len(idx), max_probe)
+	in_b1 = hit(idx, np.full(len(idx), b1))
+	lo[in_b1], hi[in_b1] = 0.0, b1
+	rest = ~in_b1
+	in_b2 = np.zeros(len(idx), dtype=bool)
+	in_b2[rest] = hit(idx[rest], np.full(rest.sum(), b2))
+	lo[in_b2], hi[in_b2] = b1, b2
+	# Safety: if lo already hits (very rare), keep lo
+	lo_hit = hit(idx, lo)
+	distances[idx[lo_hit]] = lo[lo_hit]
+	idx, lo, hi = idx[~lo_hit], lo[~lo_hit], hi[~lo_hit]
+	# Binary search of all the transects at once
+	searching = (hi - lo) > tol
+	while searching.any():
+		mid = 0.5 * (lo[searching] + hi[searching])
+		mid_hit = hit(idx[searching], mid)
+		new_lo = lo[searching]
+		new_hi = hi[searching]
+		new_hi[mid_hit] = mid[mid_hit]
+		new_lo[~mid_hit] = mid[~mid_hit]
+		lo[searching], hi[searching] = new_lo, new_hi
+		searching = (hi - lo) > tol
+	distances[idx] = hi
+	return distances
+
+
+def natural_width_ratio(widths, div_distance):
+	# Share of the width variations between consecutive samples that are natural (1 if there are less than 2 samples)
+	widths = np.asarray(widths, dtype=float)
+	if len(widths) < 2:
+		return 1.0
+	difs_percent = (widths[1:] - widths[:-1]) / widths[1:]
+	if difs_percent.size == 0:
+		return 1.0
+	# Specific variation (per km) and unnatural variations
+	difs_specific = difs_percent * 1000 / div_distance
+	unnatural_widths = np.where((difs_specific < 0) | (difs_specific > 0.2))[0].size
+	return 1 - (unnatural_widths / difs_percent.size)
+
+
+# ------------------------------------------------------------------------------
+# Scores
+# ------------------------------------------------------------------------------
+
+def scalar_score(scores):
+	# Score of one segment from the score array of IQM_Core.scoring (None for NULL)
+	score = float(scores[0])
+	return None if np.isnan(score) else int(score)
+
+
+def score_f1(struct_count):
+	# F1 index of one segment (table 'F1' of IQM_Core.scoring)
+	return scalar_score(scoring.score_f1([struct_count]))
+
+
+def score_f2(median_length):
+	# F2 index of one segment (table 'F2' of IQM_Core.scoring)
+	return scalar_score(scoring.score_f2([median_length]))
+
+
+def score_f3(intersect_perc):
+	# F3 index of one segment (table 'F3' of IQM_Core.scoring)
+	return scalar_score(scoring.score_f3([intersect_perc]))
+
+
+def score_f4(ratio):
+	# F4 index of one segment (table 'F4' of IQM_Core.scoring)
+	return scalar_score(scoring.score_f4([ratio]))
+
+
+def score_f5(p30, p15to30):
+	# F5 index of one segment (table 'F5' of IQM_Core.scoring)
+	return scalar_score(scoring.score_f5([p30], [p15to30]))
+
+
+def score_a4(sinuosity):
+	# A4 index calculation where sinuosity is an array of sinuosity indices (table 'A4' of IQM_Core.scoring)
+	return scoring.score_a4(sinuosity).astype(int)
+
+
+# ------------------------------------------------------------------------------
+# Sequential sampling
+# ------------------------------------------------------------------------------
+
+# Number of points (both sides) of the first batch of transects probed, and minimal size of the next ones
+SEQUENTIAL_BATCH = 8
+# Points (both sides) probed by a quick look, and confidence level of its boundary-proximity flag
+QUICK_LOOK_POINTS = 8
+QUICK_LOOK_CONFIDENCE = 0.8
+# Length of the pieces of a transect tested by their middle point once the time budget of a segment is spent (m)
+APPROX_SPACING = 1.0
+# Tolerance of the obstacles simplified once the time budget of a segment is spent (m, QGIS kernels)
+APPROX_TOLERANCE = 2.0
+
+
+def bit_reversed_order(n):
+	# Indices 0 to n-1 in bit-reversed order (van der Corput) : every prefix is spread over the whole segment, from coarse to fine
+	if n <= 1:
+		return np.arange(n)
+	bits = int(n - 1).bit_length()
+	idx = np.arange(1 << bits)
+	rev = np.zeros_like(idx)
+	for b in range(bits):
+		rev |= ((idx >> b) & 1) << (bits - 1 - b)
+	return rev[rev < n]
+
+
+def over_budget(started, budget, share=1.0):
+	# True if the time spent on a segment since started (time.perf_counter), projected from the share of its work done to all of it, exceeds the budget (s, None or 0 : no budget)
+	if not budget:
+		return False
+	return (time.perf_counter() - started) / max(share, 1e-9) > budget
+
+
+def confidence_z(confidence):
+	# Normal quantile of a two-sided confidence level (None for exact bounds)
+	return None if confidence >= 1 else NormalDist().inv_cdf((1 + confidence) / 2.0)
+
+
+def weighted_quantile(values, weights, q):
+	# Lower weighted quantile : first of the sorted values whose cumulative weight reaches q of the total weight
+	values = np.asarray(values, dtype=float)
+	order = np.argsort(values)
+	cumulative = np.cumsum(np.asarray(weights, dtype=float)[order])
+	return float(values[order][min(np.searchsorted(cumulative, q * cumulative[-1]), len(values) - 1)])
+
+
+def weighted_count(mask, weights=None):
+	# [number of transects where mask is True, number of transects], each transect counting for its weight (1 if None)
+	mask = np.asarray(mask, dtype=bool)
+	if weights is None:
+		return int(mask.sum()), len(mask)
+	return float(np.asarray(weights)[mask].sum()), float(np.sum(weights))
+
+
+def share_bounds(count, k, n, z):
+	"""
+	Bounds of the share of the n transects of a segment meeting a condition, from
+	the count among the k transects probed.
+
+	The unprobed transects can all meet the condition or not (exact bounds). With
+	a confidence level (z), the bounds are narrowed to the Wilson interval of the
+	share, with the finite population correction of a draw without replacement.
+	"""
+	lo, hi = count / n, (count + n - k) / n
+	if z is None or k >= n:
+		return [lo, hi]
+	k_eff = k * (n - 1) / (n - k)
+	p = count / k
+	denom = 1 + z * z / k_eff
+	centre = (p + z * z / (2 * k_eff)) / denom
+	half = z * math.sqrt(p * (1 - p) / k_eff + z * z / (4 * k_eff * k_eff)) / denom
+	return [max(lo, centre - half), min(hi, centre + half)]
+
+
+def median_bounds(values, n, low, high, z, weights=None):
+	"""
+	Bounds of the median of the n transects of a segment from the values of the
+	probed ones, the unprobed values lying within [low, high].
+
+	The exact bounds put all the unprobed values at low or at high. With a
+	confidence level (z), they are narrowed to the sample quantiles 0.5 -/+ the
+	margin of a share of 0.5. With weights (transects placed by curvature), the
+	transects count for their weight and n is the total weight.
+	"""
+	values = np.asarray(values, dtype=float)
+	if weights is not None:
+		k = float(np.sum(weights))
+		rest = max(n - k, 0.0)
+		lo = weighted_quantile(np.append(values, low), np.append(weights, rest), 0.5)
+		hi = weighted_quantile(np.append(values, high), np.append(weights, rest), 0.5)
+		quantile = lambda q: weighted_quantile(values, weights, q)
+	else:
+		k = len(values)
+		lo = float(np.median(np.concatenate([values, np.full(n - k, low)])))
+		hi = float(np.median(np.concatenate([values, np.full(n - k, high)])))
+		quantile = lambda q: float(np.quantile(values, q))
+	if z is None or k >= n:
+		return [lo, hi]
+	margin = z * math.sqrt(0.25 * (n - k) / (k * (n - 1)))
+	if margin < 0.5:
+		lo = max(lo, quantile(0.5 - margin))
+		hi = min(hi, quantile(0.5 + margin))
+	return [lo, hi]
+
+
+def probe_transects(state, n_points, probe, bounds, table, weights=None, fallback=None):
+	"""
+	Results of the transects (left and right) of the n_points points of a segment.
+
+	Without state['confidence'], all the transects are probed at once. Otherwise the
+	points are probed in bit-reversed order by growing batches, until the score of
+	the table is the same over the bounds of its metrics : the median or shares of
+	the probed transects then give the score of the segment. A quick look
+	(state['quick_look'] points) only probes the first points of that order.
+	With a time budget per segment (state['time_budget'] in seconds), the points are
+	also probed by batches and the remaining transects go to the fallback once the
+	time spent, projected to all the points, exceeds the budget.
+
+	Parameters
+	----------
+	probe : callable
+		probe(sides) -> results of the transects sides (indices of the left transects of all the points, then of the right ones)
+	bounds : callable
+		bounds(results, weights, n, z) -> {metric: [lower bound, upper bound]} of the table over the n transects from the probed results
+	table : str
+		Key of the score table in IQM_Core.scoring
+	weights : numpy.ndarray
+		Length of line each point stands for (None for evenly spaced points)
+	fallback : callable
+		fallback(sides) -> approximate results of the transects sides, cheaper than probe (None : no time budget)
+
+	Returns
+	----------
+	results : numpy.ndarray
+		Results of the probed transects
+	weights : numpy.ndarray
+		Weights of the probed transects, of mean 1 over all the transects (None for evenly spaced points)
+	fixed : bool
+		False if the class of the segment may differ with all its transects (quick look at QUICK_LOOK_CONFIDENCE)
+	approx : bool
+		True if some transects were evaluated by the fallback
+	"""
+	side_weights = None if weights is None or not len(weights) else np.tile(weights, 2) / np.mean(weights)
+
+	def probed(sides, results):
+		return results, (None if side_weights is None else side_weights[sides])
+
+	def is_fixed(sides, results, z):
+		_, w = probed(sides, results)
+		return scoring.score_is_fixed(scoring.SCORE_TABLES[table], bounds(results, w, 2 * n_points, z))
+
+	quick_look = state.get('quick_look')
+	if quick_look:
+		idx = bit_reversed_order(n_points)[:quick_look]
+		sides = np.concatenate([idx, idx + n_points])
+		results = probe(sides)
+		fixed = len(idx) >= n_points or is_fixed(sides, results, confidence_z(QUICK_LOOK_CONFIDENCE))
+		return (*probed(sides, results), fixed, False)
+	confidence = state.get('confidence')
+	budget = state.get('time_budget') if fallback is not None else None
+	if (not confidence and not budget) or n_points <= SEQUENTIAL_BATCH:
+		sides = np.arange(2 * n_points)
+		return (*probed(sides, probe(sides)), True, False)
+	z = confidence_z(confidence) if confidence else None
+	started = time.perf_counter()
+	approx = False
+	order = bit_reversed_order(n_points)
+	sides = []
+	results = []
+	done = 0
+	while done < n_points:
+		idx = order[done:done + max(SEQUENTIAL_BATCH, done // 2)]
+		sides.append(np.concatenate([idx, idx + n_points]))
+		results.append((fallback if approx else probe)(sides[-1]))
+		done += len(idx)
+		if done >= n_points:
+			break
+		if confidence and is_fixed(np.concatenate(sides), np.concatenate(results), z):
+			break
+		# The remaining transects are approximated once the projected time of the segment exceeds its budget
+		approx = approx or over_budget(started, budget, done / n_points)
+	return (*probed(np.concatenate(sides), np.concatenate(results)), True, approx)
+
+
+def with_approx(state, values, approx=False):
+	# Values of a segment, followed by its approximation flag with a time budget (1 : some transects were evaluated approximately)
+	return values + [1 if approx else 0] if state.get('time_budget') else values
+
+
+def with_flag(state, values, fixed=True, approx=False):
+	# Values of a segment, followed by its approximation flag with a time budget and its boundary-proximity flag in a quick look (1 : the class may change with all the transects)
+	values = with_approx(state, values, approx)
+	return values + [0 if fixed else 1] if state.get('quick_look') else values
+
+
+# ------------------------------------------------------------------------------
+# Segments of F2, F3, F4 and F5
+# ------------------------------------------------------------------------------
+
+def short_segment_message(seg_id_field, sid):
+	return f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."
+
+
+def null_segment_message(seg_id_field, sid, index, score):
+	return f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice {index} mis à {score}."
+
+
+def segment_step(seg_len, target_pts, step_min):
+	# Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
+	return max(step_min, seg_len / target_pts)
+
+
+def segment_transects(state, sid, parts, seg_len, length, default_offset):
+	"""
+	Transects of a segment : sampled points, start offset from the nearest PtRef width
+	and local tangent. The points are evenly spaced, or placed by cumulative turning
+	angle with as many points (state['sampler'] 'curvature').
+
+	Returns
+	----------
+	n_points : int
+	starts, units : numpy.ndarray
+		(2n, 2) start and unit direction of each transect (left then right)
+	weights : numpy.ndarray
+		Length of line each point stands for (None for evenly spaced points)
+	"""
+	step = segment_step(seg_len, state['target_pts'], state['step_min'])
+	weights = None
+	if state.get('sampler') == 'curvature':
+		distances, weights = curvature_distances(parts, len(sample_distances(seg_len, step)))
+		points = interpolate(parts, distances)
+	else:
+		points = points_along_line(parts, step)
+	widths = nearest_widths(points, state['ptref'].get(sid))
+	offsets = np.where(widths > 0, widths / 2.0, default_offset)
+	angles = tangent_angles(parts, points)
+	starts, units = transects(points, angles, offsets, length)
+	return len(points), starts, units, weights
+
+
+def transect_cost(state, starts, ends, probed):
+	# Adds the probed transects and the vertices of the polygon parts around the transects [start, end] to the cost of the segment (when it is recorded)
+	if state.get('cost') is not None:
+		instrumentation.add_cost(state, transects=probed, vertices=state['polygons'].vertex_count(starts, ends))
+
+
+def f2_values(distances, weights=None):
+	# [median first obstacle distance, F2 index] of the transects of a segment (51 if there is none), weighted by the length each transect stands for
+	if not len(distances):
+		median = 51.0
+	elif weights is None:
+		median = float(np.median(distances))
+	else:
+		median = weighted_quantile(distances, weights, 0.5)
+	return [median, score_f2(median)]
+
+
+def f3_values(blocked, weights=None):
+	# [percentage of free transects, F3 index] of the transects (both sides) of a segment
+	free, total = weighted_count(~np.asarray(blocked, dtype=bool), weights)
+	den = float(total) if len(blocked) else 1.0
+	perc15 = free / den
+	return [perc15*100, score_f3(perc15)]
+
+
+def f5_values(lengths, weights=None):
+	# [percentage 15 to 30 m, percentage over 30 m, F5 index] of the riparian lengths of the transects (both sides) of a segment
+	lengths = np.asarray(lengths, dtype=float)
+	over30, total = weighted_count(lengths > 30.0, weights)
+	between, _ = weighted_count((lengths >= 15.0) & (lengths <= 30.0), weights)
+	den = float(total) if len(lengths) else 1.0
+	perc30 = over30 / den
+	perc15to30 = between / den
+	return [perc15to30*100, perc30*100, score_f5(perc30, perc15to30)]
+
+
+def f2_segment(state, sid, parts):
+	"""
+	Median width of lateral connectivity and F2 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[median width of lateral connectivity, F2 index] (and the boundary-proximity flag in a quick look)
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	seg_len = line_length(parts)
+	if seg_len <= 2:
+		messages.append(short_segment_message(state['seg_id_field'], sid))
+	# Transects of 50 m on both sides, first obstacle met by each
+	TRANSECT_LENGTH = 50.0
+	n_points, starts, units, weights = segment_transects(state, sid, parts, seg_len, TRANSECT_LENGTH, 2/2)
+	distances, weights, fixed, _ = probe_transects(
+		state, n_points,
+		lambda sides: first_hit_distances(state['polygons'], starts[sides], units[sides], no_hit_value=51.0, max_probe=TRANSECT_LENGTH),
+		lambda distances, w, n, z: {'median_length': median_bounds(distances, n, 0.0, 51.0, z, w)},
+		'F2', weights
+	)
+	transect_cost(state, starts, starts + TRANSECT_LENGTH * units, len(distances))
+	return with_flag(state, f2_values(distances, weights), fixed), messages
+
+
+def f3_segment(state, sid, parts):
+	"""
+	Percentage of free 15 m transects and F3 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[percentage of free 15 m transects, F3 index] (and the boundary-proximity flag in a quick look)
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	seg_len = line_length(parts)
+	if seg_len <= 0:
+		messages.append(null_segment_message(state['seg_id_field'], sid, 'F3', 5))
+		return with_flag(state, [0.0, 5]), messages
+	if seg_len <= 2:
+		messages.append(short_segment_message(state['seg_id_field'], sid))
+	TRANSECT_LENGTH = state['transect_length']
+	n_points, starts, units, weights = segment_transects(state, sid, parts, seg_len, TRANSECT_LENGTH, 2/2)
+	# Shores (left+right) without obstacle within the transect (obstacle met by a piece of the transect over the time budget)
+	blocked, weights, fixed, approx = probe_transects(
+		state, n_points,
+		lambda sides: state['polygons'].intersects(starts[sides], starts[sides] + TRANSECT_LENGTH * units[sides]),
+		lambda blocked, w, n, z: {'free_ratio': share_bounds(*weighted_count(~blocked, w), n, z)},
+		'F3', weights,
+		lambda sides: state['polygons'].sampled_lengths(starts[sides], starts[sides] + TRANSECT_LENGTH * units[sides], APPROX_SPACING) > 0
+	)
+	transect_cost(state, starts, starts + TRANSECT_LENGTH * units, len(blocked))
+	return with_flag(state, f3_values(blocked, weights), fixed, approx), messages
+
+
+def f4_segment(state, sid, parts):
+	"""
+	Percentage of natural width variation and F4 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[percentage of natural width variation, F4 index]
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	seg_len = line_length(parts)
+	if seg_len <= 0:
+		messages.append(null_segment_message(state['seg_id_field'], sid, 'F4', 3))
+		return [0.0, 3], messages
+	if seg_len <= 2:
+		messages.append(short_segment_message(state['seg_id_field'], sid))
+	points = points_along_line(parts, segment_step(seg_len, state['target_pts'], state['step_min']))
+	# Nearest PtRef width of the segment (of any segment if the segment has none)
+	seg_widths = state['ptref'].get(sid)
+	if seg_widths is None or not len(seg_widths):
+		seg_widths = state['all_ptref']
+	widths = nearest_widths(points, seg_widths)
+	instrumentation.add_cost(state, transects=len(points), vertices=sum(len(part) for part in parts))
+	ratio = natural_width_ratio(widths, seg_len / max(1, len(points)))
+	return [ratio, score_f4(ratio)], messages
+
+
+def f5_segment(state, sid, parts):
+	"""
+	Percentages of riparian strip and F5 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[percentage 15 to 30 m, percentage over 30 m, F5 index] (and the boundary-proximity flag in a quick look)
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	seg_len = line_length(parts)
+	if seg_len <= 0:
+		messages.append(null_segment_message(state['seg_id_field'], sid, 'F5', 4))
+		return with_flag(state, [0.0, 0.0, 4]), messages
+	if seg_len <= 2:
+		messages.append(short_segment_message(state['seg_id_field'], sid))
+	TRANSECT_LENGTH = state['transect_length']
+	n_points, starts, units, weights = segment_transects(state, sid, parts, seg_len, TRANSECT_LENGTH, 0.0)
+	# Length of riparian strip along each transect (sampled by pieces over the time budget)
+	lengths, weights, fixed, approx = probe_transects(
+		state, n_points,
+		lambda sides: state['polygons'].intersection_lengths(starts[sides], starts[sides] + TRANSECT_LENGTH * units[sides]),
+		lambda lengths, w, n, z: {
+			'p30': share_bounds(*weighted_count(lengths > 30.0, w), n, z),
+			'p15to30': share_bounds(*weighted_count((lengths >= 15.0) & (lengths <= 30.0), w), n, z),
+		},
+		'F5', weights,
+		lambda sides: state['polygons'].sampled_lengths(starts[sides], starts[sides] + TRANSECT_LENGTH * units[sides], APPROX_SPACING)
+	)
+	transect_cost(state, starts, starts + TRANSECT_LENGTH * units, len(lengths))
+	return with_flag(state, f5_values(lengths, weights), fixed, approx), messages
+
+
+# Segment evaluation of each index and key of its polygons in the payload
+SEGMENT_KERNELS = {
+	'F2': [f2_segment, 'obstacles'],
+	'F3': [f3_segment, 'obstacles'],
+	'F4': [f4_segment, None],
+	'F5': [f5_segment, 'bands'],
+}
+
+
+def worker_init(payload):
+	"""
+	State of the segment kernels of an index (payload['index']) from its packed payload.
+	"""
+	state = dict(payload)
+	state['ptref'] = transport.unpack_groups(payload['ptref'])
+	if 'all_ptref' in payload:
+		state['all_ptref'] = np.asarray(payload['all_ptref'], dtype=float)
+	polygons_key = SEGMENT_KERNELS[payload['index']][1]
+	state['polygons'] = Polygons(payload[polygons_key]) if polygons_key else None
+	return state
+
+
+def evaluate_chunk(state, segments, ids, start, stop):
+	"""
+	Evaluates the segments [start, stop[ of packed segments, returns [[sid, values, messages], ...]
+	(each followed by the cost of the segment with a cost report, IQM_Core.instrumentation.evaluated).
+	"""
+	kernel = SEGMENT_KERNELS[state['index']][0]
+	results = []
+	for i in range(start, stop):
+		results.append(instrumentation.evaluated(state, kernel, ids[i], transport.unpack_parts(segments, i)))
+	return results
+
+
+# ------------------------------------------------------------------------------
+# Parameter sweep
+# ------------------------------------------------------------------------------
+
+# Masks of the packed obstacles [without agricultural land, with agricultural land] of each use_agri variant
+AGRI_MASKS = {True: [False, True], False: [True, False]}
+
+
+def sweep_segment(state, sid, parts, parameter_sets, indices, agri_variants):
+	"""
+	F2, F3 and F5 of one segment for several parameter sets and use_agri variants.
+
+	The points of all the parameter sets are sampled once : their distances along
+	the segment are merged (the samplings of coarser steps are subsets of the finest
+	one when the steps are multiples), and the transects of each point are tested
+	once against the obstacles of each variant. Each parameter set then reads the
+	results of its own points, which gives the same values as separate runs.
+
+	Parameters
+	----------
+	state : dict
+		'ptref', 'seg_id_field', 'obstacles' (Polygons of the packed [anthropic, agricultural] obstacles),
+		'bands' (Polygons of the riparian strip) and the transect lengths 'f2_length', 'f3_length', 'f5_length'
+	parameter_sets : list
+		[[target_pts, step_min], ...]
+	indices : list of str
+		Indices to compute among 'F2', 'F3' and 'F5'
+	agri_variants : list of bool
+		use_agri variants of F2 and F3
+
+	Returns
+	----------
+	rows : list
+		[[target_pts, step_min, use_agri (None without F2 and F3), values], ...] where values are the values of each index in order
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	seg_len = line_length(parts)
+	if seg_len <= 0:
+		for index, score in [['F3', 5], ['F5', 4]]:
+			if index in indices:
+				messages.append(null_segment_message(state['seg_id_field'], sid, index, score))
+	elif seg_len <= 2:
+		messages.append(short_segment_message(state['seg_id_field'], sid))
+	# Distances sampled by each parameter set, merged and located in the merged points
+	samplings = [sample_distances(seg_len, segment_step(seg_len, target_pts, step_min)) for target_pts, step_min in parameter_sets]
+	distances = np.unique(np.concatenate(samplings)) if samplings else np.empty(0)
+	positions = [np.searchsorted(distances, d) for d in samplings]
+	points = interpolate(parts, distances)
+	n = len(points)
+	widths = nearest_widths(points, state['ptref'].get(sid))
+	angles = tangent_angles(parts, points)
+
+	# Transects of every merged point, tested once for each variant
+	obstacle_indices = [index for index in indices if index in ['F2', 'F3']]
+	variants = agri_variants if obstacle_indices else [None]
+	first_hits = {}
+	blocked = {}
+	if obstacle_indices:
+		starts, units = transects(points, angles, np.where(widths > 0, widths / 2.0, 2/2), state['f2_length'])
+		for use_agri in agri_variants:
+			if 'F2' in indices:
+				first_hits[use_agri] = first_hit_distances(state['obstacles'], starts, units, no_hit_value=51.0, max_probe=state['f2_length'], geometries=AGRI_MASKS[use_agri])
+			if 'F3' in indices:
+				blocked[use_agri] = state['obstacles'].intersects(starts, starts + state['f3_length'] * units, AGRI_MASKS[use_agri])
+	if 'F5' in indices:
+		starts, units = transects(points, angles, np.where(widths > 0, widths / 2.0, 0.0), state['f5_length'])
+		band_lengths = state['bands'].intersection_lengths(starts, starts + state['f5_length'] * units)
+
+	rows = []
+	for (target_pts, step_min), pos in zip(parameter_sets, positions):
+		# Both shores (left+right) of the points of the parameter set
+		sides = np.concatenate([pos, pos + n])
+		for use_agri in variants:
+			values = []
+			for index in indices:
+				if index == 'F2':
+					values += f2_values(first_hits[use_agri][sides])
+				elif index == 'F3':
+					values += [0.0, 5] if seg_len <= 0 else f3_values(blocked[use_agri][sides])
+				elif index == 'F5':
+					values += [0.0, 0.0, 4] if seg_len <= 0 else f5_values(band_lengths[sides])
+			rows.append([target_pts, step_min, use_agri, values])
+	return rows, messages
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Fingerprints of the input layers of an IQM run.
+
+A fingerprint is a JSON-serialisable summary of a layer, fine enough to find
+what changed between two runs without keeping a copy of the data:
+	- vector layers : one hash per feature (geometry and attributes) with its
+	  bounding box, keyed by the segment identifier for the river network or
+	  by the hash itself for the other layers;
+	- raster layers : one hash per block of pixels with the extent of the block.
+Comparing two fingerprints gives the changed keys and the extents of the
+changes, from which the segments to recompute are found (see incremental).
+"""
+
+
+import json
+import hashlib
+from pathlib import Path
+
+from qgis.core import QgsRasterLayer, QgsRectangle
+
+
+# Version of the fingerprint file, older files are ignored
+FORMAT_VERSION = 1
+# Size (pixels) of the raster blocks
+BLOCK_SIZE = 256
+
+
+def digest(*parts):
+	"""
+	SHA-1 hash of byte strings.
+	"""
+	h = hashlib.sha1()
+	for part in parts:
+		h.update(part)
+	return h.hexdigest()
+
+
+def bbox_of(rect):
+	return [rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()]
+
+
+def vector_fingerprint(layer, key_field=None):
+	"""
+	Fingerprint of a vector layer.
+
+	Parameters
+	----------
+	layer : QgsVectorLayer
+		Layer to summarise
+	key_field : str
+		Field identifying the features (their hash is used if None)
+
+	Returns
+	----------
+	fingerprint : dict
+		{'type': 'vector', 'key': key_field, 'features': {key: [hash, bbox]}}
+	"""
+	features = {}
+	for feat in layer.getFeatures():
+		geom = feat.geometry()
+		has_geom = geom is not None and not geom.isNull()
+		wkb = bytes(geom.asWkb()) if has_geom else b''
+		feat_hash = digest(wkb, repr(feat.attributes()).encode('utf-8'))
+		bbox = bbox_of(geom.boundingBox()) if has_geom else None
+		key = str(feat[key_field]) if key_field else feat_hash
+		features[key] = [feat_hash, bbox]
+	return {'type': 'vector', 'key': key_field, 'features': features}
+
+
+def raster_fingerprint(layer, block_size=BLOCK_SIZE):
+	"""
+	Fingerprint of a raster layer, made of the hash of each block of block_size pixels (all bands).
+
+	Returns
+	----------
+	fingerprint : dict
+		{'type': 'raster', 'grid': [extent, width, height, block_size], 'blocks': {'row_col': [hash, bbox]}}
+	"""
+	provider = layer.dataProvider()
+	extent = layer.extent()
+	width, height = layer.width(), layer.height()
+	pixel_x = extent.width() / width
+	pixel_y = extent.height() / height
+	blocks = {}
+	for row in range(0, height, block_size):
+		for col in range(0, width, block_size):
+			w = min(block_size, width - col)
+			h = min(block_size, height - row)
+			rect = QgsRectangle(
+				extent.xMinimum() + col * pixel_x, extent.yMaximum() - (row + h) * pixel_y,
+				extent.xMinimum() + (col + w) * pixel_x, extent.yMaximum() - row * pixel_y
+			)
+			parts = [bytes(provider.block(band, rect, w, h).data()) for band in range(1, layer.bandCount() + 1)]
+			blocks[f"{row // block_size}_{col // block_size}"] = [digest(*parts), bbox_of(rect)]
+	return {'type': 'raster', 'grid': [bbox_of(extent), width, height, block_size], 'blocks': blocks}
+
+
+def layer_fingerprint(layer, key_field=None):
+	if isinstance(layer, QgsRasterLayer):
+		return raster_fingerprint(layer)
+	return vector_fingerprint(layer, key_field)
+
+
+def diff_fingerprints(old, new):
+	"""
+	Differences between two fingerprints of the same input.
+
+	Parameters
+	----------
+	old, new : dict
+		Fingerprints of the previous and the current run (old can be None)
+
+	Returns
+	----------
+	changed_keys : set
+		Keys of the changed, added or removed features (keyed vector layers only)
+	bboxes : list
+		Bounding boxes [xmin, ymin, xmax, ymax] of the changes (previous and current extents)
+	full : bool
+		True if the two fingerprints cannot be compared (everything is considered changed)
+	"""
+	if old is None or new is None or old['type'] != new['type']:
+		return set(), [], True
+	if new['type'] == 'raster':
+		if old['grid'] != new['grid']:
+			return set(), [], True
+		old_items, new_items = old['blocks'], new['blocks']
+	else:
+		if old['key'] != new['key']:
+			return set(), [], True
+		old_items, new_items = old['features'], new['features']
+	changed_keys = set()
+	bboxes = []
+	for key in set(old_items) | set(new_items):
+		old_item = old_items.get(key)
+		new_item = new_items.get(key)
+		if old_item is not None and new_item is not None and old_item[0] == new_item[0]:
+			continue
+		changed_keys.add(key)
+		bboxes += [item[1] for item in [old_item, new_item] if item is not None and item[1] is not None]
+	if new['type'] == 'raster' or not new['key']:
+		# Only the extents matter for layers without keys
+		changed_keys = set()
+	return changed_keys, bboxes, False
+
+
+def load_fingerprints(path):
+	"""
+	Reads a fingerprint file. Returns None if the file is missing, unreadable or of another version.
+	"""
+	try:
+		with open(path, 'r', encoding='utf-8') as f:
+			data = json.load(f)
+	except (OSError, ValueError):
+		return None
+	if data.get('version') != FORMAT_VERSION:
+		return None
+	return data
+
+
+def save_fingerprints(path, layers, parameters):
+	"""
+	Writes the fingerprints of the inputs of a run.
+
+	Parameters
+	----------
+	path : str
+		JSON file to write
+	layers : dict
+		{input name: fingerprint}
+	parameters : dict
+		Parameters of the run changing the results of every segment (a change of
+		one of them makes the next run a complete one)
+	"""
+	Path(path).parent.mkdir(parents=True, exist_ok=True)
+	with open(path, 'w', encoding='utf-8') as f:
+		json.dump({'version': FORMAT_VERSION, 'parameters': parameters, 'layers': layers}, f)
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Incremental recomputation of the IQM indices.
+
+The changes of the inputs since the previous run (see fingerprints) are turned
+into the set of segments to recompute for each index, according to how far the
+index looks from the segment:
+	- near : segments within the reach of the index transects or corridor;
+	- downstream : segments near the change and the next 1000 m downstream
+	  (structures and dams counted by F1 and A3);
+	- basin : segments draining the change and all the network downstream
+	  (upstream watershed of A1 and A2).
+The other segments keep the values of the previous output layer.
+"""
+
+
+from qgis.core import (
+	QgsFeatureRequest,
+	QgsGeometry,
+	QgsRectangle,
+	QgsSpatialIndex,
+	QgsMemoryProviderUtils
+)
+
+
+# Indices affected by a change of each input layer, and how the change propagates
+INPUT_EFFECTS = {
+	'ptref_widths': {'near': ['A3', 'F2', 'F3', 'F4', 'F5']},
+	'routes': {'near': ['F2', 'F3'], 'downstream': ['F1']},
+	'structures': {'downstream': ['F1']},
+	'dams': {'downstream': ['A3'], 'basin': ['A1', 'A2']},
+	'landuse': {'near': ['A3', 'F2', 'F3'], 'basin': ['A1', 'A2']},
+	'bande_riv': {'near': ['F5']},
+	'dem': {'basin': ['A1', 'A2']}
+}
+# Reach of each index from the banks (m), half the maximal width of the river is added
+# (A3 reaches twice the width of the river, see index_reach)
+INDEX_REACH = {'F2': 50, 'F3': 15, 'F4': 50, 'F5': 31}
+# Distance (m) downstream of a structure or a dam within which the segments are counted (F1 and A3)
+DOWNSTREAM_DISTANCE = 1000
+# Radius of the A3 corridor in river widths (see calcul_a3.compute_a3_series)
+A3_CORRIDOR_WIDTHS = 2
+
+
+def a3_neighbour_distance(max_width, cell_size=0.0):
+	"""
+	Distance (m) within which a segment can claim land use cells of the A3 corridor of another
+	segment (each cell goes to the nearest segment): the two corridors overlap.
+	"""
+	return 2 * A3_CORRIDOR_WIDTHS * max_width + cell_size
+
+
+def index_reach(key, name, max_width, cell_size=0.0, road_half_width=0.0):
+	"""
+	Distance (m) from a change of the input name within which the segments of an index are affected.
+
+	Parameters
+	----------
+	key : str
+		Index
+	name : str
+		Changed input
+	max_width : float
+		Maximal width of the river (m)
+	cell_size : float
+		Size of the land use cells (m)
+	road_half_width : float
+		Maximal half right-of-way of the roads (demi_emp, m), the roads being buffered by it in F2 and F3
+
+	Returns
+	----------
+	reach : float
+	"""
+	if key == 'A3':
+		# Land use cells within the corridor radius of the segment
+		return A3_CORRIDOR_WIDTHS * max_width + cell_size
+	reach = INDEX_REACH[key] + max_width / 2.0
+	if name == 'routes':
+		reach += road_half_width
+	return reach
+
+
+class RiverNetwork:
+	"""
+	Geometries, spatial index and downstream links of the segments of a river network.
+	"""
+	def __init__(self, layer, seg_id_field, seg_id_down_field):
+		self.geoms = {}
+		self.down = {}
+		self.fid_to_sid = {}
+		self.index = QgsSpatialIndex()
+		for feat in layer.getFeatures():
+			sid = feat[seg_id_field]
+			self.geoms[sid] = feat.geometry()
+			self.down[sid] = feat[seg_id_down_field]
+			self.fid_to_sid[feat.id()] = sid
+			self.index.addFeature(feat)
+
+	def near(self, bbox, distance):
+		"""
+		Segments within distance of a bounding box [xmin, ymin, xmax, ymax].
+		"""
+		rect = QgsRectangle(*bbox)
+		rect_geom = QgsGeometry.fromRect(rect)
+		rect.grow(distance)
+		sids = set()
+		for fid in self.index.intersects(rect):
+			sid = self.fid_to_sid[fid]
+			if self.geoms[sid].distance(rect_geom) <= distance:
+				sids.add(sid)
+		return sids
+
+	def draining(self, bbox, distance):
+		"""
+		Segments near a bounding box, or the nearest segment if none (segment draining a change far from the network).
+		"""
+		sids = self.near(bbox, distance)
+		if not sids:
+			center = QgsRectangle(*bbox).center()
+			sids = {self.fid_to_sid[fid] for fid in self.index.nearestNeighbor(center, 1)}
+		return sids
+
+	def downstream(self, sids, max_distance=None):
+		"""
+		Segments downstream of the given ones (included), up to max_distance meters along the network (all if None).
+		"""
+		result = set()
+		for sid in sids:
+			dist = 0.0
+			visited = set()
+			# A segment is reached while the length of the segments between it and the starting one is under the distance
+			while sid in self.geoms and sid not in visited and (max_distance is None or dist < max_distance or not visited):
+				if max_distance is None and sid in result:
+					# The rest of the network downstream was already walked
+					break
+				visited.add(sid)
+				result.add(sid)
+				if len(visited) > 1:
+					dist += self.geoms[sid].length()
+				sid = self.down.get(sid)
+		return result
+
+	def around(self, sids, distance):
+		"""
+		Segments within distance of the given ones (excluded).
+		"""
+		sids = set(sids)
+		result = set()
+		for sid in sids:
+			geom = self.geoms.get(sid)
+			if geom is None:
+				continue
+			rect = geom.boundingBox()
+			rect.grow(distance)
+			for fid in self.index.intersects(rect):
+				other = self.fid_to_sid[fid]
+				if other not in sids and other not in result and self.geoms[other].distance(geom) <= distance:
+					result.add(other)
+		return result
+
+	def upstream(self, sids, max_distance):
+		"""
+		Segments upstream of the given ones (excluded) whose downstream end is within max_distance meters
+		along the network (a structure or a dam on them can be counted by the given segments).
+		"""
+		if not hasattr(self, 'up'):
+			self.up = {}
+			for sid, down_sid in self.down.items():
+				if down_sid in self.geoms and down_sid != sid:
+					self.up.setdefault(down_sid, []).append(sid)
+		sids = set(sids)
+		result = set()
+		# Distance between the downstream end of each segment to visit and the given segments
+		stack = [[up_sid, 0.0] for sid in sids for up_sid in self.up.get(sid, [])]
+		while stack:
+			sid, dist = stack.pop()
+			if sid in sids or sid in result or dist >= max_distance:
+				continue
+			result.add(sid)
+			stack += [[up_sid, dist + self.geoms[sid].length()] for up_sid in self.up.get(sid, [])]
+		return result
+
+
+def affected_segments(network, changes, indices, max_width=0.0, cell_size=0.0, road_half_width=0.0):
+	"""
+	Segments to recompute for each index.
+
+	Parameters
+	----------
+	network : RiverNetwork
+		Current river network
+	changes : dict
+		{input name: (changed_keys, bboxes, full)} as returned by fingerprints.diff_fingerprints,
+		'stream_network' keys being segment identifiers
+	indices : list of str
+		Indices computed by the run
+	max_width : float
+		Maximal width of the river (m), added to the reach of the indices
+	cell_size : float
+		Size of the land use cells (m), added to the reach of A3
+	road_half_width : float
+		Maximal half right-of-way of the roads (m), added to the reach of F2 and F3 for a change of the roads
+
+	Returns
+	----------
+	affected : dict
+		{index: set of segment identifiers, or None to recompute every segment}
+	"""
+	affected = {key: set() for key in indices}
+
+	def add(keys, sids):
+		for key in keys:
+			if key in affected and affected[key] is not None:
+				affected[key] |= sids
+
+	for name, (changed_keys, bboxes, full) in changes.items():
+		if name == 'stream_network':
+			if full:
+				return {key: None for key in indices}
+			# Changed segments and the segments touching the old and new geometries
+			sids = {sid for sid in network.geoms if str(sid) in changed_keys}
+			for bbox in bboxes:
+				sids |= network.near(bbox, 1.0)
+			add(indices, sids)
+			add(['F1', 'A3'], network.downstream(sids, DOWNSTREAM_DISTANCE))
+			# Neighbours sharing the A3 corridor of the changed segments
+			add(['A3'], network.around(sids, a3_neighbour_distance(max_width, cell_size)))
+			add(['A1', 'A2'], network.downstream(sids))
+			continue
+		effects = INPUT_EFFECTS.get(name, {})
+		if full:
+			for keys in effects.values():
+				for key in keys:
+					if key in affected:
+						affected[key] = None
+			continue
+		for bbox in bboxes:
+			for key in effects.get('near', []):
+				if key in affected and affected[key] is not None:
+					affected[key] |= network.near(bbox, index_reach(key, name, max_width, cell_size, road_half_width))
+			if name == 'ptref_widths' and 'A3' in effects.get('near', []):
+				# A new width moves the corridor of the segment, and so the cells shared with its neighbours
+				add(['A3'], network.around(network.near(bbox, 5.0), a3_neighbour_distance(max_width, cell_size)))
+			if effects.get('downstream'):
+				add(effects['downstream'], network.downstream(network.near(bbox, 5.0), DOWNSTREAM_DISTANCE))
+			if effects.get('basin'):
+				add(effects['basin'], network.downstream(network.draining(bbox, 5.0)))
+	return affected
+
+
+def segments_to_compute(layer, seg_id_field, affected, indices):
+	"""
+	River network restricted to the segments to recompute for the given indices.
+
+	Parameters
+	----------
+	layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	affected : dict
+		Segments to recompute for each index as returned by affected_segments (None for a complete run)
+	indices : list of str
+		Indices computed on the returned layer
+
+	Returns
+	----------
+	layer : QgsVectorLayer
+		The river network itself if every segment is computed, a memory layer of the affected segments otherwise
+	"""
+	indices = [key for key in indices if key in affected] if affected is not None else indices
+	if affected is None or any(affected[key] is None for key in indices):
+		return layer
+	sids = set()
+	for key in indices:
+		sids |= affected[key]
+	return subset_layer(layer, seg_id_field, sids)
+
+
+def subset_layer(layer, seg_id_field, sids, name='segments', fids=None):
+	"""
+	Memory layer with the segments of layer whose identifier is in sids.
+
+	With fids ({sid: [feature ids]} of layer, see feature_ids), only the features of
+	the subset are read instead of the whole layer.
+	"""
+	subset = QgsMemoryProviderUtils.createMemoryLayer(name, layer.fields(), layer.wkbType(), layer.crs())
+	if fids is None:
+		features = [feat for feat in layer.getFeatures() if feat[seg_id_field] in sids]
+	else:
+		features = list(layer.getFeatures(QgsFeatureRequest().setFilterFids([fid for sid in sids for fid in fids.get(sid, [])])))
+	subset.dataProvider().addFeatures(features)
+	subset.updateExtents()
+	return subset
+
+
+def feature_ids(layer, seg_id_field):
+	"""
+	Feature ids of each segment of layer ({sid: [feature ids]}), read once without the geometries.
+	"""
+	fids = {}
+	request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([seg_id_field], layer.fields())
+	for feat in layer.getFeatures(request):
+		fids.setdefault(feat[seg_id_field], []).append(feat.id())
+	return fids
+
+
+def previous_results(layer, seg_id_field, field_lists):
+	"""
+	Values of the indices in the output layer of the previous run.
+
+	Parameters
+	----------
+	layer : QgsVectorLayer
+		Previous output of Calcul IQM
+	seg_id_field : str
+		Name of the segment identifier field
+	field_lists : dict
+		{index: OUTPUT_FIELDS of the index}
+
+	Returns
+	----------
+	results : dict
+		{index: {sid: [values]}}, None for an index whose fields are missing from the layer
+	"""
+	names = [f.name() for f in layer.fields()]
+	indexes = {}
+	for key, fields in field_lists.items():
+		if all(field.name() in names for field in fields):
+			indexes[key] = [names.index(field.name()) for field in fields]
+	results = {key: ({} if key in indexes else None) for key in field_lists}
+	for feat in layer.getFeatures():
+		sid = feat[seg_id_field]
+		attributes = feat.attributes()
+		for key, field_indexes in indexes.items():
+			results[key][sid] = [attributes[i] for i in field_indexes]
+	return results
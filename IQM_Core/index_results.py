@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+In-memory results of the IQM indices.
+
+Each index computation returns a dict {segment id: [values]} holding the values
+of its output fields, in the order of the OUTPUT_FIELDS list of its script.
+These helpers add those fields to a layer's fields and write the features of
+the river network with the values of one or several indices. The results of a
+land use time series (one land use raster per year) are joined side by side in
+one dict, and split back into one dict per year.
+"""
+
+
+from qgis.PyQt.QtCore import QMetaType
+from qgis.core import QgsField, QgsFields, QgsFeatureSink
+
+
+# Approximation flag added after the output fields of a transect index (F3, F5) computed with a time budget per segment
+APPROX_FIELD = QgsField('Approx', QMetaType.Int)
+
+
+def output_fields(source_fields, *field_lists):
+	"""
+	Fields of the source followed by the output fields of each index.
+
+	Parameters
+	----------
+	source_fields : QgsFields
+		Fields of the river network layer
+	field_lists : list of QgsField
+		OUTPUT_FIELDS of each index, in the order of the values written
+
+	Returns
+	----------
+	fields : QgsFields
+		New fields object (the source fields are not modified)
+	"""
+	fields = QgsFields(source_fields)
+	for field_list in field_lists:
+		for field in field_list:
+			fields.append(field)
+	return fields
+
+
+def budget_fields(fields, time_budget):
+	# Output fields of a transect index, followed by the approximation flag when the segments have a time budget
+	return fields + [APPROX_FIELD] if time_budget else fields
+
+
+def series_fields(fields, label):
+	# Copies of the fields with the label of a step of a time series (e.g. its year) appended to their names
+	labelled = []
+	for field in fields:
+		copy = QgsField(field)
+		copy.setName(f"{field.name()}_{label}")
+		labelled.append(copy)
+	return labelled
+
+
+def join_series(maps, width):
+	"""
+	Results of each step of a time series joined side by side.
+
+	Parameters
+	----------
+	maps : list of dict
+		Results {sid: [values]} of each step (width values per segment)
+	width : int
+		Number of values of a step
+
+	Returns
+	----------
+	results : dict
+		{sid: [values of the first step, values of the second step, ...]} (None values for a step without the segment, None if a step is None)
+	"""
+	if any(results is None for results in maps):
+		return None
+	sids = dict.fromkeys(sid for results in maps for sid in results)
+	return {sid: [v for results in maps for v in results.get(sid, [None] * width)] for sid in sids}
+
+
+def split_series(results, width, n_steps):
+	# Results {sid: [values]} of each of the n_steps steps of joined results (see join_series)
+	return [{sid: list(values[i * width:(i + 1) * width]) for sid, values in results.items()} for i in range(n_steps)]
+
+
+def write_results(sink, features, seg_id_field, *results, feedback=None, total=0):
+	"""
+	Writes the features to the sink with the values of each index appended.
+
+	Parameters
+	----------
+	sink : QgsFeatureSink
+		Output sink (created with output_fields)
+	features : iterable of QgsFeature
+		Features of the river network
+	seg_id_field : str
+		Name of the segment identifier field
+	results : tuple (dict, int)
+		Results {sid: [values]} of each index and the number of output fields of that index
+		(None values are written for segments without results)
+	"""
+	for current, feat in enumerate(features):
+		if feedback is not None and feedback.isCanceled():
+			return False
+		sid = feat[seg_id_field]
+		values = feat.attributes()
+		for index_results, width in results:
+			values += list(index_results.get(sid, [None] * width))
+		feat.setAttributes(values)
+		sink.addFeature(feat, QgsFeatureSink.FastInsert)
+		if feedback is not None and total:
+			feedback.setProgress(int(100 * current / total))
+	return True
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Cost instrumentation of the per-segment work of the indices.
+
+When a cost report is asked for, the cost of each segment is recorded : wall
+time, number of transects (or width samples) evaluated, number of geometry
+(GEOS) operations and vertex count of the local geometry (obstacles or
+riparian strip around the transects, segment line otherwise). The kernels of
+the worker processes return the cost of each segment with its values
+(evaluated), the loops of the Processing scripts measure theirs (measure). A
+CostRecorder gathers them and writes the N most expensive segments and a
+histogram of the segment times as CSV tables.
+
+The geometry operations are counted by the calls to count_geos placed next to
+them, only once counting is switched on in the process (nothing is counted
+without a cost report or a count of the geometry operations). They are kept
+by operation and call site (module and function calling count_geos) : the
+worker processes and the compute service send theirs back with their results
+(take_geos_counts, merge_geos_counts), and start_geos_counts and
+report_geos_counts give the operations of an index run, asked for by the
+parameter of the algorithm or the IQM_GEOS_COUNTS environment variable. These
+counts do not depend on the speed of the machine.
+"""
+
+
+import os
+import csv
+import sys
+import time
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Costs recorded for each segment, in the order of the cost lists
+COST_FIELDS = ['seconds', 'transects', 'geos_calls', 'vertices']
+# Number of segments of the cost report
+REPORT_SIZE = 50
+# Upper bounds of the time classes of the histogram (s), the last class is open
+HISTOGRAM_BOUNDS = [0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, 100.0]
+
+# Environment variable asking for the count of the geometry operations of every index run (e.g. IQM_GEOS_COUNTS=1)
+GEOS_COUNTS_VARIABLE = 'IQM_GEOS_COUNTS'
+# Number of call sites listed in the report of the geometry operations
+GEOS_REPORT_SITES = 15
+
+# Geometry (GEOS) operations counted in this process, in total and by (operation, call site)
+_geos = {'enabled': False, 'calls': 0, 'sites': Counter()}
+# Call site of each code object calling count_geos
+_sites = {}
+
+
+def enable_geos_counts(enabled=True):
+	# Switches the counting of the geometry operations of this process
+	_geos['enabled'] = enabled
+
+
+def geos_counting():
+	# True if the geometry operations of this process are counted
+	return _geos['enabled']
+
+
+def count_geos(op, n=1):
+	# Counts n geometry operations op ('intersects', 'intersection', 'buffer', 'unaryUnion', 'distance', ...) when counting is on
+	if _geos['enabled']:
+		_geos['calls'] += n
+		code = sys._getframe(1).f_code
+		site = _sites.get(code)
+		if site is None:
+			# Module (file) and function of the call, nested functions included (e.g. calcul_f2.first_hit_distance_bsearch._hit)
+			name = getattr(code, 'co_qualname', code.co_name).replace('.<locals>', '')
+			site = _sites[code] = f"{Path(code.co_filename).stem}.{name}"
+		_geos['sites'][(op, site)] += n
+
+
+def geos_calls():
+	# Geometry operations counted so far in this process
+	return _geos['calls']
+
+
+def take_geos_counts():
+	# {(operation, call site): count} counted since the last call, sent back by the worker processes and the service
+	counts = dict(_geos['sites'])
+	_geos['sites'].clear()
+	return counts
+
+
+def merge_geos_counts(counts):
+	# Adds the counts of a worker process or of the service (take_geos_counts) to those of this process
+	if counts:
+		_geos['sites'].update(counts)
+		_geos['calls'] += sum(counts.values())
+
+
+def geos_counts_requested(requested=False):
+	# True if the count of the geometry operations is asked for by the parameter of the algorithm or by the environment variable
+	return bool(requested) or os.environ.get(GEOS_COUNTS_VARIABLE, '').strip() not in ('', '0')
+
+
+def start_geos_counts(requested=False):
+	"""
+	Starts the count of the geometry operations of an index run, if asked for
+	(geos_counts_requested).
+
+	Returns
+	----------
+	start : dict
+		Counts so far, given to report_geos_counts (None if not asked for)
+	"""
+	if not geos_counts_requested(requested):
+		return None
+	start = {'enabled': _geos['enabled'], 'sites': Counter(_geos['sites'])}
+	enable_geos_counts()
+	return start
+
+
+def report_geos_counts(start, index, feedback=None):
+	"""
+	Pushes to the feedback the geometry operations of an index run, in total, by
+	operation and by call site (the GEOS_REPORT_SITES first), and switches the
+	counting back to its state before start_geos_counts.
+
+	Parameters
+	----------
+	start : dict
+		Return of start_geos_counts (None : nothing is reported)
+	index : str
+		Name of the index ('F3', ...)
+
+	Returns
+	----------
+	counts : collections.Counter
+		{(operation, call site): count} of the run (None if not asked for)
+	"""
+	if start is None:
+		return None
+	counts = Counter(_geos['sites'])
+	counts.subtract(start['sites'])
+	counts = +counts
+	enable_geos_counts(start['enabled'])
+	if feedback is not None:
+		by_op = Counter()
+		for (op, _), n in counts.items():
+			by_op[op] += n
+		feedback.pushInfo(f"Opérations géométriques (GEOS) de l'indice {index} : {sum(counts.values())}")
+		if by_op:
+			feedback.pushInfo("\t" + ", ".join(f"{op} : {n}" for op, n in by_op.most_common()))
+		for (op, site), n in counts.most_common(GEOS_REPORT_SITES):
+			feedback.pushInfo(f"\t{site} ({op}) : {n}")
+	return counts
+
+
+def new_cost():
+	# Counters of a segment filled by the kernels (add_cost)
+	return {'transects': 0, 'vertices': 0}
+
+
+def add_cost(state, transects=0, vertices=0):
+	# Adds transects evaluated and vertices of the local geometry to the cost of the segment being evaluated (when state['instrument'] is set)
+	cost = state.get('cost')
+	if cost is not None:
+		cost['transects'] += transects
+		cost['vertices'] += vertices
+
+
+def evaluated(state, kernel, sid, geometry):
+	"""
+	Evaluates one segment with a kernel of an index.
+
+	Parameters
+	----------
+	kernel : callable
+		kernel(state, sid, geometry) -> values, messages
+	geometry : list of numpy.ndarray or QgsGeometry
+		Segment line, as taken by the kernel
+
+	Returns
+	----------
+	result : list
+		[sid, values, messages], followed by the cost of the segment (list in the order of COST_FIELDS) when state['instrument'] is set
+	"""
+	if not state.get('instrument'):
+		values, messages = kernel(state, sid, geometry)
+		return [sid, values, messages]
+	# Counting switched on for the segment only, then back to its previous state
+	enabled = geos_counting()
+	enable_geos_counts()
+	state['cost'] = new_cost()
+	calls = geos_calls()
+	started = time.perf_counter()
+	try:
+		values, messages = kernel(state, sid, geometry)
+	finally:
+		enable_geos_counts(enabled)
+	seconds = time.perf_counter() - started
+	cost = state.pop('cost')
+	return [sid, values, messages, [seconds, cost['transects'], geos_calls() - calls, cost['vertices']]]
+
+
+@contextmanager
+def measure(costs, sid=None):
+	"""
+	Records the work of a block as cost of a segment. The block adds its transects
+	and vertices to the yielded counters, and can set their 'sid' when the segment
+	is only known inside the block (e.g. the segment of a dam).
+
+	Parameters
+	----------
+	costs : CostRecorder
+		Recorder of the costs (None : nothing is recorded)
+	sid : str
+		Segment identifier
+	"""
+	cost = dict(new_cost(), sid=sid)
+	if costs is None:
+		yield cost
+		return
+	calls = geos_calls()
+	started = time.perf_counter()
+	yield cost
+	if cost['sid'] is not None:
+		costs.add(cost['sid'], [time.perf_counter() - started, cost['transects'], geos_calls() - calls, cost['vertices']])
+
+
+class CostRecorder:
+	"""
+	Costs of the segments of an index run. The costs of a segment recorded several
+	times (dams or structures of the same segment, land use years of a time series)
+	add up. Creating a recorder switches on the counting of the geometry operations
+	of the process, until stop (called by write_report).
+	"""
+	def __init__(self):
+		self.costs = {}
+		self.geos_enabled = geos_counting()
+		enable_geos_counts()
+
+	def stop(self):
+		# Switches the counting of the geometry operations back to its state before the recorder
+		enable_geos_counts(self.geos_enabled)
+
+	def __len__(self):
+		return len(self.costs)
+
+	def add(self, sid, cost):
+		previous = self.costs.get(sid)
+		self.costs[sid] = list(cost) if previous is None else [a + b for a, b in zip(previous, cost)]
+
+	def total(self):
+		# Sum of each cost over all the segments
+		return [sum(cost[i] for cost in self.costs.values()) for i in range(len(COST_FIELDS))]
+
+	def top(self, n=REPORT_SIZE):
+		# [[sid, cost], ...] of the n most expensive segments (wall time), most expensive first
+		return sorted(self.costs.items(), key=lambda item: item[1][0], reverse=True)[:n]
+
+	def histogram(self):
+		# [[lower bound, upper bound (None for the last class), number of segments, time of these segments], ...] of the segment times (s)
+		lower = [0.0] + HISTOGRAM_BOUNDS
+		upper = HISTOGRAM_BOUNDS + [None]
+		rows = [[low, high, 0, 0.0] for low, high in zip(lower, upper)]
+		for cost in self.costs.values():
+			k = sum(cost[0] >= bound for bound in HISTOGRAM_BOUNDS)
+			rows[k][2] += 1
+			rows[k][3] += cost[0]
+		return rows
+
+	def write_report(self, path, n=REPORT_SIZE):
+		"""
+		Writes the n most expensive segments to path (CSV) and the histogram of the
+		segment times to <path>_histogramme.csv.
+
+		Returns
+		----------
+		histogram_path : str
+		"""
+		total_seconds = self.total()[0]
+		with open(path, 'w', newline='', encoding='utf-8') as f:
+			writer = csv.writer(f)
+			writer.writerow(['rank', 'id'] + COST_FIELDS + ['share'])
+			for rank, (sid, cost) in enumerate(self.top(n), start=1):
+				writer.writerow([rank, sid] + [round(cost[0], 6)] + [int(c) for c in cost[1:]] + [round(cost[0] / total_seconds, 6) if total_seconds else 0.0])
+		histogram_path = str(Path(path).with_suffix('')) + '_histogramme.csv'
+		with open(histogram_path, 'w', newline='', encoding='utf-8') as f:
+			writer = csv.writer(f)
+			writer.writerow(['min_seconds', 'max_seconds', 'segments', 'seconds'])
+			for low, high, count, seconds in self.histogram():
+				writer.writerow([low, '' if high is None else high, count, round(seconds, 6)])
+		return histogram_path
+
+	def summary(self, n=5):
+		# Lines of text on the total cost and the n most expensive segments
+		seconds, transects, calls, _ = self.total()
+		lines = [f"Coût des {len(self.costs)} segments : {seconds:.2f} s, {int(transects)} transects, {int(calls)} opérations géométriques"]
+		for sid, cost in self.top(n):
+			share = cost[0] / seconds if seconds else 0.0
+			lines.append(f"\t{sid} : {cost[0]:.3f} s ({share:.1%}), {int(cost[1])} transects, {int(cost[2])} opérations géométriques, {int(cost[3])} sommets")
+		return lines
+
+
+def write_report(costs, path, feedback=None):
+	"""
+	Writes the cost report of a run (CostRecorder.write_report) and pushes its summary to the feedback.
+	The recorder is stopped (CostRecorder.stop).
+
+	Returns
+	----------
+	path : str
+		Path of the report (None without costs or path)
+	"""
+	if costs is None:
+		return None
+	costs.stop()
+	if not path:
+		return None
+	histogram_path = costs.write_report(path)
+	if feedback is not None:
+		for line in costs.summary():
+			feedback.pushInfo(line)
+		feedback.pushInfo(f"Rapport des segments les plus coûteux : {path} (histogramme : {histogram_path})")
+	return path
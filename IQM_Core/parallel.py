@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Parallel evaluation of the per-segment loops of the indices (F2, F3 and F5).
+
+Once the obstacles (or riparian strip) and the PtRef widths are prepared, the
+segments are independent. The prepared data and the segments are packed as
+flat arrays (IQM_Core.transport) in a shared memory block viewed by every
+worker process without copy. The workers are then sent ranges of segment
+positions, rebuild the geometries of their range and the results are collected
+in the order of the input layer.
+
+The module of an index (or IQM_Core.compute, which does not import QGIS)
+provides two functions, also used by the serial mode:
+	- worker_init(payload) -> state : rebuilds the geometries and prepared
+	  predicates from the packed payload;
+	- evaluate_chunk(state, segments, ids, start, stop) -> [[sid, values, messages], ...]
+	  for the segments [start, stop[ of the packed segments, each followed by
+	  its cost when payload['instrument'] is set (IQM_Core.instrumentation).
+
+The geometry operations counted in the workers (payload['geos_counts'] set
+when they are counted in the calling process) are sent back with the results
+of each range.
+"""
+
+
+import os
+import sys
+import importlib.util
+import multiprocessing
+
+from IQM_Core import instrumentation, transport
+
+# Number of segments sent at once to a worker
+CHUNK_SIZE = 32
+
+# Index module, state and shared block of a worker process
+_worker = {}
+
+
+def worker_count(workers):
+	"""
+	Number of processes to use (0 : number of cores). Returns 1 inside a process
+	of a pool, which cannot start processes of its own (e.g. IQM_Core.batch).
+	"""
+	if multiprocessing.current_process().daemon:
+		return 1
+	return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def python_executable():
+	# Within QGIS, sys.executable is the QGIS application and not the Python interpreter
+	if os.path.basename(sys.executable).lower().startswith('python'):
+		return sys.executable
+	if sys.platform == 'win32':
+		return os.path.join(sys.exec_prefix, 'python.exe')
+	return os.path.join(sys.exec_prefix, 'bin', f"python{sys.version_info.major}")
+
+
+def load_module(module_path):
+	# The scripts are loaded from their file (the Processing script provider does not import them as packages)
+	name = 'iqm_parallel_' + os.path.splitext(os.path.basename(module_path))[0]
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.spec_from_file_location(name, module_path)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	spec.loader.exec_module(module)
+	return module
+
+
+def _init_worker(module_path, spec):
+	shared, shm = transport.attach(spec)
+	module = load_module(module_path)
+	_worker['shm'] = shm
+	_worker['module'] = module
+	_worker['segment_ids'] = transport.unpack_keys(shared['segment_ids'])
+	_worker['segments'] = shared['segments']
+	_worker['state'] = module.worker_init(shared['payload'])
+	instrumentation.enable_geos_counts(bool(shared['payload'].get('geos_counts')))
+
+
+def _evaluate(positions):
+	# Segments of the range read from the shared arrays
+	start, stop = positions
+	chunk_results = _worker['module'].evaluate_chunk(_worker['state'], _worker['segments'], _worker['segment_ids'], start, stop)
+	return chunk_results, instrumentation.take_geos_counts()
+
+
+def evaluate_segments(module, payload, layer, seg_id_field, workers=1, chunk_size=CHUNK_SIZE, feedback=None, costs=None):
+	"""
+	Evaluates every segment of the layer with the functions of an index module.
+
+	Parameters
+	----------
+	module : module
+		Index module or IQM_Core.compute (worker_init and evaluate_chunk), loaded from its file in the worker processes
+	payload : dict
+		Data given to worker_init (NumPy arrays, packed geometries and plain values)
+	layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	workers : int
+		Number of processes (1 : in the current process, 0 : number of cores)
+	chunk_size : int
+		Number of segments sent at once to a worker
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment (None : costs not recorded)
+
+	Returns
+	----------
+	results : dict
+		{sid: values} in the order of the layer (None if canceled)
+	"""
+	if costs is not None:
+		payload = dict(payload, instrument=True)
+	if instrumentation.geos_counting():
+		payload = dict(payload, geos_counts=True)
+	features = [[segment[seg_id_field], segment.geometry()] for segment in layer.getFeatures()]
+	segment_ids = [sid for sid, _ in features]
+	segments = transport.pack_geometries([geom for _, geom in features])
+	total = len(features)
+	if feedback is not None:
+		feedback.pushInfo(f"{total} features (segments) à traiter")
+	ranges = [[start, min(start + chunk_size, total)] for start in range(0, total, chunk_size)]
+	workers = min(worker_count(workers), max(1, len(ranges)))
+	results = {}
+	done = 0
+
+	def collect(chunk_results):
+		nonlocal done
+		for sid, values, messages, *cost in chunk_results:
+			results[sid] = values
+			if cost and costs is not None:
+				costs.add(sid, cost[0])
+			if feedback is not None:
+				for message in messages:
+					feedback.pushInfo(message)
+		done += len(chunk_results)
+		if feedback is not None:
+			feedback.setProgress(int(100 * done / max(1, total)))
+
+	if workers <= 1:
+		state = module.worker_init(payload)
+		for start, stop in ranges:
+			if feedback is not None and feedback.isCanceled():
+				return None
+			collect(module.evaluate_chunk(state, segments, segment_ids, start, stop))
+		return results
+
+	if feedback is not None:
+		feedback.pushInfo(f"Évaluation des segments sur {workers} processus")
+	shared = transport.SharedPayload({
+		'payload': payload,
+		'segment_ids': transport.pack_keys(segment_ids),
+		'segments': segments
+	})
+	pool_context = multiprocessing.get_context('spawn')
+	pool_context.set_executable(python_executable())
+	pool = pool_context.Pool(processes=workers, initializer=_init_worker, initargs=(module.__file__, shared.spec))
+	try:
+		# imap keeps the order of the ranges
+		for chunk_results, geos_counts in pool.imap(_evaluate, ranges):
+			if feedback is not None and feedback.isCanceled():
+				return None
+			collect(chunk_results)
+			instrumentation.merge_geos_counts(geos_counts)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+		shared.close()
+	return results
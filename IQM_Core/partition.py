@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Partitioned computation of the IQM indices over large river networks.
+
+The network is split into sub-basins following the downstream links
+(Id_UEA_aval) so that each partition holds at most a given number of
+segments. The per-segment indices are then computed partition by partition on
+a memory layer of the partition and its halo: the obstacles of F2, F3 and F5
+are gathered by the corridor of the partition only, and F1 and A3 get the
+segments within 1000 m upstream so the structures and dams counted by the
+partition are found. A3 also gets the neighbouring segments whose corridor
+overlaps the corridor of the partition, as each land use cell goes to the
+nearest segment. Each partition reads only its own segments (by feature id),
+and F1 and A3 only the structures, dams and PtRef within its extent. Only the
+results of the partition segments are kept and the partitions are merged in a
+fixed order.
+"""
+
+
+from IQM_Core import incremental
+
+
+def partition_network(network, max_size):
+	"""
+	Splits the river network into sub-basins of at most max_size segments.
+
+	The segments are visited from the upstream ends to the outlets: each segment
+	gathers the groups of segments still pending upstream of it, and the largest
+	of those groups are closed as partitions while the total exceeds max_size.
+
+	Parameters
+	----------
+	network : incremental.RiverNetwork
+		River network with its downstream links
+	max_size : int
+		Maximal number of segments of a partition
+
+	Returns
+	----------
+	partitions : list of list
+		Segment identifiers of each partition, in a deterministic order
+	"""
+	max_size = max(1, int(max_size))
+	upstream = {}
+	for sid, down_sid in network.down.items():
+		if down_sid in network.geoms and down_sid != sid:
+			upstream.setdefault(down_sid, []).append(sid)
+	# Outlets first, then the segments left (loops in the links) in the order of their identifiers
+	roots = sorted((sid for sid, down_sid in network.down.items() if down_sid not in network.geoms or down_sid == sid), key=str)
+	roots += sorted(network.geoms, key=str)
+	partitions = []
+	pending = {}
+	visited = set()
+	for root in roots:
+		if root in visited:
+			continue
+		# Iterative post-order traversal (upstream segments before their downstream one)
+		order = []
+		stack = [root]
+		while stack:
+			sid = stack.pop()
+			if sid in visited:
+				continue
+			visited.add(sid)
+			order.append(sid)
+			stack += sorted((up_sid for up_sid in upstream.get(sid, []) if up_sid not in visited), key=str)
+		for sid in reversed(order):
+			groups = [pending.pop(up_sid) for up_sid in upstream.get(sid, []) if up_sid in pending]
+			groups.sort(key=lambda group: (-len(group), str(group[0])))
+			total = 1 + sum(len(group) for group in groups)
+			while total > max_size and groups:
+				group = groups.pop(0)
+				partitions.append(group)
+				total -= len(group)
+			pending[sid] = [sid] + [up_sid for group in groups for up_sid in group]
+		partitions.append(pending.pop(root))
+	return partitions
+
+
+def run_partitioned(compute, layer, seg_id_field, partitions=None, sids=None, halo=None, feedback=None):
+	"""
+	Runs an index computation partition by partition.
+
+	Parameters
+	----------
+	compute : callable
+		compute(layer) returning the results {sid: [values]} of the segments of a layer (None if canceled)
+	layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	partitions : list of list
+		Segment identifiers of each partition (None to compute the whole network at once)
+	sids : set
+		Segments to compute (all if None)
+	halo : callable
+		halo(sids) returning the segments to add to a partition for its computation (their results are dropped)
+
+	Returns
+	----------
+	results : dict
+		{sid: [values]} of the computed segments (None if canceled)
+	"""
+	if partitions is None:
+		if sids is None:
+			return compute(layer)
+		partitions = [list(sids)]
+	# Feature ids of the segments, so each partition reads its own features only
+	fids = incremental.feature_ids(layer, seg_id_field)
+	results = {}
+	for current, part in enumerate(partitions):
+		if feedback is not None and feedback.isCanceled():
+			return None
+		part_sids = [sid for sid in part if sids is None or sid in sids]
+		if not part_sids:
+			continue
+		if feedback is not None and len(partitions) > 1:
+			feedback.pushInfo(f"\tPartition {current + 1}/{len(partitions)} ({len(part_sids)} segments)")
+		layer_sids = set(part_sids) | (halo(part_sids) if halo is not None else set())
+		part_results = compute(incremental.subset_layer(layer, seg_id_field, layer_sids, fids=fids))
+		if part_results is None:
+			return None
+		for sid in part_sids:
+			if sid in part_results:
+				results[sid] = part_results[sid]
+	return results
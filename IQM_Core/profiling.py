@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Opt-in profiling of the steps of the algorithms (child algorithms and index loops).
+
+When the profile parameter of an algorithm is set, each of its steps runs under
+cProfile and under a sampling profiler (a thread of the standard library reading
+the call stack of the profiled thread at a fixed interval). Each step writes,
+in the folder of the output :
+	- <prefix>_<nn>_<step>.prof : cProfile statistics (pstats, snakeviz, ...);
+	- <prefix>_<nn>_<step>.collapsed : collapsed stacks ("f1;f2;f3 count" per
+	  line) of the sampling profiler, read by flamegraph.pl, speedscope, ...
+
+The worker processes of the parallel evaluation (IQM_Core.parallel) and the
+compute service are not profiled : a step evaluating its segments in several
+processes only shows the waiting for their results.
+"""
+
+
+import re
+import sys
+import time
+import cProfile
+import threading
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Interval between two samples of the call stack (s)
+SAMPLE_INTERVAL = 0.005
+
+
+def code_label(code):
+	# Module (file) and function of a code object, nested functions included (e.g. calcul_f2.first_hit_distance_bsearch._hit)
+	name = getattr(code, 'co_qualname', code.co_name).replace('.<locals>', '')
+	return f"{Path(code.co_filename).stem}.{name}"
+
+
+def output_directory(destination):
+	# Folder of the output file of an algorithm, the temporary folder of Processing for a memory or database output
+	path = Path(str(destination or '').split('|')[0])
+	if path.suffix and path.parent.is_dir():
+		return path.parent
+	from qgis.core import QgsProcessingUtils
+	return Path(QgsProcessingUtils.tempFolder())
+
+
+class Sampler(threading.Thread):
+	"""
+	Sampling profiler of a thread : counts its call stacks (collapsed, outermost
+	function first) read every interval seconds until stop.
+	"""
+	def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+		super().__init__(daemon=True)
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = Counter()
+		self.labels = {}
+		self.done = threading.Event()
+
+	def run(self):
+		while not self.done.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			names = []
+			while frame is not None:
+				code = frame.f_code
+				label = self.labels.get(code)
+				if label is None:
+					label = self.labels[code] = code_label(code)
+				names.append(label)
+				frame = frame.f_back
+			if names:
+				self.stacks[';'.join(reversed(names))] += 1
+
+	def stop(self):
+		self.done.set()
+		self.join()
+
+	def write(self, path):
+		# Collapsed stacks, one "f1;f2;f3 count" line per stack
+		with open(path, 'w', encoding='utf-8') as f:
+			for stack, count in self.stacks.most_common():
+				f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+	"""
+	Profiles the steps of an algorithm run and writes their files in a folder.
+
+	Parameters
+	----------
+	directory : str or Path
+		Folder of the profiles (see output_directory)
+	prefix : str
+		Start of the file names, followed by the number and the name of the step
+	feedback : QgsProcessingFeedback
+		Optional feedback receiving the paths of the files
+	"""
+	def __init__(self, directory, prefix, feedback=None, interval=SAMPLE_INTERVAL):
+		self.directory = Path(directory)
+		self.prefix = prefix
+		self.feedback = feedback
+		self.interval = interval
+		self.files = []
+		self.steps = 0
+		self.active = False
+
+	@contextmanager
+	def step(self, name):
+		# cProfile allows a single profiler at a time : a step within a step is part of the outer one
+		if self.active:
+			yield
+			return
+		self.active = True
+		self.steps += 1
+		base = self.directory / f"{self.prefix}_{self.steps:02d}_{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}"
+		sampler = Sampler(threading.get_ident(), self.interval)
+		profile = cProfile.Profile()
+		started = time.perf_counter()
+		sampler.start()
+		profile.enable()
+		try:
+			yield
+		finally:
+			profile.disable()
+			sampler.stop()
+			self.active = False
+			seconds = time.perf_counter() - started
+			try:
+				self.directory.mkdir(parents=True, exist_ok=True)
+				profile.dump_stats(str(base) + '.prof')
+				sampler.write(str(base) + '.collapsed')
+				self.files += [str(base) + '.prof', str(base) + '.collapsed']
+				if self.feedback is not None:
+					self.feedback.pushInfo(f"Profil de l'étape {name} ({seconds:.1f} s, {sum(sampler.stacks.values())} échantillons) : {base}.prof, {base}.collapsed")
+			except OSError as e:
+				if self.feedback is not None:
+					self.feedback.reportError(f"Impossible d'écrire le profil de l'étape {name} : {e}")
+
+
+def new_profiler(requested, destination, name, feedback=None):
+	"""
+	Profiler of an algorithm run if asked for, writing next to its output.
+
+	Parameters
+	----------
+	requested : bool
+		Value of the profile parameter of the algorithm
+	destination : str
+		Output of the algorithm (file path, or memory/database layer : temporary folder of Processing)
+	name : str
+		Name of the algorithm, start of the file names with the date and time of the run
+
+	Returns
+	----------
+	profiler : Profiler
+		None if not asked for
+	"""
+	if not requested:
+		return None
+	return Profiler(output_directory(destination), f"profil_{name}_{time.strftime('%Y%m%d_%H%M%S')}", feedback)
+
+
+@contextmanager
+def step(profiler, name):
+	"""
+	Profiles a step of an algorithm (child algorithm, index loop) with the profiler.
+
+	Parameters
+	----------
+	profiler : Profiler
+		Profiler of the run (None : the step is not profiled)
+	name : str
+		Name of the step in the file names
+	"""
+	if profiler is None:
+		yield
+		return
+	with profiler.step(name):
+		yield
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Widths of the PtRef points of each segment, held as plain NumPy arrays.
+
+The arrays replace the per-segment spatial indexes of PtRef features so that
+they can be sent as is to the worker processes of IQM_Core.parallel.
+"""
+
+
+import numpy as np
+
+# Half size (m) of the box searched around a transect point for the nearest PtRef
+SEARCH_RADIUS = 100.0
+
+
+def width_arrays(ptref_layer, seg_id_field, width_field):
+	"""
+	Gathers the PtRef points of each segment.
+
+	Parameters
+	----------
+	ptref_layer : QgsVectorLayer
+		PtRef width layer
+	seg_id_field, width_field : str
+		Names of the segment identifier and width fields
+
+	Returns
+	----------
+	widths : dict
+		{sid: array of [x, y, width] of the PtRef of the segment (width nan if missing)}
+	"""
+	rows = {}
+	for pf in ptref_layer.getFeatures():
+		g = pf.geometry()
+		if not g or g.isEmpty():
+			continue
+		p = g.asPoint() if not g.isMultipart() else g.asMultiPoint()[0]
+		try:
+			val = pf[width_field]
+			w = float(val) if val is not None else np.nan
+		except Exception:
+			w = np.nan
+		rows.setdefault(pf[seg_id_field], []).append([p.x(), p.y(), w])
+	return {sid: np.array(pts, dtype=float) for sid, pts in rows.items()}
+
+
+def nearest_width(x, y, seg_widths):
+	"""
+	Width of the nearest PtRef of the segment to (x, y), searched in a box of
+	SEARCH_RADIUS around the point (all the PtRef of the segment if the box is empty).
+	Returns None if the segment has no PtRef with a width.
+	"""
+	if seg_widths is None or not len(seg_widths):
+		return None
+	dx = seg_widths[:, 0] - x
+	dy = seg_widths[:, 1] - y
+	in_box = (np.abs(dx) <= SEARCH_RADIUS) & (np.abs(dy) <= SEARCH_RADIUS)
+	candidates = in_box if in_box.any() else np.ones(len(seg_widths), dtype=bool)
+	candidates &= ~np.isnan(seg_widths[:, 2])
+	if not candidates.any():
+		return None
+	d2 = np.where(candidates, dx * dx + dy * dy, np.inf)
+	return float(seg_widths[int(np.argmin(d2)), 2])
+
+
+def max_width(seg_widths, default=2):
+	"""
+	Maximal width of the PtRef of the segment (0 if none has a width, default if the segment has no PtRef).
+	"""
+	if seg_widths is None or not len(seg_widths):
+		return default
+	widths = seg_widths[:, 2]
+	widths = widths[~np.isnan(widths)]
+	return max(0.0, float(widths.max())) if len(widths) else 0.0
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Quick look and refinement of the transect indices (F2, F3 and F5).
+
+A quick look probes a few transects of each segment (IQM_Core.compute.QUICK_LOOK_POINTS
+points, spread over the segment) and writes provisional values with a
+boundary-proximity flag : 1 when the class of the segment may differ with all
+its transects. A refinement run starts from that output and only computes the
+flagged segments (and those missing from it) at full resolution, the others
+keeping their provisional values.
+"""
+
+
+from qgis.PyQt.QtCore import QMetaType
+from qgis.core import QgsField
+
+from IQM_Core import incremental
+
+
+# Evaluation modes of the transect indices
+MODES = ['Complet', 'Aperçu (échantillonnage grossier)', "Raffinement d'un aperçu"]
+FULL, QUICK_LOOK, REFINE = range(len(MODES))
+# Boundary-proximity flag added after the output fields of the index in the quick look and refinement modes
+FLAG_FIELD = QgsField('Pres_seuil', QMetaType.Int)
+
+
+def output_fields(fields, mode):
+	# Output fields of an index in the given mode
+	return fields + [FLAG_FIELD] if mode != FULL else fields
+
+
+def missing_fields(layer, seg_id_field, fields):
+	# Names of the fields of a quick look output (segment identifier, index fields and flag) missing from a layer
+	names = [f.name() for f in layer.fields()]
+	return [name for name in [seg_id_field] + [field.name() for field in fields + [FLAG_FIELD]] if name not in names]
+
+
+def refine(compute, layer, seg_id_field, provisional_layer, fields, feedback=None):
+	"""
+	Results of a refinement run from the output of a quick look.
+
+	Parameters
+	----------
+	compute : callable
+		compute(layer) returning the full resolution results {sid: [values]} of the segments of a layer (None if canceled)
+	layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	provisional_layer : QgsVectorLayer
+		Output of the quick look
+	fields : list of QgsField
+		OUTPUT_FIELDS of the index
+
+	Returns
+	----------
+	results : dict
+		{sid: [values, flag]} of every segment (None if canceled)
+	"""
+	provisional = incremental.previous_results(provisional_layer, seg_id_field, {'index': fields + [FLAG_FIELD]})['index']
+	sids = [feat[seg_id_field] for feat in layer.getFeatures()]
+	to_refine = {sid for sid in sids if sid not in provisional or provisional[sid][-1] != 0}
+	if feedback is not None:
+		feedback.pushInfo(f"{len(to_refine)} segments sur {len(sids)} à raffiner (près d'un seuil de classe ou absents de l'aperçu)")
+	results = {sid: values for sid, values in provisional.items() if sid not in to_refine}
+	if to_refine:
+		refined = compute(incremental.subset_layer(layer, seg_id_field, to_refine))
+		if refined is None:
+			return None
+		for sid, values in refined.items():
+			results[sid] = list(values) + [0]
+	return results
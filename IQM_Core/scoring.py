@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Table-driven scoring of the IQM indices.
+
+Each index is described by a table of rules evaluated in order over metric
+columns (NumPy arrays), the first rule that matches giving the score. A rule
+maps metric names to a comparison [operator, value] (all the comparisons of a
+rule must be true) and a score (None for NULL). The tables only hold plain
+lists, numbers and strings so they can be written to or read from JSON.
+
+As with the QGIS expressions these tables replace, a NULL metric (NaN) fails
+every comparison and gets the default score of the table.
+
+The scores of an IQM output layer can be recomputed from its stored metrics
+with other thresholds (script Rescorer IQM) : the revised tables are read from
+a JSON configuration holding the tables to replace (load_tables).
+"""
+
+
+import copy
+import json
+import numpy as np
+
+
+OPERATORS = {
+	'<': np.less,
+	'<=': np.less_equal,
+	'>': np.greater,
+	'>=': np.greater_equal,
+	'==': np.equal,
+	'!=': np.not_equal,
+}
+
+
+SCORE_TABLES = {
+	# Forest and agricultural cover of the upstream watershed
+	'A1': {
+		'rules': [
+			{'when': {'watershed_area': ['==', 0]}, 'score': None},
+			{'when': {'forest_ratio': ['<=', 0.10]}, 'score': 5},
+			{'when': {'forest_ratio': ['<', 0.33]}, 'score': 4},
+			{'when': {'forest_ratio': ['<', 0.66], 'agri_ratio': ['<', 0.33]}, 'score': 2},
+			{'when': {'forest_ratio': ['<', 0.66]}, 'score': 3},
+			{'when': {'forest_ratio': ['<', 0.90]}, 'score': 1},
+		],
+		'default': 0,
+	},
+	# Upstream watershed area controlled by dams
+	'A2': {
+		'rules': [
+			{'when': {'watershed_area': ['==', 0]}, 'score': None},
+			{'when': {'dam_ratio': ['<', 0.05]}, 'score': 0},
+			{'when': {'dam_ratio': ['<', 0.33]}, 'score': 2},
+			{'when': {'dam_ratio': ['<', 0.66]}, 'score': 3},
+		],
+		'default': 4,
+	},
+	# Number of dams within 1000 m upstream
+	'A3_dams': {
+		'rules': [
+			{'when': {'dam_count': ['==', 1]}, 'score': 2},
+			{'when': {'dam_count': ['>', 1]}, 'score': 4},
+		],
+		'default': 0,
+	},
+	# Anthropic and agricultural cover of the fluvial corridor
+	'A3_corridor': {
+		'rules': [
+			{'when': {'land_area': ['==', 0]}, 'score': 2},
+			{'when': {'altered_ratio': ['>=', 0.9]}, 'score': 4},
+			{'when': {'altered_ratio': ['>=', 0.66]}, 'score': 3},
+			{'when': {'altered_ratio': ['>=', 0.33]}, 'score': 2},
+			{'when': {'altered_ratio': ['>=', 0.1]}, 'score': 1},
+		],
+		'default': 0,
+	},
+	# Sinuosity index of the segment
+	'A4': {
+		'rules': [
+			{'when': {'sinuosity': ['>=', 1.5]}, 'score': 0},
+			{'when': {'sinuosity': ['>=', 1.25]}, 'score': 2},
+			{'when': {'sinuosity': ['>=', 1.05]}, 'score': 4},
+		],
+		'default': 6,
+	},
+	# Number of structures within 1000 m upstream
+	'F1': {
+		'rules': [
+			{'when': {'struct_count': ['==', 0]}, 'score': 0},
+			{'when': {'struct_count': ['<=', 1]}, 'score': 2},
+		],
+		'default': 4,
+	},
+	# Median width of lateral connectivity with the alluvial plain (m)
+	'F2': {
+		'rules': [
+			{'when': {'median_length': ['>', 50]}, 'score': 0},
+			{'when': {'median_length': ['>=', 30]}, 'score': 2},
+			{'when': {'median_length': ['>=', 15]}, 'score': 3},
+			{'when': {'median_length': ['<', 15]}, 'score': 5},
+		],
+		'default': None,
+	},
+	# Share of the banks with a mobility space of at least 15 m
+	'F3': {
+		'rules': [
+			{'when': {'free_ratio': ['>', 0.9]}, 'score': 0},
+			{'when': {'free_ratio': ['>', 0.66]}, 'score': 2},
+			{'when': {'free_ratio': ['>', 0.33]}, 'score': 3},
+		],
+		'default': 5,
+	},
+	# Share of natural width variations
+	'F4': {
+		'rules': [
+			{'when': {'natural_ratio': ['>=', 0.9]}, 'score': 0},
+			{'when': {'natural_ratio': ['>=', 0.66]}, 'score': 1},
+			{'when': {'natural_ratio': ['>=', 0.33]}, 'score': 2},
+		],
+		'default': 3,
+	},
+	# Share of the banks with a riparian strip over 30 m and between 15 and 30 m
+	'F5': {
+		'rules': [
+			{'when': {'p30': ['>', 0.90]}, 'score': 0},
+			{'when': {'p30': ['>', 0.66]}, 'score': 1},
+			{'when': {'p15to30': ['>', 0.66]}, 'score': 2},
+			{'when': {'p30': ['>=', 0.33]}, 'score': 2},
+			{'when': {'p15to30': ['>=', 0.33], 'p30': ['<', 0.33]}, 'score': 3},
+		],
+		'default': 4,
+	},
+	# Final score : 1 - (sum of the index scores / maximum alteration score)
+	'IQM': {
+		'max_score': 40,
+	},
+}
+
+
+def as_array(values):
+	# Converts a column of attribute values to a float array (None and NULL become NaN)
+	return np.array([np.nan if v is None or v != v or not isinstance(v, (int, float)) else v for v in values], dtype=float)
+
+
+def as_attributes(scores, integer=True):
+	# Converts an array of scores to attribute values (NaN becomes None)
+	if integer:
+		return [None if np.isnan(s) else int(s) for s in scores]
+	return [None if np.isnan(s) else float(s) for s in scores]
+
+
+def ratio(numerator, denominator):
+	# Element-wise ratio, NaN where the denominator is 0 or NULL
+	numerator = np.asarray(numerator, dtype=float)
+	denominator = np.asarray(denominator, dtype=float)
+	out = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+	np.divide(numerator, denominator, out=out, where=(denominator != 0) & ~np.isnan(denominator))
+	return out
+
+
+def apply_rules(table, metrics):
+	"""
+	Evaluates a score table over metric columns.
+
+	Parameters
+	----------
+	table : dict
+		Score table ({'rules': [{'when': {metric: [op, value]}, 'score': s}], 'default': s}).
+	metrics : dict
+		Metric name -> array of values (all of the same length).
+
+	Returns
+	----------
+	scores : numpy.ndarray
+		Float array of the scores (NaN for NULL).
+	"""
+	n = len(next(iter(metrics.values()))) if metrics else 0
+	conditions = []
+	choices = []
+	for rule in table['rules']:
+		cond = np.ones(n, dtype=bool)
+		for metric, (op, value) in rule['when'].items():
+			with np.errstate(invalid='ignore'):
+				cond &= OPERATORS[op](np.asarray(metrics[metric], dtype=float), value)
+		conditions.append(cond)
+		choices.append(np.nan if rule['score'] is None else float(rule['score']))
+	default = table.get('default')
+	default = np.nan if default is None else float(default)
+	if not conditions:
+		return np.full(n, default)
+	return np.select(conditions, choices, default=default)
+
+
+def score_is_fixed(table, bounds):
+	"""
+	Checks whether the score of a table is the same for every value of its metrics
+	within bounds, e.g. when only a share of the transects of a segment is known.
+
+	The rules compare each metric to thresholds, so the score can only change at a
+	threshold : it is evaluated at the bounds, at the thresholds within the bounds
+	and between them, for every combination of the metrics.
+
+	Parameters
+	----------
+	table : dict
+		Score table
+	bounds : dict
+		Metric name -> [lower bound, upper bound]
+
+	Returns
+	----------
+	fixed : bool
+		True if the score is the same over the bounds
+	"""
+	grids = []
+	for metric, (lo, hi) in bounds.items():
+		cuts = {float(lo), float(hi)}
+		for rule in table['rules']:
+			if metric in rule['when']:
+				value = float(rule['when'][metric][1])
+				if lo < value < hi:
+					cuts.add(value)
+		cuts = sorted(cuts)
+		grids.append(cuts + [(a + b) / 2.0 for a, b in zip(cuts[:-1], cuts[1:])])
+	mesh = np.meshgrid(*grids, indexing='ij')
+	scores = apply_rules(table, {metric: grid.ravel() for metric, grid in zip(bounds, mesh)})
+	return bool(np.all(np.isnan(scores)) or np.all(scores == scores[0]))
+
+
+def score_a1(watershed_area, forest_area, agri_area, tables=SCORE_TABLES):
+	# A1 index from the watershed, forest and agricultural areas of each segment
+	watershed_area = np.asarray(watershed_area, dtype=float)
+	metrics = {
+		'watershed_area': watershed_area,
+		'forest_ratio': ratio(forest_area, watershed_area),
+		'agri_ratio': ratio(agri_area, watershed_area),
+	}
+	return apply_rules(tables['A1'], metrics)
+
+
+def score_a2(watershed_area, dam_area, tables=SCORE_TABLES):
+	# A2 index from the watershed area and the area controlled by dams (NULL dam area is 0)
+	watershed_area = np.asarray(watershed_area, dtype=float)
+	dam_area = np.nan_to_num(np.asarray(dam_area, dtype=float), nan=0.0)
+	metrics = {
+		'watershed_area': watershed_area,
+		'dam_ratio': ratio(dam_area, watershed_area),
+	}
+	return apply_rules(tables['A2'], metrics)
+
+
+def score_a3(dam_count, forest_area, agri_area, anthro_area, tables=SCORE_TABLES):
+	# A3 index : dam penalty + anthropisation level of the corridor
+	forest_area = np.asarray(forest_area, dtype=float)
+	agri_area = np.asarray(agri_area, dtype=float)
+	anthro_area = np.asarray(anthro_area, dtype=float)
+	land_area = forest_area + agri_area + anthro_area
+	penalty = apply_rules(tables['A3_dams'], {'dam_count': np.asarray(dam_count, dtype=float)})
+	corridor = apply_rules(tables['A3_corridor'], {
+		'land_area': land_area,
+		'altered_ratio': ratio(anthro_area + agri_area, land_area),
+	})
+	return penalty + corridor
+
+
+def score_a4(sinuosity, tables=SCORE_TABLES):
+	# A4 index from the sinuosity index of each segment
+	return apply_rules(tables['A4'], {'sinuosity': np.asarray(sinuosity, dtype=float)})
+
+
+def score_f1(struct_count, tables=SCORE_TABLES):
+	# F1 index from the number of structures within 1000 m upstream of each segment
+	return apply_rules(tables['F1'], {'struct_count': np.asarray(struct_count, dtype=float)})
+
+
+def score_f2(median_length, tables=SCORE_TABLES):
+	# F2 index from the median width of lateral connectivity of each segment
+	return apply_rules(tables['F2'], {'median_length': np.asarray(median_length, dtype=float)})
+
+
+def score_f3(free_ratio, tables=SCORE_TABLES):
+	# F3 index from the share (0 to 1) of free 15 m transects of each segment
+	return apply_rules(tables['F3'], {'free_ratio': np.asarray(free_ratio, dtype=float)})
+
+
+def score_f4(natural_ratio, tables=SCORE_TABLES):
+	# F4 index from the share of natural width variations of each segment
+	return apply_rules(tables['F4'], {'natural_ratio': np.asarray(natural_ratio, dtype=float)})
+
+
+def score_f5(p30, p15to30, tables=SCORE_TABLES):
+	# F5 index from the shares (0 to 1) of riparian strip over 30 m and between 15 and 30 m of each segment
+	return apply_rules(tables['F5'], {'p30': np.asarray(p30, dtype=float), 'p15to30': np.asarray(p15to30, dtype=float)})
+
+
+def score_iqm(index_scores, tables=SCORE_TABLES):
+	"""
+	Final IQM score of each segment.
+
+	Parameters
+	----------
+	index_scores : array_like
+		(n, k) array of the index scores of n segments (NaN for NULL, ignored in the sum).
+
+	Returns
+	----------
+	iqm : numpy.ndarray
+		1 - (sum of the index scores / maximum alteration score) for each segment.
+	"""
+	index_scores = np.asarray(index_scores, dtype=float)
+	if index_scores.ndim == 1:
+		index_scores = index_scores[None, :]
+	return 1 - np.nansum(index_scores, axis=1) / tables['IQM']['max_score']
+
+
+def load_tables(path):
+	"""
+	Score tables of a JSON threshold configuration.
+
+	The configuration holds the tables to replace, under the keys of SCORE_TABLES
+	(e.g. {"F2": {"rules": [...], "default": 5}, "IQM": {"max_score": 40}}), the
+	other tables keeping their default rules.
+
+	Returns
+	----------
+	tables : dict
+		Score tables (a copy of SCORE_TABLES with the tables of the configuration)
+	"""
+	with open(path, encoding='utf-8') as f:
+		config = json.load(f)
+	tables = copy.deepcopy(SCORE_TABLES)
+	for key, table in config.items():
+		if key not in tables:
+			raise ValueError(f"Table de score inconnue : '{key}' (tables : {', '.join(tables)})")
+		for rule in table.get('rules', []):
+			for metric, (op, _) in rule['when'].items():
+				if op not in OPERATORS:
+					raise ValueError(f"Opérateur inconnu '{op}' pour '{metric}' dans la table '{key}'")
+		tables[key] = table
+	return tables
+
+
+def save_tables(path, tables=SCORE_TABLES):
+	# Writes score tables as a JSON threshold configuration (e.g. the default tables, to be edited)
+	with open(path, 'w', encoding='utf-8') as f:
+		json.dump(tables, f, indent='\t')
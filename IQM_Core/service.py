@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Local compute service keeping the prepared data of F2, F3 and F5 between runs.
+
+	python -m IQM_Core.service [--port 6543] [--max-entries 8]
+	python -m IQM_Core.service --stop
+
+When the same basin is computed many times (calibration of target_pts, step_min,
+...), most of the time of F2, F3 and F5 goes to rebuilding the obstacles (or
+riparian strip) and the PtRef widths. The service is a long-lived process
+holding these prepared structures (IQM_Core.compute) in memory, keyed by a
+fingerprint of the content of the inputs (IQM_Core.fingerprints) and of the
+options they depend on. The Processing algorithms connect to it over a local
+socket (with the key of the file ~/.iqm_service_key, written by the service) :
+the payload is only built and sent when the service does not hold it yet, then
+the segments are sent by chunks and evaluated by the service.
+"""
+
+
+import os
+import sys
+import json
+import secrets
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing import connection
+
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+from IQM_Core import compute, instrumentation, transport
+
+# Local address of the service (port overridden by the IQM_SERVICE_PORT environment variable)
+HOST = 'localhost'
+PORT = int(os.environ.get('IQM_SERVICE_PORT', 6543))
+# File of the authentication key shared by the service and its clients
+KEY_FILE = Path.home() / '.iqm_service_key'
+# Number of prepared payloads kept in memory (the least recently used is dropped)
+MAX_ENTRIES = 8
+# Number of segments sent at once to the service
+CHUNK_SIZE = 256
+
+
+def read_key(create=False):
+	# Authentication key of the service, created (readable by the user only) by the service
+	if create and not KEY_FILE.exists():
+		KEY_FILE.write_text(secrets.token_hex(32), encoding='utf-8')
+		os.chmod(KEY_FILE, 0o600)
+	return KEY_FILE.read_text(encoding='utf-8').strip().encode('ascii')
+
+
+def fingerprint(index, layers, options):
+	"""
+	Key of the prepared data of an index.
+
+	Parameters
+	----------
+	index : str
+		Index name ('F2', 'F3' or 'F5')
+	layers : list
+		Input layers the prepared data are built from
+	options : list
+		Plain values the prepared data depend on (fields, options)
+
+	Returns
+	----------
+	key : str
+		SHA-1 of the index, of the content of the layers (IQM_Core.fingerprints) and of the options
+	"""
+	# Imported here, the service process itself does not load QGIS
+	from IQM_Core import fingerprints
+	content = json.dumps([index, [fingerprints.layer_fingerprint(layer) for layer in layers], options], sort_keys=True, default=str)
+	return fingerprints.digest(content.encode('utf-8'))
+
+
+# ------------------------------------------------------------------------------
+# Service
+# ------------------------------------------------------------------------------
+
+class Service:
+	"""
+	Prepared states of the compute kernels, keyed by fingerprint (least recently used first).
+	"""
+	def __init__(self, max_entries=MAX_ENTRIES):
+		self.max_entries = max_entries
+		self.states = OrderedDict()
+
+	def state(self, key):
+		if key not in self.states:
+			raise LookupError(f"Données préparées absentes du service : {key}")
+		self.states.move_to_end(key)
+		return self.states[key]
+
+	def handle(self, request):
+		# Reply to a request {'op': ..., ...} of a client
+		op = request.get('op')
+		if op == 'status':
+			return {'keys': list(self.states)}
+		if op == 'has':
+			return {'cached': request['key'] in self.states}
+		if op == 'load':
+			self.states[request['key']] = compute.worker_init(request['payload'])
+			self.states.move_to_end(request['key'])
+			while len(self.states) > self.max_entries:
+				self.states.popitem(last=False)
+			return {}
+		if op == 'evaluate':
+			# Options of the run (target_pts, step_min) over the prepared state
+			state = dict(self.state(request['key']), **request['params'])
+			ids = transport.unpack_keys(request['segment_ids'])
+			# The geometry operations are counted for the clients counting theirs, and sent back with the results
+			instrumentation.enable_geos_counts(bool(state.get('geos_counts')))
+			results = compute.evaluate_chunk(state, request['segments'], ids, 0, len(ids))
+			return {'results': results, 'geos_counts': instrumentation.take_geos_counts()}
+		if op == 'clear':
+			self.states.clear()
+			return {}
+		raise ValueError(f"Requête inconnue : {op}")
+
+
+def serve(port=PORT, max_entries=MAX_ENTRIES):
+	"""
+	Runs the service until a 'shutdown' request. The clients are served one at a time.
+	"""
+	if not compute.HAS_SHAPELY:
+		raise RuntimeError("Le service de calcul nécessite Shapely (version 2 ou plus).")
+	service = Service(max_entries)
+	with connection.Listener((HOST, port), authkey=read_key(create=True)) as listener:
+		print(f"Service de calcul IQM à l'écoute sur {HOST}:{port}")
+		while True:
+			try:
+				conn = listener.accept()
+			except (OSError, connection.AuthenticationError) as e:
+				print(f"Connexion refusée : {e}")
+				continue
+			with conn:
+				while True:
+					try:
+						request = conn.recv()
+					except EOFError:
+						break
+					if request.get('op') == 'shutdown':
+						conn.send({'ok': True})
+						return
+					try:
+						reply = service.handle(request)
+						reply['ok'] = True
+					except Exception as e:
+						reply = {'ok': False, 'error': f"{type(e).__name__} : {e}"}
+					conn.send(reply)
+
+
+# ------------------------------------------------------------------------------
+# Client
+# ------------------------------------------------------------------------------
+
+class Client:
+	"""
+	Connection of a Processing algorithm to the service.
+	"""
+	def __init__(self, port=PORT):
+		self.conn = connection.Client((HOST, port), authkey=read_key())
+
+	def request(self, op, **kwargs):
+		self.conn.send(dict(kwargs, op=op))
+		reply = self.conn.recv()
+		if not reply.pop('ok'):
+			raise RuntimeError(reply['error'])
+		return reply
+
+	def close(self):
+		self.conn.close()
+
+	def evaluate_segments(self, key, build_payload, params, layer, seg_id_field, chunk_size=CHUNK_SIZE, feedback=None, costs=None):
+		"""
+		Evaluates every segment of the layer in the service.
+
+		Parameters
+		----------
+		key : str
+			Fingerprint of the prepared data (see fingerprint)
+		build_payload : callable
+			Builds the payload of IQM_Core.compute.worker_init (None if canceled), called only if the service does not hold it
+		params : dict
+			Options of the run applied over the prepared data (target_pts, step_min)
+		layer : QgsVectorLayer
+			River network layer
+		seg_id_field : str
+			Name of the segment identifier field
+		costs : IQM_Core.instrumentation.CostRecorder
+			Recorder of the cost of each segment, measured in the service (None : costs not recorded)
+
+		Returns
+		----------
+		results : dict
+			{sid: values} in the order of the layer (None if canceled)
+		"""
+		if costs is not None:
+			params = dict(params, instrument=True)
+		if instrumentation.geos_counting():
+			params = dict(params, geos_counts=True)
+		if self.request('has', key=key)['cached']:
+			if feedback is not None:
+				feedback.pushInfo("Données préparées reprises du service de calcul")
+		else:
+			payload = build_payload()
+			if payload is None:
+				return None
+			self.request('load', key=key, payload=payload)
+		features = [[segment[seg_id_field], segment.geometry()] for segment in layer.getFeatures()]
+		total = len(features)
+		results = {}
+		for start in range(0, total, chunk_size):
+			if feedback is not None and feedback.isCanceled():
+				return None
+			chunk = features[start:start + chunk_size]
+			reply = self.request(
+				'evaluate', key=key, params=params,
+				segment_ids=transport.pack_keys([sid for sid, _ in chunk]),
+				segments=transport.pack_geometries([geom for _, geom in chunk])
+			)
+			for sid, values, messages, *cost in reply['results']:
+				results[sid] = values
+				if cost and costs is not None:
+					costs.add(sid, cost[0])
+				if feedback is not None:
+					for message in messages:
+						feedback.pushInfo(message)
+			instrumentation.merge_geos_counts(reply.get('geos_counts'))
+			if feedback is not None:
+				feedback.setProgress(int(100 * min(total, start + chunk_size) / max(1, total)))
+		return results
+
+
+def connect(feedback=None, port=PORT):
+	"""
+	Client of the service, or None (with a warning) if the service cannot be reached.
+	"""
+	try:
+		client = Client(port)
+		client.request('status')
+		return client
+	except (OSError, EOFError, connection.AuthenticationError, RuntimeError) as e:
+		if feedback is not None:
+			feedback.pushWarning(f"Service de calcul injoignable ({e}), calcul dans le processus courant.")
+		return None
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Service de calcul local conservant les données préparées de F2, F3 et F5 entre les exécutions.")
+	parser.add_argument('--port', type=int, default=PORT, help="Port local du service")
+	parser.add_argument('--max-entries', type=int, default=MAX_ENTRIES, help="Nombre de jeux de données préparées conservés en mémoire")
+	parser.add_argument('--stop', action='store_true', help="Arrête le service en cours")
+	args = parser.parse_args(argv)
+
+	if args.stop:
+		client = Client(args.port)
+		client.request('shutdown')
+		client.close()
+		print("Service de calcul arrêté")
+		return 0
+	serve(args.port, args.max_entries)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
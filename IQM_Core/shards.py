@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Job queue of basin shards in a shared folder, for runs of Calcul IQM over several computers.
+
+	python -m IQM_Core.shards emit config.json queue_dir
+	python -m IQM_Core.shards work queue_dir [--heartbeat 30] [--stale 600]
+	python -m IQM_Core.shards requeue queue_dir [--stale 600]
+	python -m IQM_Core.shards collect queue_dir
+
+The configuration is the one of IQM_Core.batch. "emit" writes a JSON manifest
+per basin (inputs, parameters, output) in queue_dir/pending. Each "work" command
+(any number, on any computer mounting the folder) claims the shards one at a
+time by renaming them to queue_dir/running (the rename is atomic, so a shard is
+claimed by a single worker, under a name of its own), runs them and moves them to queue_dir/done or
+queue_dir/failed with their status. While a shard runs, its heartbeat file is
+touched regularly; the shards whose heartbeat is older than --stale seconds
+(worker stopped or computer lost) are put back in pending by "requeue" and by
+the workers themselves. "collect" merges the outputs of the done shards and
+writes the status file, as IQM_Core.batch does.
+"""
+
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from pathlib import Path
+
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+from IQM_Core import batch
+
+# States of the shards (one folder per state)
+STATES = ['pending', 'running', 'done', 'failed']
+# Seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 30
+# Seconds without heartbeat after which a running shard is abandoned
+STALE_TIMEOUT = 600
+
+
+def shard_name(basin_id):
+	# File name of a shard, from its basin identifier
+	return re.sub(r'[^\w.-]', '_', str(basin_id))
+
+
+def queue_folders(queue_dir):
+	folders = {state: os.path.join(queue_dir, state) for state in STATES}
+	for folder in folders.values():
+		os.makedirs(folder, exist_ok=True)
+	return folders
+
+
+def write_json(path, data):
+	# Written to a temporary file then renamed, so that readers never see a partial file
+	tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+	with open(tmp_path, 'w', encoding='utf-8') as f:
+		json.dump(data, f, indent=1)
+	os.replace(tmp_path, path)
+
+
+def read_json(path):
+	with open(path, 'r', encoding='utf-8') as f:
+		return json.load(f)
+
+
+def emit_shards(config, queue_dir):
+	"""
+	Writes the manifest of every basin of a configuration in the pending shards of a queue.
+
+	Parameters
+	----------
+	config : dict
+		Configuration of IQM_Core.batch (the paths must be reachable from all the workers)
+	queue_dir : str
+		Shared folder of the queue
+
+	Returns
+	----------
+	names : list of str
+		Names of the emitted shards, in the order of the basins
+	"""
+	config = dict(config)
+	config.setdefault('work_dir', str(Path(config['output']).with_suffix('')) + '_bassins')
+	folders = queue_folders(queue_dir)
+	# The basin list needs QGIS only with a basin layer
+	qgs = None
+	if 'bundles' not in config:
+		qgs = batch.start_qgis(config.get('qgis_prefix'), config.get('plugins'))
+	tasks = batch.basin_tasks(config)
+	# Configuration shared by the shards, the bundles being in their own manifest
+	shared = {key: value for key, value in config.items() if key != 'bundles'}
+	write_json(os.path.join(queue_dir, 'config.json'), shared)
+	names = []
+	for order, (basin_id, bundle) in enumerate(tasks):
+		name = shard_name(basin_id)
+		write_json(os.path.join(folders['pending'], f"{name}.json"), {
+			'id': basin_id,
+			'order': order,
+			'bundle': bundle,
+			'output': attempt_output(os.path.join(config['work_dir'], str(basin_id), 'iqm.gpkg'), 0),
+			'attempts': 0
+		})
+		names.append(name)
+	if qgs is not None:
+		qgs.exitQgis()
+	return names
+
+
+def claim_shard(folders, worker_id):
+	"""
+	Claims a pending shard (atomic rename to running/<name>.<worker>.json), or returns None if none is left.
+	"""
+	for file_name in sorted(os.listdir(folders['pending'])):
+		if not file_name.endswith('.json'):
+			continue
+		# Running under a name of the worker : once requeued, the shard claimed again by another worker is not its own
+		running_path = os.path.join(folders['running'], f"{file_name[:-len('.json')]}.{worker_tag(worker_id)}.json")
+		try:
+			os.rename(os.path.join(folders['pending'], file_name), running_path)
+		except OSError:
+			# Claimed by another worker in the meantime
+			continue
+		heartbeat_path = heartbeat_of(running_path)
+		write_json(heartbeat_path, {'worker': worker_id, 'start': time.time()})
+		return running_path
+	return None
+
+
+def heartbeat_of(shard_path):
+	return shard_path[:-len('.json')] + '.heartbeat'
+
+
+def worker_tag(worker_id):
+	# Part of the file name of a running shard identifying its worker (no dot, see running_name)
+	return re.sub(r'[^\w-]', '_', str(worker_id))
+
+
+def running_name(file_name):
+	# Name of a shard (<name>.json) from the file name of its running manifest (<name>.<worker>.json)
+	return file_name[:-len('.json')].rsplit('.', 1)[0] + '.json'
+
+
+def attempt_output(output, attempts):
+	# Output path of an attempt of a shard (iqm_<attempts>.gpkg in the folder of the basin)
+	return os.path.join(os.path.dirname(output), f"iqm_{attempts}.gpkg")
+
+
+def requeue_stale(queue_dir, stale=STALE_TIMEOUT):
+	"""
+	Puts back in pending the running shards whose heartbeat is older than stale seconds.
+
+	Returns
+	----------
+	names : list of str
+		Names of the requeued shards
+	"""
+	folders = queue_folders(queue_dir)
+	now = time.time()
+	names = []
+	for file_name in sorted(os.listdir(folders['running'])):
+		if not file_name.endswith('.json'):
+			continue
+		shard_path = os.path.join(folders['running'], file_name)
+		heartbeat_path = heartbeat_of(shard_path)
+		try:
+			last_beat = os.path.getmtime(heartbeat_path if os.path.exists(heartbeat_path) else shard_path)
+		except OSError:
+			continue
+		if now - last_beat < stale:
+			continue
+		# Taken out of running first (the rename is atomic, so a single process requeues the shard or moves
+		# it to done), and updated in pending under a name the workers do not claim
+		pending_name = running_name(file_name)
+		requeued_path = os.path.join(folders['pending'], f"{pending_name}.requeued")
+		try:
+			os.rename(shard_path, requeued_path)
+		except OSError:
+			# Finished or requeued by another process in the meantime
+			continue
+		if os.path.exists(heartbeat_path):
+			os.remove(heartbeat_path)
+		shard = read_json(requeued_path)
+		shard['attempts'] = shard.get('attempts', 0) + 1
+		# Output of its own, the abandoned worker may still be writing the previous one
+		shard['output'] = attempt_output(shard['output'], shard['attempts'])
+		write_json(requeued_path, shard)
+		os.rename(requeued_path, os.path.join(folders['pending'], pending_name))
+		names.append(pending_name[:-len('.json')])
+	return names
+
+
+class Heartbeat(threading.Thread):
+	"""
+	Touches the heartbeat file of a running shard until stopped.
+	"""
+	def __init__(self, path, interval=HEARTBEAT_INTERVAL):
+		super().__init__(daemon=True)
+		self.path = path
+		self.interval = interval
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			try:
+				os.utime(self.path)
+			except OSError:
+				# Shard requeued by another process
+				return
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+
+def work(queue_dir, heartbeat=HEARTBEAT_INTERVAL, stale=STALE_TIMEOUT, max_shards=None):
+	"""
+	Claims and runs shards until the queue is empty (pending and running shards all finished).
+
+	Returns
+	----------
+	count : int
+		Number of shards run by this worker
+	"""
+	folders = queue_folders(queue_dir)
+	worker_id = f"{socket.gethostname()}:{os.getpid()}"
+	config = read_json(os.path.join(queue_dir, 'config.json'))
+	batch.init_worker(config)
+	count = 0
+	while max_shards is None or count < max_shards:
+		shard_path = claim_shard(folders, worker_id)
+		if shard_path is None:
+			# Shards abandoned by other workers are taken back, otherwise wait for the running ones
+			if requeue_stale(queue_dir, stale):
+				continue
+			if not any(name.endswith('.json') for name in os.listdir(folders['running'])):
+				break
+			time.sleep(heartbeat)
+			continue
+		shard = read_json(shard_path)
+		print(f"{worker_id} : bassin {shard['id']} (essai {shard.get('attempts', 0) + 1})")
+		beat = Heartbeat(heartbeat_of(shard_path), heartbeat)
+		beat.start()
+		status = batch.run_basin([shard['id'], shard['bundle'], shard['output']])
+		beat.stop()
+		shard['status'] = dict(status, worker=worker_id)
+		state = 'done' if status['status'] == 'ok' else 'failed'
+		# Taken out of running first (atomic rename of the manifest of this worker) : if it fails, the shard was requeued
+		finished_path = shard_path[:-len('.json')] + '.finished'
+		try:
+			os.rename(shard_path, finished_path)
+		except OSError:
+			print(f"{worker_id} : bassin {shard['id']} remis en file par un autre processus, résultat ignoré", file=sys.stderr)
+			continue
+		if os.path.exists(heartbeat_of(shard_path)):
+			os.remove(heartbeat_of(shard_path))
+		write_json(finished_path, shard)
+		os.rename(finished_path, os.path.join(folders[state], running_name(os.path.basename(shard_path))))
+		print(f"{worker_id} : bassin {shard['id']} : {status['status']} ({status['seconds']} s)")
+		count += 1
+	batch._worker['qgs'].exitQgis()
+	return count
+
+
+def collect(queue_dir):
+	"""
+	Merges the outputs of the done shards and writes the status file of all the shards.
+
+	Returns
+	----------
+	statuses : list of dict
+		Status of each basin, in the order of the basins
+	"""
+	folders = queue_folders(queue_dir)
+	config = read_json(os.path.join(queue_dir, 'config.json'))
+	shards = []
+	for state in STATES:
+		for file_name in os.listdir(folders[state]):
+			if file_name.endswith('.json'):
+				shard = read_json(os.path.join(folders[state], file_name))
+				status = shard.get('status') or {'id': shard['id'], 'status': state, 'output': '', 'seconds': '', 'messages': ''}
+				status = {key: status.get(key, '') for key in ['id', 'status', 'output', 'seconds', 'messages']}
+				shards.append([shard['order'], status])
+	statuses = [status for _, status in sorted(shards, key=lambda shard: shard[0])]
+	qgs = batch.start_qgis(config.get('qgis_prefix'), config.get('plugins'))
+	batch.merge_outputs(statuses, config['output'])
+	batch.write_status(statuses, str(Path(config['output']).with_suffix('')) + '_status.csv')
+	qgs.exitQgis()
+	return statuses
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="File de tâches (un fichier par bassin) de Calcul IQM dans un dossier partagé.")
+	commands = parser.add_subparsers(dest='command', required=True)
+	emit_parser = commands.add_parser('emit', help="Écrit les tâches des bassins d'une configuration")
+	emit_parser.add_argument('config', help="Fichier de configuration JSON (voir IQM_Core.batch)")
+	emit_parser.add_argument('queue_dir', help="Dossier partagé de la file")
+	work_parser = commands.add_parser('work', help="Exécute les tâches en attente")
+	work_parser.add_argument('queue_dir', help="Dossier partagé de la file")
+	work_parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, help="Secondes entre deux signaux de vie")
+	work_parser.add_argument('--stale', type=float, default=STALE_TIMEOUT, help="Secondes sans signal de vie avant de remettre une tâche en file")
+	work_parser.add_argument('--max-shards', type=int, default=None, help="Nombre maximal de tâches à exécuter")
+	requeue_parser = commands.add_parser('requeue', help="Remet en file les tâches abandonnées")
+	requeue_parser.add_argument('queue_dir', help="Dossier partagé de la file")
+	requeue_parser.add_argument('--stale', type=float, default=STALE_TIMEOUT, help="Secondes sans signal de vie avant de remettre une tâche en file")
+	collect_parser = commands.add_parser('collect', help="Fusionne les sorties des tâches terminées")
+	collect_parser.add_argument('queue_dir', help="Dossier partagé de la file")
+	args = parser.parse_args(argv)
+
+	if args.command == 'emit':
+		with open(args.config, 'r', encoding='utf-8') as f:
+			config = json.load(f)
+		names = emit_shards(config, args.queue_dir)
+		print(f"{len(names)} tâches écrites dans {args.queue_dir}")
+	elif args.command == 'work':
+		count = work(args.queue_dir, args.heartbeat, args.stale, args.max_shards)
+		print(f"{count} tâches exécutées")
+	elif args.command == 'requeue':
+		names = requeue_stale(args.queue_dir, args.stale)
+		print(f"{len(names)} tâches remises en file")
+	else:
+		statuses = collect(args.queue_dir)
+		n_errors = sum(status['status'] != 'ok' for status in statuses)
+		print(f"{len(statuses) - n_errors} bassins calculés, {n_errors} en erreur ou non terminés")
+		return 1 if n_errors else 0
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
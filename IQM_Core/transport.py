@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Compact transport of geometries and per-segment arrays to worker processes.
+
+Geometries are packed as flat coordinate arrays with offset arrays (CSR
+layout) : the coordinates of the rings, the rings of the parts and the parts of
+the geometries, with their type and bounding box. Groups of rows per segment
+(e.g. the PtRef widths) are packed the same way with their keys. The NumPy
+arrays of a payload are then placed in one multiprocessing.shared_memory block
+that the workers view without copy, and a geometry is rebuilt as a QgsGeometry
+(or as NumPy arrays for IQM_Core.compute) only when a worker needs it. QGIS
+is only imported by the functions that read or build a QgsGeometry, so that
+the workers of the NumPy kernels do not load it.
+"""
+
+
+import sys
+import numpy as np
+from multiprocessing import shared_memory
+
+# Alignment (bytes) of the arrays in a shared block
+ALIGNMENT = 64
+
+
+def pack_geometries(geoms):
+	"""
+	Packs line or polygon geometries as CSR coordinate arrays.
+
+	Parameters
+	----------
+	geoms : list of QgsGeometry
+		Line or polygon geometries (single or multipart, curves are segmentized)
+
+	Returns
+	----------
+	packed : dict
+		'coords' : (n_vertices, 2) coordinates, 'ring_offsets' : first vertex of each ring,
+		'part_offsets' : first ring of each part, 'geom_offsets' : first part of each geometry,
+		'kinds' : geometry type (QgsWkbTypes.LineGeometry or PolygonGeometry, -1 if empty),
+		'multi' : multipart flags, 'bounds' : (n, 4) bounding boxes (nan if empty)
+	"""
+	from qgis.core import QgsWkbTypes
+	coords = []
+	ring_offsets = [0]
+	part_offsets = [0]
+	geom_offsets = [0]
+	kinds = []
+	multi = []
+	bounds = []
+	n_vertices = 0
+	for geom in geoms:
+		if geom is None or geom.isNull() or geom.isEmpty():
+			kinds.append(-1)
+			multi.append(False)
+			bounds.append([np.nan] * 4)
+			geom_offsets.append(geom_offsets[-1])
+			continue
+		kind = QgsWkbTypes.geometryType(geom.wkbType())
+		if kind not in (QgsWkbTypes.LineGeometry, QgsWkbTypes.PolygonGeometry):
+			raise ValueError(f"Type de géométrie non pris en charge : {QgsWkbTypes.displayString(geom.wkbType())}")
+		abstract = geom.constGet()
+		if QgsWkbTypes.isCurvedType(geom.wkbType()):
+			abstract = abstract.segmentize()
+		is_multi = QgsWkbTypes.isMultiType(abstract.wkbType())
+		parts = [abstract.geometryN(i) for i in range(abstract.numGeometries())] if is_multi else [abstract]
+		for part in parts:
+			if kind == QgsWkbTypes.LineGeometry:
+				rings = [part]
+			else:
+				rings = [part.exteriorRing()] + [part.interiorRing(k) for k in range(part.numInteriorRings())]
+			for ring in rings:
+				xy = np.column_stack([np.asarray(ring.xVector(), dtype=float), np.asarray(ring.yVector(), dtype=float)])
+				coords.append(xy)
+				n_vertices += len(xy)
+				ring_offsets.append(n_vertices)
+			part_offsets.append(len(ring_offsets) - 1)
+		geom_offsets.append(len(part_offsets) - 1)
+		kinds.append(int(kind))
+		multi.append(is_multi)
+		box = geom.boundingBox()
+		bounds.append([box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()])
+	return {
+		'coords': np.concatenate(coords) if coords else np.empty((0, 2)),
+		'ring_offsets': np.array(ring_offsets, dtype=np.int64),
+		'part_offsets': np.array(part_offsets, dtype=np.int64),
+		'geom_offsets': np.array(geom_offsets, dtype=np.int64),
+		'kinds': np.array(kinds, dtype=np.int8),
+		'multi': np.array(multi, dtype=bool),
+		'bounds': np.array(bounds, dtype=float).reshape(-1, 4)
+	}
+
+
+def geometry_count(packed):
+	return len(packed['kinds'])
+
+
+def unpack_geometry(packed, i):
+	"""
+	Rebuilds the i-th geometry of a packed set as a QgsGeometry.
+	"""
+	from qgis.core import QgsGeometry, QgsLineString, QgsPolygon, QgsMultiLineString, QgsMultiPolygon, QgsWkbTypes
+	kind = int(packed['kinds'][i])
+	if kind < 0:
+		return QgsGeometry()
+	coords = packed['coords']
+	ring_offsets = packed['ring_offsets']
+	part_offsets = packed['part_offsets']
+	parts = []
+	for p in range(packed['geom_offsets'][i], packed['geom_offsets'][i + 1]):
+		rings = []
+		for r in range(part_offsets[p], part_offsets[p + 1]):
+			xy = coords[ring_offsets[r]:ring_offsets[r + 1]]
+			rings.append(QgsLineString(xy[:, 0].tolist(), xy[:, 1].tolist()))
+		if kind == QgsWkbTypes.LineGeometry:
+			parts.append(rings[0])
+		else:
+			polygon = QgsPolygon()
+			polygon.setExteriorRing(rings[0])
+			for ring in rings[1:]:
+				polygon.addInteriorRing(ring)
+			parts.append(polygon)
+	if not packed['multi'][i]:
+		return QgsGeometry(parts[0])
+	collection = QgsMultiLineString() if kind == QgsWkbTypes.LineGeometry else QgsMultiPolygon()
+	for part in parts:
+		collection.addGeometry(part)
+	return QgsGeometry(collection)
+
+
+def unpack_parts(packed, i):
+	"""
+	Views the parts of the i-th line of a packed set as (n, 2) coordinate arrays (no copy).
+	"""
+	coords = packed['coords']
+	ring_offsets = packed['ring_offsets']
+	part_offsets = packed['part_offsets']
+	parts = []
+	for p in range(packed['geom_offsets'][i], packed['geom_offsets'][i + 1]):
+		r = part_offsets[p]
+		parts.append(coords[ring_offsets[r]:ring_offsets[r + 1]])
+	return parts
+
+
+def line_parts(geom):
+	"""
+	Parts of a (multi)line QgsGeometry as (n, 2) coordinate arrays (curves are segmentized).
+	"""
+	from qgis.core import QgsWkbTypes
+	if geom is None or geom.isNull() or geom.isEmpty():
+		return []
+	abstract = geom.constGet()
+	if QgsWkbTypes.isCurvedType(geom.wkbType()):
+		abstract = abstract.segmentize()
+	parts = [abstract.geometryN(i) for i in range(abstract.numGeometries())] if QgsWkbTypes.isMultiType(abstract.wkbType()) else [abstract]
+	return [np.column_stack([np.asarray(part.xVector(), dtype=float), np.asarray(part.yVector(), dtype=float)]) for part in parts]
+
+
+def pack_keys(keys):
+	# Keys as a NumPy array (shared) when they have a fixed type, otherwise as a list (pickled)
+	array = np.asarray(list(keys))
+	return list(keys) if array.dtype == object else array
+
+
+def unpack_keys(keys):
+	return keys.tolist() if isinstance(keys, np.ndarray) else list(keys)
+
+
+def pack_groups(groups):
+	"""
+	Packs a dict {key: (n_i, k) array} as CSR arrays : 'keys', 'offsets' and 'values'.
+	"""
+	keys = list(groups)
+	arrays = [np.asarray(groups[key], dtype=float) for key in keys]
+	width = arrays[0].shape[1] if arrays else 0
+	offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum([len(array) for array in arrays])
+	return {
+		'keys': pack_keys(keys),
+		'offsets': offsets,
+		'values': np.concatenate(arrays) if arrays else np.empty((0, width))
+	}
+
+
+def unpack_groups(packed):
+	"""
+	Views the packed groups as a dict {key: (n_i, k) array} (no copy).
+	"""
+	offsets = packed['offsets']
+	values = packed['values']
+	return {key: values[offsets[i]:offsets[i + 1]] for i, key in enumerate(unpack_keys(packed['keys']))}
+
+
+class SharedArray:
+	"""
+	Reference to an array of a shared block (placed in the payload sent to the workers).
+	"""
+	def __init__(self, dtype, shape, offset):
+		self.dtype = dtype
+		self.shape = shape
+		self.offset = offset
+
+
+def _extract(obj, arrays, size):
+	# Replaces the NumPy arrays (of fixed type) of a payload by references to the shared block
+	if isinstance(obj, dict):
+		spec = {}
+		for key, value in obj.items():
+			spec[key], size = _extract(value, arrays, size)
+		return spec, size
+	if isinstance(obj, np.ndarray) and obj.dtype != object:
+		array = np.ascontiguousarray(obj)
+		offset = -(-size // ALIGNMENT) * ALIGNMENT
+		arrays.append([array, offset])
+		return SharedArray(array.dtype.str, array.shape, offset), offset + array.nbytes
+	return obj, size
+
+
+def _resolve(spec, buffer):
+	if isinstance(spec, dict):
+		return {key: _resolve(value, buffer) for key, value in spec.items()}
+	if isinstance(spec, SharedArray):
+		array = np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=buffer, offset=spec.offset)
+		array.flags.writeable = False
+		return array
+	return spec
+
+
+class SharedPayload:
+	"""
+	Payload whose NumPy arrays are copied once in a shared memory block.
+
+	The spec attribute (block name and payload with references to the arrays) is
+	small and is sent to the workers, which view the arrays with attach. The
+	creator releases the block with close.
+	"""
+	def __init__(self, payload):
+		arrays = []
+		spec, size = _extract(payload, arrays, 0)
+		self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+		for array, offset in arrays:
+			np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf, offset=offset)[...] = array
+		self.spec = {'block': self.shm.name, 'payload': spec}
+
+	def close(self):
+		self.shm.close()
+		self.shm.unlink()
+
+
+def attach(spec):
+	"""
+	Views the payload of a shared block in a worker process.
+
+	Returns
+	----------
+	payload : dict
+		Payload with read-only views of the shared arrays
+	shm : SharedMemory
+		Shared block, to keep open as long as the views are used
+	"""
+	if sys.version_info >= (3, 13):
+		# The creator only must release the block
+		shm = shared_memory.SharedMemory(name=spec['block'], track=False)
+	else:
+		shm = shared_memory.SharedMemory(name=spec['block'])
+	return _resolve(spec['payload'], shm.buf), shm
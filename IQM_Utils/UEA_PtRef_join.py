@@ -7,11 +7,16 @@ With QGIS : 33000
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import QgsProcessing
+from qgis.core import QgsFields
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsFeatureRequest
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingAlgorithm
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterFeatureSink
-import processing
 
 
 class Uea_ptref_join(QgsProcessingAlgorithm):
@@ -25,36 +30,63 @@ class Uea_ptref_join(QgsProcessingAlgorithm):
     def processAlgorithm(self, parameters, context, model_feedback):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
         # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
         results = {}
-        outputs = {}
 
-        # Extraire par expression
-        alg_params = {
-            'EXPRESSION': f"array_contains(\n\taggregate(\n\t\t '{parameters['riv_net']}' \n\t\t,\'array_agg\',\n\t\t\"Id_UEA\"\n\t),\n\t\"Id_UEA\"\n) AND Valide_bv",
-            'INPUT': parameters['ptref'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtraireParExpression'] = processing.run('native:extractbyexpression', alg_params, context=context, feedback=None, is_child_algorithm=True)
+        ptref = self.parameterAsVectorLayer(parameters, 'ptref', context)
+        ptref_mod_lotique = self.parameterAsVectorLayer(parameters, 'ptref_mod_lotique', context)
+        riv_net = self.parameterAsVectorLayer(parameters, 'riv_net', context)
+
+        # Hash set of the network UEA and extent of the network (in the PtRef CRS)
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(['Id_UEA'], riv_net.fields())
+        network_ids = {f['Id_UEA'] for f in riv_net.getFeatures(request)}
+        network_extent = riv_net.extent()
+        if riv_net.crs() != ptref.crs():
+            transform = QgsCoordinateTransform(riv_net.crs(), ptref.crs(), context.transformContext())
+            network_extent = transform.transformBoundingBox(network_extent)
+        feedback.pushInfo(self.tr(f"{len(network_ids)} UEA dans le réseau hydrographique"))
 
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # Join attributes by field value
-        alg_params = {
-            'DISCARD_NONMATCHING': True,
-            'FIELD': 'Id_PtRef',
-            'FIELDS_TO_COPY': ['Largeur_mod'],
-            'FIELD_2': 'Id_PtRef',
-            'INPUT': outputs['ExtraireParExpression']['OUTPUT'],
-            'INPUT_2': parameters['ptref_mod_lotique'],
-            'METHOD': 1,  # Prendre uniquement les attributs de la première entité correspondante (un à un)
-            'PREFIX': '',
-            'OUTPUT': parameters['Ptref_largeur']
-        }
-        outputs['JoinAttributesByFieldValue'] = processing.run('native:joinattributestable', alg_params, context=context, feedback=None, is_child_algorithm=True)
-        results['Ptref_largeur'] = outputs['JoinAttributesByFieldValue']['OUTPUT']
+        # Dict Id_PtRef -> Largeur_mod (first matching row, as a one-to-one join)
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(['Id_PtRef', 'Largeur_mod'], ptref_mod_lotique.fields())
+        widths = {}
+        for f in ptref_mod_lotique.getFeatures(request):
+            widths.setdefault(f['Id_PtRef'], f['Largeur_mod'])
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        # Output fields: PtRef fields + Largeur_mod
+        join_fields = QgsFields()
+        join_fields.append(ptref_mod_lotique.fields().field('Largeur_mod'))
+        out_fields = QgsProcessingUtils.combineFields(ptref.fields(), join_fields)
+        (sink, dest_id) = self.parameterAsSink(parameters, 'Ptref_largeur', context, out_fields, ptref.wkbType(), ptref.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, 'Ptref_largeur'))
+
+        # Single streaming pass over PtRef, with the Valide_bv filter and the network bbox pushed to the provider
+        request = QgsFeatureRequest().setFilterRect(network_extent).setFilterExpression('"Valide_bv"')
+        total = ptref.featureCount()
+        for current, f in enumerate(ptref.getFeatures(request)):
+            if feedback.isCanceled():
+                return {}
+            if f['Id_UEA'] not in network_ids:
+                continue
+            if f['Id_PtRef'] not in widths:
+                # Non matching features are discarded
+                continue
+            width = widths[f['Id_PtRef']]
+            f.setFields(out_fields, False)
+            f.setAttributes(f.attributes() + [width])
+            sink.addFeature(f, QgsFeatureSink.FastInsert)
+            if total:
+                feedback.setProgress(int(100 * (current / total)))
+
+        results['Ptref_largeur'] = dest_id
         return results
 
     def name(self):
@@ -0,0 +1,299 @@
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (
+	QgsProcessing,
+	QgsGeometry,
+	QgsUnitTypes,
+	QgsFeatureSink,
+	QgsFeatureRequest,
+	QgsMemoryProviderUtils,
+	QgsProcessingException,
+	QgsProcessingAlgorithm,
+	QgsProcessingMultiStepFeedback,
+	QgsProcessingParameterNumber,
+	QgsProcessingParameterString,
+	QgsProcessingParameterVectorLayer,
+	QgsProcessingParameterFeatureSink
+)
+
+
+class CorridorPrefilter(QgsProcessingAlgorithm):
+	DEFAULT_SEG_ID_FIELD = 'Id_UEA'
+	DEFAULT_WIDTH_FIELD = 'Largeur_mod'
+	ROADS_OUTPUT = 'roads_corridor'
+	BANDE_OUTPUT = 'bande_riv_corridor'
+
+	def initAlgorithm(self, config=None):
+		self.addParameter(QgsProcessingParameterVectorLayer('rivnet', self.tr('Réseau hydrographique (CRHQ)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None))
+		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
+		self.addParameter(QgsProcessingParameterVectorLayer('ptref_widths', self.tr('PtRef largeur (CRHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterString('ptref_width_field', self.tr('Nom du champ de largeur dans PtRef'), defaultValue=self.DEFAULT_WIDTH_FIELD))
+		self.addParameter(QgsProcessingParameterVectorLayer('roads', self.tr('Réseau routier (OSM)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterVectorLayer('bande_riv', self.tr('Bande riveraine (peuplement forestier; MELCCFP)'), types=[QgsProcessing.TypeVectorPolygon], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('distance', self.tr('Portée des transects au-delà du lit mineur (m)'), type=QgsProcessingParameterNumber.Double, defaultValue=50, minValue=0))
+		self.addParameter(QgsProcessingParameterFeatureSink(self.ROADS_OUTPUT, self.tr('Réseau routier dans le corridor'), type=QgsProcessing.TypeVectorLine, optional=True, createByDefault=False, defaultValue=None))
+		self.addParameter(QgsProcessingParameterFeatureSink(self.BANDE_OUTPUT, self.tr('Bande riveraine dans le corridor'), type=QgsProcessing.TypeVectorPolygon, optional=True, createByDefault=False, defaultValue=None))
+
+
+	def checkParameterValues(self, parameters, context):
+		# Check if the parameters are given properly
+		rivnet_layer = self.parameterAsVectorLayer(parameters, 'rivnet', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
+		width_field = self.parameterAsString(parameters, 'ptref_width_field', context)
+		if seg_id_field not in [f.name() for f in rivnet_layer.fields()]:
+			return False, self.tr(f"Le champ '{seg_id_field}' est absent de la couche du réseau hydro ! Veuillez fournir un champ identifiant du segment commun aux deux couches (res. hydro. et PtRef largeur).")
+		if ptref_layer is not None:
+			if seg_id_field not in [f.name() for f in ptref_layer.fields()]:
+				return False, self.tr(f"Le champ '{seg_id_field}' est absent de la couche PtRef largeur! Veuillez fournir un champ identifiant du segment commun aux deux couches (res. hydro. et PtRef largeur).")
+			if width_field not in [f.name() for f in ptref_layer.fields()]:
+				return False, self.tr(f"Le champ '{width_field}' est absent de la couche PtRef largeur! Veuillez fournir un champ identifiant la largeur du segment qui se trouve dans cette couche.")
+		if not is_metric_crs(rivnet_layer.crs()) :
+			return False, self.tr(f"La couche de réseau hydro n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
+		for name, key in [["réseau routier", 'roads'], ["bande riveraine", 'bande_riv']]:
+			layer = self.parameterAsVectorLayer(parameters, key, context)
+			if layer is not None and layer.crs() != rivnet_layer.crs():
+				return False, self.tr(f"La couche de {name} n'est pas dans le même CRS que le réseau hydro! Veuillez reprojeter la couche dans un CRS valide.")
+		return True, ''
+
+
+	def processAlgorithm(self, parameters, context, model_feedback):
+		# Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the overall progress through the model
+		feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
+		results = {}
+		rivnet_layer = self.parameterAsVectorLayer(parameters, 'rivnet', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		roads_layer = self.parameterAsVectorLayer(parameters, 'roads', context)
+		bande_layer = self.parameterAsVectorLayer(parameters, 'bande_riv', context)
+		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
+		width_field = self.parameterAsString(parameters, 'ptref_width_field', context)
+		distance = self.parameterAsDouble(parameters, 'distance', context)
+
+		# Buffered and dissolved network corridor, built only once for every filtered layer
+		feedback.setProgressText(self.tr("Création du corridor du réseau hydrographique..."))
+		try :
+			corridor = build_network_corridor(rivnet_layer, seg_id_field, ptref_layer, width_field, distance)
+		except Exception as e :
+			feedback.reportError(self.tr(f"Erreur dans la création du corridor : {str(e)}"))
+			return {}
+		feedback.setCurrentStep(1)
+		if feedback.isCanceled():
+			return {}
+
+		# Filter each given layer. Roads are later buffered by their half right-of-way, so their corridor is widened by the largest one
+		for step, (layer, key, extra_field) in enumerate([[roads_layer, self.ROADS_OUTPUT, 'demi_emp'], [bande_layer, self.BANDE_OUTPUT, None]], start=2):
+			if layer is None or parameters.get(key) is None:
+				feedback.setCurrentStep(step)
+				continue
+			feedback.setProgressText(self.tr(f"Sélection des entités de {layer.name()} dans le corridor..."))
+			(sink, dest_id) = self.parameterAsSink(parameters, key, context, layer.fields(), layer.wkbType(), layer.sourceCrs())
+			if sink is None:
+				raise QgsProcessingException(self.invalidSinkError(parameters, key))
+			extra = corridor_extra(layer, extra_field)
+			try :
+				kept = 0
+				for feat in features_in_corridor(layer, corridor, extra, feedback):
+					sink.addFeature(feat, QgsFeatureSink.FastInsert)
+					kept += 1
+				feedback.pushInfo(self.tr(f"{kept} entités sur {layer.featureCount()} conservées pour {layer.name()}"))
+			except Exception as e :
+				feedback.reportError(self.tr(f"Erreur dans la sélection des entités du corridor : {str(e)}"))
+				return {}
+			results[key] = dest_id
+			feedback.setCurrentStep(step)
+			if feedback.isCanceled():
+				return {}
+
+		# Ending message
+		feedback.setProgressText(self.tr('\tProcessus terminé !'))
+
+		return results
+
+	def name(self):
+		return 'corridorprefilter'
+
+	def displayName(self):
+		return self.tr('Préfiltrage par corridor')
+
+	def group(self):
+		return self.tr('IQM utils')
+
+	def groupId(self):
+		return 'iqmutils'
+
+	def shortHelpString(self):
+		return self.tr(
+			"Conserve seulement les routes et les polygones de bande riveraine qui se trouvent dans le corridor du réseau hydrographique, avant leur fusion (dissolve), simplification et tampon dans les indices F2, F3 et F5.\n Le corridor correspond à la demi-largeur maximale du lit mineur de chaque segment additionnée de la portée des transects et d'une marge de 2 m. Les routes sont sélectionnées avec un corridor élargi de leur demi-emprise maximale.\n" \
+			"Paramètres\n" \
+			"----------\n" \
+			"Réseau hydrographique : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MELCCFP. Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
+			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière. Source des données : Couche réseau hydrographique.\n" \
+			"PtRef largeur : Vectoriel (points)(optionnel)\n" \
+			"-> Points de référence rapportant la largeur modélisée du segment (couche sortante du script UEA_PtRef_join). Une largeur de 2 m est utilisée pour les segments sans PtRef.\n" \
+			" Champ PtRef largeur : Chaine de caractère ('Largeur_mod' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant la largeur du chenal. Source des données : Couche PtRef largeur.\n" \
+			"Réseau routier : Vectoriel (lignes)(optionnel)\n" \
+			"-> Réseau routier ayant passé par un des scripts d'extraction des routes (IQM utils).\n" \
+			"Bande riveraine : Vectoriel (polygones)(optionnel)\n" \
+			"-> Données vectorielles surfacique des peuplements écoforestiers pour le bassin versant donné.\n" \
+			"Portée des transects au-delà du lit mineur (m) : double (50 m par défaut)\n" \
+			"-> Distance maximale évaluée à partir de la rive (50 m pour F2, 15 m pour F3 et 31 m pour F5).\n" \
+			"Retourne\n" \
+			"----------\n" \
+			"Réseau routier dans le corridor : Vectoriel (lignes)\n" \
+			"-> Routes qui intersectent le corridor du réseau.\n" \
+			"Bande riveraine dans le corridor : Vectoriel (polygones)\n" \
+			"-> Polygones de bande riveraine qui intersectent le corridor du réseau."
+		)
+
+	def tr(self, string):
+		return QCoreApplication.translate('Processing', string)
+
+	def createInstance(self):
+		return CorridorPrefilter()
+
+
+def is_metric_crs(crs):
+	# True if the distance unit of the CRS is the meter
+	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
+
+
+def build_network_corridor(rivnet_layer, seg_id_field, ptref_layer, width_field, distance, margin=2.0, default_width=2.0):
+	"""
+	Buffered and dissolved corridor of the river network.
+
+	Each segment is buffered by half of its maximal PtRef width plus the transect
+	reach and a margin (same radius as the local clipping of F3 and F5), then all
+	the buffers are dissolved into a single geometry.
+
+	Parameters
+	----------
+	rivnet_layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	ptref_layer : QgsVectorLayer
+		PtRef width layer (can be None)
+	width_field : str
+		Name of the width field of the PtRef layer
+	distance : float
+		Reach of the transects from the channel bank (m)
+
+	Returns
+	----------
+	corridor : QgsGeometry
+		Dissolved corridor of the network
+	"""
+	max_widths = {}
+	if ptref_layer is not None:
+		request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([seg_id_field, width_field], ptref_layer.fields())
+		for pf in ptref_layer.getFeatures(request):
+			try:
+				w = float(pf[width_field])
+			except (TypeError, ValueError):
+				continue
+			sid = pf[seg_id_field]
+			if w > max_widths.get(sid, 0.0):
+				max_widths[sid] = w
+	buffers = []
+	for seg in rivnet_layer.getFeatures():
+		g = seg.geometry()
+		if not g or g.isEmpty():
+			continue
+		radius = max_widths.get(seg[seg_id_field], default_width) / 2.0 + distance + margin
+		buffers.append(g.buffer(radius, 5))
+	return QgsGeometry.unaryUnion(buffers) if buffers else QgsGeometry()
+
+
+def corridor_extra(layer, extra_field):
+	# Largest value of extra_field in layer (0 if the field is absent)
+	if extra_field and extra_field in [f.name() for f in layer.fields()]:
+		return float(layer.maximumValue(layer.fields().indexOf(extra_field)) or 0.0)
+	return 0.0
+
+
+def prefilter_layers(rivnet_layer, seg_id_field, ptref_layer, width_field, distance, roads_layer=None, bande_layer=None, feedback=None):
+	"""
+	In-memory version of the algorithm, for the scripts calling it directly.
+
+	Parameters
+	----------
+	rivnet_layer : QgsVectorLayer
+		River network layer
+	seg_id_field : str
+		Name of the segment identifier field
+	ptref_layer : QgsVectorLayer
+		PtRef width layer (can be None)
+	width_field : str
+		Name of the width field of the PtRef layer
+	distance : float
+		Reach of the transects from the channel bank (m)
+	roads_layer, bande_layer : QgsVectorLayer
+		Layers to filter (can be None)
+
+	Returns
+	----------
+	roads_corridor, bande_corridor : QgsVectorLayer
+		Memory layers of the features within the corridor (None for a layer not given)
+	"""
+	corridor = build_network_corridor(rivnet_layer, seg_id_field, ptref_layer, width_field, distance)
+	filtered = []
+	for layer, extra_field in [[roads_layer, 'demi_emp'], [bande_layer, None]]:
+		if layer is None:
+			filtered.append(None)
+			continue
+		out = QgsMemoryProviderUtils.createMemoryLayer(f"{layer.name()}_corridor", layer.fields(), layer.wkbType(), layer.crs())
+		out.dataProvider().addFeatures(list(features_in_corridor(layer, corridor, corridor_extra(layer, extra_field), feedback)))
+		filtered.append(out)
+	return filtered[0], filtered[1]
+
+
+def features_in_corridor(layer, corridor, extra=0.0, feedback=None):
+	"""
+	Yields the features of layer that intersect the corridor (widened by extra meters).
+	Candidates are first requested by the bounding box of each corridor part,
+	then checked with a prepared geometry of that part.
+	"""
+	if corridor is None or corridor.isEmpty():
+		return
+	if extra > 0:
+		corridor = corridor.buffer(extra, 5)
+	seen = set()
+	for part in corridor.asGeometryCollection():
+		if feedback is not None and feedback.isCanceled():
+			return
+		engine = QgsGeometry.createGeometryEngine(part.constGet())
+		engine.prepareGeometry()
+		request = QgsFeatureRequest().setFilterRect(part.boundingBox())
+		for feat in layer.getFeatures(request):
+			if feat.id() in seen:
+				continue
+			g = feat.geometry()
+			if g and not g.isEmpty() and engine.intersects(g.constGet()):
+				seen.add(feat.id())
+				yield feat
@@ -451,4 +451,27 @@ def reduce_landuse(parameters, context, feedback):
 		'TABLE': CLASSES,
 		'OUTPUT': QgsProcessingUtils.generateTempFilename("landuse.tif"),
 	}
-	return processing.run('native:reclassifybytable', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
\ No newline at end of file
+	return processing.run('native:reclassifybytable', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
+
+def update_landuse_areas(landuse, watersheds, context, feedback):
+	"""
+	Replaces the land use areas of the sub-watersheds (output of this script) by
+	those of another land use raster, e.g. another year of a time series. The
+	sub-watersheds and the dam areas are kept.
+
+	Returns
+	----------
+	watersheds : QgsVectorLayer
+		Sub-watersheds with the land use areas of the raster
+	"""
+	area_fields = ['forest_area', 'agri_area', 'anthro_area', 'water_area', 'land_area']
+	# Zonal histogram (lc_*) and area fields of the previous land use
+	old_fields = [f.name() for f in watersheds.fields() if f.name().startswith('lc_') or f.name() in area_fields]
+	alg_params = {
+		'INPUT': watersheds,
+		'COLUMN': old_fields,
+		'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+	}
+	stripped = processing.run('native:deletecolumn', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
+	reclassified = reduce_landuse(landuse, context, feedback=None)
+	return QgsProcessingUtils.mapLayerFromString(compute_landuse_areas(reclassified, stripped, context=context, feedback=feedback), context)
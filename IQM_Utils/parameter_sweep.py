@@ -0,0 +1,325 @@
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+import sys
+import numpy as np
+from pathlib import Path
+
+from qgis.PyQt.QtCore import QMetaType, QCoreApplication
+from qgis.core import (
+	QgsField,
+	QgsFields,
+	QgsFeature,
+	QgsGeometry,
+	QgsWkbTypes,
+	QgsProcessing,
+	QgsFeatureSink,
+	QgsProcessingException,
+	QgsProcessingAlgorithm,
+	QgsProcessingMultiStepFeedback,
+	QgsProcessingParameterEnum,
+	QgsProcessingParameterString,
+	QgsProcessingParameterBoolean,
+	QgsProcessingParameterRasterLayer,
+	QgsProcessingParameterVectorLayer,
+	QgsProcessingParameterFeatureSink
+)
+
+# Shared modules of the tool (IQM_Core), the utility scripts and the indices are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, ptref, transport
+from IQM_Utils import corridor_prefilter
+from Indicateurs_IQM import calcul_f2, calcul_f3, calcul_f5
+
+# Indices of the sweep and their output fields
+SWEEP_INDICES = [['F2', calcul_f2.OUTPUT_FIELDS], ['F3', calcul_f3.OUTPUT_FIELDS], ['F5', calcul_f5.OUTPUT_FIELDS]]
+# use_agri variants of each option of the 'use_agri' parameter
+AGRI_OPTIONS = [[True], [False], [True, False]]
+# Transect lengths of the indices (m), as in calcul_f2, calcul_f3 and calcul_f5
+TRANSECT_LENGTHS = {'f2_length': 50.0, 'f3_length': 15.0, 'f5_length': 31.0}
+
+
+class ParameterSweep(QgsProcessingAlgorithm):
+	OUTPUT = 'OUTPUT'
+	DEFAULT_SEG_ID_FIELD = 'Id_UEA'
+	DEFAULT_WIDTH_FIELD = 'Largeur_mod'
+	DEFAULT_PARAMETER_SETS = '50:10; 25:20; 100:5'
+
+	def initAlgorithm(self, config=None):
+		self.addParameter(QgsProcessingParameterVectorLayer('rivnet', self.tr('Réseau hydrographique (CRHQ)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None))
+		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
+		self.addParameter(QgsProcessingParameterVectorLayer('ptref_widths', self.tr('PtRef largeur (CRHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+		self.addParameter(QgsProcessingParameterString('ptref_width_field', self.tr('Nom du champ de largeur dans PtRef'), defaultValue=self.DEFAULT_WIDTH_FIELD))
+		self.addParameter(QgsProcessingParameterVectorLayer('roads', self.tr('Réseau routier (OSM)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterRasterLayer('landuse', self.tr('Utilisation du territoire (MELCCFP)'), defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterVectorLayer('bande_riv', self.tr('Bande riveraine (peuplement forestier; MELCCFP)'), types=[QgsProcessing.TypeVectorPolygon], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterEnum('indices', self.tr('Indices à calculer'), options=[key for key, _ in SWEEP_INDICES], defaultValue=[key for key, _ in SWEEP_INDICES], allowMultiple=True, usesStaticStrings=True))
+		self.addParameter(QgsProcessingParameterString('parameter_sets', self.tr('Jeux de paramètres (points visés:longueur min; ...)'), defaultValue=self.DEFAULT_PARAMETER_SETS))
+		self.addParameter(QgsProcessingParameterEnum('use_agri', self.tr('Utiliser milieux agricoles ?'), options=[self.tr('Oui'), self.tr('Non'), self.tr('Les deux')], defaultValue=2))
+		self.addParameter(QgsProcessingParameterBoolean('corridor_prefilter', self.tr('Préfiltrer les routes et la bande riveraine par corridor du réseau ?'), defaultValue=True, optional=True))
+		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Table des résultats du balayage'), type=QgsProcessing.TypeVector, defaultValue=None))
+
+
+	def checkParameterValues(self, parameters, context):
+		# Check if the parameters are given properly
+		rivnet_layer = self.parameterAsVectorLayer(parameters, 'rivnet', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
+		width_field = self.parameterAsString(parameters, 'ptref_width_field', context)
+		selected = self.parameterAsEnumStrings(parameters, 'indices', context)
+		if not compute.HAS_SHAPELY:
+			return False, self.tr("Le balayage de paramètres nécessite Shapely 2 ! Veuillez l'installer dans l'environnement Python de QGIS.")
+		if seg_id_field not in [f.name() for f in rivnet_layer.fields()]:
+			return False, self.tr(f"Le champ '{seg_id_field}' est absent de la couche du réseau hydro ! Veuillez fournir un champ identifiant du segment commun aux deux couches (res. hydro. et PtRef largeur).")
+		if seg_id_field not in [f.name() for f in ptref_layer.fields()]:
+			return False, self.tr(f"Le champ '{seg_id_field}' est absent de la couche PtRef largeur! Veuillez fournir un champ identifiant du segment commun aux deux couches (res. hydro. et PtRef largeur).")
+		if width_field not in [f.name() for f in ptref_layer.fields()]:
+			return False, self.tr(f"Le champ '{width_field}' est absent de la couche PtRef largeur! Veuillez fournir un champ identifiant la largeur du segment qui se trouve dans cette couche.")
+		if not selected:
+			return False, self.tr("Veuillez choisir au moins un indice à calculer !")
+		try:
+			parse_parameter_sets(self.parameterAsString(parameters, 'parameter_sets', context))
+		except ValueError as e:
+			return False, self.tr(f"Jeux de paramètres invalides : {str(e)}")
+		# Verify that each selected index has its layers
+		roads_layer = self.parameterAsVectorLayer(parameters, 'roads', context)
+		landuse_layer = self.parameterAsRasterLayer(parameters, 'landuse', context)
+		bande_layer = self.parameterAsVectorLayer(parameters, 'bande_riv', context)
+		if ('F2' in selected or 'F3' in selected) and (roads_layer is None or landuse_layer is None):
+			return False, self.tr("Les indices F2 et F3 nécessitent les couches de réseau routier et d'utilisation du territoire !")
+		if roads_layer is not None and "demi_emp" not in [f.name() for f in roads_layer.fields()]:
+			return False, self.tr("Le champ 'demi_emp' est absent de la couche du réseau routier! Veuillez vous assurer que la couche de réseau routier à préalablement passé par le script Extraction routes d'OSM (IQM utils).")
+		if 'F5' in selected and bande_layer is None:
+			return False, self.tr("L'indice F5 nécessite la couche de bande riveraine !")
+		if not corridor_prefilter.is_metric_crs(rivnet_layer.crs()) :
+			return False, self.tr(f"La couche de réseau hydro n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
+		return True, ''
+
+
+	def processAlgorithm(self, parameters, context, model_feedback):
+		# Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the overall progress through the model
+		feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
+		source = self.parameterAsVectorLayer(parameters, 'rivnet', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		roads_layer = self.parameterAsVectorLayer(parameters, 'roads', context)
+		landuse_layer = self.parameterAsRasterLayer(parameters, 'landuse', context)
+		bande_layer = self.parameterAsVectorLayer(parameters, 'bande_riv', context)
+		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
+		width_field = self.parameterAsString(parameters, 'ptref_width_field', context)
+		selected = self.parameterAsEnumStrings(parameters, 'indices', context)
+		indices = [key for key, _ in SWEEP_INDICES if key in selected]
+		parameter_sets = parse_parameter_sets(self.parameterAsString(parameters, 'parameter_sets', context))
+		agri_variants = AGRI_OPTIONS[self.parameterAsEnum(parameters, 'use_agri', context)]
+		use_corridor = self.parameterAsBool(parameters, 'corridor_prefilter', context)
+
+		# One row per segment, parameter set and use_agri variant
+		sink_fields = QgsFields()
+		sink_fields.append(source.fields().field(seg_id_field))
+		sink_fields.append(QgsField("target_pts", QMetaType.Int))
+		sink_fields.append(QgsField("step_min", QMetaType.Double, prec=2))
+		sink_fields.append(QgsField("use_agri", QMetaType.Int))
+		for key, fields in SWEEP_INDICES:
+			if key in indices:
+				for field in fields:
+					sink_fields.append(QgsField(field))
+		(sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, sink_fields, QgsWkbTypes.NoGeometry, source.sourceCrs())
+		if sink is None:
+			raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+		# Obstacles of both use_agri variants and riparian strip, prepared once for every parameter set
+		feedback.pushInfo(self.tr(f"{len(parameter_sets)} jeux de paramètres x {len(agri_variants)} variante(s) de milieux agricoles"))
+		state = {'seg_id_field': seg_id_field}
+		state.update(TRANSECT_LENGTHS)
+		try :
+			feedback.setProgressText(self.tr('Indexation des PtRef par segment…'))
+			state['ptref'] = ptref.width_arrays(ptref_layer, seg_id_field, width_field)
+			if 'F2' in indices or 'F3' in indices:
+				obstacles = prepare_obstacles(source, roads_layer, ptref_layer, landuse_layer, seg_id_field, width_field, use_corridor, agri_variants, context, feedback)
+				if obstacles is None:
+					return {}
+				state['obstacles'] = compute.Polygons(obstacles)
+			feedback.setCurrentStep(1)
+			if 'F5' in indices:
+				payload = calcul_f5.prepare_f5(source, bande_layer, ptref_layer, seg_id_field, width_field, use_corridor, context, feedback)
+				if payload is None:
+					return {}
+				state['bands'] = compute.Polygons(payload['bands'])
+			feedback.setCurrentStep(2)
+		except Exception as e :
+			feedback.reportError(self.tr(f"Erreur dans la préparation des couches : {str(e)}"))
+			return {}
+		if feedback.isCanceled():
+			return {}
+
+		# Iteration over all river network features
+		feedback.setProgressText(self.tr('Itération sur les segments du réseau...'))
+		total = source.featureCount()
+		try :
+			for current, feat in enumerate(source.getFeatures()):
+				if feedback.isCanceled():
+					return {}
+				sid = feat[seg_id_field]
+				rows, messages = compute.sweep_segment(state, sid, transport.line_parts(feat.geometry()), parameter_sets, indices, agri_variants)
+				for message in messages:
+					feedback.pushInfo(self.tr(message))
+				for target_pts, step_min, use_agri, values in rows:
+					out = QgsFeature(sink_fields)
+					out.setAttributes([sid, target_pts, step_min, None if use_agri is None else int(use_agri)] + [to_attribute(v) for v in values])
+					sink.addFeature(out, QgsFeatureSink.FastInsert)
+				if total:
+					feedback.setProgress(int(100 * current / total))
+		except Exception as e :
+			feedback.reportError(self.tr(f"Erreur dans la boucle de segments : {str(e)}"))
+			return {}
+		feedback.setCurrentStep(3)
+
+		# Ending message
+		feedback.setProgressText(self.tr('\tProcessus terminé !'))
+
+		return {self.OUTPUT: dest_id}
+
+	def name(self):
+		return 'parametersweep'
+
+	def displayName(self):
+		return self.tr('Balayage de paramètres F2 F3 F5')
+
+	def group(self):
+		return self.tr('IQM utils')
+
+	def groupId(self):
+		return 'iqmutils'
+
+	def shortHelpString(self):
+		return self.tr(
+			"Calcule les indices F2, F3 et F5 pour plusieurs jeux de paramètres (nombre de points visés et longueur minimale entre les transects) et avec ou sans les milieux agricoles, pour les analyses de sensibilité.\n Les obstacles de chaque variante sont préparés une seule fois pour tous les jeux de paramètres (routes tamponnées une seule fois, utilisation du territoire polygonisée comme dans les calculs séparés, avec ou sans les milieux agricoles), et les transects de tous les jeux de paramètres sont évalués une seule fois par segment : les points d'un pas plus grand sont un sous-ensemble des points du plus petit pas lorsque les pas sont des multiples. Les valeurs sont les mêmes que celles de calculs séparés des indices.\n" \
+			"Paramètres\n" \
+			"----------\n" \
+			"Réseau hydrographique : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MELCCFP. Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
+			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière. NOTE : Doit se retrouver à la fois dans la table attributaire de la couche de réseau hydro et de la couche de PtRef. Source des données : Couche réseau hydrographique.\n" \
+			"PtRef largeur : Vectoriel (points)\n" \
+			"-> Points de référence rapportant la largeur modélisée du segment (couche sortante du script UEA_PtRef_join).\n" \
+			" Champ PtRef largeur : Chaine de caractère ('Largeur_mod' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant la largeur du chenal. Source des données : Couche PtRef largeur.\n" \
+			"Réseau routier : Vectoriel (lignes)(optionnel)\n" \
+			"-> Réseau routier ayant passé par un des scripts d'extraction des routes (IQM utils). Nécessaire pour F2 et F3.\n" \
+			"Utilisation du territoire : Matriciel (optionnel)\n" \
+			"-> Classes d'utilisation du territoire pour le bassin versant donné sous forme matriciel (résolution 10 m). Nécessaire pour F2 et F3.\n" \
+			"Bande riveraine : Vectoriel (polygones)(optionnel)\n" \
+			"-> Données vectorielles surfacique des peuplements écoforestiers pour le bassin versant donné. Nécessaire pour F5.\n" \
+			"Indices à calculer : Choix multiple (F2, F3 et F5 par défaut)\n" \
+			"-> Indices évalués pour chaque jeu de paramètres.\n" \
+			"Jeux de paramètres : Chaine de caractère ('50:10; 25:20; 100:5' par défaut)\n" \
+			"-> Jeux 'points visés:longueur min entre transects (m)' séparés par des points-virgules.\n" \
+			"Utiliser milieux agricoles : Choix (optionnel; valeur par défaut : Les deux)\n" \
+			"-> Variantes de F2 et F3 calculées : avec les milieux agricoles comme obstacles, sans, ou les deux.\n" \
+			"Préfiltrer par corridor : Booléen (optionnel; valeur par défaut : Vrai) \n" \
+			"-> Conserve seulement les routes et les polygones de bande riveraine à l'intérieur du corridor du réseau hydrographique (script Préfiltrage par corridor) avant leur fusion et simplification.\n" \
+			"Retourne\n" \
+			"----------\n" \
+			"Table des résultats du balayage : Table\n" \
+			"-> Une ligne par segment, jeu de paramètres et variante de milieux agricoles (use_agri : 1 avec, 0 sans, vide sans F2 ni F3) avec les valeurs des indices choisis."
+		)
+
+	def tr(self, string):
+		return QCoreApplication.translate('Processing', string)
+
+	def createInstance(self):
+		return ParameterSweep()
+
+
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def parse_parameter_sets(text):
+	"""
+	Parameter sets of the sweep from 'target_pts:step_min' pairs separated by semicolons.
+
+	Returns
+	----------
+	parameter_sets : list
+		[[target_pts, step_min], ...] without duplicates, in the given order
+	"""
+	parameter_sets = []
+	for item in text.split(';'):
+		item = item.strip()
+		if not item:
+			continue
+		try:
+			target_pts, step_min = item.split(':')
+			target_pts, step_min = int(target_pts), float(step_min)
+		except ValueError:
+			raise ValueError(f"'{item}' n'est pas de la forme points visés:longueur min")
+		if target_pts <= 0 or step_min <= 0:
+			raise ValueError(f"'{item}' doit avoir un nombre de points et une longueur positifs")
+		if [target_pts, step_min] not in parameter_sets:
+			parameter_sets.append([target_pts, step_min])
+	if not parameter_sets:
+		raise ValueError("aucun jeu de paramètres")
+	return parameter_sets
+
+
+def to_attribute(value):
+	# Python value of an attribute (NumPy scalars are not accepted by QgsFeature)
+	return value.item() if isinstance(value, np.generic) else value
+
+
+def prepare_obstacles(source, roads_layer, ptref_layer, landuse, seg_id_field, width_field, use_corridor, agri_variants, context, feedback):
+	"""
+	Obstacles of F2 and F3 for the given use_agri variants.
+
+	The roads are buffered once, and the land use of each variant is polygonized
+	and simplified as in compute_f2 (the agricultural land merged with the
+	anthropised land for use_agri=True), so each variant gets the obstacles of a
+	separate run. The packed geometries are selected by compute.AGRI_MASKS.
+
+	Returns
+	----------
+	obstacles : dict
+		Packed [obstacles without agricultural land, obstacles with agricultural land] (None for a variant
+		not computed, None if canceled)
+	"""
+	roads_poly = calcul_f2.prepare_roads(source, roads_layer, ptref_layer, seg_id_field, width_field, use_corridor, TRANSECT_LENGTHS['f2_length'], context, feedback)
+	if roads_poly is None:
+		return None
+	roads = [f.geometry() for f in roads_poly.getFeatures()]
+	variants = []
+	for use_agri in [False, True]:
+		if use_agri not in agri_variants:
+			variants.append(None)
+			continue
+		feedback.setProgressText(tr("Polygonisation et reclassification de l'utilisation du territoire..."))
+		vectorised_landuse = calcul_f2.polygonize_landuse(use_agri, source, landuse, context, feedback)
+		if feedback.isCanceled():
+			return None
+		feedback.setProgressText(tr("Fusion des couches d'obstacles..."))
+		landuse_simpl = calcul_f2.simplify_layer_once(vectorised_landuse, tol=5.0)
+		parts = roads + [f.geometry() for f in landuse_simpl.getFeatures()]
+		variants.append(QgsGeometry.unaryUnion(parts) if parts else None)
+	return transport.pack_geometries(variants)
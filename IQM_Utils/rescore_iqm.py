@@ -0,0 +1,235 @@
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+import sys
+import numpy as np
+from pathlib import Path
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (
+	QgsProcessing,
+	QgsFeatureSink,
+	QgsFeatureRequest,
+	QgsProcessingException,
+	QgsProcessingAlgorithm,
+	QgsProcessingParameterFile,
+	QgsProcessingParameterVectorLayer,
+	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterFileDestination
+)
+
+# Shared modules of the tool (IQM_Core) and the indices are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import scoring
+from Indicateurs_IQM import calcul_a1, calcul_a2, calcul_a3, calcul_a4, calcul_f1, calcul_f2, calcul_f3, calcul_f4, calcul_f5
+
+# Indices of the IQM9 and score of each one from the columns of its stored metrics (its OUTPUT_FIELDS without the score, in order, then EXTRA_METRICS)
+INDEX_SCORES = [
+	['A1', calcul_a1, lambda tables, ws_area, forest_area, agri_area: scoring.score_a1(ws_area, forest_area, agri_area, tables)],
+	['A2', calcul_a2, lambda tables, dam_area, ws_area: scoring.score_a2(ws_area, dam_area, tables)],
+	['A3', calcul_a3, lambda tables, dam_count, forest_area, agri_area, anthro_area: scoring.score_a3(dam_count, forest_area, agri_area, anthro_area, tables)],
+	['A4', calcul_a4, lambda tables, distance, sinuosity: scoring.score_a4(sinuosity, tables)],
+	['F1', calcul_f1, lambda tables, struct_count: scoring.score_f1(struct_count, tables)],
+	['F2', calcul_f2, lambda tables, median_length: scoring.score_f2(median_length, tables)],
+	['F3', calcul_f3, lambda tables, perc15: scoring.score_f3(perc15 / 100, tables)],
+	['F4', calcul_f4, lambda tables, ratio: scoring.score_f4(ratio, tables)],
+	['F5', calcul_f5, lambda tables, perc15to30, perc30: scoring.score_f5(perc30 / 100, perc15to30 / 100, tables)],
+]
+# Metrics stored by another index (the watershed area of A2 is written by A1)
+EXTRA_METRICS = {'A2': ['watershed_area_m2']}
+IQM_FIELD = 'Score IQM9'
+
+
+class RescoreIQM(QgsProcessingAlgorithm):
+	OUTPUT = 'OUTPUT'
+
+	def initAlgorithm(self, config=None):
+		self.addParameter(QgsProcessingParameterVectorLayer('iqm_layer', self.tr('Couche IQM (sortie de Calcul IQM ou des indices)'), types=[QgsProcessing.TypeVectorAnyGeometry], defaultValue=None))
+		self.addParameter(QgsProcessingParameterFile('thresholds', self.tr('Configuration des seuils (JSON)'), extension='json', defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche IQM rescorée'), type=QgsProcessing.TypeVectorAnyGeometry, defaultValue=None))
+		self.addParameter(QgsProcessingParameterFileDestination('used_thresholds', self.tr('Seuils utilisés (JSON)'), fileFilter='JSON (*.json)', defaultValue=None, optional=True, createByDefault=False))
+
+
+	def checkParameterValues(self, parameters, context):
+		# Check if the parameters are given properly
+		layer = self.parameterAsVectorLayer(parameters, 'iqm_layer', context)
+		names = [f.name() for f in layer.fields()]
+		if not any(score_suffixes(module.OUTPUT_FIELDS[-1].name(), names) for _, module, _ in INDEX_SCORES):
+			return False, self.tr("La couche ne contient aucun champ de score d'indice (p. ex. 'Indice F2') ! Veuillez fournir une couche de sortie de Calcul IQM ou d'un des indices.")
+		thresholds = self.parameterAsFile(parameters, 'thresholds', context)
+		if thresholds:
+			try:
+				scoring.load_tables(thresholds)
+			except (OSError, ValueError, KeyError, TypeError) as e:
+				return False, self.tr(f"Configuration des seuils invalide : {str(e)}")
+		return True, ''
+
+
+	def processAlgorithm(self, parameters, context, feedback):
+		layer = self.parameterAsVectorLayer(parameters, 'iqm_layer', context)
+		thresholds = self.parameterAsFile(parameters, 'thresholds', context)
+		tables = scoring.load_tables(thresholds) if thresholds else scoring.SCORE_TABLES
+		(sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, layer.fields(), layer.wkbType(), layer.sourceCrs())
+		if sink is None:
+			raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+		# Stored metrics and scores of all the segments, read once without the geometries
+		feedback.setProgressText(self.tr("Lecture des métriques des segments..."))
+		fields = layer.fields()
+		names = [f.name() for f in fields]
+		request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+		fids = []
+		rows = []
+		for feat in layer.getFeatures(request):
+			if feedback.isCanceled():
+				return {}
+			fids.append(feat.id())
+			rows.append(feat.attributes())
+		columns = {name: scoring.as_array([row[i] for row in rows]) for i, name in enumerate(names)}
+
+		# New scores {field name: array} of every index found in the layer (with the suffixes of a land use time series)
+		feedback.setProgressText(self.tr("Calcul des scores..."))
+		scores = {}
+		for key, module, score_function in INDEX_SCORES:
+			score_name = module.OUTPUT_FIELDS[-1].name()
+			metrics = [f.name() for f in module.OUTPUT_FIELDS[:-1]] + EXTRA_METRICS.get(key, [])
+			for suffix in score_suffixes(score_name, names):
+				metric_names = [find_field(name, suffix, names) for name in metrics]
+				if None in metric_names:
+					missing = [name + suffix for name, found in zip(metrics, metric_names) if found is None]
+					feedback.pushInfo(self.tr(f"\t{score_name}{suffix} conservé (métriques absentes : {', '.join(missing)})"))
+					continue
+				new_scores = score_function(tables, *[columns[name] for name in metric_names])
+				changed = int(np.sum(~((new_scores == columns[score_name + suffix]) | (np.isnan(new_scores) & np.isnan(columns[score_name + suffix])))))
+				feedback.pushInfo(self.tr(f"\t{score_name}{suffix} : {changed} segments changent de score"))
+				scores[score_name + suffix] = new_scores
+
+		# IQM9 scores from the new (or stored) index scores, for each IQM field of the layer
+		iqm_scores = {}
+		for suffix in score_suffixes(IQM_FIELD, names):
+			index_columns = []
+			index_names = []
+			for key, module, _ in INDEX_SCORES:
+				score_name = module.OUTPUT_FIELDS[-1].name()
+				# The indices not depending on the land use have no suffix in a time series
+				name = next((n for n in [score_name + suffix, score_name] if n in names), None)
+				if name is None:
+					break
+				index_columns.append(scores.get(name, columns[name]))
+				index_names.append(name)
+			if len(index_columns) != len(INDEX_SCORES):
+				feedback.pushInfo(self.tr(f"\t{IQM_FIELD}{suffix} conservé (scores d'indices absents)"))
+				continue
+			# An index whose scores are all NULL failed in Calcul IQM : the IQM9 stays NULL, as it was written
+			failed = [name for name, column in zip(index_names, index_columns) if len(column) and np.all(np.isnan(column))]
+			if failed:
+				feedback.pushInfo(self.tr(f"\t{IQM_FIELD}{suffix} conservé NULL (scores d'indices NULL : {', '.join(failed)})"))
+				iqm_scores[IQM_FIELD + suffix] = np.full(len(fids), np.nan)
+				continue
+			iqm = scoring.score_iqm(np.column_stack(index_columns), tables)
+			# Segments whose stored IQM9 is NULL (index failed for them) keep it NULL
+			stored_null = np.isnan(columns[IQM_FIELD + suffix])
+			if np.any(stored_null):
+				feedback.pushInfo(self.tr(f"\t{IQM_FIELD}{suffix} conservé NULL pour {int(np.sum(stored_null))} segments"))
+				iqm[stored_null] = np.nan
+			iqm_scores[IQM_FIELD + suffix] = iqm
+
+		# Write the features with their new scores
+		feedback.setProgressText(self.tr("Écriture de la couche rescorée..."))
+		row_of = {fid: i for i, fid in enumerate(fids)}
+		new_values = [[names.index(name), scoring.as_attributes(values)] for name, values in scores.items()]
+		new_values += [[names.index(name), scoring.as_attributes(values, integer=False)] for name, values in iqm_scores.items()]
+		total = len(fids)
+		for current, feat in enumerate(layer.getFeatures()):
+			if feedback.isCanceled():
+				return {}
+			values = feat.attributes()
+			i = row_of[feat.id()]
+			for field_index, column in new_values:
+				values[field_index] = column[i]
+			feat.setAttributes(values)
+			sink.addFeature(feat, QgsFeatureSink.FastInsert)
+			if total:
+				feedback.setProgress(int(100 * current / total))
+
+		results = {self.OUTPUT: dest_id}
+		used_thresholds = self.parameterAsFileOutput(parameters, 'used_thresholds', context)
+		if used_thresholds:
+			scoring.save_tables(used_thresholds, tables)
+			results['used_thresholds'] = used_thresholds
+
+		# Ending message
+		feedback.setProgressText(self.tr('\tProcessus terminé !'))
+
+		return results
+
+	def name(self):
+		return 'rescoreiqm'
+
+	def displayName(self):
+		return self.tr('Rescorer IQM')
+
+	def group(self):
+		return self.tr('IQM utils')
+
+	def groupId(self):
+		return 'iqmutils'
+
+	def shortHelpString(self):
+		return self.tr(
+			"Recalcule les scores des indices et le score IQM9 d'une couche de sortie de Calcul IQM (ou d'un des indices) à partir des métriques qu'elle contient, avec de nouveaux seuils de classes, sans refaire les calculs géométriques.\n Les métriques utilisées sont les aires du bassin versant (A1, A2), le nombre de barrages et les aires du corridor (A3), l'indice de sinuosité (A4), le nombre de structures (F1), la largeur médiane de connectivité (F2), le pourcentage de rives libres sur 15 m (F3), la variation de largeur (F4) et les pourcentages de bande riveraine (F5). Les indices dont une métrique est absente gardent leur score. Le score IQM9 reste NULL pour les segments où il l'est dans la couche, et pour tous les segments lorsque les scores d'un indice sont tous NULL (indice en erreur dans Calcul IQM).\n" \
+			"Paramètres\n" \
+			"----------\n" \
+			"Couche IQM : Vectoriel\n" \
+			"-> Couche de sortie de Calcul IQM ou d'un des scripts d'indice, y compris les champs d'une série temporelle d'utilisation du territoire (suffixe de l'année).\n" \
+			"Configuration des seuils : Fichier JSON (optionnel)\n" \
+			"-> Tables de score à remplacer (A1, A2, A3_dams, A3_corridor, A4, F1 à F5, IQM), sous la forme {\"F2\": {\"rules\": [{\"when\": {\"median_length\": [\">\", 50]}, \"score\": 0}, ...], \"default\": null}, \"IQM\": {\"max_score\": 40}}. Les règles sont évaluées dans l'ordre et la première vérifiée donne le score. Sans fichier, les seuils par défaut sont utilisés.\n" \
+			"Retourne\n" \
+			"----------\n" \
+			"Couche IQM rescorée : Vectoriel\n" \
+			"-> Copie de la couche avec les scores des indices et le score IQM9 recalculés.\n" \
+			"Seuils utilisés : Fichier JSON (si demandé)\n" \
+			"-> Toutes les tables de score utilisées, à modifier comme configuration des seuils d'une prochaine exécution."
+		)
+
+	def tr(self, string):
+		return QCoreApplication.translate('Processing', string)
+
+	def createInstance(self):
+		return RescoreIQM()
+
+
+def score_suffixes(score_name, names):
+	# Suffixes of the fields of a score in the layer : '' for the field itself and '_<year>' for those of a land use time series
+	return [name[len(score_name):] for name in names if name == score_name or name.startswith(score_name + '_')]
+
+
+def find_field(name, suffix, names):
+	# Field of a metric with the suffix of its score, without suffix, or with any suffix (None if absent)
+	for candidate in [name + suffix, name]:
+		if candidate in names:
+			return candidate
+	return next((n for n in names if n.startswith(name + '_')), None)
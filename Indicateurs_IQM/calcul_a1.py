@@ -24,13 +24,13 @@
 """
 
 
+import sys
+from pathlib import Path
 import processing
 from qgis.PyQt.QtCore import QMetaType, QCoreApplication
 from qgis.core import (
 	QgsProcessing,
 	QgsField,
-	QgsFeatureSink,
-	QgsVectorLayer,
 	QgsProcessingUtils,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterRasterLayer,
@@ -41,6 +41,20 @@ from qgis.core import (
 	QgsProcessingMultiStepFeedback,
 )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import scoring, index_results
+
+# Fields added to the river network by the A1 index, in the order of the values returned by compute_a1
+OUTPUT_FIELDS = [
+	QgsField("watershed_area_m2", QMetaType.Double),
+	QgsField("forest_area_m2", QMetaType.Double),
+	QgsField("agri_area_m2", QMetaType.Double),
+	QgsField("Indice A1", QMetaType.Int)
+]
+
 
 class IndiceA1(QgsProcessingAlgorithm):
 	OUTPUT = 'OUTPUT'
@@ -76,7 +90,6 @@ class IndiceA1(QgsProcessingAlgorithm):
 
 	def processAlgorithm(self, parameters, context, model_feedback):
 		feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
-		outputs = {}
 
 		# Making layers and parameters needed for processing
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
@@ -85,11 +98,7 @@ class IndiceA1(QgsProcessingAlgorithm):
 		source = self.parameterAsVectorLayer(parameters, 'stream_network', context)
 
 		# Define Sink fields
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("watershed_area_m2", QMetaType.Double))
-		sink_fields.append(QgsField("forest_area_m2", QMetaType.Double))
-		sink_fields.append(QgsField("agri_area_m2", QMetaType.Double))
-		sink_fields.append(QgsField("Indice A1", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		# Define sink
 		(sink, dest_id) = self.parameterAsSink(
@@ -129,9 +138,10 @@ class IndiceA1(QgsProcessingAlgorithm):
 		# Compute A1 index
 		feedback.setProgressText(self.tr(f"Calcul de l'indice A1"))
 		try :
-			outputs['watersheds'] = computeA1(watersheds, context, feedback=None)
+			a1_map = compute_a1(watersheds, seg_id_field)
 		except Exception as e :
 			feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice A1 : {str(e)}"))
+			return {}
 		feedback.setCurrentStep(2)
 		if feedback.isCanceled():
 			return {}
@@ -139,29 +149,8 @@ class IndiceA1(QgsProcessingAlgorithm):
 		# Getting results ready to output
 		feedback.setProgressText(self.tr(f"Sortie des résultats."))
 		try :
-			# Convert watershed features to vector layers
-			watersheds_lyr = QgsVectorLayer(outputs['watersheds'], 'ws', 'ogr')
-			# If present, a 'seg_id_field' key is preferred; otherwise, 'DN' is used.
-			use_key = seg_id_field if (watersheds_lyr.fields().indexFromName(seg_id_field) != -1) else 'DN'
-			# Map feature ID and index values for each watershed layer
-			a1_map = {f[use_key]: f['Indice A1'] for f in watersheds_lyr.getFeatures()}
-			ws_area_map = {f[use_key]: f["watershed_area"] for f in watersheds.getFeatures()}
-			forest_map = {f[use_key]: f["forest_area"] for f in watersheds.getFeatures()}
-			agri_map = {f[use_key]: f["agri_area"] for f in watersheds.getFeatures()}
 			# Write final indices to sink using map
-			for feat in source.getFeatures():
-				seg = feat[seg_id_field]
-				# Get existing attributes
-				vals = feat.attributes()
-				# Get wanted values (None if absent)
-				a1_val   = a1_map.get(seg, None)
-				ws_val   = ws_area_map.get(seg, None)
-				f_val    = forest_map.get(seg, None)
-				a_val    = agri_map.get(seg, None)
-				# Add the new attributes
-				vals += [ws_val, f_val, a_val, a1_val]
-				feat.setAttributes(vals)
-				sink.addFeature(feat, QgsFeatureSink.FastInsert)
+			index_results.write_results(sink, source.getFeatures(), seg_id_field, (a1_map, len(OUTPUT_FIELDS)))
 		except Exception as e :
 			feedback.reportError(self.tr(f"Erreur dans la sortie des résultats : {str(e)}"))
 		feedback.setCurrentStep(3)
@@ -224,31 +213,39 @@ class IndiceA1(QgsProcessingAlgorithm):
 		)
 
 
-def computeA1(watersheds, context, feedback) :
-	a1_formula = """
-		CASE
-			WHEN "watershed_area" = 0 THEN NULL
-			WHEN "forest_area"/"watershed_area" <= 0.10 THEN 5
-			WHEN "forest_area"/"watershed_area" < 0.33 THEN 4
-			WHEN "forest_area"/"watershed_area" >= 0.33 
-				AND "forest_area"/"watershed_area" < 0.66
-				AND "agri_area"/"watershed_area" < 0.33 THEN 2
-			WHEN "forest_area"/"watershed_area" >= 0.33 
-				AND "forest_area"/"watershed_area" < 0.66
-				AND "agri_area"/"watershed_area" >= 0.33 THEN 3
-			WHEN "forest_area"/"watershed_area" >= 0.66 
-				AND "forest_area"/"watershed_area" < 0.90 THEN 1
-			ELSE 0
-		END
-		"""
-	alg_params = {
-		'INPUT': watersheds,
-		'FIELD_NAME': 'Indice A1',
-		'FIELD_TYPE': 2,  # 2 = Integer
-		'FIELD_LENGTH': 3,
-		'FIELD_PRECISION': 0,
-		'NEW_FIELD': True,
-		'FORMULA': a1_formula,
-		'OUTPUT': QgsProcessingUtils.generateTempFilename("watersheds.shp")
-	}
-	return processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
\ No newline at end of file
+def compute_a1(watersheds, seg_id_field='Id_UEA'):
+	"""
+	Computes the A1 index of every sub watershed.
+
+	Parameters
+	----------
+	watersheds : QgsVectorLayer
+		Sub watersheds with their land use areas (output of Extract sous-BV)
+	seg_id_field : str
+		Name of the segment identifier field ('DN' is used if absent from the watersheds)
+
+	Returns
+	----------
+	a1_map : dict
+		{sid: [watershed area, forest area, agricultural area, A1 index]}
+	"""
+	# If present, a 'seg_id_field' key is preferred; otherwise, 'DN' is used.
+	use_key = seg_id_field if (watersheds.fields().indexFromName(seg_id_field) != -1) else 'DN'
+	# Read the areas of all the watersheds in a single pass, then score them at once
+	keys, ws_areas, forest_areas, agri_areas = [], [], [], []
+	for f in watersheds.getFeatures():
+		keys.append(f[use_key])
+		ws_areas.append(f["watershed_area"])
+		forest_areas.append(f["forest_area"])
+		agri_areas.append(f["agri_area"])
+	ws_areas = scoring.as_array(ws_areas)
+	forest_areas = scoring.as_array(forest_areas)
+	agri_areas = scoring.as_array(agri_areas)
+	indices_a1 = scoring.score_a1(ws_areas, forest_areas, agri_areas)
+	# Map the watershed key to the output values
+	return {key: list(values) for key, values in zip(keys, zip(
+		scoring.as_attributes(ws_areas, integer=False),
+		scoring.as_attributes(forest_areas, integer=False),
+		scoring.as_attributes(agri_areas, integer=False),
+		scoring.as_attributes(indices_a1)
+	))}
@@ -24,13 +24,13 @@
 """
 
 
+import sys
+from pathlib import Path
 import processing
 from qgis.PyQt.QtCore import QMetaType, QCoreApplication
 from qgis.core import (
 	QgsProcessing,
 	QgsField,
-	QgsFeatureSink,
-	QgsVectorLayer,
 	QgsProcessingUtils,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterRasterLayer,
@@ -41,6 +41,18 @@ from qgis.core import (
 	QgsProcessingParameterFeatureSink
 )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import scoring, index_results
+
+# Fields added to the river network by the A2 index, in the order of the values returned by compute_a2
+OUTPUT_FIELDS = [
+	QgsField("dam_area_sum_m2", QMetaType.Double),
+	QgsField("Indice A2", QMetaType.Int)
+]
+
 
 class IndiceA2(QgsProcessingAlgorithm):
 	OUTPUT = 'OUTPUT'
@@ -76,7 +88,6 @@ class IndiceA2(QgsProcessingAlgorithm):
 
 	def processAlgorithm(self, parameters, context, model_feedback):
 		feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
-		outputs = {}
 
 		# Making layers and parameters needed for processing
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
@@ -85,9 +96,7 @@ class IndiceA2(QgsProcessingAlgorithm):
 		source = self.parameterAsVectorLayer(parameters, 'stream_network', context)
 
 		# Define Sink fields
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("dam_area_sum_m2", QMetaType.Double))
-		sink_fields.append(QgsField("Indice A2", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		# Define sink
 		(sink, dest_id) = self.parameterAsSink(
@@ -127,9 +136,10 @@ class IndiceA2(QgsProcessingAlgorithm):
 		# Compute A2 index
 		feedback.setProgressText(self.tr(f"Calcul de l'indice A2"))
 		try :
-			outputs['watersheds'] = computeA2(watersheds, context, feedback=None)
+			a2_map = compute_a2(watersheds, seg_id_field)
 		except Exception as e :
 			feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice A2 : {str(e)}"))
+			return {}
 		feedback.setCurrentStep(2)
 		if feedback.isCanceled():
 			return {}
@@ -137,25 +147,8 @@ class IndiceA2(QgsProcessingAlgorithm):
 		# Getting results ready to output
 		feedback.setProgressText(self.tr(f"Sortie des résultats."))
 		try :
-			# Convert watershed features to vector layers
-			watersheds_lyr = QgsVectorLayer(outputs['watersheds'], 'ws', 'ogr')
-			# If present, a ‘seg_id_field’ key is preferred; otherwise, ‘DN’ (temporary) is used.
-			use_key = seg_id_field if (watersheds_lyr.fields().indexFromName(seg_id_field) != -1) else 'DN'
-			# Map feature ID and index values for each watershed layer
-			a2_map = {f[use_key]: f['Indice A2'] for f in watersheds_lyr.getFeatures()}
-			dam_area_map = {f[use_key]: f["dam_area_sum"] for f in watersheds.getFeatures()}
 			# Write final indices to sink using map
-			for feat in source.getFeatures():
-				seg = feat[seg_id_field]
-				# Get existing attributes
-				vals = feat.attributes()
-				# Get wanted values (None if absent)
-				a2_val   = a2_map.get(seg, None)
-				dam_area_val = dam_area_map.get(seg, None)
-				# Add the new attributes
-				vals += [dam_area_val, a2_val]
-				feat.setAttributes(vals)
-				sink.addFeature(feat, QgsFeatureSink.FastInsert)
+			index_results.write_results(sink, source.getFeatures(), seg_id_field, (a2_map, len(OUTPUT_FIELDS)))
 		except Exception as e :
 			feedback.reportError(self.tr(f"Erreur dans la sortie des résultats : {str(e)}"))
 		feedback.setCurrentStep(3)
@@ -211,24 +204,34 @@ class IndiceA2(QgsProcessingAlgorithm):
 		)
 
 
-def computeA2(watersheds, context, feedback) :
-	a2_formula = """
-		CASE
-			WHEN "watershed_area" = 0 THEN NULL
-			WHEN (coalesce("dam_area_sum", 0)/"watershed_area") < 0.05 THEN 0
-			WHEN (coalesce("dam_area_sum", 0)/"watershed_area") < 0.33 THEN 2
-			WHEN (coalesce("dam_area_sum", 0)/"watershed_area") < 0.66 THEN 3
-			ELSE 4
-		END
-		"""
-	alg_params = {
-		'INPUT': watersheds,
-		'FIELD_NAME': 'Indice A2',
-		'FIELD_TYPE': 2,  # 2 = Integer
-		'FIELD_LENGTH': 3,
-		'FIELD_PRECISION': 0,
-		'NEW_FIELD': True,
-		'FORMULA': a2_formula,
-		'OUTPUT': QgsProcessingUtils.generateTempFilename("watersheds.shp")
-	}
-	return processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
\ No newline at end of file
+def compute_a2(watersheds, seg_id_field='Id_UEA'):
+	"""
+	Computes the A2 index of every sub watershed.
+
+	Parameters
+	----------
+	watersheds : QgsVectorLayer
+		Sub watersheds with their dam controlled areas (output of Extract sous-BV)
+	seg_id_field : str
+		Name of the segment identifier field ('DN' is used if absent from the watersheds)
+
+	Returns
+	----------
+	a2_map : dict
+		{sid: [dam controlled area, A2 index]}
+	"""
+	# If present, a ‘seg_id_field’ key is preferred; otherwise, ‘DN’ (temporary) is used.
+	use_key = seg_id_field if (watersheds.fields().indexFromName(seg_id_field) != -1) else 'DN'
+	# Read the areas of all the watersheds in a single pass, then score them at once
+	keys, ws_areas, dam_areas = [], [], []
+	for f in watersheds.getFeatures():
+		keys.append(f[use_key])
+		ws_areas.append(f["watershed_area"])
+		dam_areas.append(f["dam_area_sum"])
+	dam_areas = scoring.as_array(dam_areas)
+	indices_a2 = scoring.score_a2(scoring.as_array(ws_areas), dam_areas)
+	# Map the watershed key to the output values
+	return {key: list(values) for key, values in zip(keys, zip(
+		scoring.as_attributes(dam_areas, integer=False),
+		scoring.as_attributes(indices_a2)
+	))}
@@ -24,14 +24,17 @@
 """
 
 
+import sys
+import math
+import numpy as np
 import processing
+from pathlib import Path
+from osgeo import gdal
 from qgis.PyQt.QtCore import QMetaType, QCoreApplication
 from qgis.core import (QgsProcessing,
 	QgsField,
-	QgsFeatureSink,
-	QgsFeature,
 	QgsPointXY,
-	QgsVectorLayer,
+	NULL,
 	QgsFeatureRequest,
 	QgsProcessingUtils,
 	QgsUnitTypes,
@@ -39,14 +42,32 @@ from qgis.core import (QgsProcessing,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterRasterLayer,
 	QgsProcessingParameterString,
-	QgsWkbTypes,
 	QgsGeometry,
 	QgsProcessingParameterNumber,
 	QgsProcessingParameterVectorLayer,
 	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterBoolean,
+	QgsProcessingParameterFileDestination,
+	QgsProcessingContext,
+	QgsProcessingFeedback,
 	QgsProcessingMultiStepFeedback
 )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, profiling, scoring, transport
+
+# Fields added to the river network by the A3 index, in the order of the values returned by compute_a3
+OUTPUT_FIELDS = [
+	QgsField("Nb_barrage_amont", QMetaType.Int),
+	QgsField("corridor_forest_m2", QMetaType.Double),
+	QgsField("corridor_agri_m2", QMetaType.Double),
+	QgsField("corridor_anthro_m2", QMetaType.Double),
+	QgsField("Indice A3", QMetaType.Int)
+]
+
 
 class IndiceA3(QgsProcessingAlgorithm):
 	DEFAULT_SEG_ID_FIELD = 'Id_UEA'
@@ -63,6 +84,9 @@ class IndiceA3(QgsProcessingAlgorithm):
 		self.addParameter(QgsProcessingParameterRasterLayer('landuse', self.tr('Utilisation du territoire (MELCCFP)'), defaultValue=None))
 		self.addParameter(QgsProcessingParameterVectorLayer('ptref_widths', self.tr('PtRef largeur (CRHQ)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
 		self.addParameter(QgsProcessingParameterString('ptref_width_field', self.tr('Nom du champ de largeur dans PtRef'), defaultValue=self.DEFAULT_WIDTH_FIELD))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie'), defaultValue=None))
 
 
@@ -94,11 +118,10 @@ class IndiceA3(QgsProcessingAlgorithm):
 
 
 	def processAlgorithm(self, parameters, context, model_feedback):
-		feedback = QgsProcessingMultiStepFeedback(9, model_feedback)
+		feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
 		width_field  = self.parameterAsString(parameters, 'ptref_width_field', context)
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 		seg_id_down_field = self.parameterAsString(parameters, 'segment_id_down_field', context)
-		outputs = {}
 
 		# Define stream network as source for data output
 		source = self.parameterAsVectorLayer(parameters, 'stream_network', context)
@@ -106,9 +129,7 @@ class IndiceA3(QgsProcessingAlgorithm):
 		max_dam_distance = self.parameterAsInt(parameters, 'dam_distance', context)
 
 		# Define sink fields
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Nb_barrage_amont", QMetaType.Int))
-		sink_fields.append(QgsField("Indice A3", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		# Define sink
 		(sink, dest_id) = self.parameterAsSink(
@@ -123,34 +144,183 @@ class IndiceA3(QgsProcessingAlgorithm):
 		if feedback.isCanceled():
 			return {}
 
-		# Initialising treatment layers
-		dam_counts = {}
+		# Compute the dam counts, the corridor land use and the A3 index of every segment
 		dams_layer = self.parameterAsVectorLayer(parameters, 'dams', context)
-		hydro_layer = self.parameterAsVectorLayer(parameters, 'stream_network', context)
+		ptref_layer = self.parameterAsVectorLayer(parameters, 'ptref_widths', context)
+		landuse_layer = self.parameterAsRasterLayer(parameters, 'landuse', context)
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), feedback)
+		try :
+			with profiling.step(profiler, 'indice A3'):
+				a3_map = compute_a3(source, dams_layer, landuse_layer, ptref_layer, seg_id_field, seg_id_down_field, width_field, max_dam_distance, costs=costs, context=context, feedback=feedback)
+		except Exception as e :
+			feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice A3 : {str(e)}"))
+			return {}
+		feedback.setCurrentStep(1)
+		if a3_map is None or feedback.isCanceled():
+			return {}
+
+		# Write results to sink
+		feedback.setProgressText(self.tr(f"Sortie des résultats."))
+		try :
+			index_results.write_results(sink, source.getFeatures(), seg_id_field, (a3_map, len(OUTPUT_FIELDS)))
+		except Exception as e :
+			feedback.reportError(self.tr(f"Erreur dans la sortie des résultats : {str(e)}"))
+		feedback.setCurrentStep(2)
+		if feedback.isCanceled():
+			return {}
 
-		# Create spatial index to make the finding of the nearest segment faster
-		hydro_index = QgsSpatialIndex(hydro_layer.getFeatures())
-		id_to_feat = {f[seg_id_field]: f for f in hydro_layer.getFeatures()}
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'A3', feedback)
 
-		# Gets the number of features (dams) to iterate over
-		total_features = dams_layer.featureCount()
-		feedback.pushInfo(self.tr(f"\t {total_features} features (barrages) à traiter"))
+		# Ending message
+		feedback.setProgressText(self.tr('\tProcessus terminé !'))
 
-		feedback.setProgressText(self.tr(f"Compte des barrages"))
-		try :
-			for current, dam in enumerate(dams_layer.getFeatures()):
+		return results
+
+	def tr(self, string):
+		return QCoreApplication.translate('Processing', string)
+
+	def createInstance(self):
+		return IndiceA3()
+
+	def name(self):
+		return 'indicea3'
+
+	def displayName(self):
+		return self.tr('Indice A3')
+
+	def group(self):
+		return self.tr('IQM (indice solo)')
+
+	def groupId(self):
+		return 'iqm'
+
+	def shortHelpString(self):
+		return self.tr(
+			"Calcule l'indice A3 pour évaluer l’altération des régimes hydrologiques et sédimentaires ainsi que la présence de formes au niveau de la plaine alluviale à l’échelle du segment.\n Le niveau d’anthropisation du segment et la présence d’unités géomorphologiques sur la plaine sont évalués à l’intérieur du corridor fluvial sur une largeur respective de deux fois la largeur du lit mineur pour les milieux non confinés, ou de 15 m pour les milieux confinés. Le niveau d’anthropisation correspond à la surface de recouvrement relative à l’intérieur du corridor fluvial lié aux affectations urbanisées et agricoles. Une pénalité est appliquée en fonction du nombre de barrages à l’intérieur d’une distance de 1000 m à l’amont du segment analysé. Ces entraves qui créent des discontinuités dans le transport par charge de fond affectent grandement les conditions hydrauliques influençant les processus hydrogéomorphologiques et les formes présentes dans le lit mineur en aval de celles-ci.\n" \
+			"Paramètres\n" \
+			"----------\n" \
+			"Distance max du barrage au segment : Chiffre (int)(optionnel; valeur par défaut : 15)\n" \
+			"-> Distance maximale (en m) des barrages au segment. Parfois les points de barrages n'intersectent pas les lignes de réseau hydrographique. Cette distance est la distance maximale que l'algorithme va chercher autour de chaque barrage pour trouver le segment de rivière le plus proche pour effectuer le compte du nombre de barrages.\n" \
+			"Réseau hydrographique : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS. Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
+			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière. NOTE : Doit se retrouver à la fois dans la table attributaire de la couche de réseau hydro et de la couche de PtRef. Source des données : Couche réseau hydrographique.\n" \
+			" Champ ID segment d'aval : Chaine de caractère ('Id_UEA_aval' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière situé en aval. Source des données : Couche réseau hydrographique.\n" \
+			" Nbr de points visés : nombre entier (int; 200 par défaut)\n" \
+			"Barrages : Vectoriel (point)\n" \
+			"-> Répertorie les barrages d'un mètre et plus pour le bassin versant donné. Source des données : Centre d'expertise hydrique du Québec (CEHQ). Répertoire des barrages, [Jeu de données], dans Navigateur cartographique du Partenariat Données Québec, IGO2.\n" \
+			"Utilisation du territoire : Matriciel\n" \
+			"-> Classes d'utilisation du territoire pour le bassin versant donné sous forme matricielle (résolution 10 m) qui sera reclassé pour les classes forestières, agricole et anthropique, selon le guide d'utilisation du jeu de données. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Utilisation du territoire, [Jeu de données], dans Données Québec.\n" \
+			"PtRef largeur : Vectoriel (points)\n" \
+			"-> Points de référence rapportant la largeur modélisée du segment contenant l'information de la couche PtRef et la table PtRef_mod_lotique provenant des données du CRHQ (couche sortante du script UEA_PtRef_join). Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
+			" Champ PtRef largeur : Chaine de caractère ('Largeur_mod' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant la largeur du chenal. Source des données : Couche PtRef largeur.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
+			"Retourne\n" \
+			"----------\n" \
+			"Couche de sortie : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique du bassin versant avec le nombre de barrages en amont, les aires forestière, agricole et anthropique du corridor (m²) et le score de l'indice A3 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
+		)
+
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def compute_a3(hydro_layer, dams_layer, landuse, ptref_layer, seg_id_field='Id_UEA', seg_id_down_field='Id_UEA_aval', width_field='Largeur_mod', max_dam_distance=5, costs=None, context=None, feedback=None):
+	"""
+	Computes the A3 index of every segment of the river network.
+
+	Parameters
+	----------
+	hydro_layer : QgsVectorLayer
+		River network layer
+	dams_layer : QgsVectorLayer
+		Dams layer (CEHQ)
+	landuse : QgsRasterLayer or str
+		Land use raster (MELCCFP)
+	ptref_layer : QgsVectorLayer
+		PtRef width layer
+	seg_id_field, seg_id_down_field, width_field : str
+		Names of the segment identifier, downstream segment identifier and PtRef width fields
+	max_dam_distance : float
+		Maximal distance between a dam and its segment (m)
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (dam walks and corridor allocation, None : costs not recorded)
+
+	Returns
+	----------
+	a3_map : dict
+		{sid: [number of dams within 1000 m upstream, forest, agricultural and anthropic areas of the corridor, A3 index]} (None if canceled)
+	"""
+	return compute_a3_series(hydro_layer, dams_layer, [landuse], ptref_layer, seg_id_field, seg_id_down_field, width_field, max_dam_distance, costs=costs, context=context, feedback=feedback)
+
+
+def compute_a3_series(hydro_layer, dams_layer, landuses, ptref_layer, seg_id_field='Id_UEA', seg_id_down_field='Id_UEA_aval', width_field='Largeur_mod', max_dam_distance=5, costs=None, context=None, feedback=None):
+	"""
+	Computes the A3 index of every segment of the river network for each land use
+	raster of a time series. The dam counts and the corridor widths are computed once,
+	only the land use areas of the corridors are computed for each raster.
+
+	Parameters
+	----------
+	landuses : list of QgsRasterLayer or str
+		Land use rasters (MELCCFP) of each year
+	(the other parameters are those of compute_a3)
+
+	Returns
+	----------
+	a3_map : dict
+		{sid: [number of dams, corridor areas, A3 index] of each land use one after the other} (None if canceled)
+	"""
+	context = context if context is not None else QgsProcessingContext()
+	feedback = QgsProcessingMultiStepFeedback(2 + 2*len(landuses), feedback if feedback is not None else QgsProcessingFeedback())
+
+	# Initialising treatment layers
+	dam_counts = {}
+
+	# Create spatial index to make the finding of the nearest segment faster
+	hydro_index = QgsSpatialIndex(hydro_layer.getFeatures())
+	id_to_feat = {f[seg_id_field]: f for f in hydro_layer.getFeatures()}
+
+	# Only the dams within reach of the network (a partition of a large network reads its own dams)
+	dams = list(dams_layer.getFeatures(QgsFeatureRequest().setFilterRect(hydro_layer.extent().buffered(max_dam_distance))))
+	# Gets the number of features (dams) to iterate over
+	total_features = len(dams)
+	feedback.pushInfo(tr(f"\t {total_features} features (barrages) à traiter"))
+
+	feedback.setProgressText(tr(f"Compte des barrages"))
+	try :
+		for current, dam in enumerate(dams):
+			# The work of a dam is the cost of its segment in the cost report
+			with instrumentation.measure(costs) as cost:
 				current_feat = None
 				try :
 					# Finds the river segment of the current structure
 					current_feat = find_segment_for_structure_fast(dam, hydro_layer, hydro_index, max_dist=max_dam_distance)
 				except Exception as e :
-					feedback.reportError(self.tr(f"Erreur dans find_segment_for_structure : {str(e)}"))
-					return {}
+					raise RuntimeError(tr(f"Erreur dans find_segment_for_structure : {str(e)}"))
 				if current_feat is None: # if no segment associated to the dam
-					#feedback.pushInfo(self.tr(f"Pas de segment associé au barrage actuel. Prochain segment."))
+					#feedback.pushInfo(tr(f"Pas de segment associé au barrage actuel. Prochain segment."))
 					continue
+				cost['sid'] = current_feat[seg_id_field]
 				if feedback.isCanceled():
-					return {}
+					return None
 
 				downstream_feat = None
 				try :
@@ -158,10 +328,9 @@ class IndiceA3(QgsProcessingAlgorithm):
 					downstream_id = current_feat[seg_id_down_field]
 					downstream_feat = id_to_feat.get(downstream_id)
 				except Exception as e :
-					feedback.reportError(self.tr(f"Erreur dans la découverte du segment d'aval : {str(e)}"))
-					return {}
+					raise RuntimeError(tr(f"Erreur dans la découverte du segment d'aval : {str(e)}"))
 				if downstream_feat is None:
-					#feedback.pushInfo(self.tr(f"Le segment d'aval ne fait pas partie du réseau hydrographique. Prochain segment."))
+					#feedback.pushInfo(tr(f"Le segment d'aval ne fait pas partie du réseau hydrographique. Prochain segment."))
 					continue
 
 				cum_dist = 0
@@ -172,14 +341,15 @@ class IndiceA3(QgsProcessingAlgorithm):
 				while (cum_dist < 1000) and (downstream_feat is not None) :
 					intersection_point = None
 					if feedback.isCanceled():
-						return {}
+						return None
+					cost['vertices'] += downstream_feat.geometry().constGet().nCoordinates()
 					try :
 						# Find the intersecting point between the dam river segment and the downstream segment
 						intersection_point = get_intersection_point(current_feat, downstream_feat, tol=5)
 					except Exception as e :
-						feedback.reportError(self.tr(f"Erreur dans get_intersection_point : {str(e)}"))
+						feedback.reportError(tr(f"Erreur dans get_intersection_point : {str(e)}"))
 					if intersection_point is None or intersection_point.isEmpty():
-						#feedback.pushInfo(self.tr(f"Le segment d'aval ne retourne pas d'intersection avec le segment courant. Prochain segment."))
+						#feedback.pushInfo(tr(f"Le segment d'aval ne retourne pas d'intersection avec le segment courant. Prochain segment."))
 						break
 
 					try :
@@ -189,8 +359,7 @@ class IndiceA3(QgsProcessingAlgorithm):
 						else : # Otherwise get the distance between the previous intersection and the current intersection
 							dist = line_distance_between_points(current_feat.geometry(), prev_intersection, intersection_point)
 					except Exception as e :
-						feedback.reportError(self.tr(f"Erreur dans compute_shortest_path : {str(e)}"))
-						return {}
+						raise RuntimeError(tr(f"Erreur dans compute_shortest_path : {str(e)}"))
 					# If the distance is < 1000 m, increment the downstream segment dam counter.
 					if dist is None or dist <= 0:
 						# Null or invalid distance.
@@ -226,170 +395,56 @@ class IndiceA3(QgsProcessingAlgorithm):
 				feedback.setProgress(progress)
 
 				if feedback.isCanceled():
-					return {}
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans la boucle de barrages : {str(e)}"))
-		feedback.setCurrentStep(1)
-		if feedback.isCanceled():
-			return {}
-
-		# Adding dam count field
-		feedback.setProgressText(self.tr(f"Ajout du champ de compte de barrage"))
-		try :
-			count_lyr = QgsVectorLayer("None", "dam_counts", "memory")
-			prov = count_lyr.dataProvider()
-			seg_field = source.fields().field(seg_id_field)
-			prov.addAttributes([QgsField(seg_id_field, seg_field.type()), QgsField("Nb_barrage_amont", QMetaType.Int)])
-			count_lyr.updateFields()
-
-			new_feats = []
-			for f in source.getFeatures():
-				seg = f[seg_id_field]
-				c = int(dam_counts.get(seg, 0)) # Puts either the count found in dam_counts or 0
-				nf = QgsFeature(count_lyr.fields())
-				nf.setAttributes([seg, c])
-				new_feats.append(nf)
-			prov.addFeatures(new_feats)
-			count_lyr.updateExtents()
+					return None
+	except Exception as e :
+		feedback.reportError(tr(f"Erreur dans la boucle de barrages : {str(e)}"))
+	feedback.setCurrentStep(1)
+	if feedback.isCanceled():
+		return None
 
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans l'ajout du champ de compte des barrages : {str(e)}"))
-		feedback.setCurrentStep(2)
-		if feedback.isCanceled():
-				return {}
+	# Compute mean stream width for stream network segments
+	feedback.setProgressText(tr(f"Calcul de la largeur moyenne des segments"))
+	try :
+		mean_widths = mean_widths_near_segments(hydro_layer, ptref_layer, seg_id_field, width_field, max_distance=5, default_width=5)
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans le calcul de la largeur moyenne des segments : {str(e)}"))
+	feedback.setCurrentStep(2)
+	if feedback.isCanceled():
+		return None
 
-		# Creating buffers for alluvial plain simulation
-		feedback.setProgressText(self.tr(f"Création des tampons de 2x du lit mineur et calcul de l'util. du terr."))
+	segs = list({feat[seg_id_field] for feat in hydro_layer.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([seg_id_field], hydro_layer.fields()))})
+	counts = np.array([dam_counts.get(seg, 0) for seg in segs], dtype=float)
+	radii = {sid: 2 * w for sid, w in mean_widths.items()}
+	a3_maps = []
+	for step, landuse in enumerate(landuses):
+		# Reclassify land use
+		feedback.setProgressText(tr(f"Reclassification de l'utilisation du territoire"))
 		try :
-			# Compute mean stream width for stream network segments
-			ptref_id = parameters['ptref_widths']
-			expr = f"coalesce(array_mean(overlay_nearest('{ptref_id}', '{width_field}', limit:=-1, max_distance:=5)), 5)"
-			alg_params = {
-				'INPUT': parameters['stream_network'],
-				'FIELD_NAME': 'mean_width',
-				'FIELD_TYPE': 0,  # 0 = float
-				'FIELD_LENGTH': 10,
-				'FIELD_PRECISION': 3,
-				'NEW_FIELD': True,
-				'FORMULA': expr,
-				'OUTPUT': 'memory:stream_w_mean'
-			}
-			stream_w_mean = processing.run('native:fieldcalculator', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
-			feedback.setCurrentStep(3)
-			# Create 'Mean width x 2' buffer
-			expr = 'buffer($geometry, "mean_width" * 2, 30, \'round\', \'miter\', 2)'
-			alg_params = {
-				'INPUT': stream_w_mean,
-				'EXPRESSION': expr,
-				'OUTPUT': QgsProcessingUtils.generateTempFilename('buffer2x.shp')
-			}
-			outputs['buffer2x'] = processing.run('qgis:geometrybyexpression', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
-			feedback.setCurrentStep(4)
-			# Reclassify land use
-			outputs['reclassifiedlanduse'] = reduce_landuse(parameters['landuse'], context, feedback=None)
-			feedback.setCurrentStep(5)
-			# Compute land use within 2x mean width buffer
-			stream2x = compute_landuse_areas(outputs['reclassifiedlanduse'], outputs['buffer2x'], context=context, feedback=None)
-			feedback.setCurrentStep(6)
-			# Join dam_count to stream2x
-			alg_params = {
-				'INPUT': stream2x,
-				'FIELD': seg_id_field,
-				'INPUT_2': count_lyr,
-				'FIELD_2': seg_id_field,
-				'FIELDS_TO_COPY': ['Nb_barrage_amont'],
-				'METHOD': 1,  # 1 = one-to-one
-				'DISCARD_NONMATCHING': False,
-				'OUTPUT': 'memory:stream2x'
-			}
-			stream2x = processing.run('native:joinattributestable', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
+			reclassified_landuse = reduce_landuse(landuse, context, feedback=None)
 		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans création des tampons de lit mineur : {str(e)}"))
-		feedback.setCurrentStep(7)
+			raise RuntimeError(tr(f"Erreur dans la reclassification de l'utilisation du territoire : {str(e)}"))
+		feedback.setCurrentStep(3 + 2*step)
 		if feedback.isCanceled():
-			return {}
+			return None
 
-		# Compute A3 index
-		feedback.setProgressText(self.tr(f"Calcul de l'indice A3"))
+		# Compute land use within the 2x mean width corridor of every segment in a single raster pass
+		feedback.setProgressText(tr(f"Calcul de l'util. du terr. dans le corridor de 2x la largeur du lit mineur"))
 		try :
-			outputs['streams2x'] = computeA3(stream2x, context, feedback=None)
+			corridor_areas = corridor_landuse_areas(reclassified_landuse, hydro_layer, seg_id_field, radii, feedback=feedback, costs=costs)
 		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice A3 : {str(e)}"))
-		feedback.setCurrentStep(8)
+			raise RuntimeError(tr(f"Erreur dans le calcul de l'util. du terr. du corridor : {str(e)}"))
+		feedback.setCurrentStep(4 + 2*step)
 		if feedback.isCanceled():
-			return {}
-		
-		# Getting results ready to output 
-		feedback.setProgressText(self.tr(f"Sortie des résultats."))
-		try :
-			# Convert stream features to vector layers
-			streams2x_lyr = QgsVectorLayer(outputs['streams2x'], 'ws2x', 'ogr')
-			# Map feature ID and index values for each watershed layer
-			a3_map = {f[seg_id_field]: f['Indice A3'] for f in streams2x_lyr.getFeatures()}
-			# Write final indices to sink using map
-			for feat in source.getFeatures():
-				seg = feat[seg_id_field]
-				a3_vals = a3_map.get(seg, None)
-				dam_count = dam_counts.get(feat[seg_id_field],0)
-				# add both the dam count and A3 index score
-				feat.setAttributes(feat.attributes() + [dam_count, a3_vals])
-				sink.addFeature(feat, QgsFeatureSink.FastInsert)
-		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans la sortie des résultats : {str(e)}"))
-		feedback.setCurrentStep(9)
-		if feedback.isCanceled():
-			return {}
-
-		# Ending message
-		feedback.setProgressText(self.tr('\tProcessus terminé !'))
+			return None
 
-		return {self.OUTPUT: dest_id}
+		# Score all the segments at once from the dam counts and corridor land use areas
+		feedback.setProgressText(tr(f"Calcul de l'indice A3"))
+		areas = np.array([corridor_areas.get(seg, (0.0, 0.0, 0.0)) for seg in segs], dtype=float).reshape(-1, 3)
+		indices_a3 = scoring.score_a3(counts, areas[:, 0], areas[:, 1], areas[:, 2])
+		# The corridor land use areas are kept to rescore the index with other thresholds
+		a3_maps.append({seg: [dam_counts.get(seg, 0)] + [float(a) for a in seg_areas] + [a3] for seg, seg_areas, a3 in zip(segs, areas, scoring.as_attributes(indices_a3))})
+	return index_results.join_series(a3_maps, len(OUTPUT_FIELDS))
 
-	def tr(self, string):
-		return QCoreApplication.translate('Processing', string)
-
-	def createInstance(self):
-		return IndiceA3()
-
-	def name(self):
-		return 'indicea3'
-
-	def displayName(self):
-		return self.tr('Indice A3')
-
-	def group(self):
-		return self.tr('IQM (indice solo)')
-
-	def groupId(self):
-		return 'iqm'
-
-	def shortHelpString(self):
-		return self.tr(
-			"Calcule l'indice A3 pour évaluer l’altération des régimes hydrologiques et sédimentaires ainsi que la présence de formes au niveau de la plaine alluviale à l’échelle du segment.\n Le niveau d’anthropisation du segment et la présence d’unités géomorphologiques sur la plaine sont évalués à l’intérieur du corridor fluvial sur une largeur respective de deux fois la largeur du lit mineur pour les milieux non confinés, ou de 15 m pour les milieux confinés. Le niveau d’anthropisation correspond à la surface de recouvrement relative à l’intérieur du corridor fluvial lié aux affectations urbanisées et agricoles. Une pénalité est appliquée en fonction du nombre de barrages à l’intérieur d’une distance de 1000 m à l’amont du segment analysé. Ces entraves qui créent des discontinuités dans le transport par charge de fond affectent grandement les conditions hydrauliques influençant les processus hydrogéomorphologiques et les formes présentes dans le lit mineur en aval de celles-ci.\n" \
-			"Paramètres\n" \
-			"----------\n" \
-			"Distance max du barrage au segment : Chiffre (int)(optionnel; valeur par défaut : 15)\n" \
-			"-> Distance maximale (en m) des barrages au segment. Parfois les points de barrages n'intersectent pas les lignes de réseau hydrographique. Cette distance est la distance maximale que l'algorithme va chercher autour de chaque barrage pour trouver le segment de rivière le plus proche pour effectuer le compte du nombre de barrages.\n" \
-			"Réseau hydrographique : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS. Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
-			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
-			"-> Nom du champ (attribut) identifiant le segment de rivière. NOTE : Doit se retrouver à la fois dans la table attributaire de la couche de réseau hydro et de la couche de PtRef. Source des données : Couche réseau hydrographique.\n" \
-			" Champ ID segment d'aval : Chaine de caractère ('Id_UEA_aval' par défaut)\n" \
-			"-> Nom du champ (attribut) identifiant le segment de rivière situé en aval. Source des données : Couche réseau hydrographique.\n" \
-			" Nbr de points visés : nombre entier (int; 200 par défaut)\n" \
-			"Barrages : Vectoriel (point)\n" \
-			"-> Répertorie les barrages d'un mètre et plus pour le bassin versant donné. Source des données : Centre d'expertise hydrique du Québec (CEHQ). Répertoire des barrages, [Jeu de données], dans Navigateur cartographique du Partenariat Données Québec, IGO2.\n" \
-			"Utilisation du territoire : Matriciel\n" \
-			"-> Classes d'utilisation du territoire pour le bassin versant donné sous forme matricielle (résolution 10 m) qui sera reclassé pour les classes forestières, agricole et anthropique, selon le guide d'utilisation du jeu de données. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Utilisation du territoire, [Jeu de données], dans Données Québec.\n" \
-			"PtRef largeur : Vectoriel (points)\n" \
-			"-> Points de référence rapportant la largeur modélisée du segment contenant l'information de la couche PtRef et la table PtRef_mod_lotique provenant des données du CRHQ (couche sortante du script UEA_PtRef_join). Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
-			" Champ PtRef largeur : Chaine de caractère ('Largeur_mod' par défaut)\n" \
-			"-> Nom du champ (attribut) identifiant la largeur du chenal. Source des données : Couche PtRef largeur.\n" \
-			"Retourne\n" \
-			"----------\n" \
-			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec le nombre de barrages en amont et le score de l'indice A3 calculé pour chaque UEA."
-		)
 
 def is_metric_crs(crs):
 	# True if the distance unit of the CRS is the meter
@@ -403,6 +458,7 @@ def find_segment_for_structure_fast(struct, hydro_layer, hydro_index, max_dist=5
 	best_d = float('inf')
 	for fid in candidate_ids:
 		feat = next(hydro_layer.getFeatures(QgsFeatureRequest(fid)))
+		instrumentation.count_geos('distance')
 		d = feat.geometry().distance(struct.geometry())
 		if d < best_d:
 			best_d = d
@@ -410,79 +466,15 @@ def find_segment_for_structure_fast(struct, hydro_layer, hydro_index, max_dist=5
 	return best if best and best_d <= max_dist else None
 
 
-def endpoints_as_points(geom: QgsGeometry):
-	# Return (p0, p1) as QgsPointXY, by taking the longuest point if MultiLine
-	if geom.isMultipart():
-		lines = geom.asMultiPolyline()
-		line = max(lines, key=lambda l: QgsGeometry.fromPolylineXY(l).length())
-	else:
-		line = geom.asPolyline()
-	if not line:
-		return None, None
-	return QgsPointXY(line[0]), QgsPointXY(line[-1])
-
-
-def nearest_endpoint_to_geom(p0: QgsPointXY, p1: QgsPointXY, other_geom: QgsGeometry):
-	gp0 = QgsGeometry.fromPointXY(p0)
-	gp1 = QgsGeometry.fromPointXY(p1)
-	d0 = gp0.distance(other_geom)
-	d1 = gp1.distance(other_geom)
-	return (gp0, d0) if d0 <= d1 else (gp1, d1)
-
-
 def get_intersection_point(upstream_feat, downstream_feat, tol=1.0):
 	"""
 	Returns a QgsGeometry point belonging to upstream_feat (current segment),
-	representing the “junction” with downstream_feat.
-	Cases
-	1) explicit intersction -> point
-	2) close endpoints -> upstream enpoint as intersection
-	3) fallback nearestPoints -> nearest upstream enpoint 
-	4) Safeguard against parallele segments (distance at endpoints >> nearestPoints)
+	representing the “junction” with downstream_feat (see IQM_Core.compute.junction_point).
 	"""
-	g_up = upstream_feat.geometry()
-	g_dw = downstream_feat.geometry()
-	# 1) Explicit intersection
-	inter = g_up.intersection(g_dw)
-	if inter and not inter.isEmpty():
-		if inter.type() == QgsWkbTypes.PointGeometry:
-			if inter.isMultipart():
-				pts = inter.asMultiPoint()
-				return QgsGeometry.fromPointXY(pts[0]) if pts else None
-			else:
-				return inter
-		elif inter.type() == QgsWkbTypes.LineGeometry:
-			# Overlap : we take the upstream end closest to the downstream segment
-			p0, p1 = endpoints_as_points(g_up)
-			if p0 is None: 
-				return None
-			cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-			if distc <= tol:
-				return cand
-			# Otherwise fallback
-		# If PolygonGeometry or other, goes to fallback
-	# 2) Proximal endpoints (tol): the upstream end closest to the downstream segment is selected
-	p0, p1 = endpoints_as_points(g_up)
-	if p0 is None:
+	point = compute.junction_point(transport.line_parts(upstream_feat.geometry()), transport.line_parts(downstream_feat.geometry()), tol)
+	if point is None:
 		return None
-	cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-	if distc <= tol:
-		return cand  # point on upstream
-	# 3) Fallback nearestPoints
-	n_up = g_up.nearestPoint(g_dw)
-	n_dw = g_dw.nearestPoint(g_up)
-	if (n_up is None) or n_up.isEmpty() or (n_dw is None) or n_dw.isEmpty():
-		return None
-	# Minimum Euclidean distance between geometries (on potential internal points)
-	d_np = n_up.distance(n_dw)  # distance between the 2 points
-	# The junction is constrained to the upstream end closest to g_dw (not an interior point).
-	# (makes sure that lineLocatePoint() applies correctly to upstream)
-	cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-	# 4) Parallelism safeguard: if dist endpoint >> dist nearestPoints (on interior point), we doubt
-	if d_np > 0 and distc > 3.0 * d_np:
-		return None
-	# Otherwise, the most plausible upstream end is used as the junction
-	return cand
+	return QgsGeometry.fromPointXY(QgsPointXY(float(point[0]), float(point[1])))
 
 
 def line_distance_between_points(line_geom: QgsGeometry, ptA_geom: QgsGeometry, ptB_geom: QgsGeometry) -> float:
@@ -491,6 +483,7 @@ def line_distance_between_points(line_geom: QgsGeometry, ptA_geom: QgsGeometry,
 	in meters (assumes metric CRS).
 	Uses lineLocatePoint to project points onto the polyline.
 	"""
+	instrumentation.count_geos('lineLocatePoint', 2)
 	a = line_geom.lineLocatePoint(ptA_geom)
 	b = line_geom.lineLocatePoint(ptB_geom)
 	# a and b are distances from the start of the line
@@ -524,77 +517,143 @@ def reduce_landuse(landuse, context, feedback):
 	return processing.run('native:reclassifybytable', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
 
 
-def compute_landuse_areas(landuse_raster, basin_layer, context, feedback):
-		# Inputs: Landuse raster, Basin polygon
-		# Output: Landuse counts (m²)
-
-		# Zonal histogram: produces pixel counts as fields lc_1, lc_2, lc_3, lc_4
-		alg_params = {
-			'INPUT_RASTER': landuse_raster,
-			'RASTER_BAND': 1,
-			'INPUT_VECTOR': basin_layer,
-			'COLUMN_PREFIX': 'lc_',
-			'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-		}
-		zonalhist = processing.run('qgis:zonalhistogram', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
-
-		# Multiply pixel counts for each land class by 100 to get area in m²
-		lc_fields = ['lc_1', 'lc_2', 'lc_3', 'lc_4']
-		area_fields = ['forest_area', 'agri_area', 'anthro_area', 'water_area']
-
-		for i, field in enumerate(lc_fields):
-			alg_params = {
-				'INPUT': zonalhist,
-				'FIELD_NAME': area_fields[i],
-				'FIELD_TYPE': 0,  # Float
-				'FIELD_LENGTH': 20,
-				'FIELD_PRECISION': 2,
-				'FORMULA': f'"{field}" * 100',
-				'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-			}
-			zonalhist = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
-
-		# Compute total land area = forest + agri + anthro
-		alg_params = {
-			'INPUT': zonalhist,
-			'FIELD_NAME': 'land_area',
-			'FIELD_TYPE': 0,  # Float
-			'FIELD_LENGTH': 20,
-			"FIELD_PRECISION": 2,
-			'FORMULA': '"forest_area" + "agri_area" + "anthro_area"',
-			'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-		}
-		return processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
-
-
-def computeA3(stream2x, context, feedback):
-	a3_formula = """
-		with_variable(
-		'penalty',
-		CASE
-			WHEN "Nb_barrage_amont" = 1 THEN 2
-			WHEN "Nb_barrage_amont" > 1 THEN 4
-			ELSE 0
-		END,
-		CASE
-			WHEN "land_area" = 0 THEN @penalty + 2
-			WHEN (("anthro_area" + "agri_area")/"land_area") >= 0.9 THEN @penalty + 4
-			WHEN (("anthro_area" + "agri_area")/"land_area") >= 0.66 THEN @penalty + 3
-			WHEN (("anthro_area" + "agri_area")/"land_area") >= 0.33 THEN @penalty + 2
-			WHEN (("anthro_area" + "agri_area")/"land_area") >= 0.1 THEN @penalty + 1
-			ELSE @penalty
-		END	
+def mean_widths_near_segments(hydro_layer, ptref_layer, seg_id_field, width_field, max_distance=5, default_width=5):
+	"""
+	Mean width of the PtRef points located within max_distance of each segment.
+	Same result as coalesce(array_mean(overlay_nearest(ptref, width, limit:=-1, max_distance:=5)), 5)
+	but with a single spatial index instead of one expression evaluation per segment.
+	Returns a dict: {sid: mean_width}
+	"""
+	ptref_index = QgsSpatialIndex()
+	ptref_items = {}
+	# Only the PtRef within reach of the network
+	for pf in ptref_layer.getFeatures(QgsFeatureRequest().setFilterRect(hydro_layer.extent().buffered(max_distance))):
+		g = pf.geometry()
+		val = pf[width_field]
+		if not g or g.isEmpty() or val is None or val == NULL:
+			continue
+		ptref_index.addFeature(pf)
+		ptref_items[pf.id()] = (g, float(val))
+
+	mean_widths = {}
+	for seg in hydro_layer.getFeatures():
+		seg_geom = seg.geometry()
+		widths = []
+		if seg_geom and not seg_geom.isEmpty():
+			for fid in ptref_index.intersects(seg_geom.boundingBox().buffered(max_distance)):
+				g, w = ptref_items[fid]
+				instrumentation.count_geos('distance')
+				if seg_geom.distance(g) <= max_distance:
+					widths.append(w)
+		mean_widths[seg[seg_id_field]] = float(np.mean(widths)) if widths else float(default_width)
+	return mean_widths
+
+
+def corridor_landuse_areas(landuse_raster, hydro_layer, seg_id_field, radii, feedback=None, chunk=32, costs=None):
+	"""
+	Land use areas inside the fluvial corridor of every segment, computed in a single raster pass.
+
+	Every cell of the reclassified land use raster is allocated to its nearest segment
+	(exact distance from the cell center to the line) as long as this distance is at most
+	the corridor radius of that segment. The class cells of all the segments are then
+	counted at once, instead of reading the raster once per buffer polygon.
+
+	Parameters
+	----------
+	landuse_raster : str
+		Path of the reclassified land use raster (1 forest, 2 agricultural, 3 anthropic, 4 water)
+	hydro_layer : QgsVectorLayer
+		River network layer, in the CRS of the raster
+	seg_id_field : str
+		Name of the segment identifier field
+	radii : dict
+		Corridor radius (m) of each segment identifier
+	feedback : QgsProcessingFeedback
+		Optional feedback used to report the progress
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (None : costs not recorded)
+
+	Returns
+	----------
+	areas : dict
+		{sid: (forest_area, agri_area, anthro_area)} in m²
+	"""
+	ds = gdal.Open(str(landuse_raster))
+	if ds is None:
+		raise RuntimeError(f"Impossible d'ouvrir le raster d'utilisation du territoire : {landuse_raster}")
+	x0, px, _, y0, _, py = ds.GetGeoTransform()
+	cell_area = abs(px * py)
+
+	# Vertex arrays and corridor radius of every segment (index 0 is kept for unallocated cells)
+	keys = [None]
+	seg_parts = [[]]
+	seg_radii = [0.0]
+	for f in hydro_layer.getFeatures():
+		sid = f[seg_id_field]
+		keys.append(sid)
+		seg_parts.append(transport.line_parts(f.geometry()))
+		seg_radii.append(float(radii.get(sid, 0.0)))
+	areas = {sid: (0.0, 0.0, 0.0) for sid in keys[1:]}
+	all_parts = [p for parts in seg_parts for p in parts]
+	if not all_parts:
+		return areas
+
+	# Read only the raster window covering the network and its widest corridor
+	r_max = max(seg_radii)
+	xy = np.vstack(all_parts)
+	col0 = max(0, int(math.floor((xy[:, 0].min() - r_max - x0) / px)))
+	col1 = min(ds.RasterXSize, int(math.ceil((xy[:, 0].max() + r_max - x0) / px)))
+	row0 = max(0, int(math.floor((xy[:, 1].max() + r_max - y0) / py)))
+	row1 = min(ds.RasterYSize, int(math.ceil((xy[:, 1].min() - r_max - y0) / py)))
+	if col1 <= col0 or row1 <= row0:
+		return areas
+	classes = ds.GetRasterBand(1).ReadAsArray(col0, row0, col1 - col0, row1 - row0).astype(np.int64)
+	classes[(classes < 0) | (classes > 4)] = 0
+	ds = None
+
+	# Nearest-segment allocation and distance rasters, restricted to the corridors
+	best_dist = np.full(classes.shape, np.inf, dtype=np.float32)
+	alloc = np.zeros(classes.shape, dtype=np.int32)
+	n_seg = len(keys) - 1
+	for k in range(1, n_seg + 1):
+		r = seg_radii[k]
+		if r <= 0:
+			continue
+		# Allocation of the corridor cells of the segment (cost of the segment in the cost report)
+		with instrumentation.measure(costs, keys[k]) as cost:
+			cost['vertices'] += sum(len(coords) for coords in seg_parts[k])
+			for coords in seg_parts[k]:
+				# Vertices are handled by overlapping chunks to keep the cell windows small
+				for i in range(0, len(coords) - 1, chunk):
+					pts = coords[i:i + chunk + 1]
+					ca = max(0, int(math.floor((pts[:, 0].min() - r - x0) / px)) - col0)
+					cb = min(col1, int(math.ceil((pts[:, 0].max() + r - x0) / px))) - col0
+					ra = max(0, int(math.floor((pts[:, 1].max() + r - y0) / py)) - row0)
+					rb = min(row1, int(math.ceil((pts[:, 1].min() - r - y0) / py))) - row0
+					if cb <= ca or rb <= ra:
+						continue
+					xs = x0 + (np.arange(ca, cb) + col0 + 0.5) * px
+					ys = y0 + (np.arange(ra, rb) + row0 + 0.5) * py
+					d = compute.distance_to_polyline(xs, ys, pts)
+					win_dist = best_dist[ra:rb, ca:cb]
+					win_alloc = alloc[ra:rb, ca:cb]
+					closer = (d <= r) & (d < win_dist)
+					win_dist[closer] = d[closer]
+					win_alloc[closer] = k
+		if feedback is not None:
+			if feedback.isCanceled():
+				return areas
+			feedback.setProgress(int(100 * (k / n_seg)))
+
+	# One pass over the land use: class counts of every segment at once
+	inside = alloc > 0
+	counts = np.bincount(alloc[inside].astype(np.int64) * 5 + classes[inside], minlength=(n_seg + 1) * 5).reshape(n_seg + 1, 5)
+	for k in range(1, n_seg + 1):
+		forest, agri, anthro = areas[keys[k]]
+		areas[keys[k]] = (
+			forest + counts[k, 1] * cell_area,
+			agri + counts[k, 2] * cell_area,
+			anthro + counts[k, 3] * cell_area
 		)
-		"""
-	# Compute A3
-	alg_params = {
-		'INPUT': stream2x,
-		'FIELD_NAME': 'Indice A3',
-		'FIELD_TYPE': 2,  # 2 = integer
-		'FIELD_LENGTH': 3,
-		'FIELD_PRECISION': 0,
-		'NEW_FIELD': True,
-		'FORMULA': a3_formula,
-		'OUTPUT': QgsProcessingUtils.generateTempFilename("watersheds2x.shp")
-	}
-	return processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)['OUTPUT']
\ No newline at end of file
+	return areas
+
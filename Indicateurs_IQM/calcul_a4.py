@@ -28,15 +28,32 @@
 from qgis.PyQt.QtCore import QCoreApplication, QMetaType
 from qgis.core import (
 	QgsProcessing,
-	QgsFeatureSink,
 	QgsField,
 	QgsProcessingException,
+	QgsProcessingFeedback,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterString,
 	QgsProcessingParameterVectorLayer,
 	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterBoolean,
+	QgsProcessingParameterFileDestination,
 )
-from qgis import processing
+import sys
+import numpy as np
+from pathlib import Path
+
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, profiling, transport
+
+# Fields added to the river network by the A4 index, in the order of the values returned by compute_a4
+OUTPUT_FIELDS = [
+	QgsField("Dist lineaire", QMetaType.Double, prec=2),
+	QgsField("Indice sinuosite", QMetaType.Double, prec=2),
+	QgsField("Indice A4", QMetaType.Int)
+]
 
 
 class calculerIc(QgsProcessingAlgorithm):
@@ -47,6 +64,9 @@ class calculerIc(QgsProcessingAlgorithm):
 	def initAlgorithm(self, config=None):
 		self.addParameter(QgsProcessingParameterVectorLayer(self.INPUT, self.tr('Réseau hydrographique (CRHQ)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None))
 		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie')))
 
 
@@ -75,10 +95,7 @@ class calculerIc(QgsProcessingAlgorithm):
 			raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
 
 		#Adding new field to output
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Dist lineaire", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Indice sinuosite", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Indice A4", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		(sink, dest_id) = self.parameterAsSink(
 			parameters,
@@ -97,125 +114,39 @@ class calculerIc(QgsProcessingAlgorithm):
 		if sink is None:
 			raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
 
-		# Get boundaries of all river segments
-		feedback.setProgressText(self.tr("Extraction des extrémités avec native:boundary..."))
+		# Compute the chord length, the sinuosity index and A4 for all river segments at once
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), feedback)
 		try :
-			rivnet_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
-			boundary_layer = processing.run("native:boundary", {
-				'INPUT': rivnet_layer,
-				'OUTPUT': 'memory:'
-			}, context=context)['OUTPUT']
+			with profiling.step(profiler, 'indice A4'):
+				a4_map = compute_a4(source, seg_id_field, costs=costs, feedback=feedback)
 		except Exception as e :
-			feedback.reportError(self.tr(f"Erreur dans la création des points d'extrémités : {str(e)}"))
+			feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice A4 : {str(e)}"))
+			return {}
+		if a4_map is None:
 			return {}
 
-		# Regroup the points per segments (Id_UEA)
-		extremities = {}
-		for point_feat in boundary_layer.getFeatures():
-			fid = point_feat[seg_id_field]
-			if fid not in extremities:
-				extremities[fid] = []
-			geom = point_feat.geometry()
-			# Gérer Point et MultiPoint
-			if geom.isMultipart():
-				pts = geom.asMultiPoint()
-			else:
-				pts = [geom.asPoint()]
-			for pt in pts:
-				extremities[fid].append(pt)
-		
-		# Compute the number of steps to display within the progress bar and
-		# get features from source
-		total_features = source.featureCount()
-		feedback.pushInfo(self.tr(f"{total_features} features (segments) à traiter"))
-
-		# Calculate sinuosity index and A4 for each river segment
-		feedback.setProgressText(self.tr("Calcul de l'indice de sinuosité et de l'indice A4..."))
+		# Write the results in the sink
 		try :
-			for current, feature in enumerate(source.getFeatures()):
-				# Stop the algorithm if cancel button has been clicked
-				if feedback.isCanceled():
-					break
-
-				# Extract boundary points for the current segment
-				sid = feature[seg_id_field]
-				geom = feature.geometry()
-				points = extremities.get(sid, [])
-
-				if len(points) == 2:
-					# Normal case, 2 extremities
-					distance = points[0].distance(points[1])
-				# If more than two points (non continuous line), removes vertices of disjoint lines until only the two extremities of the segment remains
-				elif len(points) > 2:
-					try:
-						# Initialise the list of remaining points
-						remaining_points = points.copy()
-						while len(remaining_points) > 2 : 
-							# Finds disjoint vertices pairs (those closest to each others)
-							min_dist = float('inf')
-							p_close1, p_close2 = None, None
-							# Iterates over the boundary points and finds those furthest from each others (the extremities)
-							for i in range(len(remaining_points)):
-								for j in range(i+1, len(remaining_points)):
-									d = remaining_points[i].distance(remaining_points[j])
-									if d < min_dist:
-										min_dist = d
-										p_close1, p_close2 = remaining_points[i], remaining_points[j]
-							# Verify that we found a pair
-							if p_close1 is None or p_close2 is None:
-								feedback.reportError(self.tr(f"Impossible de trouver une paire de points pour le segment {sid}"))
-								distance = 0
-								break
-							remaining_points.remove(p_close1)
-							remaining_points.remove(p_close2)
-						# The last two points are the extremities of the segment
-						if len(remaining_points) == 2 :
-							distance = remaining_points[0].distance(remaining_points[1])
-						else : 
-							feedback.reportError(self.tr(f"Nombre de points restants incorrect ({len(remaining_points)}) pour le segment {sid}"))
-							distance = 0
-					except Exception as e :
-						feedback.reportError(self.tr(f"Erreur dans la recherche des points d'extremites : {str(e)}"))
-				else:
-					distance = 0  # Edge case
-				if distance <= 2 :
-					feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
-				# Calculate the sinuosity index (Is)
-				if distance > 0:
-					# Is = length of the channel/length from both extremities
-					Is = geom.length() / distance
-				else:
-					# If start and endpoint are connected make 
-					Is = 1
-
-				# A4 index calculation where Is is the sinuosity index
-				if Is >= 1.5:      # Sinuosity greater or equal than 1.5 (High sinuosity)
-					indice_A4 = 0
-				elif Is >= 1.25:   # Sinuosity between [1.25-1.5[ (Medium sinuosity)
-					indice_A4 = 2
-				elif Is >= 1.05:   # Sinuosity between [1.05-1.25[ (Low sinuosity)
-					indice_A4 = 4
-				else:              # Suniosity < 1.05 (linear)
-					indice_A4 = 6
-
-				feature.setAttributes(feature.attributes() + [distance, Is, indice_A4])
-
-				# Add a feature in the sink
-				sink.addFeature(feature, QgsFeatureSink.FastInsert)
-
-				# Increments the progress bar
-				if total_features != 0:
-					progress = int(100*(current/total_features))
-				else:
-					progress = 0
-				feedback.setProgress(progress)
+			index_results.write_results(sink, source.getFeatures(), seg_id_field, (a4_map, len(OUTPUT_FIELDS)))
 		except Exception as e :
 			feedback.reportError(self.tr(f"Erreur dans la boucle de segments : {str(e)}"))
 
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'A4', feedback)
+
 		# Ending message
 		feedback.setProgressText(self.tr('Processus terminé !'))
 
-		return {self.OUTPUT: dest_id}
+		return results
 
 
 	def tr(self, string):
@@ -251,8 +182,85 @@ class calculerIc(QgsProcessingAlgorithm):
 			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS. Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
 			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
 			"-> Nom du champ (attribut) identifiant le segment de rivière. NOTE : Doit se retrouver à la fois dans la table attributaire de la couche de réseau hydro et de la couche de PtRef. Source des données : Couche réseau hydrographique.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
 			"Retourne\n" \
 			"----------\n" \
 			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec la distance linéaire entre les extrémités du segment, l'indice de sinuosité et le score de l'indice A4 calculé pour chaque UEA."
+			"-> Réseau hydrographique du bassin versant avec la distance linéaire entre les extrémités du segment, l'indice de sinuosité et le score de l'indice A4 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
 		)
+
+
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def compute_a4(source, seg_id_field='Id_UEA', costs=None, feedback=None):
+	"""
+	Computes the sinuosity index and the A4 index of every segment of the river network.
+
+	Parameters
+	----------
+	source : QgsFeatureSource
+		River network
+	seg_id_field : str
+		Name of the segment identifier field
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (None : costs not recorded)
+
+	Returns
+	----------
+	a4_map : dict
+		{sid: [linear distance between the extremities, sinuosity index, A4 index]} (None if canceled)
+	"""
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	total_features = source.featureCount()
+	feedback.pushInfo(tr(f"{total_features} features (segments) à traiter"))
+
+	# Read the vertex array of each segment once to get its length and the chord between its extremities
+	feedback.setProgressText(tr("Calcul de la distance linéaire entre les extrémités des segments..."))
+	sids = []
+	lengths = []
+	chords = []
+	for current, feature in enumerate(source.getFeatures()):
+		# Stop the algorithm if cancel button has been clicked
+		if feedback.isCanceled():
+			return None
+		geom = feature.geometry()
+		sids.append(feature[seg_id_field])
+		with instrumentation.measure(costs, feature[seg_id_field]) as cost:
+			instrumentation.count_geos('length')
+			lengths.append(geom.length() if geom and not geom.isEmpty() else 0.0)
+			# Parts sharing an endpoint are first merged
+			if geom and geom.isMultipart():
+				instrumentation.count_geos('mergeLines')
+				merged = geom.mergeLines()
+				if merged and not merged.isEmpty():
+					geom = merged
+			parts = transport.line_parts(geom)
+			cost['vertices'] += sum(len(part) for part in parts)
+			chords.append(compute.chord_length(parts))
+		# Increments the progress bar
+		if total_features != 0:
+			progress = int(100*(current/total_features))
+		else:
+			progress = 0
+		feedback.setProgress(progress)
+
+	# Calculate sinuosity index and A4 for all river segments at once
+	feedback.setProgressText(tr("Calcul de l'indice de sinuosité et de l'indice A4..."))
+	lengths = np.asarray(lengths, dtype=float)
+	distances = np.asarray(chords, dtype=float)
+	sinuosity = compute.sinuosity_index(lengths, distances)
+	indices_a4 = compute.score_a4(sinuosity)
+	a4_map = {}
+	for i, sid in enumerate(sids):
+		distance = float(distances[i])
+		if distance <= 2 :
+			feedback.pushInfo(tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
+		a4_map[sid] = [distance, float(sinuosity[i]), int(indices_a4[i])]
+	return a4_map
@@ -23,13 +23,14 @@
 *********************************************************************************
 """
 
+import sys
 import processing
+from pathlib import Path
 from qgis.PyQt.QtCore import QCoreApplication, QMetaType
 from qgis.core import (
 	QgsProcessing,
 	QgsProcessingUtils,
 	QgsPointXY,
-	QgsFeatureSink,
 	QgsField,
 	QgsProcessingException,
 	QgsProcessingAlgorithm,
@@ -38,13 +39,26 @@ from qgis.core import (
 	QgsProcessingParameterBoolean,
 	QgsProcessingParameterVectorLayer,
 	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterFileDestination,
 	QgsSpatialIndex,
-	QgsWkbTypes,
 	QgsUnitTypes,
 	QgsFeatureRequest,
-	QgsGeometry
+	QgsGeometry,
+	QgsProcessingFeedback
 )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, profiling, transport
+
+# Fields added to the river network by the F1 index, in the order of the values returned by compute_f1
+OUTPUT_FIELDS = [
+	QgsField("Nb_struct_amont", QMetaType.Int),
+	QgsField("Indice F1", QMetaType.Int)
+]
+
 
 class IndiceF1(QgsProcessingAlgorithm):
 	INPUT = 'INPUT'
@@ -59,6 +73,9 @@ class IndiceF1(QgsProcessingAlgorithm):
 		self.addParameter(QgsProcessingParameterString('segment_id_down_field', self.tr("Nom du champ identifiant le segment d'aval"), defaultValue=self.DEFAULT_DOWN_SEG_ID_FIELD))
 		self.addParameter(QgsProcessingParameterVectorLayer('structs', self.tr('Structures (MTMD) (filtrées ou non)'), types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
 		self.addParameter(QgsProcessingParameterVectorLayer('routes', self.tr('Réseau routier (OSM)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie')))
 
 
@@ -104,9 +121,7 @@ class IndiceF1(QgsProcessingAlgorithm):
 			raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
 
 		#Adding new field to output
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Nb_struct_amont", QMetaType.Int))
-		sink_fields.append(QgsField("Indice F1", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		(sink, dest_id) = self.parameterAsSink(
 			parameters,
@@ -128,10 +143,6 @@ class IndiceF1(QgsProcessingAlgorithm):
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 		seg_id_down_field = self.parameterAsString(parameters, 'segment_id_down_field', context)
 
-		# Create spatial index to make the finding of the nearest segment faster
-		hydro_index = QgsSpatialIndex(hydro_layer.getFeatures())
-		id_to_feat = {f[seg_id_field]: f for f in hydro_layer.getFeatures()}
-
 		# Make the filtered structure df if its not given
 		structs_are_filtered = self.parameterAsBool(parameters, 'structs_are_filtered', context)
 		if structs_are_filtered == False :
@@ -156,25 +167,155 @@ class IndiceF1(QgsProcessingAlgorithm):
 		else : # If its already filtered makes the layer from what is given as a parameter
 			struct_layer = self.parameterAsVectorLayer(parameters, 'structs', context)
 
-		structure_counts = {}
-		# Gets the number of features to iterate over for the progress bar
-		total_features = struct_layer.featureCount()
-		model_feedback.pushInfo(self.tr(f"\t {total_features} features (structures) à traiter"))
+		# Count the structures within 1000 m upstream of each segment and compute the F1 index
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), model_feedback)
+		try :
+			with profiling.step(profiler, 'indice F1'):
+				f1_map = compute_f1(hydro_layer, struct_layer, seg_id_field, seg_id_down_field, costs=costs, feedback=model_feedback)
+		except Exception as e :
+			model_feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice F1 : {str(e)}"))
+			return {}
+		if f1_map is None:
+			return {}
 
+		model_feedback.setProgressText(self.tr(f"Compte des structures terminé."))
+		if model_feedback.isCanceled():
+			return {}
+
+		# Write the structure count and the F1 score of each river segment
 		try :
-			for current, struct in enumerate(struct_layer.getFeatures()):
+			index_results.write_results(sink, source.getFeatures(), seg_id_field, (f1_map, len(OUTPUT_FIELDS)))
+		except Exception as e :
+			model_feedback.reportError(self.tr(f"Erreur dans le calcul de F1 et le sink des features : {str(e)}"))
+
+		model_feedback.setProgressText(self.tr(f"Calcul du score de F1 terminé."))
+		if model_feedback.isCanceled():
+				return {}
+
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, model_feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'F1', model_feedback)
+
+		# Ending message
+		model_feedback.setProgressText(self.tr('\tProcessus terminé !'))
+
+		return results
+
+
+	def tr(self, string):
+		return QCoreApplication.translate('Processing', string)
+
+
+	def createInstance(self):
+		return IndiceF1()
+
+
+	def name(self):
+		return 'indicef1'
+
+
+	def displayName(self):
+		return self.tr('Indice F1')
+
+
+	def group(self):
+		return self.tr('IQM (indice solo)')
+
+
+	def groupId(self):
+		return 'iqm'
+
+
+	def shortHelpString(self):
+		return self.tr(
+			"Calcule l'indice F1 pour évaluer la continuité du transit longitudinal du transit de sédiments et de bois.\n L'outil évalue la présence d\'obstacles (traverses, ponts, ponceaux, intersections, etc.) du réseau routier ou ferroviaire qui pourraient entraver ou nuire au transport de sédiments et de bois. Il prend en compte la densité linéaire des entraves sur 1000 m de rivière. Puisque les effets des entraves affectent la portion en aval de l'infrastructure, l'outil considère seulement les éléments artificiels situés à une distance maximale de 1000 m à l'amont du segment.\n" \
+			"Paramètres\n" \
+			"----------\n" \
+			"Couche de structures déjà filtrée fournise: Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Détermine si la couche de structures fournise à déjà été filtrée (préalablement produite par Filtrer structures).\n" \
+			"Réseau hydrographique : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
+			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière. Source des données : Couche réseau hydrographique.\n" \
+			" Champ ID segment d'aval : Chaine de caractère ('Id_UEA_aval' par défaut)\n" \
+			"-> Nom du champ (attribut) identifiant le segment de rivière situé en aval. Source des données : Couche réseau hydrographique.\n" \
+			"Structures : Vectoriel (points)\n" \
+			"-> Ensemble de données vectorielles ponctuelles des structures sous la gestion du Ministère des Transports et de la Mobilité durable du Québec (MTMD) (pont, ponceau, portique, mur et tunnel) ayant été préalablement filtrées par le script Filtrer structures ou non. Source des données : MTMD. Structure, [Jeu de données], dans Données Québec.\n" \
+			"Réseau routier : Vectoriel (lignes; optionnel)\n" \
+			"-> Réseau routier linéaire représentant les rues, les avenues, les autoroutes et les chemins de fer. Doit avoir préalablement avoir passé par le script Extraction routes d'OSM. Source des données : OpenStreetMap contributors. Dans OpenStreetMap.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
+			"Retourne\n" \
+			"----------\n" \
+			"Couche de sortie : Vectoriel (lignes)\n" \
+			"-> Réseau hydrographique du bassin versant avec le score de l'indice F1 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
+		)
+
+
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def compute_f1(hydro_layer, struct_layer, seg_id_field='Id_UEA', seg_id_down_field='Id_UEA_aval', costs=None, feedback=None):
+	"""
+	Computes the F1 index of every segment of the river network.
+
+	Parameters
+	----------
+	hydro_layer : QgsVectorLayer
+		River network layer
+	struct_layer : QgsVectorLayer
+		Filtered structures (output of Filtrer structures)
+	seg_id_field, seg_id_down_field : str
+		Names of the segment and downstream segment identifier fields
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (work of the structures of the segment, None : costs not recorded)
+
+	Returns
+	----------
+	f1_map : dict
+		{sid: [number of structures within 1000 m upstream, F1 index]} (None if canceled)
+	"""
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	# Create spatial index to make the finding of the nearest segment faster
+	hydro_index = QgsSpatialIndex(hydro_layer.getFeatures())
+	id_to_feat = {f[seg_id_field]: f for f in hydro_layer.getFeatures()}
+
+	structure_counts = {}
+	# Only the structures within reach of the network (a partition of a large network reads its own structures)
+	structures = list(struct_layer.getFeatures(QgsFeatureRequest().setFilterRect(hydro_layer.extent().buffered(5))))
+	# Gets the number of features to iterate over for the progress bar
+	total_features = len(structures)
+	feedback.pushInfo(tr(f"\t {total_features} features (structures) à traiter"))
+
+	try :
+		for current, struct in enumerate(structures):
+			# The work of a structure is the cost of its segment in the cost report
+			with instrumentation.measure(costs) as cost:
 				current_feat = None
 				try :
 					# Finds the river segment of the current structure
 					current_feat = find_segment_for_structure_fast(struct, hydro_layer, hydro_index)
 				except Exception as e :
-					model_feedback.reportError(self.tr(f"Erreur dans find_segment_for_structure : {str(e)}"))
-					return {}
+					raise RuntimeError(tr(f"Erreur dans find_segment_for_structure : {str(e)}"))
 				if current_feat is None: # if no segment associated to the structure
-					#model_feedback.pushInfo(self.tr(f"Pas de segment associé à la structure actuelle. Prochain segment."))
+					#feedback.pushInfo(tr(f"Pas de segment associé à la structure actuelle. Prochain segment."))
 					continue
-				if model_feedback.isCanceled():
-					return {}
+				cost['sid'] = current_feat[seg_id_field]
+				if feedback.isCanceled():
+					return None
 
 				downstream_feat = None
 				try :
@@ -182,10 +323,9 @@ class IndiceF1(QgsProcessingAlgorithm):
 					downstream_id = current_feat[seg_id_down_field]
 					downstream_feat = id_to_feat.get(downstream_id)
 				except Exception as e :
-					model_feedback.reportError(self.tr(f"Erreur dans get_downstream_segment : {str(e)}"))
-					return {}
+					raise RuntimeError(tr(f"Erreur dans get_downstream_segment : {str(e)}"))
 				if downstream_feat is None:
-					#model_feedback.pushInfo(self.tr(f"Le segment d'aval ne fait pas partie du réseau hydrographique. Prochain segment."))
+					#feedback.pushInfo(tr(f"Le segment d'aval ne fait pas partie du réseau hydrographique. Prochain segment."))
 					continue
 
 				cum_dist = 0
@@ -195,15 +335,16 @@ class IndiceF1(QgsProcessingAlgorithm):
 				# Iterate over the next downstream segments while the cumulative distance from the structure to the downstream segment is less than 1000 meters
 				while (cum_dist < 1000) and (downstream_feat is not None) :
 					intersection_point = None
-					if model_feedback.isCanceled():
-						return {}
+					if feedback.isCanceled():
+						return None
+					cost['vertices'] += downstream_feat.geometry().constGet().nCoordinates()
 					try :
 						# Find the intersecting point between the structure river segment and the downstream segment
 						intersection_point = get_intersection_point(current_feat, downstream_feat, tol=5)
 					except Exception as e :
-						model_feedback.reportError(self.tr(f"Erreur dans get_intersection_point : {str(e)}"))
+						feedback.reportError(tr(f"Erreur dans get_intersection_point : {str(e)}"))
 					if intersection_point is None or intersection_point.isEmpty():
-						#model_feedback.pushInfo(self.tr(f"Le segment d'aval ne retourne pas d'intersection avec le segment courant. Prochain segment."))
+						#feedback.pushInfo(tr(f"Le segment d'aval ne retourne pas d'intersection avec le segment courant. Prochain segment."))
 						break
 
 					try :
@@ -213,8 +354,7 @@ class IndiceF1(QgsProcessingAlgorithm):
 						else : # Otherwise get the distance between the previous intersection and the current intersection
 							dist = line_distance_between_points(current_feat.geometry(), prev_intersection, intersection_point)
 					except Exception as e :
-						model_feedback.reportError(self.tr(f"Erreur dans compute_shortest_path : {str(e)}"))
-						return {}
+						raise RuntimeError(tr(f"Erreur dans compute_shortest_path : {str(e)}"))
 					# If the distance is < 1000 m, increment the downstream segment structure counter.
 					if dist is None or dist <= 0:
 						# Null or invalid distance.
@@ -247,85 +387,19 @@ class IndiceF1(QgsProcessingAlgorithm):
 					progress = int(100*(current/total_features))
 				else:
 					progress = 0
-				model_feedback.setProgress(progress)
-
-				if model_feedback.isCanceled():
-					return {}
-		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans la boucle de structure : {str(e)}"))
-
-		model_feedback.setProgressText(self.tr(f"Compte des structures terminé."))
-		if model_feedback.isCanceled():
-			return {}
-
-		# Computing the F1 score for each river segment
-		try :
-			for feat in source.getFeatures():
-				seg_id = feat[seg_id_field]
-				struct_count = structure_counts.get(seg_id, 0)
-				f1_score = computeF1(struct_count)
-				# Add both the structure count and the f1_score to the attributes table
-				feat.setAttributes(feat.attributes() + [struct_count, f1_score])
-				sink.addFeature(feat, QgsFeatureSink.FastInsert)
-		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans le calcul de F1 et le sink des features : {str(e)}"))
-
-		model_feedback.setProgressText(self.tr(f"Calcul du score de F1 terminé."))
-		if model_feedback.isCanceled():
-				return {}
-
-		# Ending message
-		model_feedback.setProgressText(self.tr('\tProcessus terminé !'))
-
-		return {self.OUTPUT: dest_id}
-
-
-	def tr(self, string):
-		return QCoreApplication.translate('Processing', string)
-
-
-	def createInstance(self):
-		return IndiceF1()
-
-
-	def name(self):
-		return 'indicef1'
-
-
-	def displayName(self):
-		return self.tr('Indice F1')
-
-
-	def group(self):
-		return self.tr('IQM (indice solo)')
+				feedback.setProgress(progress)
 
+				if feedback.isCanceled():
+					return None
+	except Exception as e :
+		feedback.reportError(tr(f"Erreur dans la boucle de structure : {str(e)}"))
 
-	def groupId(self):
-		return 'iqm'
-
-
-	def shortHelpString(self):
-		return self.tr(
-			"Calcule l'indice F1 pour évaluer la continuité du transit longitudinal du transit de sédiments et de bois.\n L'outil évalue la présence d\'obstacles (traverses, ponts, ponceaux, intersections, etc.) du réseau routier ou ferroviaire qui pourraient entraver ou nuire au transport de sédiments et de bois. Il prend en compte la densité linéaire des entraves sur 1000 m de rivière. Puisque les effets des entraves affectent la portion en aval de l'infrastructure, l'outil considère seulement les éléments artificiels situés à une distance maximale de 1000 m à l'amont du segment.\n" \
-			"Paramètres\n" \
-			"----------\n" \
-			"Couche de structures déjà filtrée fournise: Booléen (optionnel; valeur par défaut : Faux)\n" \
-			"-> Détermine si la couche de structures fournise à déjà été filtrée (préalablement produite par Filtrer structures).\n" \
-			"Réseau hydrographique : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique segmenté en unités écologiques aquatiques (UEA) pour le bassin versant donné. Source des données : MINISTÈRE DE L’ENVIRONNEMENT, LUTTE CONTRE LES CHANGEMENTS CLIMATIQUES, FAUNE ET PARCS (MELCCFP). Cadre de référence hydrologique du Québec (CRHQ), [Jeu de données], dans Données Québec.\n" \
-			" Champ ID segment : Chaine de caractère ('Id_UEA' par défaut)\n" \
-			"-> Nom du champ (attribut) identifiant le segment de rivière. Source des données : Couche réseau hydrographique.\n" \
-			" Champ ID segment d'aval : Chaine de caractère ('Id_UEA_aval' par défaut)\n" \
-			"-> Nom du champ (attribut) identifiant le segment de rivière situé en aval. Source des données : Couche réseau hydrographique.\n" \
-			"Structures : Vectoriel (points)\n" \
-			"-> Ensemble de données vectorielles ponctuelles des structures sous la gestion du Ministère des Transports et de la Mobilité durable du Québec (MTMD) (pont, ponceau, portique, mur et tunnel) ayant été préalablement filtrées par le script Filtrer structures ou non. Source des données : MTMD. Structure, [Jeu de données], dans Données Québec.\n" \
-			"Réseau routier : Vectoriel (lignes; optionnel)\n" \
-			"-> Réseau routier linéaire représentant les rues, les avenues, les autoroutes et les chemins de fer. Doit avoir préalablement avoir passé par le script Extraction routes d'OSM. Source des données : OpenStreetMap contributors. Dans OpenStreetMap.\n" \
-			"Retourne\n" \
-			"----------\n" \
-			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec le score de l'indice F1 calculé pour chaque UEA."
-		)
+	# Computing the F1 score for each river segment
+	f1_map = {}
+	for sid in id_to_feat:
+		struct_count = structure_counts.get(sid, 0)
+		f1_map[sid] = [struct_count, compute.score_f1(struct_count)]
+	return f1_map
 
 
 def is_metric_crs(crs):
@@ -340,6 +414,7 @@ def find_segment_for_structure_fast(struct, hydro_layer, hydro_index, max_dist=5
 	best_d = float('inf')
 	for fid in candidate_ids:
 		feat = next(hydro_layer.getFeatures(QgsFeatureRequest(fid)))
+		instrumentation.count_geos('distance')
 		d = feat.geometry().distance(struct.geometry())
 		if d < best_d:
 			best_d = d
@@ -347,79 +422,15 @@ def find_segment_for_structure_fast(struct, hydro_layer, hydro_index, max_dist=5
 	return best if best and best_d <= max_dist else None
 
 
-def endpoints_as_points(geom: QgsGeometry):
-	# Return (p0, p1) as QgsPointXY, by taking the longuest point if MultiLine
-	if geom.isMultipart():
-		lines = geom.asMultiPolyline()
-		line = max(lines, key=lambda l: QgsGeometry.fromPolylineXY(l).length())
-	else:
-		line = geom.asPolyline()
-	if not line:
-		return None, None
-	return QgsPointXY(line[0]), QgsPointXY(line[-1])
-
-
-def nearest_endpoint_to_geom(p0: QgsPointXY, p1: QgsPointXY, other_geom: QgsGeometry):
-	gp0 = QgsGeometry.fromPointXY(p0)
-	gp1 = QgsGeometry.fromPointXY(p1)
-	d0 = gp0.distance(other_geom)
-	d1 = gp1.distance(other_geom)
-	return (gp0, d0) if d0 <= d1 else (gp1, d1)
-
-
 def get_intersection_point(upstream_feat, downstream_feat, tol=1.0):
 	"""
 	Returns a QgsGeometry point belonging to upstream_feat (current segment),
-	representing the “junction” with downstream_feat.
-	Cases
-	1) explicit intersction -> point
-	2) close endpoints -> upstream enpoint as intersection
-	3) fallback nearestPoints -> nearest upstream enpoint 
-	4) Safeguard against parallele segments (distance at endpoints >> nearestPoints)
+	representing the “junction” with downstream_feat (see IQM_Core.compute.junction_point).
 	"""
-	g_up = upstream_feat.geometry()
-	g_dw = downstream_feat.geometry()
-	# 1) Explicit intersection
-	inter = g_up.intersection(g_dw)
-	if inter and not inter.isEmpty():
-		if inter.type() == QgsWkbTypes.PointGeometry:
-			if inter.isMultipart():
-				pts = inter.asMultiPoint()
-				return QgsGeometry.fromPointXY(pts[0]) if pts else None
-			else:
-				return inter
-		elif inter.type() == QgsWkbTypes.LineGeometry:
-			# Overlap : we take the upstream end closest to the downstream segment
-			p0, p1 = endpoints_as_points(g_up)
-			if p0 is None: 
-				return None
-			cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-			if distc <= tol:
-				return cand
-			# Otherwise fallback
-		# If PolygonGeometry or other, goes to fallback
-	# 2) Proximal endpoints (tol): the upstream end closest to the downstream segment is selected
-	p0, p1 = endpoints_as_points(g_up)
-	if p0 is None:
-		return None
-	cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-	if distc <= tol:
-		return cand  # point on upstream
-	# 3) Fallback nearestPoints
-	n_up = g_up.nearestPoint(g_dw)
-	n_dw = g_dw.nearestPoint(g_up)
-	if (n_up is None) or n_up.isEmpty() or (n_dw is None) or n_dw.isEmpty():
+	point = compute.junction_point(transport.line_parts(upstream_feat.geometry()), transport.line_parts(downstream_feat.geometry()), tol)
+	if point is None:
 		return None
-	# Minimum Euclidean distance between geometries (on potential internal points)
-	d_np = n_up.distance(n_dw)  # distance between the 2 points
-	# The junction is constrained to the upstream end closest to g_dw (not an interior point).
-	# (makes sure that lineLocatePoint() applies correctly to upstream)
-	cand, distc = nearest_endpoint_to_geom(p0, p1, g_dw)
-	# 4) Parallelism safeguard: if dist endpoint >> dist nearestPoints (on interior point), we doubt
-	if d_np > 0 and distc > 3.0 * d_np:
-		return None
-	# Otherwise, the most plausible upstream end is used as the junction
-	return cand
+	return QgsGeometry.fromPointXY(QgsPointXY(float(point[0]), float(point[1])))
 
 
 def line_distance_between_points(line_geom: QgsGeometry, ptA_geom: QgsGeometry, ptB_geom: QgsGeometry) -> float:
@@ -428,19 +439,9 @@ def line_distance_between_points(line_geom: QgsGeometry, ptA_geom: QgsGeometry,
 	in meters (assumes metric CRS).
 	Uses lineLocatePoint to project points onto the polyline.
 	"""
+	instrumentation.count_geos('lineLocatePoint', 2)
 	a = line_geom.lineLocatePoint(ptA_geom)
 	b = line_geom.lineLocatePoint(ptB_geom)
 	# a and b are distances from the start of the line
 	return abs(b - a)
 
-
-def computeF1(struct_count):
-	if struct_count == 0:
-		# No obstruction or alteration in the continuity of sediment and wood transport upstream of the segment
-		return 0
-	if struct_count <= 1:
-		# Presence of at least one obstacle to the continuous flow of sediment and wood upstream of the segment
-		return 2
-	elif struct_count > 1:
-		# Presence of more than one obstacle to the continuous flow of sediment and wood upstream of the segment
-		return 4
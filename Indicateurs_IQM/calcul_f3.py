@@ -25,15 +25,17 @@
 """
 
 
+import sys
+import time
 import numpy as np
 import math
+from pathlib import Path
 
 import processing
 from qgis.PyQt.QtCore import QMetaType, QCoreApplication
 from qgis.core import (
 	QgsProcessing,
 	QgsField,
-	QgsFeatureSink,
 	QgsUnitTypes,
 	QgsWkbTypes,
 	QgsPointXY,
@@ -48,10 +50,27 @@ from qgis.core import (
 	QgsProcessingUtils,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterVectorLayer,
+	QgsProcessingParameterEnum,
 	QgsProcessingParameterNumber,
-	QgsProcessingParameterFeatureSink
+	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterFileDestination,
+	QgsProcessingContext,
+	QgsProcessingFeedback
 )
 
+# Shared modules of the tool (IQM_Core) and the utility scripts are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, parallel, profiling, ptref, quicklook, service, transport
+from IQM_Utils import corridor_prefilter
+
+# Fields added to the river network by the F3 index, in the order of the values returned by compute_f3
+OUTPUT_FIELDS = [
+	QgsField("Pourc_15m", QMetaType.Double, prec=2),
+	QgsField("Indice F3", QMetaType.Int)
+]
+
 
 class IndiceF3(QgsProcessingAlgorithm):
 	OUTPUT = 'OUTPUT'
@@ -66,8 +85,19 @@ class IndiceF3(QgsProcessingAlgorithm):
 		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
 		self.addParameter(QgsProcessingParameterNumber('target_pts', self.tr('Nombre de points visés par segment'), type=QgsProcessingParameterNumber.Integer, defaultValue=50))
 		self.addParameter(QgsProcessingParameterNumber('step_min', self.tr('Longueur minimale entre les transects (m)'), type=QgsProcessingParameterNumber.Double, defaultValue=10))
+		self.addParameter(QgsProcessingParameterEnum('sampler', self.tr('Placement des transects'), options=compute.SAMPLER_LABELS, defaultValue=0))
+		self.addParameter(QgsProcessingParameterNumber('early_stop', self.tr("Niveau de confiance de l'arrêt anticipé des transects (0 : tous les transects)"), type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('time_budget', self.tr('Budget de temps par segment (s, 0 : aucun)'), type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterEnum('mode', self.tr('Mode d\'évaluation'), options=quicklook.MODES, defaultValue=quicklook.FULL))
+		self.addParameter(QgsProcessingParameterVectorLayer('quick_look_layer', self.tr('Couche de sortie de l\'aperçu (mode raffinement)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
 		self.addParameter(QgsProcessingParameterRasterLayer("landuse", self.tr("Utilisation du territoire (MELCCFP)"), defaultValue=None))
 		self.addParameter(QgsProcessingParameterBoolean('use_agri', self.tr('Utiliser milieux agricoles ?'), defaultValue=True, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('corridor_prefilter', self.tr('Préfiltrer les routes par corridor du réseau ?'), defaultValue=True, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('workers', self.tr('Nombre de processus pour les segments (0 : tous les coeurs)'), type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('use_service', self.tr('Utiliser le service de calcul local (IQM_Core.service) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie'), type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, supportsAppend=True, defaultValue=None))
 
 
@@ -96,6 +126,15 @@ class IndiceF3(QgsProcessingAlgorithm):
 			return False, self.tr(f"La couche de PtRef n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
 		if not is_metric_crs(roads_layer.crs()) :
 			return False, self.tr(f"La couche de bande riveraine n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
+		# Verify that the refinement starts from the output of a quick look
+		if self.parameterAsEnum(parameters, 'mode', context) == quicklook.REFINE:
+			quick_look_layer = self.parameterAsVectorLayer(parameters, 'quick_look_layer', context)
+			if quick_look_layer is None:
+				return False, self.tr("Le mode raffinement nécessite la couche de sortie de l'aperçu ! Veuillez fournir la couche produite par le mode aperçu.")
+			time_budget = self.parameterAsDouble(parameters, 'time_budget', context)
+			missing = quicklook.missing_fields(quick_look_layer, seg_id_field, index_results.budget_fields(OUTPUT_FIELDS, time_budget))
+			if missing:
+				return False, self.tr(f"La couche fournie ne contient pas les champs d'un aperçu de l'indice F3 ({', '.join(missing)}) ! Veuillez fournir la couche produite par le mode aperçu.")
 		return True, ''
 
 
@@ -111,18 +150,23 @@ class IndiceF3(QgsProcessingAlgorithm):
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 		target_pts = int(self.parameterAsDouble(parameters, 'target_pts', context))
 		step_min = float(self.parameterAsDouble(parameters, 'step_min', context))
+		sampler = compute.SAMPLERS[self.parameterAsEnum(parameters, 'sampler', context)]
+		confidence = self.parameterAsDouble(parameters, 'early_stop', context)
+		time_budget = self.parameterAsDouble(parameters, 'time_budget', context)
+		mode = self.parameterAsEnum(parameters, 'mode', context)
+		quick_look_layer = self.parameterAsVectorLayer(parameters, 'quick_look_layer', context)
 		use_agri = self.parameterAsBool(parameters, 'use_agri', context)
-		# Length of the transects and margin to use
-		TRANSECT_LENGTH = 16
-		MARGIN = 2.0
+		use_corridor = self.parameterAsBool(parameters, 'corridor_prefilter', context)
+		workers = self.parameterAsInt(parameters, 'workers', context)
+		use_service = self.parameterAsBool(parameters, 'use_service', context)
 		# Verify the layers are created properly
 		for layer, name in [[rivnet_layer, "Réseau hydrographique"], [roads_layer, "Réseau routier"], [ptref_layer, "PtRef largeur"]] :
 			if layer is None or not layer.isValid() :
 				raise RuntimeError(self.tr(f"Couche {name} invalide."))
 		# Define sink
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Pourc_15m", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Indice F3", QMetaType.Int))
+		# Output fields of the index (with the approximation flag when the segments have a time budget)
+		fields = index_results.budget_fields(OUTPUT_FIELDS, time_budget)
+		sink_fields = index_results.output_fields(source.fields(), quicklook.output_fields(fields, mode))
 		(sink, dest_id) = self.parameterAsSink(
 			parameters,
 			self.OUTPUT,
@@ -132,195 +176,41 @@ class IndiceF3(QgsProcessingAlgorithm):
 			source.sourceCrs()
 		)
 
-		# Pre-indexation of PtRef per segment (for faster searching)
-		model_feedback.pushInfo(self.tr('Indexation des PtRef par segment…'))
-		ptref_indexes_by_seg = build_ptref_spatial_indexes(ptref_layer, seg_id_field, width_field)
-		# Length of the transects (m) and margin to use
-		TRANSECT_LENGTH = 15 # Needs to stay the minimal with desired for the mobility space
-		MARGIN = 2.0
-
-		# Reclassify landUse
-		model_feedback.setProgressText(self.tr("Polygonisation et reclassification de l'utilisation du territoire..."))
+		# Compute the percentage of the 15 m mobility space and the F3 index of every segment
+		landuse_layer = self.parameterAsRasterLayer(parameters, 'landuse', context)
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), model_feedback)
 		try :
-			vectorised_landuse = polygonize_landuse(use_agri, parameters, context, feedback=model_feedback)
+			with profiling.step(profiler, 'indice F3'):
+				if mode == quicklook.REFINE:
+					# Only the segments of the quick look near a class breakpoint are computed at full resolution
+					f3_map = quicklook.refine(lambda layer: compute_f3(layer, roads_layer, ptref_layer, landuse_layer, seg_id_field, width_field, target_pts, step_min, use_agri, use_corridor, workers, use_service, confidence, sampler=sampler, time_budget=time_budget, costs=costs, context=context, feedback=model_feedback), rivnet_layer, seg_id_field, quick_look_layer, fields, feedback=model_feedback)
+				else:
+					f3_map = compute_f3(rivnet_layer, roads_layer, ptref_layer, landuse_layer, seg_id_field, width_field, target_pts, step_min, use_agri, use_corridor, workers, use_service, confidence, quick_look=mode == quicklook.QUICK_LOOK, sampler=sampler, time_budget=time_budget, costs=costs, context=context, feedback=model_feedback)
 		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans polygonize_landuse : {str(e)}"))
+			model_feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice F3 : {str(e)}"))
 			return {}
-		if model_feedback.isCanceled():
+		if f3_map is None:
 			return {}
 
-		model_feedback.setProgressText(self.tr("Fusion des couches d'obstacles..."))
-		try :
-			roads_simpl = simplify_layer_once(roads_layer, tol=5.0)
-			landuse_simpl = simplify_layer_once(vectorised_landuse, tol=5.0)
-			# Convert roads (LineString) to polygons via buffer
-			# Choose a realistic width in meters to represent the blocking right-of-way.
-			# E.g., 20 m (10 m on each side). Adjust according to your data context.
-			roads_poly = processing.run("native:buffer", {
-				"INPUT": roads_simpl,
-				"DISTANCE": QgsProperty.fromField("demi_emp"),   # half width from side to sides
-				"SEGMENTS": 5,
-				"END_CAP_STYLE": 1,              # Round=0, Flat=1, Square=2
-				"JOIN_STYLE": 0,
-				"MITER_LIMIT": 2,
-				"DISSOLVE": True,                # important for reducing the number of parts
-				"OUTPUT": "memory:"
-			}, context=context)["OUTPUT"]
-			# ----- (B) Dissolve the polygonized land cover (already in polygons) -----
-			landuse_diss = processing.run("native:dissolve", {
-				"INPUT": landuse_simpl,
-				"SEPARATE_DISJOINT": False,
-				"FIELD": [],
-				"OUTPUT": "memory:"
-			}, context=context)["OUTPUT"]
-			# ----- (C) Merge the two polygon layers (buffered roads + land use) -----
-			all_obstacles_poly = processing.run("native:mergevectorlayers", {
-				"LAYERS": [roads_poly, landuse_diss],
-				"OUTPUT": "memory:"
-			}, context=context)["OUTPUT"]
-			# ----- (D) Dissolve to obtain few features -----
-			obstacles_dissolved = processing.run("native:dissolve", {
-				"INPUT": all_obstacles_poly,
-				"SEPARATE_DISJOINT": False,
-				"FIELD": [],
-				"OUTPUT": "memory:"
-			}, context=context)["OUTPUT"]
-		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans fusion des couches d'obstacles : {str(e)}"))
-			return {}
+		# Write the results to the sink
+		index_results.write_results(sink, source.getFeatures(), seg_id_field, (f3_map, len(quicklook.output_fields(fields, mode))))
 
-		# Making spatial index of the obstacles
-		obstacle_indexes = QgsSpatialIndex(obstacles_dissolved.getFeatures())
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, model_feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'F3', model_feedback)
 
-		# Gets the number of features to iterate over for the progress bar
-		total_features = source.featureCount()
-		model_feedback.pushInfo(self.tr(f"{total_features} features (segments) à traiter"))
-
-		# Iteration over all river network features
-		model_feedback.setProgressText(self.tr('Itération sur les segments du réseau...'))
-		try :
-			for current, segment in enumerate(source.getFeatures()):
-					if model_feedback.isCanceled():
-						return {}
-					# Making geometry object of the river segment
-					seg_geom = segment.geometry()
-					seg_len = seg_geom.length()
-					sid = segment[seg_id_field]
-					# Adjusting the number of steps based on segment length
-					if seg_len <= 0: # If segment length is lesser or equal to zero
-						model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice F3 mis à 5."))
-						segment.setAttributes(segment.attributes() + [0.0, 5])
-						sink.addFeature(segment, QgsFeatureSink.FastInsert)
-						model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-						continue
-					else:
-						if seg_len <= 2 :
-							model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
-						# Calculate an appropriate step for the transect points
-						step_m_local = max(step_min, seg_len / target_pts) # Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
-						# Get points along segment based on given step_m_local for the segment
-						pts = safe_points_along_line(seg_geom, step_m_local)
-					# 1) Max river width on the segment
-					ptref_idx_entry = ptref_indexes_by_seg.get(sid)
-					w_max = max_width_for_segment(ptref_idx_entry)  # 2 m if no PtRef
-					# 2) Adaptative clip radius (max offset + L + margin)
-					R = (w_max / 2.0) + TRANSECT_LENGTH + MARGIN
-					# 3) Adaptive buffer and simplified dissolved obstacles
-					segment_buffer = seg_geom.buffer(R, 8)
-					# Intersect the geometry of the obstacles polygon with the segment max width buffer collect the obstacles intersecting this BBOX
-					bbox = segment_buffer.boundingBox()
-					bbox_g = QgsRectangle(
-							bbox.xMinimum()-R, bbox.yMinimum()-R,
-							bbox.xMaximum()+R, bbox.yMaximum()+R
-					)
-					local_parts = []
-					candidate_ids = obstacle_indexes.intersects(bbox_g)
-					for fid in candidate_ids:
-						f = obstacles_dissolved.getFeature(fid)
-						g = f.geometry()
-						if g and not g.isEmpty():
-							# fast double check: bbox & intersects
-							if not g.boundingBox().intersects(bbox_g):
-								continue
-							if not g.intersects(segment_buffer):
-								continue
-							# Local clip (only useful portion)
-							c = g.intersection(segment_buffer)
-							if c and not c.isEmpty():
-								local_parts.append(c)
-					union_geom = QgsGeometry.unaryUnion(local_parts)
-					# If no local obstacle -> all free
-					if not local_parts or not union_geom or union_geom.isEmpty():
-						perc15=1.0
-						indiceF3 = computeF3(perc15)
-						segment.setAttributes(segment.attributes() + [perc15*100, indiceF3])
-						sink.addFeature(segment, QgsFeatureSink.FastInsert)
-						model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-						continue
-					# Make bounding box of the clipped obstacles polygon to verify if the transect intersects
-					engine_prepared, band_bbox = make_prepared_engine_and_bbox(union_geom)
-					# Verify if the obstacles union is empty (no obstacles around the segment)
-					if (engine_prepared is None):
-						# Nothing to intersect for this segment
-						perc15=1.0
-						indiceF3 = computeF3(perc15)
-						segment.setAttributes(segment.attributes() + [perc15*100, indiceF3])
-						sink.addFeature(segment, QgsFeatureSink.FastInsert)
-						model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-						continue
-					# Counters of transect in intersection with the obstacles
-					count_15 = 0   # Number of shores (left+right) that have an obstacles >= 15 m
-					n_pts = len(pts)
-					# Go over each transect points to calculate the intersection with obstacles
-					for center_pt in pts:
-						# 1) Angle of local tangent
-						theta = direction_angle_at_point_fast(seg_geom, center_pt)
-						# In case there's some weird geometries
-						if theta == 0.0:
-							theta = direction_angle_at_point(seg_geom, center_pt)
-						# 2) Start offset = channel width/2 if PtRef exists, else 2 m (width)/2
-						# Get the PtRef points index for this segments
-						ptref_idx_entry = ptref_indexes_by_seg.get(sid)
-						w = nearest_width_value_indexed(center_pt, ptref_idx_entry)
-						offset = (float(w) / 2.0) if (w and w > 0) else 2/2
-						# Transects left/right of length of TRANSECT_LENGTH 
-						left_line  = make_transect_line(center_pt, theta + math.pi/2.0, offset, TRANSECT_LENGTH)
-						right_line = make_transect_line(center_pt, theta - math.pi/2.0, offset, TRANSECT_LENGTH)
-						# Check the length of the transect intersection with obstacles, if no obstacles to intersect returns zero
-						left_int_len  = fast_intersection_status(left_line, union_geom, engine_prepared, band_bbox)
-						right_int_len = fast_intersection_status(right_line, union_geom, engine_prepared, band_bbox)
-						# Tests if there is an obstacle within 15m in both sides, if its not the case we skip the count of the transect
-						if (left_int_len == True) and (right_int_len == True):
-							continue
-						# 3) Counts the number of transects for which the intersect is within the width treshold (15m) (taking into account each sides)
-						count_15 += (1 if left_int_len == False else 0) + (1 if right_int_len == False else 0)
-
-					# Pourcentages
-					den = 2.0 * float(n_pts) if n_pts else 1.0
-					perc15 = count_15 / den
-
-					# Compute the IQM Score
-					indiceF3 = computeF3(perc15)
-
-					# Write to layer
-					segment.setAttributes(segment.attributes() + [perc15*100, indiceF3])
-					# Add a feature to sink
-					sink.addFeature(segment, QgsFeatureSink.FastInsert)
-
-					# Increments the progress bar
-					if total_features != 0:
-						progress = int(100*(current/total_features))
-					else:
-						progress = 0
-					model_feedback.setProgress(progress)
-
-		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans la boucle de segments : {str(e)}"))
-			return {}
 		# Ending message
 		model_feedback.setProgressText(self.tr('\tProcessus terminé !'))
 
-		return {self.OUTPUT : dest_id}
+		return results
 
 	def tr(self, string):
 		return QCoreApplication.translate('Processing', string)
@@ -363,41 +253,427 @@ class IndiceF3(QgsProcessingAlgorithm):
 			"-> Classes d'utilisation du territoire pour le bassin versant donné sous forme matriciel (résolution 10 m) qui sera reclassé pour les classes anthropique et agricole (optionnel), selon le guide d'utilisation du jeu de données. Source des données : MELCCFP. Utilisation du territoire, [Jeu de données], dans Données Québec.\n" \
 			"Utiliser milieux agricoles : Booléen (optionnel; valeur par défaut : Vrai) \n" \
 			"-> Détermine si l'algorithme doit considérer les milieux agricoles comme obstacles supplémentaires dans la plaine alluviale pour la reclassification des classes d'utilisation du territoire.\n" \
+			"Préfiltrer les routes par corridor : Booléen (optionnel; valeur par défaut : Vrai) \n" \
+			"-> Conserve seulement les routes à l'intérieur du corridor du réseau hydrographique (script Préfiltrage par corridor) avant leur fusion et simplification. Peut être désactivé lorsque la couche a déjà été préfiltrée.\n" \
+			"Placement des transects : Liste (valeur par défaut : Uniforme)\n" \
+			"-> Uniforme : transects à intervalles réguliers le long du segment. Courbure : le même nombre de transects est placé selon l'angle de virage cumulé (la moitié selon la longueur, la moitié selon la courbure), ce qui en met davantage dans les méandres et moins dans les tronçons rectilignes. Chaque transect compte alors pour la longueur de segment qu'il représente dans la médiane et les pourcentages. Nécessite Shapely.\n" \
+			"Niveau de confiance de l'arrêt anticipé : double (optionnel; valeur par défaut : 0)\n" \
+			"-> Évalue les transects de chaque segment du plus grossier au plus fin (ordre binaire inversé des points) et s'arrête dès que la classe de l'indice ne peut plus changer au niveau de confiance donné (p. ex. 0.95). À 1, l'arrêt se fait seulement lorsque la classe est certaine, quels que soient les transects restants (scores identiques). À 0, tous les transects sont évalués. La valeur de l'indice est alors celle des transects évalués. Nécessite Shapely.\n" \
+			"Budget de temps par segment (s) : double (optionnel; valeur par défaut : 0)\n" \
+			"-> Temps de calcul maximal d'un segment (0 : aucun). Lorsque le temps d'un segment, projeté sur tous ses transects, dépasse ce budget (géométrie du segment très détaillée, grand polygone proche), ses transects restants sont évalués de façon approchée : par points à chaque mètre le long des transects avec Shapely, avec les obstacles simplifiés à 2 m sans Shapely. Le champ Approx ajouté à la sortie vaut alors 1 pour ce segment.\n" \
+			"Mode d'évaluation : Liste (valeur par défaut : Complet)\n" \
+			"-> Complet : tous les transects sont évalués. Aperçu : seuls quelques transects répartis sur chaque segment (8 points) sont évalués, pour un premier résultat rapide sur de grands territoires, et le champ Pres_seuil vaut 1 lorsque la classe de l'indice pourrait changer avec tous les transects (métrique près d'un seuil de classe, niveau de confiance de 0.8). Raffinement : reprend la couche de sortie d'un aperçu et calcule à pleine résolution seulement les segments avec Pres_seuil à 1 (ou absents de l'aperçu), les autres gardant leurs valeurs.\n" \
+			"Couche de sortie de l'aperçu : Vectoriel (lignes) (optionnel)\n" \
+			"-> Couche produite par le mode aperçu sur le même réseau, utilisée par le mode raffinement.\n" \
+			"Nombre de processus : nombre entier (optionnel; 1 par défaut)\n" \
+			"-> Nombre de processus évaluant les transects des segments en parallèle (0 : un par coeur). Les obstacles préparés et les largeurs des PtRef sont placés en mémoire partagée, lue sans copie par chaque processus.\n" \
+			"Utiliser le service de calcul : Booléen (optionnel; valeur par défaut : Faux) \n" \
+			"-> Évalue les segments dans le service de calcul local (python -m IQM_Core.service), qui conserve en mémoire les obstacles préparés et les largeurs des PtRef d'une exécution à l'autre pour les mêmes données. Utile pour relancer l'indice en changeant le nombre de points visés ou la longueur minimale entre les transects. Si le service est injoignable, le calcul se fait dans QGIS.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
 			"Retourne\n" \
 			"----------\n" \
 			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec le score de l'indice F3 calculé pour chaque UEA."
+			"-> Réseau hydrographique du bassin versant avec le score de l'indice F3 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
 		)
 
 
-def is_metric_crs(crs):
-	# True if the distance unit of the CRS is the meter
-	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def compute_f3(source, roads_layer, ptref_layer, landuse, seg_id_field='Id_UEA', width_field='Largeur_mod', target_pts=50, step_min=10.0, use_agri=True, use_corridor=True, workers=1, use_service=False, confidence=0.0, quick_look=False, sampler='uniform', time_budget=0.0, costs=None, context=None, feedback=None, roads_poly=None):
+	"""
+	Computes the F3 index of every segment of the river network.
+
+	Parameters
+	----------
+	source : QgsVectorLayer
+		River network layer
+	roads_layer : QgsVectorLayer
+		Roads with their half right-of-way (demi_emp)
+	ptref_layer : QgsVectorLayer
+		PtRef width layer
+	landuse : QgsRasterLayer or str
+		Land use raster (MELCCFP)
+	seg_id_field, width_field : str
+		Names of the segment identifier and PtRef width fields
+	target_pts : int
+		Number of transect points aimed for each segment
+	step_min : float
+		Minimal distance between the transects (m)
+	use_agri : bool
+		Use the agricultural land as obstacles
+	use_corridor : bool
+		Keep only the roads within the network corridor before the dissolve
+	workers : int
+		Number of processes of the segment loop (0 : number of cores)
+	use_service : bool
+		Evaluate the segments in the local compute service (IQM_Core.service), which keeps the prepared data between runs
+	confidence : float
+		Confidence level of the early stop of the transects of a segment, once its class is fixed (0 : all the transects, 1 : exact bounds, IQM_Core.compute.probe_transects)
+	quick_look : bool
+		Only probe a few transects of each segment and add the boundary-proximity flag to the values (IQM_Core.quicklook)
+	sampler : str
+		Placement of the transect points : 'uniform' (evenly spaced) or 'curvature' (by cumulative turning angle, the statistics being weighted by the length each point stands for)
+	time_budget : float
+		Time budget of each segment (s, 0 : none) : past it, the segment is approximated and its approximation flag is added to the values (IQM_Core.compute.probe_transects)
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (None : costs not recorded)
+	roads_poly : QgsVectorLayer
+		Buffered roads of prepare_roads, shared by the rasters of a land use time series (built if None)
+
+	Returns
+	----------
+	f3_map : dict
+		{sid: [percentage of free 15 m transects, F3 index]} (None if canceled)
+	"""
+	context = context if context is not None else QgsProcessingContext()
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	params = {'target_pts': target_pts, 'step_min': step_min, 'confidence': confidence, 'quick_look': compute.QUICK_LOOK_POINTS if quick_look else 0, 'sampler': sampler, 'time_budget': time_budget}
+	# Prepared data kept by the local compute service between runs
+	if use_service:
+		client = service.connect(feedback)
+		if client is not None:
+			key = service.fingerprint('F3', [source, roads_layer, ptref_layer, landuse], [seg_id_field, width_field, use_agri, use_corridor])
+			try:
+				return client.evaluate_segments(key, lambda: prepare_f3(source, roads_layer, ptref_layer, landuse, seg_id_field, width_field, use_agri, use_corridor, context, feedback, roads_poly), params, source, seg_id_field, feedback=feedback, costs=costs)
+			finally:
+				client.close()
+	payload = prepare_f3(source, roads_layer, ptref_layer, landuse, seg_id_field, width_field, use_agri, use_corridor, context, feedback, roads_poly)
+	if payload is None:
+		return None
+	payload.update(params)
+
+	# Iteration over all river network features
+	if (confidence or quick_look or sampler != 'uniform') and not compute.HAS_SHAPELY:
+		feedback.pushInfo(tr("Arrêt anticipé, aperçu et placement par courbure des transects indisponibles sans Shapely : tous les transects sont évalués, à intervalles réguliers."))
+	feedback.setProgressText(tr('Itération sur les segments du réseau...'))
+	try :
+		# NumPy/Shapely kernels when Shapely is installed, GEOS predicates through QGIS otherwise
+		kernel = compute if compute.HAS_SHAPELY else sys.modules[__name__]
+		f3_map = parallel.evaluate_segments(kernel, payload, source, seg_id_field, workers, feedback=feedback, costs=costs)
+		# The QGIS kernels evaluate every transect : the class of each segment is known
+		if quick_look and f3_map is not None and not compute.HAS_SHAPELY:
+			f3_map = {sid: list(values) + [0] for sid, values in f3_map.items()}
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans la boucle de segments : {str(e)}"))
+	return f3_map
+
+
+def compute_f3_series(source, roads_layer, ptref_layer, landuses, seg_id_field='Id_UEA', width_field='Largeur_mod', target_pts=50, step_min=10.0, use_agri=True, use_corridor=True, workers=1, use_service=False, confidence=0.0, sampler='uniform', context=None, feedback=None):
+	"""
+	Computes the F3 index of every segment of the river network for each land use
+	raster of a time series. The roads are buffered once, only the land use obstacles
+	are prepared for each raster.
 
+	Parameters
+	----------
+	landuses : list of QgsRasterLayer or str
+		Land use rasters (MELCCFP) of each year
+	(the other parameters are those of compute_f3)
 
-def build_ptref_spatial_indexes(ptref_layer, seg_id_field: str, width_field: str):
+	Returns
+	----------
+	f3_map : dict
+		{sid: [percentage of free 15 m transects, F3 index] of each land use one after the other} (None if canceled)
 	"""
-	Builds spatial indexes by segment.
-	Returns a dict: {sid: {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': width_field}}
+	context = context if context is not None else QgsProcessingContext()
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	roads_poly = prepare_roads(source, roads_layer, ptref_layer, seg_id_field, width_field, use_corridor, 15, context, feedback)
+	if roads_poly is None:
+		return None
+	f3_maps = []
+	for landuse in landuses:
+		f3_maps.append(compute_f3(source, roads_layer, ptref_layer, landuse, seg_id_field, width_field, target_pts, step_min, use_agri, use_corridor, workers, use_service, confidence, sampler=sampler, context=context, feedback=feedback, roads_poly=roads_poly))
+		if f3_maps[-1] is None:
+			return None
+	return index_results.join_series(f3_maps, len(OUTPUT_FIELDS))
+
+
+def prepare_f3(source, roads_layer, ptref_layer, landuse, seg_id_field, width_field, use_agri, use_corridor, context, feedback, roads_poly=None):
 	"""
-	seg_to_features = {}
-	for pf in ptref_layer.getFeatures():
-		sid = pf[seg_id_field]
-		seg_to_features.setdefault(sid, []).append(pf)
+	Prepares the obstacles and the PtRef widths of the segment loop.
 
-	seg_to_index = {}
-	for sid, feats in seg_to_features.items():
-		idx = QgsSpatialIndex()
-		for f in feats:
-			idx.addFeature(f)
-		seg_to_index[sid] = {'index': idx, 'features': feats, 'width_field': width_field}
-	return seg_to_index
+	Parameters
+	----------
+	roads_poly : QgsVectorLayer
+		Buffered roads of prepare_roads (built here if None)
 
+	Returns
+	----------
+	payload : dict
+		Packed data given to worker_init (None if canceled)
+	"""
+	if feedback.isCanceled():
+		return None
+	# Widths of the PtRef of each segment (for faster searching)
+	feedback.pushInfo(tr('Indexation des PtRef par segment…'))
+	ptref_widths = ptref.width_arrays(ptref_layer, seg_id_field, width_field)
+	# Length of the transects (m) and margin to use
+	TRANSECT_LENGTH = 15 # Needs to stay the minimal with desired for the mobility space
+	MARGIN = 2.0
+
+	# Reclassify landUse
+	feedback.setProgressText(tr("Polygonisation et reclassification de l'utilisation du territoire..."))
+	try :
+		vectorised_landuse = polygonize_landuse(use_agri, source, landuse, context, feedback=feedback)
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans polygonize_landuse : {str(e)}"))
+	if feedback.isCanceled():
+		return None
+
+	# Buffered roads (independent of the land use, shared by the rasters of a time series)
+	if roads_poly is None:
+		roads_poly = prepare_roads(source, roads_layer, ptref_layer, seg_id_field, width_field, use_corridor, TRANSECT_LENGTH, context, feedback)
+		if roads_poly is None:
+			return None
 
-def polygonize_landuse(use_agri, parameters, context, feedback):
+	feedback.setProgressText(tr("Fusion des couches d'obstacles..."))
+	try :
+		landuse_simpl = simplify_layer_once(vectorised_landuse, tol=5.0)
+		# ----- (B) Dissolve the polygonized land cover (already in polygons) -----
+		landuse_diss = processing.run("native:dissolve", {
+			"INPUT": landuse_simpl,
+			"SEPARATE_DISJOINT": False,
+			"FIELD": [],
+			"OUTPUT": "memory:"
+		}, context=context)["OUTPUT"]
+		# ----- (C) Merge the two polygon layers (buffered roads + land use) -----
+		all_obstacles_poly = processing.run("native:mergevectorlayers", {
+			"LAYERS": [roads_poly, landuse_diss],
+			"OUTPUT": "memory:"
+		}, context=context)["OUTPUT"]
+		# ----- (D) Dissolve to obtain few features -----
+		obstacles_dissolved = processing.run("native:dissolve", {
+			"INPUT": all_obstacles_poly,
+			"SEPARATE_DISJOINT": False,
+			"FIELD": [],
+			"OUTPUT": "memory:"
+		}, context=context)["OUTPUT"]
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans fusion des couches d'obstacles : {str(e)}"))
+
+	# Packed data of the segment loop (shared with the worker processes)
+	payload = {
+		'index': 'F3',
+		'obstacles': transport.pack_geometries([f.geometry() for f in obstacles_dissolved.getFeatures()]),
+		'ptref': transport.pack_groups(ptref_widths),
+		'seg_id_field': seg_id_field,
+		'transect_length': TRANSECT_LENGTH,
+		'margin': MARGIN
+	}
+	return payload
+
+
+def prepare_roads(source, roads_layer, ptref_layer, seg_id_field, width_field, use_corridor, distance, context, feedback):
+	"""
+	Buffers the roads by their half right-of-way (demi_emp), the part of the obstacles
+	that does not depend on the land use.
+
+	Parameters
+	----------
+	distance : float
+		Reach of the transects, to keep only the roads within the network corridor (use_corridor)
+
+	Returns
+	----------
+	roads_poly : QgsVectorLayer
+		Dissolved buffered roads (None if canceled)
+	"""
+	# Keep only the roads within the network corridor before the dissolve
+	if use_corridor:
+		feedback.setProgressText(tr("Préfiltrage des routes par corridor du réseau..."))
+		try :
+			roads_layer, _ = corridor_prefilter.prefilter_layers(source, seg_id_field, ptref_layer, width_field, distance, roads_layer=roads_layer, feedback=feedback)
+		except Exception as e :
+			raise RuntimeError(tr(f"Erreur dans le préfiltrage par corridor : {str(e)}"))
+		if feedback.isCanceled():
+			return None
+
+	feedback.setProgressText(tr("Tampon des routes..."))
+	try :
+		# Convert roads (LineString) to polygons via buffer
+		# Choose a realistic width in meters to represent the blocking right-of-way.
+		# E.g., 20 m (10 m on each side). Adjust according to your data context.
+		return processing.run("native:buffer", {
+			"INPUT": simplify_layer_once(roads_layer, tol=5.0),
+			"DISTANCE": QgsProperty.fromField("demi_emp"),   # half width from side to sides
+			"SEGMENTS": 5,
+			"END_CAP_STYLE": 1,              # Round=0, Flat=1, Square=2
+			"JOIN_STYLE": 0,
+			"MITER_LIMIT": 2,
+			"DISSOLVE": True,                # important for reducing the number of parts
+			"OUTPUT": "memory:"
+		}, context=context)["OUTPUT"]
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans le tampon des routes : {str(e)}"))
+
+
+def worker_init(payload):
+	"""
+	Builds the spatial index of the packed obstacles from their bounding boxes,
+	the obstacle geometries being rebuilt when first met by a segment.
+	"""
+	state = dict(payload)
+	state['ptref'] = transport.unpack_groups(payload['ptref'])
+	state['geometries'] = {}
+	# Simplified obstacles of the segments over their time budget
+	state['simplified'] = {}
+	# Making spatial index of the obstacles
+	state['obstacle_index'] = QgsSpatialIndex()
+	for i, (xmin, ymin, xmax, ymax) in enumerate(payload['obstacles']['bounds']):
+		if not np.isnan(xmin):
+			state['obstacle_index'].addFeature(i, QgsRectangle(xmin, ymin, xmax, ymax))
+	return state
+
+
+def evaluate_chunk(state, segments, ids, start, stop):
+	"""
+	Evaluates the segments [start, stop[ of packed segments, returns [[sid, values, messages], ...]
+	(each followed by the cost of the segment with a cost report, IQM_Core.instrumentation.evaluated).
+	"""
+	results = []
+	for i in range(start, stop):
+		results.append(instrumentation.evaluated(state, evaluate_segment, ids[i], transport.unpack_geometry(segments, i)))
+	return results
+
+
+def evaluate_segment(state, sid, seg_geom):
+	"""
+	Percentage of free 15 m transects and F3 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[percentage of free 15 m transects, F3 index] (and the approximation flag with a time budget)
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	# Past the time budget of the segment, the obstacles are simplified (APPROX_TOLERANCE) before their clip and union
+	started = time.perf_counter()
+	budget = state.get('time_budget')
+	approx = False
+	TRANSECT_LENGTH = state['transect_length']
+	MARGIN = state['margin']
+	seg_id_field = state['seg_id_field']
+	seg_len = seg_geom.length()
+	# Adjusting the number of steps based on segment length
+	if seg_len <= 0: # If segment length is lesser or equal to zero
+		messages.append(tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice F3 mis à 5."))
+		return compute.with_approx(state, [0.0, 5]), messages
+	if seg_len <= 2 :
+		messages.append(tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
+	# Calculate an appropriate step for the transect points
+	step_m_local = max(state['step_min'], seg_len / state['target_pts']) # Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
+	# Get points along segment based on given step_m_local for the segment
+	pts = safe_points_along_line(seg_geom, step_m_local)
+	# 1) Max river width on the segment
+	seg_widths = state['ptref'].get(sid)
+	w_max = ptref.max_width(seg_widths)  # 2 m if no PtRef
+	# 2) Adaptative clip radius (max offset + L + margin)
+	R = (w_max / 2.0) + TRANSECT_LENGTH + MARGIN
+	# 3) Adaptive buffer and simplified dissolved obstacles
+	instrumentation.count_geos('buffer')
+	segment_buffer = seg_geom.buffer(R, 8)
+	# Intersect the geometry of the obstacles polygon with the segment max width buffer collect the obstacles intersecting this BBOX
+	bbox = segment_buffer.boundingBox()
+	bbox_g = QgsRectangle(
+			bbox.xMinimum()-R, bbox.yMinimum()-R,
+			bbox.xMaximum()+R, bbox.yMaximum()+R
+	)
+	local_parts = []
+	candidate_ids = state['obstacle_index'].intersects(bbox_g)
+	for fid in candidate_ids:
+		if fid not in state['geometries']:
+			state['geometries'][fid] = transport.unpack_geometry(state['obstacles'], fid)
+		g = state['geometries'][fid]
+		approx = approx or compute.over_budget(started, budget)
+		if approx and g and not g.isEmpty():
+			if fid not in state['simplified']:
+				instrumentation.count_geos('simplify')
+				state['simplified'][fid] = g.simplify(compute.APPROX_TOLERANCE)
+			g = state['simplified'][fid]
+		if g and not g.isEmpty():
+			# fast double check: bbox & intersects
+			if not g.boundingBox().intersects(bbox_g):
+				continue
+			instrumentation.count_geos('intersects')
+			if not g.intersects(segment_buffer):
+				continue
+			# Local clip (only useful portion)
+			instrumentation.count_geos('intersection')
+			c = g.intersection(segment_buffer)
+			if c and not c.isEmpty():
+				local_parts.append(c)
+	instrumentation.count_geos('unaryUnion')
+	union_geom = QgsGeometry.unaryUnion(local_parts)
+	# If no local obstacle -> all free
+	if not local_parts or not union_geom or union_geom.isEmpty():
+		perc15=1.0
+		return compute.with_approx(state, [perc15*100, compute.score_f3(perc15)], approx), messages
+	# Make bounding box of the clipped obstacles polygon to verify if the transect intersects
+	engine_prepared, band_bbox = make_prepared_engine_and_bbox(union_geom)
+	# Verify if the obstacles union is empty (no obstacles around the segment)
+	if (engine_prepared is None):
+		# Nothing to intersect for this segment
+		perc15=1.0
+		return compute.with_approx(state, [perc15*100, compute.score_f3(perc15)], approx), messages
+	# Counters of transect in intersection with the obstacles
+	count_15 = 0   # Number of shores (left+right) that have an obstacles >= 15 m
+	n_pts = len(pts)
+	instrumentation.add_cost(state, transects=2 * n_pts, vertices=union_geom.constGet().nCoordinates())
+	# Go over each transect points to calculate the intersection with obstacles
+	for center_pt in pts:
+		# Simplify the clipped obstacles once the time budget is spent
+		if not approx and compute.over_budget(started, budget):
+			approx = True
+			instrumentation.count_geos('simplify')
+			union_geom = union_geom.simplify(compute.APPROX_TOLERANCE)
+			engine_prepared, band_bbox = make_prepared_engine_and_bbox(union_geom)
+		# 1) Angle of local tangent
+		theta = direction_angle_at_point_fast(seg_geom, center_pt)
+		# In case there's some weird geometries
+		if theta == 0.0:
+			theta = direction_angle_at_point(seg_geom, center_pt)
+		# 2) Start offset = channel width/2 if PtRef exists, else 2 m (width)/2
+		w = ptref.nearest_width(center_pt.x(), center_pt.y(), seg_widths)
+		offset = (float(w) / 2.0) if (w and w > 0) else 2/2
+		# Transects left/right of length of TRANSECT_LENGTH 
+		left_line  = make_transect_line(center_pt, theta + math.pi/2.0, offset, TRANSECT_LENGTH)
+		right_line = make_transect_line(center_pt, theta - math.pi/2.0, offset, TRANSECT_LENGTH)
+		# Check the length of the transect intersection with obstacles, if no obstacles to intersect returns zero
+		left_int_len  = fast_intersection_status(left_line, union_geom, engine_prepared, band_bbox)
+		right_int_len = fast_intersection_status(right_line, union_geom, engine_prepared, band_bbox)
+		# Tests if there is an obstacle within 15m in both sides, if its not the case we skip the count of the transect
+		if (left_int_len == True) and (right_int_len == True):
+			continue
+		# 3) Counts the number of transects for which the intersect is within the width treshold (15m) (taking into account each sides)
+		count_15 += (1 if left_int_len == False else 0) + (1 if right_int_len == False else 0)
+
+	# Pourcentages
+	den = 2.0 * float(n_pts) if n_pts else 1.0
+	perc15 = count_15 / den
+
+	# Compute the IQM Score
+	indiceF3 = compute.score_f3(perc15)
+	return compute.with_approx(state, [perc15*100, indiceF3], approx), messages
+
+
+def is_metric_crs(crs):
+	# True if the distance unit of the CRS is the meter
+	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
+
+
+def polygonize_landuse(use_agri, rivnet, landuse, context, feedback):
 	# River network buffer
 	alg_params = {
-		'INPUT' : parameters['rivnet'],
+		'INPUT' : rivnet,
 		'DISTANCE' : 500,
 		'SEGMENTS' : 5,
 		'END_CAP_STYLE' : 0,
@@ -409,7 +685,7 @@ def polygonize_landuse(use_agri, parameters, context, feedback):
 	buffer = processing.run("native:buffer", alg_params, context=context, feedback=None, is_child_algorithm=True)['OUTPUT']
 	# Clip raster by mask
 	alg_params = {
-		'INPUT' : parameters['landuse'],
+		'INPUT' : landuse,
 		'MASK' : buffer,
 		'SOURCE_CRS' : None,
 		'TARGET_CRS' : None,
@@ -494,6 +770,7 @@ def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
 	eps = max(1e-6, min(0.001, 1e-3 * seg_len))
 	def _interp_point_at(dist_m: float):
 		"""Interpolate and safely convert to QgsPointXY if a point geometry is returned."""
+		instrumentation.count_geos('interpolate')
 		g = seg_geom.interpolate(dist_m)
 		if not g or g.isEmpty() or g.type() != QgsWkbTypes.PointGeometry:
 			return None
@@ -529,27 +806,6 @@ def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
 	return pts
 
 
-def max_width_for_segment(ptref_idx_entry) -> float:
-	"""
-	Returns the maximum width (Largeur_mod) on the PtRef of the segment.
-	ptref_idx_entry = {'index': QgsSpatialIndex, 'features': [QgsFeature], width_field: 'Largeur_mod'}
-	"""
-	if not ptref_idx_entry:
-		return 2
-	feats = ptref_idx_entry.get('features', [])
-	width_field = ptref_idx_entry.get('width_field', 'Largeur_mod')
-	wmax = 0.0
-	for pf in feats:
-		try:
-			val = pf[width_field]
-			w = float(val) if val is not None else None
-		except Exception:
-			w = None
-		if w is not None and w > wmax:
-			wmax = w
-	return wmax
-
-
 def make_prepared_engine_and_bbox(geom: QgsGeometry):
 	"""
 	Returns (engine_prepared, bbox) for geom.
@@ -657,6 +913,7 @@ def direction_angle_at_point(seg_geom: QgsGeometry, pt_xy: QgsPointXY) -> float:
 			continue
 		for a, b in zip(line[:-1], line[1:]):
 			seg_geom_ab = QgsGeometry.fromPolylineXY([a, b])
+			instrumentation.count_geos('distance')
 			d = seg_geom_ab.distance(pt_geom)
 			if d < best_dist:
 				best_dist = d
@@ -670,49 +927,6 @@ def direction_angle_at_point(seg_geom: QgsGeometry, pt_xy: QgsPointXY) -> float:
 	return math.atan2(dy, dx)
 
 
-def nearest_width_value_indexed(center_pt: QgsPointXY, seg_ptref_idx_entry) -> float or None:
-	"""
-	Find the closest width via spatial index for this segment.
-	seg_ptref_idx_entry = {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': 'Width_mod'}
-	"""
-	if not seg_ptref_idx_entry:
-		return None
-	idx = seg_ptref_idx_entry['index']
-	feats = seg_ptref_idx_entry['features']
-	width_field = seg_ptref_idx_entry['width_field']
-	# small search box (~50 m around the point) to limit candidates
-	# (you can adjust the radius according to the density of PtRef)
-	r = 100
-	rect = QgsRectangle(center_pt.x() - r, center_pt.y() - r, center_pt.x() + r, center_pt.y() + r)
-	candidate_ids = idx.intersects(rect)
-	best_w = None
-	best_d = float('inf')
-	center_g = QgsGeometry.fromPointXY(center_pt)
-	# if there are no candidates in the bbox, we try them all (rare)
-	if not candidate_ids:
-		candidate_ids = [f.id() for f in feats]
-	# Direct access to features by FID via a query; otherwise local loop
-	# (here, we go through the ‘feats’ list, which is simpler and faster in memory)
-	id_to_feat = {f.id(): f for f in feats}
-	for fid in candidate_ids:
-		pf = id_to_feat.get(fid)
-		if pf is None:
-			continue
-		g = pf.geometry()
-		if not g or g.isEmpty():
-			continue
-		d = g.distance(center_g)
-		# Read width
-		try:
-			val = pf[width_field]
-			w = float(val) if val is not None else None
-		except Exception:
-			w = None
-		if w is not None and d < best_d:
-			best_d, best_w = d, w
-	return best_w
-
-
 def make_transect_line(center_pt: QgsPointXY, normal_angle: float, offset: float, length_m: float) -> QgsGeometry:
 	"""
 	Construct a perpendicular line:
@@ -739,20 +953,11 @@ def fast_intersection_status(line: QgsGeometry, band_union: QgsGeometry, engine_
 	if not line.boundingBox().intersects(band_bbox):
 		return False
 	# 2) Narrow-phase: exact predicate on prepared geometry
+	instrumentation.count_geos('intersects')
 	if not engine_prepared.intersects(line.constGet()):
 		return False
 	# 3) Overlay: we finally calculate the actual (costly) intersection
+	instrumentation.count_geos('intersection')
 	inter = line.intersection(band_union)
 	return True if (inter and not inter.isEmpty()) else False
 
-
-def computeF3(intersect_perc):
-	# Compute Iqm from sequence continuity
-	if (intersect_perc > 0.9): # Mobility space of at least 15m on >90% of the length of the segment
-		return 0
-	if (intersect_perc > 0.66) and (intersect_perc <= 0.9): # Mobility space of at least 15m on ]66%-90%] of the length of the segment
-		return 2
-	if (intersect_perc > 0.33) and (intersect_perc <= 0.66): # Mobility space of at least 15m on ]33%-66%] of the length of the segment
-		return 3
-	# Mobility space of at least 15m on less than 33% of the length of the segment
-	return 5
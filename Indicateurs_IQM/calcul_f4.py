@@ -25,26 +25,37 @@
 """
 
 
+import sys
 import numpy as np
 import processing
+from pathlib import Path
 from qgis.PyQt.QtCore import QMetaType, QCoreApplication
 from qgis.core import (
 	QgsField,
 	QgsProcessing,
-	QgsFeatureSink,
-	QgsPointXY,
-	QgsGeometry,
-	QgsRectangle,
-	QgsWkbTypes,
-	QgsSpatialIndex,
 	QgsUnitTypes,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterNumber,
 	QgsProcessingParameterString,
 	QgsProcessingParameterVectorLayer,
-	QgsProcessingParameterFeatureSink
+	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterBoolean,
+	QgsProcessingParameterFileDestination,
+	QgsProcessingFeedback
   )
 
+# Shared modules of the tool (IQM_Core) are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, profiling, ptref, transport
+
+# Fields added to the river network by the F4 index, in the order of the values returned by compute_f4
+OUTPUT_FIELDS = [
+	QgsField("Pourc_var_long", QMetaType.Double, prec=2),
+	QgsField("Indice F4", QMetaType.Int)
+]
+
 
 
 class IndiceF4(QgsProcessingAlgorithm):
@@ -60,6 +71,9 @@ class IndiceF4(QgsProcessingAlgorithm):
 		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
 		self.addParameter(QgsProcessingParameterNumber('target_pts', self.tr('Nombre de points visés par segment'), type=QgsProcessingParameterNumber.Integer, defaultValue=50))
 		self.addParameter(QgsProcessingParameterNumber('step_min', self.tr('Longueur minimale entre les transects (m)'), type=QgsProcessingParameterNumber.Double, defaultValue=10))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie'), type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, supportsAppend=True, defaultValue=None))
 
 
@@ -98,9 +112,7 @@ class IndiceF4(QgsProcessingAlgorithm):
 			if layer is None or not layer.isValid() :
 				raise RuntimeError(self.tr(f"Couche {name} invalide."))
 		# Define Sink fields
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Pourc_var_long", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Indice F4", QMetaType.Int))
+		sink_fields = index_results.output_fields(source.fields(), OUTPUT_FIELDS)
 
 		# Define sink
 		(sink, dest_id) = self.parameterAsSink(
@@ -112,64 +124,36 @@ class IndiceF4(QgsProcessingAlgorithm):
 			source.sourceCrs()
 		)
 
-		# Pre-indexation of PtRef per segment (for faster searching)
-		model_feedback.pushInfo(self.tr('Indexation des PtRef par segment…'))
-		ptref_indexes_by_seg, ptref_global_index = build_ptref_spatial_indexes(ptref_layer, seg_id_field, width_field)
-
-		# Gets the number of features to iterate over for the progress bar
-		total_features = source.featureCount()
-		model_feedback.pushInfo(self.tr(f"\t {total_features} features à traiter"))
-
-		for current, segment in enumerate(source.getFeatures()):
-			if model_feedback.isCanceled():
-				return {}
-			# Making geometry object of the river segment
-			seg_geom = segment.geometry()
-			seg_len = seg_geom.length()
-			sid = segment[seg_id_field]
-			# Adjusting the number of steps based on segment length
-			if seg_len <= 0: # If segment length is lesser or equal to zero
-				model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice F4 mis à 3."))
-				segment.setAttributes(segment.attributes() + [0.0, 3])
-				sink.addFeature(segment, QgsFeatureSink.FastInsert)
-				model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-				continue
-			else:
-				if seg_len <= 2 :
-					model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
-				# Calculate an appropriate step for the transect points
-				step_m_local = max(step_min, seg_len / target_pts) # Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
-				# Get points along segment based on given step_m_local for the segment
-				pts = safe_points_along_line(seg_geom, step_m_local)
-			# Finding the nearest PtRef width
-			ptref_idx_entry = ptref_indexes_by_seg.get(sid)
-			if not ptref_idx_entry: # Fallback: if no point for this segment then use the global index
-				ptref_idx_entry = ptref_global_index
-			widths = []
-			for center_pt in pts :
-				w = nearest_width_value_indexed(center_pt, ptref_idx_entry)
-				widths.append(w)
-			# Calculate relative variations
-			div_distance = seg_len / len(pts)
-			ratio = natural_width_ratio(widths, div_distance)
-			# Compute F4
-			indiceF4 = computeF4(ratio)
-			#Write Index
-			segment.setAttributes(segment.attributes() + [ratio, indiceF4])
-			# Add a feature to sink
-			sink.addFeature(segment, QgsFeatureSink.FastInsert)
-
-			# Increments the progress bar
-			if total_features != 0:
-				progress = int(100*(current/total_features))
-			else:
-				progress = 0
-			model_feedback.setProgress(progress)
+		# Compute the longitudinal width variation and the F4 index of every segment
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), model_feedback)
+		try :
+			with profiling.step(profiler, 'indice F4'):
+				f4_map = compute_f4(rivnet_layer, ptref_layer, seg_id_field, width_field, target_pts, step_min, costs=costs, feedback=model_feedback)
+		except Exception as e :
+			model_feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice F4 : {str(e)}"))
+			return {}
+		if f4_map is None:
+			return {}
+
+		# Write the results to the sink
+		index_results.write_results(sink, source.getFeatures(), seg_id_field, (f4_map, len(OUTPUT_FIELDS)))
+
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, model_feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'F4', model_feedback)
 
 		# Ending message
 		model_feedback.setProgressText(self.tr('\tProcessus terminé !'))
 
-		return {self.OUTPUT : dest_id}
+		return results
 
 	def tr(self, string):
 		return QCoreApplication.translate('Processing', string)
@@ -206,163 +190,89 @@ class IndiceF4(QgsProcessingAlgorithm):
 			"-> Nombre de points de transects visés par segment. Permet de meilleures performances pour réduire le nombre de transects pour les longs segments. L'augmenter augmentera la précision du calcul, mais ralentira l'exécution, en particulier pour les grands bassins versants.\n" \
 			" Longueur min entre transects (m) : double (10 m par défaut)\n" \
 			"-> La distance minimale à avoir entre les transects (surtout utilisé pour les petits segments à la place d'utiliser le nombre de points visés). Tous les segments de longueur inférieure à long min intertransect*nbr de points visé, utiliserons cette distance entre les transects. L'augmenter augmentera la précision du calcul, mais ralentira l'exécution, en particulier pour les grands bassins versants.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
 			"Retourne\n" \
 			"----------\n" \
 			"Couche de sortie : Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec le score de l'indice F4 calculé pour chaque UEA."
+			"-> Réseau hydrographique du bassin versant avec le score de l'indice F4 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
 		)
 
 
-def is_metric_crs(crs):
-	# True if the distance unit of the CRS is the meter
-	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
 
 
-def build_ptref_spatial_indexes(ptref_layer, seg_id_field: str, width_field: str):
-	"""
-	Builds spatial indexes by segment.
-	Returns a dict: {sid: {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': width_field}}
-	"""
-	seg_to_features = {}
-	global_feats = []
-
-	for pf in ptref_layer.getFeatures():
-		sid = pf[seg_id_field]
-		seg_to_features.setdefault(sid, []).append(pf)
-		global_feats.append(pf)
-	# Build per-segment indexes
-	seg_to_index = {}
-	for sid, feats in seg_to_features.items():
-		idx = QgsSpatialIndex()
-		for f in feats:
-			idx.addFeature(f)
-		seg_to_index[sid] = {'index': idx, 'features': feats, 'width_field': width_field}
-	# Build global spatial index (fallback)
-	global_idx = QgsSpatialIndex()
-	for f in global_feats:
-		global_idx.addFeature(f)
-	return seg_to_index, {'index': global_idx, 'features': global_feats, 'width_field': width_field}
-
-
-def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
+def compute_f4(source, ptref_layer, seg_id_field='Id_UEA', width_field='Largeur_mod', target_pts=50, step_min=10.0, costs=None, feedback=None):
 	"""
-	Robustly sample points along a (multi)line geometry every step_m meters.
-	- Clamps interpolation distances to [0, length - eps] to avoid null geometries.
-	- Skips empty/invalid interp results defensively.
-	- Falls back to a single midpoint when the segment is shorter than the step.
+	Computes the F4 index of every segment of the river network.
+
+	Parameters
+	----------
+	source : QgsVectorLayer
+		River network layer
+	ptref_layer : QgsVectorLayer
+		PtRef width layer
+	seg_id_field, width_field : str
+		Names of the segment identifier and PtRef width fields
+	target_pts : int
+		Number of width samples aimed for each segment
+	step_min : float
+		Minimal distance between the samples (m)
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (None : costs not recorded)
+
+	Returns
+	----------
+	f4_map : dict
+		{sid: [percentage of natural width variation, F4 index]} (None if canceled)
 	"""
-	pts = []
-	if seg_geom is None or seg_geom.isEmpty():
-		return pts
-	seg_len = seg_geom.length()
-	if not np.isfinite(seg_len) or seg_len <= 0.0:
-		return pts
-	# Tiny epsilon to stay strictly inside [0, length)
-	eps = max(1e-6, min(0.001, 1e-3 * seg_len))
-	def _interp_point_at(dist_m: float):
-		"""Interpolate and safely convert to QgsPointXY if a point geometry is returned."""
-		g = seg_geom.interpolate(dist_m)
-		if not g or g.isEmpty() or g.type() != QgsWkbTypes.PointGeometry:
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	# Widths of the PtRef of each segment (for faster searching)
+	feedback.pushInfo(tr('Indexation des PtRef par segment…'))
+	ptref_widths = ptref.width_arrays(ptref_layer, seg_id_field, width_field)
+	state = {
+		'ptref': ptref_widths,
+		# Fallback when a segment has no PtRef : the PtRef of all the segments
+		'all_ptref': np.vstack(list(ptref_widths.values())) if ptref_widths else np.empty((0, 3)),
+		'seg_id_field': seg_id_field,
+		'target_pts': target_pts,
+		'step_min': step_min,
+		'instrument': costs is not None
+	}
+
+	# Gets the number of features to iterate over for the progress bar
+	total_features = source.featureCount()
+	feedback.pushInfo(tr(f"\t {total_features} features à traiter"))
+
+	# Iteration over all river network features
+	f4_map = {}
+	for current, segment in enumerate(source.getFeatures()):
+		if feedback.isCanceled():
 			return None
-		# Handle Point vs MultiPoint
-		try:
-			p = g.asPoint()
-		except Exception:
-			mp = g.asMultiPoint()
-			if not mp:
-				return None
-			p = mp[0]
-		return QgsPointXY(p.x(), p.y())
-	# If the line is shorter than the step -> single midpoint (clamped)
-	if seg_len < step_m:
-		mid = max(0.0, min(seg_len - eps, seg_len * 0.5))
-		p = _interp_point_at(mid)
-		return [p] if p is not None else []
-	# Regular sampling
-	d = 0.0
-	while d < seg_len:
-		# Clamp d to [0, seg_len - eps] to avoid "null geometry" from interpolate()
-		dd = min(seg_len - eps, max(0.0, d))
-		p = _interp_point_at(dd)
-		if p is not None:
-			pts.append(p)
-		d += step_m
-	# Safety: if nothing has been collected (rare degenerate cases), try the midpoint
-	if not pts:
-		mid = max(0.0, min(seg_len - eps, seg_len * 0.5))
-		p = _interp_point_at(mid)
-		if p is not None:
-			pts.append(p)
-
-	return pts
-
-
-def nearest_width_value_indexed(center_pt: QgsPointXY, seg_ptref_idx_entry) -> float or None:
-	"""
-	Find the closest width via spatial index for this segment.
-	seg_ptref_idx_entry = {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': 'Width_mod'}
-	"""
-	if not seg_ptref_idx_entry:
-		return None
-	idx = seg_ptref_idx_entry['index']
-	feats = seg_ptref_idx_entry['features']
-	width_field = seg_ptref_idx_entry['width_field']
-	# small search box (~50 m around the point) to limit candidates
-	# (you can adjust the radius according to the density of PtRef)
-	r = 100
-	rect = QgsRectangle(center_pt.x() - r, center_pt.y() - r, center_pt.x() + r, center_pt.y() + r)
-	candidate_ids = idx.intersects(rect)
-	best_w = None
-	best_d = float('inf')
-	center_g = QgsGeometry.fromPointXY(center_pt)
-	# if there are no candidates in the bbox, we try them all (rare)
-	if not candidate_ids:
-		candidate_ids = [f.id() for f in feats]
-	# Direct access to features by FID via a query; otherwise local loop
-	# (here, we go through the ‘feats’ list, which is simpler and faster in memory)
-	id_to_feat = {f.id(): f for f in feats}
-	for fid in candidate_ids:
-		pf = id_to_feat.get(fid)
-		if pf is None:
-			continue
-		g = pf.geometry()
-		if not g or g.isEmpty():
-			continue
-		d = g.distance(center_g)
-		# Read width
-		try:
-			val = pf[width_field]
-			w = float(val) if val is not None else None
-		except Exception:
-			w = None
-		if w is not None and d < best_d:
-			best_d, best_w = d, w
-	return best_w
-
-
-def natural_width_ratio(widths, div_distance):
-	# 1) Cas impossible à traiter → ratio = 1 (100% naturel)
-	if len(widths) < 2:
-		return 1.0
-	# 2) Calcul des variations
-	difs_percent = (np.array(widths[1:]) - np.array(widths[:-1])) / np.array(widths[1:])
-	# 3) Cas limite : pas de variations → ratio = 1
-	if difs_percent.size == 0:
-		return 1.0
-	# 4) Variation spécifique
-	difs_specific = difs_percent * 1000 / div_distance
-	# 5) Variations anormales
-	unnatural_widths = np.where((difs_specific < 0) | (difs_specific > 0.2))[0].size
-	# 6) Ratio final
-	return 1 - (unnatural_widths / difs_percent.size)
-
-
-def computeF4(ratio):
-	# Compute F4
-	if (ratio >= 0.9):
-		return 0
-	if (ratio >= 0.66):
-		return 1
-	if (ratio >= 0.33):
-		return 2
-	return 3
\ No newline at end of file
+		sid = segment[seg_id_field]
+		# Width samples along the segment and F4 index
+		_, values, messages, *cost = instrumentation.evaluated(state, compute.f4_segment, sid, transport.line_parts(segment.geometry()))
+		if cost:
+			costs.add(sid, cost[0])
+		for message in messages:
+			feedback.pushInfo(message)
+		# Keep the results of the segment
+		f4_map[sid] = values
+
+		# Increments the progress bar
+		if total_features != 0:
+			progress = int(100*(current/total_features))
+		else:
+			progress = 0
+		feedback.setProgress(progress)
+	return f4_map
+
+
+def is_metric_crs(crs):
+	# True if the distance unit of the CRS is the meter
+	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
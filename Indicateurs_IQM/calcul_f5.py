@@ -24,6 +24,8 @@
 """
 
 
+import sys
+import time
 import numpy as np
 import math
 import warnings
@@ -36,19 +38,36 @@ from qgis.core import (
 	QgsPointXY,
 	QgsUnitTypes,
 	QgsGeometry,
-	QgsFeatureSink,
 	QgsWkbTypes,
 	QgsGeometry,
 	QgsSpatialIndex,
-	QgsRectangle,
 	QgsVectorLayer,
 	QgsProcessingAlgorithm,
 	QgsProcessingParameterVectorLayer,
+	QgsProcessingParameterEnum,
 	QgsProcessingParameterNumber,
 	QgsProcessingParameterString,
-	QgsProcessingParameterFeatureSink
+	QgsProcessingParameterBoolean,
+	QgsProcessingParameterFeatureSink,
+	QgsProcessingParameterFileDestination,
+	QgsProcessingContext,
+	QgsProcessingFeedback
 )
-import sys
+from pathlib import Path
+
+# Shared modules of the tool (IQM_Core) and the utility scripts are at the root of the repository
+ROOT = str(Path(__file__).resolve().parents[1])
+if ROOT not in sys.path:
+	sys.path.append(ROOT)
+from IQM_Core import compute, index_results, instrumentation, parallel, profiling, ptref, quicklook, service, transport
+from IQM_Utils import corridor_prefilter
+
+# Fields added to the river network by the F5 index, in the order of the values returned by compute_f5
+OUTPUT_FIELDS = [
+	QgsField("Perc_15to30m", QMetaType.Double, prec=2),
+	QgsField("Perc_gt30m", QMetaType.Double, prec=2),
+	QgsField("Indice F5", QMetaType.Int)
+]
 
 class IndiceF5(QgsProcessingAlgorithm):
 	OUTPUT = 'OUTPUT'
@@ -63,6 +82,17 @@ class IndiceF5(QgsProcessingAlgorithm):
 		self.addParameter(QgsProcessingParameterString('segment_id_field', self.tr('Nom du champ identifiant segment'), defaultValue=self.DEFAULT_SEG_ID_FIELD))
 		self.addParameter(QgsProcessingParameterNumber('target_pts', self.tr('Nombre de points visés par segment'), type=QgsProcessingParameterNumber.Integer, defaultValue=50))
 		self.addParameter(QgsProcessingParameterNumber('step_min', self.tr('Longueur minimale entre les transects (m)'), type=QgsProcessingParameterNumber.Double, defaultValue=10))
+		self.addParameter(QgsProcessingParameterEnum('sampler', self.tr('Placement des transects'), options=compute.SAMPLER_LABELS, defaultValue=0))
+		self.addParameter(QgsProcessingParameterNumber('early_stop', self.tr("Niveau de confiance de l'arrêt anticipé des transects (0 : tous les transects)"), type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=1, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('time_budget', self.tr('Budget de temps par segment (s, 0 : aucun)'), type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0, optional=True))
+		self.addParameter(QgsProcessingParameterEnum('mode', self.tr('Mode d\'évaluation'), options=quicklook.MODES, defaultValue=quicklook.FULL))
+		self.addParameter(QgsProcessingParameterVectorLayer('quick_look_layer', self.tr('Couche de sortie de l\'aperçu (mode raffinement)'), types=[QgsProcessing.TypeVectorLine], defaultValue=None, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('corridor_prefilter', self.tr('Préfiltrer la bande riveraine par corridor du réseau ?'), defaultValue=True, optional=True))
+		self.addParameter(QgsProcessingParameterNumber('workers', self.tr('Nombre de processus pour les segments (0 : tous les coeurs)'), type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('use_service', self.tr('Utiliser le service de calcul local (IQM_Core.service) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterFileDestination('cost_report', self.tr('Rapport des segments les plus coûteux (CSV)'), fileFilter='CSV (*.csv)', defaultValue=None, optional=True, createByDefault=False))
+		self.addParameter(QgsProcessingParameterBoolean('geos_counts', self.tr('Compter les opérations géométriques (GEOS) ?'), defaultValue=False, optional=True))
+		self.addParameter(QgsProcessingParameterBoolean('profile', self.tr('Profiler le calcul (cProfile) ?'), defaultValue=False, optional=True))
 		self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Couche de sortie'), type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, supportsAppend=True, defaultValue=None))
 
 
@@ -87,6 +117,15 @@ class IndiceF5(QgsProcessingAlgorithm):
 			return False, self.tr(f"La couche de PtRef n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
 		if not is_metric_crs(bande_layer.crs()) :
 			return False, self.tr(f"La couche de bande riveraine n'est pas dans un CRS en mètres! Veuillez reprojeter la couche dans un CRS valide.")
+		# Verify that the refinement starts from the output of a quick look
+		if self.parameterAsEnum(parameters, 'mode', context) == quicklook.REFINE:
+			quick_look_layer = self.parameterAsVectorLayer(parameters, 'quick_look_layer', context)
+			if quick_look_layer is None:
+				return False, self.tr("Le mode raffinement nécessite la couche de sortie de l'aperçu ! Veuillez fournir la couche produite par le mode aperçu.")
+			time_budget = self.parameterAsDouble(parameters, 'time_budget', context)
+			missing = quicklook.missing_fields(quick_look_layer, seg_id_field, index_results.budget_fields(OUTPUT_FIELDS, time_budget))
+			if missing:
+				return False, self.tr(f"La couche fournie ne contient pas les champs d'un aperçu de l'indice F5 ({', '.join(missing)}) ! Veuillez fournir la couche produite par le mode aperçu.")
 		return True, ''
 
 
@@ -100,18 +139,22 @@ class IndiceF5(QgsProcessingAlgorithm):
 		seg_id_field = self.parameterAsString(parameters, 'segment_id_field', context)
 		target_pts = int(self.parameterAsDouble(parameters, 'target_pts', context))
 		step_min = float(self.parameterAsDouble(parameters, 'step_min', context))
-		# Length of the transects (m) and margin to use
-		TRANSECT_LENGTH = 31.0
-		MARGIN = 2.0
+		sampler = compute.SAMPLERS[self.parameterAsEnum(parameters, 'sampler', context)]
+		confidence = self.parameterAsDouble(parameters, 'early_stop', context)
+		time_budget = self.parameterAsDouble(parameters, 'time_budget', context)
+		mode = self.parameterAsEnum(parameters, 'mode', context)
+		quick_look_layer = self.parameterAsVectorLayer(parameters, 'quick_look_layer', context)
+		use_corridor = self.parameterAsBool(parameters, 'corridor_prefilter', context)
+		workers = self.parameterAsInt(parameters, 'workers', context)
+		use_service = self.parameterAsBool(parameters, 'use_service', context)
 		# Verify the layers are created properly
 		for layer, name in [[rivnet_layer, "Réseau hydrographique"], [bande_layer, "Bande riveraine"], [ptref_layer, "PtRef largeur"]] :
 			if layer is None or not layer.isValid() :
 				raise RuntimeError(self.tr(f"Couche {name} invalide."))
 		# Define Sink
-		sink_fields = source.fields()
-		sink_fields.append(QgsField("Perc_15to30m", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Perc_gt30m", QMetaType.Double, prec=2))
-		sink_fields.append(QgsField("Indice F5", QMetaType.Int))
+		# Output fields of the index (with the approximation flag when the segments have a time budget)
+		fields = index_results.budget_fields(OUTPUT_FIELDS, time_budget)
+		sink_fields = index_results.output_fields(source.fields(), quicklook.output_fields(fields, mode))
 		(sink, dest_id) = self.parameterAsSink(
 			parameters,
 			self.OUTPUT,
@@ -120,139 +163,40 @@ class IndiceF5(QgsProcessingAlgorithm):
 			source.wkbType(),
 			source.sourceCrs()
 		)
-		model_feedback.setProgressText(self.tr("Dissolve des polygones de bande riveraine..."))
-		# Dissolve than simplify the riparian zone (only once)
-		bande_dissolved = processing.run('native:dissolve', {
-			'INPUT': bande_layer,
-			'SEPARATE_DISJOINT': False,
-			'OUTPUT': 'memory:'
-		}, context=context)['OUTPUT']
-		if model_feedback.isCanceled():
-			return {}
-		model_feedback.setProgressText(self.tr("Simplification des polygones de bande riveraine..."))
-		bande_simplified = processing.run('native:simplifygeometries', {
-			'INPUT': bande_dissolved,
-			'METHOD': 0,          # distance
-			'TOLERANCE': 2.0,     # à ajuster (2–5 m selon ton besoin)
-			'OUTPUT': 'memory:'
-		}, context=context)['OUTPUT']
-		if model_feedback.isCanceled():
-			return {}
-		# Make a vector layer of the simplified and dissolved riparian zone polygons
-		bande_global = make_layer(bande_simplified, context, 'bande_global_dissolved_simplified')
-
-		# Pre-indexation of PtRef per segment
-		model_feedback.pushInfo(self.tr('Indexation des PtRef par segment…'))
-		ptref_indexes_by_seg = build_ptref_spatial_indexes(ptref_layer, seg_id_field, width_field)
-
-		# Gets the number of features to iterate over for the progress bar
-		total_features = source.featureCount()
-		model_feedback.pushInfo(self.tr(f"{total_features} features à traiter"))
-		# Iteration over the network to find the pourcentage of length of riparian strip in the buffers
-		model_feedback.setProgressText(self.tr('Itération sur les segments du réseau...'))
+		# Compute the percentages of riparian strip and the F5 index of every segment
+		# Cost of each segment, recorded only when a cost report is asked for
+		cost_report = self.parameterAsFileOutput(parameters, 'cost_report', context)
+		costs = instrumentation.CostRecorder() if cost_report else None
+		# Geometry operations of the run, counted when asked for (parameter or IQM_GEOS_COUNTS environment variable)
+		geos_counts = instrumentation.start_geos_counts(self.parameterAsBool(parameters, 'geos_counts', context))
+		# Profile of the computation, written next to the output when asked for
+		profiler = profiling.new_profiler(self.parameterAsBool(parameters, 'profile', context), self.parameterAsOutputLayer(parameters, self.OUTPUT, context), self.name(), model_feedback)
 		try :
-			for current, segment in enumerate(source.getFeatures()):
-				if model_feedback.isCanceled():
-					return {}
-				# Making geometry object of the river segment
-				seg_geom = segment.geometry()
-				seg_len = seg_geom.length()
-				sid = segment[seg_id_field]
-				# Adjusting the number of steps based on segment length
-				if seg_len <= 0: # If segment length is lesser or equal to zero
-					model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice F5 mis à 4."))
-					segment.setAttributes(segment.attributes() + [0.0, 0.0, 4])
-					sink.addFeature(segment, QgsFeatureSink.FastInsert)
-					model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-					continue
-				else:
-					if seg_len <= 2 :
-						model_feedback.pushInfo(self.tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
-					# Calculate an appropriate step for the transect points
-					step_m_local = max(step_min, seg_len / target_pts) # Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
-					# Get points along segment based on given step_m_local for the segment
-					pts = safe_points_along_line(seg_geom, step_m_local)
-				# 1) Max river width on the segment
-				ptref_idx_entry = ptref_indexes_by_seg.get(sid)
-				w_max = max_width_for_segment(ptref_idx_entry)  # 0.0 if no PtRef
-				# 2) Adaptative clip radius (max offset + L + margin)
-				R = (w_max / 2.0) + TRANSECT_LENGTH + MARGIN
-				# 3) Adaptive buffer and simplified dissolved riparian zone
-				clip_buf = seg_geom.buffer(R, 8)
-				# Intersect the geometry of the riparian zone polygon with the segment max width buffer
-				band_clip = QgsGeometry()
-				for bf in bande_global.getFeatures():
-					g = bf.geometry()
-					if g and not g.isEmpty() and g.intersects(clip_buf):
-						inter = g.intersection(clip_buf)
-						if inter and not inter.isEmpty():
-							band_clip = band_clip.combine(inter) if not band_clip.isEmpty() else inter
-				# Make bounding box of the clipped riparian zone polygon to verify if the transect intersects
-				engine_prepared, band_bbox = make_prepared_engine_and_bbox(band_clip)
-				# Verify if the riparian zone union is empty (no riparian zone around the segment)
-				if (engine_prepared is None):
-					# Nothing to intersect for this segment
-					perc30 = 0.0
-					perc15to30 = 0.0
-					indiceF5 = computeF5_from_sides(perc30, perc15to30)
-					segment.setAttributes(segment.attributes() + [perc30, perc15to30, indiceF5])
-					sink.addFeature(segment, QgsFeatureSink.FastInsert)
-					model_feedback.setProgress(int(100 * (current) / max(1, total_features)))
-					continue
-				# Counters of transect in intersection with the riparian zone
-				count_30   = 0   # Number of shores (left+right) that have a riparian zone > 30 m
-				count_15to30 = 0 # Number of shores that have a riparian zone >= 15 m and =< 30 m
-				n_pts = len(pts)
-				# Go over each transect points to calculate the intersection with the riparian zone
-				for center_pt in pts:
-					# 1) Angle of local tangent
-					theta = direction_angle_at_point_fast(seg_geom, center_pt)
-					# In case there's some weird geometries
-					if theta == 0.0:
-						theta = direction_angle_at_point(seg_geom, center_pt)
-					# 2) Start offset = channel width/2 if PtRef exists, else 0
-					# Get the PtRef points index for this segments
-					ptref_idx_entry = ptref_indexes_by_seg.get(sid)
-					w = nearest_width_value_indexed(center_pt, ptref_idx_entry)
-					offset = (float(w) / 2.0) if (w and w > 0) else 0.0
-					# Transects left/right of length of TRANSECT_LENGTH 
-					left_line  = make_transect_line(center_pt, theta + math.pi/2.0, offset, TRANSECT_LENGTH)
-					right_line = make_transect_line(center_pt, theta - math.pi/2.0, offset, TRANSECT_LENGTH)
-					# Check the length of the transect intersection with riparian zone, if no riparian zone to intersect returns zero
-					left_int_len  = fast_intersection_length(left_line, band_clip, engine_prepared, band_bbox)
-					right_int_len = fast_intersection_length(right_line, band_clip, engine_prepared, band_bbox)
-					# Tests if the intersection length is smaller than 15m, if its not the case we skip the count of the transect
-					if (left_int_len < 15.0) and (right_int_len < 15.0):
-						continue
-					# 3) Counts the number of transects for which the intersect is greater or equal to each width treshold (15 and 30m)(taking into account each sides)
-					count_30 += (1 if left_int_len > 30.0 else 0) + (1 if right_int_len > 30.0 else 0)
-					count_15to30  += (1 if (15.0 <= left_int_len <= 30.0) else 0) + (1 if (15.0 <= right_int_len <= 30.0) else 0)
-
-				# Pourcentages
-				den = 2.0 * float(n_pts) if n_pts else 1.0
-				perc30 = count_30 / den
-				perc15to30 = count_15to30 / den
-
-				# Compute the F5 index
-				indiceF5 = computeF5_from_sides(perc30, perc15to30)
-
-				# Adding results to the sink
-				segment.setAttributes(segment.attributes() + [perc15to30*100, perc30*100,  indiceF5])
-				sink.addFeature(segment, QgsFeatureSink.FastInsert)
-
-				# Increments the progress bar
-				if total_features != 0:
-					progress = int(100*(current/total_features))
+			with profiling.step(profiler, 'indice F5'):
+				if mode == quicklook.REFINE:
+					# Only the segments of the quick look near a class breakpoint are computed at full resolution
+					f5_map = quicklook.refine(lambda layer: compute_f5(layer, bande_layer, ptref_layer, seg_id_field, width_field, target_pts, step_min, use_corridor, workers, use_service, confidence, sampler=sampler, time_budget=time_budget, costs=costs, context=context, feedback=model_feedback), rivnet_layer, seg_id_field, quick_look_layer, fields, feedback=model_feedback)
 				else:
-					progress = 0
-				model_feedback.setProgress(progress)
+					f5_map = compute_f5(rivnet_layer, bande_layer, ptref_layer, seg_id_field, width_field, target_pts, step_min, use_corridor, workers, use_service, confidence, quick_look=mode == quicklook.QUICK_LOOK, sampler=sampler, time_budget=time_budget, costs=costs, context=context, feedback=model_feedback)
 		except Exception as e :
-			model_feedback.reportError(self.tr(f"Erreur dans la boucle de segments : {str(e)}"))
+			model_feedback.reportError(self.tr(f"Erreur dans le calcul de l'indice F5 : {str(e)}"))
+			return {}
+		if f5_map is None:
 			return {}
+
+		# Write the results to the sink
+		index_results.write_results(sink, source.getFeatures(), seg_id_field, (f5_map, len(quicklook.output_fields(fields, mode))))
+
+		results = {self.OUTPUT: dest_id}
+		report = instrumentation.write_report(costs, cost_report, model_feedback)
+		if report:
+			results['cost_report'] = report
+		instrumentation.report_geos_counts(geos_counts, 'F5', model_feedback)
+
 		# Ending message
 		model_feedback.setProgressText(self.tr('\tProcessus terminé !'))
 
-		return {self.OUTPUT : dest_id}
+		return results
 
 
 	def tr(self, string):
@@ -292,13 +236,307 @@ class IndiceF5(QgsProcessingAlgorithm):
 			"-> Nombre de points de transects visés par segment. Permet de meilleures performances pour réduire le nombre de transects pour les longs segments. L'augmenter augmentera la précision du calcul, mais ralentira l'exécution, en particulier pour les grands bassins versants.\n" \
 			" Longueur min entre transects (m) : double (10 m par défaut)\n" \
 			"-> La distance minimale à avoir entre les transects (surtout utilisé pour les petits segments à la place d'utiliser le nombre des points visés). Tous les segments de longueur inférieure à long min intertransect*nbr de points visé, utiliserons cette distance entre les transects. L'augmenter augmentera la précision du calcul, mais ralentira l'exécution, en particulier pour les grands bassins versants.\n" \
+			"Préfiltrer la bande riveraine par corridor : Booléen (optionnel; valeur par défaut : Vrai) \n" \
+			"-> Conserve seulement les polygones de bande riveraine à l'intérieur du corridor du réseau hydrographique (script Préfiltrage par corridor) avant leur fusion et simplification. Peut être désactivé lorsque la couche a déjà été préfiltrée.\n" \
+			"Placement des transects : Liste (valeur par défaut : Uniforme)\n" \
+			"-> Uniforme : transects à intervalles réguliers le long du segment. Courbure : le même nombre de transects est placé selon l'angle de virage cumulé (la moitié selon la longueur, la moitié selon la courbure), ce qui en met davantage dans les méandres et moins dans les tronçons rectilignes. Chaque transect compte alors pour la longueur de segment qu'il représente dans la médiane et les pourcentages. Nécessite Shapely.\n" \
+			"Niveau de confiance de l'arrêt anticipé : double (optionnel; valeur par défaut : 0)\n" \
+			"-> Évalue les transects de chaque segment du plus grossier au plus fin (ordre binaire inversé des points) et s'arrête dès que la classe de l'indice ne peut plus changer au niveau de confiance donné (p. ex. 0.95). À 1, l'arrêt se fait seulement lorsque la classe est certaine, quels que soient les transects restants (scores identiques). À 0, tous les transects sont évalués. La valeur de l'indice est alors celle des transects évalués. Nécessite Shapely.\n" \
+			"Budget de temps par segment (s) : double (optionnel; valeur par défaut : 0)\n" \
+			"-> Temps de calcul maximal d'un segment (0 : aucun). Lorsque le temps d'un segment, projeté sur tous ses transects, dépasse ce budget (géométrie du segment très détaillée, grand polygone proche), ses transects restants sont évalués de façon approchée : par points à chaque mètre le long des transects avec Shapely, avec la bande riveraine simplifiée à 2 m sans Shapely. Le champ Approx ajouté à la sortie vaut alors 1 pour ce segment.\n" \
+			"Mode d'évaluation : Liste (valeur par défaut : Complet)\n" \
+			"-> Complet : tous les transects sont évalués. Aperçu : seuls quelques transects répartis sur chaque segment (8 points) sont évalués, pour un premier résultat rapide sur de grands territoires, et le champ Pres_seuil vaut 1 lorsque la classe de l'indice pourrait changer avec tous les transects (métrique près d'un seuil de classe, niveau de confiance de 0.8). Raffinement : reprend la couche de sortie d'un aperçu et calcule à pleine résolution seulement les segments avec Pres_seuil à 1 (ou absents de l'aperçu), les autres gardant leurs valeurs.\n" \
+			"Couche de sortie de l'aperçu : Vectoriel (lignes) (optionnel)\n" \
+			"-> Couche produite par le mode aperçu sur le même réseau, utilisée par le mode raffinement.\n" \
+			"Nombre de processus : nombre entier (optionnel; 1 par défaut)\n" \
+			"-> Nombre de processus évaluant les transects des segments en parallèle (0 : un par coeur). La bande riveraine préparée et les largeurs des PtRef sont placées en mémoire partagée, lue sans copie par chaque processus.\n" \
+			"Utiliser le service de calcul : Booléen (optionnel; valeur par défaut : Faux) \n" \
+			"-> Évalue les segments dans le service de calcul local (python -m IQM_Core.service), qui conserve en mémoire la bande riveraine préparée et les largeurs des PtRef d'une exécution à l'autre pour les mêmes données. Utile pour relancer l'indice en changeant le nombre de points visés ou la longueur minimale entre les transects. Si le service est injoignable, le calcul se fait dans QGIS.\n" \
+			"Compter les opérations géométriques : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Compte les opérations géométriques (GEOS : intersects, intersection, buffer, unaryUnion, distance, lineLocatePoint, interpolate, ...) du calcul, y compris dans les processus parallèles et le service de calcul, et affiche à la fin leur total par opération et par fonction appelante. Ces comptes ne dépendent pas de la vitesse de la machine et permettent de comparer des variantes d'algorithme. La variable d'environnement IQM_GEOS_COUNTS=1 les active pour toutes les exécutions des indices.\n" \
+			"Profiler le calcul : Booléen (optionnel; valeur par défaut : Faux)\n" \
+			"-> Exécute le calcul de l'indice sous cProfile et sous un échantillonneur de la pile d'appels, et écrit dans le dossier de la couche de sortie (dossier temporaire de Processing pour une couche temporaire) un fichier .prof (pstats, snakeviz) et un fichier .collapsed de piles repliées (flamegraph.pl, speedscope). Les processus parallèles et le service de calcul ne sont pas profilés (utiliser 1 processus).\n" \
 			"Retourne\n" \
 			"----------\n" \
 			"Couche de sortie :  Vectoriel (lignes)\n" \
-			"-> Réseau hydrographique du bassin versant avec le pourcentage de longueur de segment ayant une bande riveraine entre 15 et 30m [15,30] et le pourcentage pour une largeur de plus de 30m ainsi que le score de l'indice F5 calculé pour chaque UEA."
+			"-> Réseau hydrographique du bassin versant avec le pourcentage de longueur de segment ayant une bande riveraine entre 15 et 30m [15,30] et le pourcentage pour une largeur de plus de 30m ainsi que le score de l'indice F5 calculé pour chaque UEA.\n" \
+			"Rapport des segments les plus coûteux : Fichier CSV (si demandé)\n" \
+			"-> Si un fichier est donné, le temps de calcul, le nombre de transects, le nombre d'opérations géométriques (GEOS) et le nombre de sommets de la géométrie locale de chaque segment sont mesurés. Les 50 segments les plus coûteux sont écrits dans ce fichier (rang, identifiant, coûts, part du temps total) et l'histogramme des temps des segments dans <fichier>_histogramme.csv. Un résumé est affiché dans le journal."
 		)
 
 
+def tr(string):
+	return QCoreApplication.translate('Processing', string)
+
+
+def compute_f5(source, bande_layer, ptref_layer, seg_id_field='Id_UEA', width_field='Largeur_mod', target_pts=50, step_min=10.0, use_corridor=True, workers=1, use_service=False, confidence=0.0, quick_look=False, sampler='uniform', time_budget=0.0, costs=None, context=None, feedback=None):
+	"""
+	Computes the F5 index of every segment of the river network.
+
+	Parameters
+	----------
+	source : QgsVectorLayer
+		River network layer
+	bande_layer : QgsVectorLayer
+		Riparian strip polygons
+	ptref_layer : QgsVectorLayer
+		PtRef width layer
+	seg_id_field, width_field : str
+		Names of the segment identifier and PtRef width fields
+	target_pts : int
+		Number of transect points aimed for each segment
+	step_min : float
+		Minimal distance between the transects (m)
+	use_corridor : bool
+		Keep only the riparian polygons within the network corridor before the dissolve
+	workers : int
+		Number of processes of the segment loop (0 : number of cores)
+	use_service : bool
+		Evaluate the segments in the local compute service (IQM_Core.service), which keeps the prepared data between runs
+	confidence : float
+		Confidence level of the early stop of the transects of a segment, once its class is fixed (0 : all the transects, 1 : exact bounds, IQM_Core.compute.probe_transects)
+	quick_look : bool
+		Only probe a few transects of each segment and add the boundary-proximity flag to the values (IQM_Core.quicklook)
+	sampler : str
+		Placement of the transect points : 'uniform' (evenly spaced) or 'curvature' (by cumulative turning angle, the statistics being weighted by the length each point stands for)
+	time_budget : float
+		Time budget of each segment (s, 0 : none) : past it, the segment is approximated and its approximation flag is added to the values (IQM_Core.compute.probe_transects)
+	costs : IQM_Core.instrumentation.CostRecorder
+		Recorder of the cost of each segment for the cost report (None : costs not recorded)
+
+	Returns
+	----------
+	f5_map : dict
+		{sid: [percentage 15 to 30 m, percentage over 30 m, F5 index]} (None if canceled)
+	"""
+	context = context if context is not None else QgsProcessingContext()
+	feedback = feedback if feedback is not None else QgsProcessingFeedback()
+	params = {'target_pts': target_pts, 'step_min': step_min, 'confidence': confidence, 'quick_look': compute.QUICK_LOOK_POINTS if quick_look else 0, 'sampler': sampler, 'time_budget': time_budget}
+	# Prepared data kept by the local compute service between runs
+	if use_service:
+		client = service.connect(feedback)
+		if client is not None:
+			key = service.fingerprint('F5', [source, bande_layer, ptref_layer], [seg_id_field, width_field, use_corridor])
+			try:
+				return client.evaluate_segments(key, lambda: prepare_f5(source, bande_layer, ptref_layer, seg_id_field, width_field, use_corridor, context, feedback), params, source, seg_id_field, feedback=feedback, costs=costs)
+			finally:
+				client.close()
+	payload = prepare_f5(source, bande_layer, ptref_layer, seg_id_field, width_field, use_corridor, context, feedback)
+	if payload is None:
+		return None
+	payload.update(params)
+
+	# Iteration over the network to find the pourcentage of length of riparian strip in the buffers
+	if (confidence or quick_look or sampler != 'uniform') and not compute.HAS_SHAPELY:
+		feedback.pushInfo(tr("Arrêt anticipé, aperçu et placement par courbure des transects indisponibles sans Shapely : tous les transects sont évalués, à intervalles réguliers."))
+	feedback.setProgressText(tr('Itération sur les segments du réseau...'))
+	try :
+		# NumPy/Shapely kernels when Shapely is installed, GEOS predicates through QGIS otherwise
+		kernel = compute if compute.HAS_SHAPELY else sys.modules[__name__]
+		f5_map = parallel.evaluate_segments(kernel, payload, source, seg_id_field, workers, feedback=feedback, costs=costs)
+		# The QGIS kernels evaluate every transect : the class of each segment is known
+		if quick_look and f5_map is not None and not compute.HAS_SHAPELY:
+			f5_map = {sid: list(values) + [0] for sid, values in f5_map.items()}
+	except Exception as e :
+		raise RuntimeError(tr(f"Erreur dans la boucle de segments : {str(e)}"))
+	return f5_map
+
+
+def prepare_f5(source, bande_layer, ptref_layer, seg_id_field, width_field, use_corridor, context, feedback):
+	"""
+	Prepares the riparian strip and the PtRef widths of the segment loop.
+
+	Returns
+	----------
+	payload : dict
+		Packed data given to worker_init (None if canceled)
+	"""
+	# Length of the transects (m) and margin to use
+	TRANSECT_LENGTH = 31.0
+	MARGIN = 2.0
+	# Keep only the riparian polygons within the network corridor before the dissolve
+	if use_corridor:
+		feedback.setProgressText(tr("Préfiltrage des polygones de bande riveraine par corridor du réseau..."))
+		try :
+			_, bande_layer = corridor_prefilter.prefilter_layers(source, seg_id_field, ptref_layer, width_field, TRANSECT_LENGTH, bande_layer=bande_layer, feedback=feedback)
+		except Exception as e :
+			raise RuntimeError(tr(f"Erreur dans le préfiltrage par corridor : {str(e)}"))
+		if feedback.isCanceled():
+			return None
+
+	feedback.setProgressText(tr("Dissolve des polygones de bande riveraine..."))
+	# Dissolve than simplify the riparian zone (only once)
+	bande_dissolved = processing.run('native:dissolve', {
+		'INPUT': bande_layer,
+		'SEPARATE_DISJOINT': False,
+		'OUTPUT': 'memory:'
+	}, context=context)['OUTPUT']
+	if feedback.isCanceled():
+		return None
+	feedback.setProgressText(tr("Simplification des polygones de bande riveraine..."))
+	bande_simplified = processing.run('native:simplifygeometries', {
+		'INPUT': bande_dissolved,
+		'METHOD': 0,          # distance
+		'TOLERANCE': 2.0,     # à ajuster (2–5 m selon ton besoin)
+		'OUTPUT': 'memory:'
+	}, context=context)['OUTPUT']
+	if feedback.isCanceled():
+		return None
+	# Make a vector layer of the simplified and dissolved riparian zone polygons
+	bande_global = make_layer(bande_simplified, context, 'bande_global_dissolved_simplified')
+
+	# Widths of the PtRef of each segment
+	feedback.pushInfo(tr('Indexation des PtRef par segment…'))
+	ptref_widths = ptref.width_arrays(ptref_layer, seg_id_field, width_field)
+
+	# Packed data of the segment loop (shared with the worker processes)
+	payload = {
+		'index': 'F5',
+		'bands': transport.pack_geometries([f.geometry() for f in bande_global.getFeatures()]),
+		'ptref': transport.pack_groups(ptref_widths),
+		'seg_id_field': seg_id_field,
+		'transect_length': TRANSECT_LENGTH,
+		'margin': MARGIN
+	}
+	return payload
+
+
+def worker_init(payload):
+	"""
+	Unpacks the PtRef widths, the riparian strip geometries being rebuilt when first met by a segment.
+	"""
+	state = dict(payload)
+	state['ptref'] = transport.unpack_groups(payload['ptref'])
+	state['geometries'] = {}
+	# Simplified strips of the segments over their time budget
+	state['simplified'] = {}
+	return state
+
+
+def evaluate_chunk(state, segments, ids, start, stop):
+	"""
+	Evaluates the segments [start, stop[ of packed segments, returns [[sid, values, messages], ...]
+	(each followed by the cost of the segment with a cost report, IQM_Core.instrumentation.evaluated).
+	"""
+	results = []
+	for i in range(start, stop):
+		results.append(instrumentation.evaluated(state, evaluate_segment, ids[i], transport.unpack_geometry(segments, i)))
+	return results
+
+
+def evaluate_segment(state, sid, seg_geom):
+	"""
+	Percentages of riparian strip and F5 index of one segment.
+
+	Returns
+	----------
+	values : list
+		[percentage 15 to 30 m, percentage over 30 m, F5 index] (and the approximation flag with a time budget)
+	messages : list of str
+		Warnings about the segment
+	"""
+	messages = []
+	# Past the time budget of the segment, the riparian strip is simplified (APPROX_TOLERANCE) before its clip
+	started = time.perf_counter()
+	budget = state.get('time_budget')
+	approx = False
+	TRANSECT_LENGTH = state['transect_length']
+	MARGIN = state['margin']
+	seg_id_field = state['seg_id_field']
+	seg_len = seg_geom.length()
+	# Adjusting the number of steps based on segment length
+	if seg_len <= 0: # If segment length is lesser or equal to zero
+		messages.append(tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale zéro mètre ! Veuillez vérifier sa validité Indice F5 mis à 4."))
+		return compute.with_approx(state, [0.0, 0.0, 4]), messages
+	if seg_len <= 2 :
+		messages.append(tr(f"ATTENTION : Le segment ({seg_id_field} : {sid}) est de longueur inférieure ou égale à deux mètres ! Veuillez vérifier si l'UEA est un artéfact de prétraitement."))
+	# Calculate an appropriate step for the transect points
+	step_m_local = max(state['step_min'], seg_len / state['target_pts']) # Makes bigger steps for long segments while keeping a set minimal resolution for smaller segments
+	# Get points along segment based on given step_m_local for the segment
+	pts = safe_points_along_line(seg_geom, step_m_local)
+	# 1) Max river width on the segment
+	seg_widths = state['ptref'].get(sid)
+	w_max = ptref.max_width(seg_widths)  # 0.0 if no PtRef
+	# 2) Adaptative clip radius (max offset + L + margin)
+	R = (w_max / 2.0) + TRANSECT_LENGTH + MARGIN
+	# 3) Adaptive buffer and simplified dissolved riparian zone
+	instrumentation.count_geos('buffer')
+	clip_buf = seg_geom.buffer(R, 8)
+	# Intersect the geometry of the riparian zone polygon with the segment max width buffer
+	band_clip = QgsGeometry()
+	clip_box = clip_buf.boundingBox()
+	bounds = state['bands']['bounds']
+	near = (bounds[:, 0] <= clip_box.xMaximum()) & (bounds[:, 2] >= clip_box.xMinimum()) & (bounds[:, 1] <= clip_box.yMaximum()) & (bounds[:, 3] >= clip_box.yMinimum())
+	for i in np.flatnonzero(near):
+		if i not in state['geometries']:
+			state['geometries'][i] = transport.unpack_geometry(state['bands'], i)
+		g = state['geometries'][i]
+		approx = approx or compute.over_budget(started, budget)
+		if approx and g and not g.isEmpty():
+			if i not in state['simplified']:
+				instrumentation.count_geos('simplify')
+				state['simplified'][i] = g.simplify(compute.APPROX_TOLERANCE)
+			g = state['simplified'][i]
+		instrumentation.count_geos('intersects')
+		if g and not g.isEmpty() and g.intersects(clip_buf):
+			instrumentation.count_geos('intersection')
+			inter = g.intersection(clip_buf)
+			if inter and not inter.isEmpty():
+				instrumentation.count_geos('combine')
+				band_clip = band_clip.combine(inter) if not band_clip.isEmpty() else inter
+	# Make bounding box of the clipped riparian zone polygon to verify if the transect intersects
+	engine_prepared, band_bbox = make_prepared_engine_and_bbox(band_clip)
+	# Verify if the riparian zone union is empty (no riparian zone around the segment)
+	if (engine_prepared is None):
+		# Nothing to intersect for this segment
+		perc30 = 0.0
+		perc15to30 = 0.0
+		indiceF5 = compute.score_f5(perc30, perc15to30)
+		return compute.with_approx(state, [perc30, perc15to30, indiceF5], approx), messages
+	# Counters of transect in intersection with the riparian zone
+	count_30   = 0   # Number of shores (left+right) that have a riparian zone > 30 m
+	count_15to30 = 0 # Number of shores that have a riparian zone >= 15 m and =< 30 m
+	n_pts = len(pts)
+	instrumentation.add_cost(state, transects=2 * n_pts, vertices=band_clip.constGet().nCoordinates())
+	# Go over each transect points to calculate the intersection with the riparian zone
+	for center_pt in pts:
+		# Simplify the clipped riparian strip once the time budget is spent
+		if not approx and compute.over_budget(started, budget):
+			approx = True
+			instrumentation.count_geos('simplify')
+			band_clip = band_clip.simplify(compute.APPROX_TOLERANCE)
+			engine_prepared, band_bbox = make_prepared_engine_and_bbox(band_clip)
+		# 1) Angle of local tangent
+		theta = direction_angle_at_point_fast(seg_geom, center_pt)
+		# In case there's some weird geometries
+		if theta == 0.0:
+			theta = direction_angle_at_point(seg_geom, center_pt)
+		# 2) Start offset = channel width/2 if PtRef exists, else 0
+		w = ptref.nearest_width(center_pt.x(), center_pt.y(), seg_widths)
+		offset = (float(w) / 2.0) if (w and w > 0) else 0.0
+		# Transects left/right of length of TRANSECT_LENGTH 
+		left_line  = make_transect_line(center_pt, theta + math.pi/2.0, offset, TRANSECT_LENGTH)
+		right_line = make_transect_line(center_pt, theta - math.pi/2.0, offset, TRANSECT_LENGTH)
+		# Check the length of the transect intersection with riparian zone, if no riparian zone to intersect returns zero
+		left_int_len  = fast_intersection_length(left_line, band_clip, engine_prepared, band_bbox)
+		right_int_len = fast_intersection_length(right_line, band_clip, engine_prepared, band_bbox)
+		# Tests if the intersection length is smaller than 15m, if its not the case we skip the count of the transect
+		if (left_int_len < 15.0) and (right_int_len < 15.0):
+			continue
+		# 3) Counts the number of transects for which the intersect is greater or equal to each width treshold (15 and 30m)(taking into account each sides)
+		count_30 += (1 if left_int_len > 30.0 else 0) + (1 if right_int_len > 30.0 else 0)
+		count_15to30  += (1 if (15.0 <= left_int_len <= 30.0) else 0) + (1 if (15.0 <= right_int_len <= 30.0) else 0)
+
+	# Pourcentages
+	den = 2.0 * float(n_pts) if n_pts else 1.0
+	perc30 = count_30 / den
+	perc15to30 = count_15to30 / den
+
+	# Compute the F5 index
+	indiceF5 = compute.score_f5(perc30, perc15to30)
+	return compute.with_approx(state, [perc15to30*100, perc30*100,  indiceF5], approx), messages
+
+
 def is_metric_crs(crs):
 	# True if the distance unit of the CRS is the meter
 	return crs.mapUnits() == QgsUnitTypes.DistanceMeters
@@ -320,25 +558,6 @@ def make_layer(obj, context, name='layer'):
 	raise TypeError(f"Type inattendu pour '{name}': {type(obj)}")
 
 
-def build_ptref_spatial_indexes(ptref_layer, seg_id_field: str, width_field: str):
-	"""
-	Builds spatial indexes by segment.
-	Returns a dict: {sid: {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': width_field}}
-	"""
-	seg_to_features = {}
-	for pf in ptref_layer.getFeatures():
-		sid = pf[seg_id_field]
-		seg_to_features.setdefault(sid, []).append(pf)
-
-	seg_to_index = {}
-	for sid, feats in seg_to_features.items():
-		idx = QgsSpatialIndex()
-		for f in feats:
-			idx.addFeature(f)
-		seg_to_index[sid] = {'index': idx, 'features': feats, 'width_field': width_field}
-	return seg_to_index
-
-
 def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
 	"""
 	Robustly sample points along a (multi)line geometry every step_m meters.
@@ -356,6 +575,7 @@ def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
 	eps = max(1e-6, min(0.001, 1e-3 * seg_len))
 	def _interp_point_at(dist_m: float):
 		"""Interpolate and safely convert to QgsPointXY if a point geometry is returned."""
+		instrumentation.count_geos('interpolate')
 		g = seg_geom.interpolate(dist_m)
 		if not g or g.isEmpty() or g.type() != QgsWkbTypes.PointGeometry:
 			return None
@@ -392,27 +612,6 @@ def safe_points_along_line(seg_geom: QgsGeometry, step_m: float) -> list:
 	return pts
 
 
-def max_width_for_segment(ptref_idx_entry) -> float:
-	"""
-	Returns the maximum width (Largeur_mod) on the PtRef of the segment.
-	ptref_idx_entry = {'index': QgsSpatialIndex, 'features': [QgsFeature], width_field: 'Largeur_mod'}
-	"""
-	if not ptref_idx_entry:
-		return 0.0
-	feats = ptref_idx_entry.get('features', [])
-	width_field = ptref_idx_entry.get('width_field', 'Largeur_mod')
-	wmax = 0.0
-	for pf in feats:
-		try:
-			val = pf[width_field]
-			w = float(val) if val is not None else None
-		except Exception:
-			w = None
-		if w is not None and w > wmax:
-			wmax = w
-	return wmax
-
-
 def make_prepared_engine_and_bbox(geom: QgsGeometry):
 	"""
 	Returns (engine_prepared, bbox) for geom.
@@ -520,6 +719,7 @@ def direction_angle_at_point(seg_geom: QgsGeometry, pt_xy: QgsPointXY) -> float:
 			continue
 		for a, b in zip(line[:-1], line[1:]):
 			seg_geom_ab = QgsGeometry.fromPolylineXY([a, b])
+			instrumentation.count_geos('distance')
 			d = seg_geom_ab.distance(pt_geom)
 			if d < best_dist:
 				best_dist = d
@@ -533,49 +733,6 @@ def direction_angle_at_point(seg_geom: QgsGeometry, pt_xy: QgsPointXY) -> float:
 	return math.atan2(dy, dx)
 
 
-def nearest_width_value_indexed(center_pt: QgsPointXY, seg_ptref_idx_entry) -> float or None:
-	"""
-	Find the closest width via spatial index for this segment.
-	seg_ptref_idx_entry = {'index': QgsSpatialIndex, 'features': [QgsFeature], 'width_field': 'Width_mod'}
-	"""
-	if not seg_ptref_idx_entry:
-		return None
-	idx = seg_ptref_idx_entry['index']
-	feats = seg_ptref_idx_entry['features']
-	width_field = seg_ptref_idx_entry['width_field']
-	# small search box (~50 m around the point) to limit candidates
-	# (you can adjust the radius according to the density of PtRef)
-	r = 100
-	rect = QgsRectangle(center_pt.x() - r, center_pt.y() - r, center_pt.x() + r, center_pt.y() + r)
-	candidate_ids = idx.intersects(rect)
-	best_w = None
-	best_d = float('inf')
-	center_g = QgsGeometry.fromPointXY(center_pt)
-	# if there are no candidates in the bbox, we try them all (rare)
-	if not candidate_ids:
-		candidate_ids = [f.id() for f in feats]
-	# Direct access to features by FID via a query; otherwise local loop
-	# (here, we go through the ‘feats’ list, which is simpler and faster in memory)
-	id_to_feat = {f.id(): f for f in feats}
-	for fid in candidate_ids:
-		pf = id_to_feat.get(fid)
-		if pf is None:
-			continue
-		g = pf.geometry()
-		if not g or g.isEmpty():
-			continue
-		d = g.distance(center_g)
-		# Read width
-		try:
-			val = pf[width_field]
-			w = float(val) if val is not None else None
-		except Exception:
-			w = None
-		if w is not None and d < best_d:
-			best_d, best_w = d, w
-	return best_w
-
-
 def make_transect_line(center_pt: QgsPointXY, normal_angle: float, offset: float, length_m: float) -> QgsGeometry:
 	"""
 	Construit une ligne perpendiculaire :
@@ -602,9 +759,11 @@ def fast_intersection_length(line: QgsGeometry, band_union: QgsGeometry, engine_
 	if not line.boundingBox().intersects(band_bbox):
 		return 0.0
 	# 2) Narrow-phase: prédicat exact sur geometry préparée
+	instrumentation.count_geos('intersects')
 	if not engine_prepared.intersects(line.constGet()):
 		return 0.0
 	# 3) Overlay: on calcule enfin l'intersection réelle (coûteuse)
+	instrumentation.count_geos('intersection')
 	inter = line.intersection(band_union)
 	return inter.length() if (inter and not inter.isEmpty()) else 0.0
 
@@ -654,22 +813,3 @@ def line_intersection_length_union(line_geom: QgsGeometry, band_union: QgsGeomet
 	inter = line_geom.intersection(band_union)
 	return inter.length() if (inter and not inter.isEmpty()) else 0.0
 
-
-def computeF5_from_sides(p30, p15to30):
-	"""  Class F5 based on the proportion of compliant banks per threshold """
-	# Classe 0 : ≥>30 m on > 90% of length
-	if p30 > 0.90:
-		return 0
-	# Classe 1 : ≥>30 m on > 66% of length
-	if p30 > 0.66:
-		return 1
-	# Classe 2 :
-	# - 15-30 m on > 66%   OU
-	# - ≥>30 m on 33-66%
-	if (p15to30 > 0.66) or (0.33 <= p30 <= 0.66):
-		return 2
-	# Classe 3 : 15-30 m (discontinued) sur 33-66% et pas de ≥30 m significatif
-	if (0.33 <= p15to30 <= 0.66) and (p30 < 0.33):
-		return 3
-	# Classe 4 : < 33% en tout
-	return 4
\ No newline at end of file
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Geometry and sequential sampling helpers of IQM_Core.compute.
+"""
+
+
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+from IQM_Core import compute
+
+
+def pack_polygons(polygons):
+	# Packed geometries (IQM_Core.transport.pack_geometries layout) of Shapely polygons, without QGIS
+	coords = []
+	ring_offsets = [0]
+	part_offsets = [0]
+	geom_offsets = [0]
+	n_vertices = 0
+	for polygon in polygons:
+		for part in getattr(polygon, 'geoms', [polygon]):
+			for ring in [part.exterior] + list(part.interiors):
+				xy = np.asarray(ring.coords)[:, :2]
+				coords.append(xy)
+				n_vertices += len(xy)
+				ring_offsets.append(n_vertices)
+			part_offsets.append(len(ring_offsets) - 1)
+		geom_offsets.append(len(part_offsets) - 1)
+	return {
+		'coords': np.concatenate(coords),
+		'ring_offsets': np.array(ring_offsets, dtype=np.int64),
+		'part_offsets': np.array(part_offsets, dtype=np.int64),
+		'geom_offsets': np.array(geom_offsets, dtype=np.int64),
+		'kinds': np.full(len(polygons), 2, dtype=np.int8),
+		'multi': np.ones(len(polygons), dtype=bool),
+		'bounds': np.array([polygon.bounds for polygon in polygons], dtype=float)
+	}
+
+
+def test_chord_length_single_part():
+	line = [np.array([[0.0, 0.0], [3.0, 10.0], [3.0, 4.0]])]
+	assert compute.chord_length(line) == pytest.approx(5.0)
+	assert compute.chord_length([]) == 0.0
+	assert compute.chord_length([np.array([[1.0, 1.0]])]) == 0.0
+
+
+def test_chord_length_disjoint_parts():
+	# Parts in any order and direction, with small gaps at the junctions : extremities (0, 0) and (30, 40)
+	parts = [
+		np.array([[10.5, 0.0], [20.0, 0.0]]),
+		np.array([[10.0, 0.0], [0.0, 0.0]]),
+		np.array([[20.0, 0.5], [30.0, 40.0]]),
+	]
+	assert compute.chord_length(parts) == pytest.approx(50.0)
+	assert compute.chord_length(parts[::-1]) == pytest.approx(50.0)
+
+
+def test_sinuosity_index():
+	assert np.allclose(compute.sinuosity_index([10.0, 15.0, 3.0], [10.0, 10.0, 0.0]), [1.0, 1.5, 1.0])
+
+
+@pytest.mark.parametrize('n', range(0, 40))
+def test_bit_reversed_order_is_a_permutation(n):
+	order = compute.bit_reversed_order(n)
+	assert sorted(order.tolist()) == list(range(n))
+
+
+def test_bit_reversed_order_coarse_to_fine():
+	assert compute.bit_reversed_order(8).tolist() == [0, 4, 2, 6, 1, 5, 3, 7]
+	# Every prefix is spread over the whole range
+	order = compute.bit_reversed_order(100)
+	assert order[:4].max() >= 50
+
+
+def test_share_bounds_exact():
+	assert compute.share_bounds(3, 5, 10, None) == [0.3, 0.8]
+	assert compute.share_bounds(4, 10, 10, None) == [0.4, 0.4]
+
+
+def test_share_bounds_confidence_within_exact():
+	for count in range(0, 21):
+		lo, hi = compute.share_bounds(count, 20, 100, compute.confidence_z(0.95))
+		exact_lo, exact_hi = compute.share_bounds(count, 20, 100, None)
+		assert exact_lo <= lo <= count / 20 <= hi <= exact_hi
+
+
+def test_median_bounds_exact():
+	values = np.array([10.0, 20.0, 30.0])
+	assert compute.median_bounds(values, 5, 0.0, 51.0, None) == [10.0, 30.0]
+	assert compute.median_bounds(values, 3, 0.0, 51.0, None) == [20.0, 20.0]
+
+
+def test_median_bounds_confidence_within_exact():
+	values = np.linspace(0.0, 50.0, 30)
+	lo, hi = compute.median_bounds(values, 100, 0.0, 51.0, compute.confidence_z(0.9))
+	exact_lo, exact_hi = compute.median_bounds(values, 100, 0.0, 51.0, None)
+	assert exact_lo <= lo <= hi <= exact_hi
+
+
+@pytest.mark.parametrize('kernel, key, length', [
+	[compute.f2_segment, 'obstacles', 50.0],
+	[compute.f3_segment, 'obstacles', 15.0],
+	[compute.f5_segment, 'bands', 31.0],
+])
+def test_early_stop_at_confidence_1_matches_full_evaluation(kernel, key, length):
+	# With exact bounds (confidence 1), the transects are probed until the score cannot change
+	polygons = {
+		'obstacles': compute.Polygons(pack_polygons([Polygon([(0, 20), (300, 20), (300, 40), (0, 60)]), Polygon([(400, 40), (700, 40), (700, 120), (400, 120)])])),
+		'bands': compute.Polygons(pack_polygons([Polygon([(0, -40), (900, -40), (900, -5), (0, -5)])])),
+	}
+	lines = [
+		[np.array([[0.0, 0.0], [100.0, 20.0], [200.0, 0.0], [300.0, 50.0], [900.0, 80.0]])],
+		[np.array([[0.0, -100.0], [900.0, -100.0]])],
+		[np.array([[0.0, 10.0], [900.0, 10.0]])],
+	]
+	for line in lines:
+		state = {'seg_id_field': 'Id', 'target_pts': 50, 'step_min': 10.0, 'ptref': {1: np.array([[0.0, 0.0, 4.0]])}, 'polygons': polygons[key], 'transect_length': length}
+		full, _ = kernel(state, 1, line)
+		state['confidence'] = 1.0
+		early, _ = kernel(state, 1, line)
+		assert early[-1] == full[-1]
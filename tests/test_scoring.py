@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Score tables of IQM_Core.scoring against the CASE expressions and computeFx functions they replace.
+"""
+
+
+import itertools
+import numpy as np
+import pytest
+
+from IQM_Core import scoring
+
+
+# Values around the thresholds of the tables
+RATIOS = sorted({0.0, 1.0} | {t + d for t in [0.05, 0.1, 0.33, 0.66, 0.9] for d in [-1e-9, 0.0, 1e-9]})
+
+
+# Scores of the indices before the score tables (CASE expressions and computeFx functions), None for NULL
+
+def baseline_a1(watershed_area, forest_area, agri_area):
+	if watershed_area == 0:
+		return None
+	forest = forest_area / watershed_area
+	agri = agri_area / watershed_area
+	if forest <= 0.10:
+		return 5
+	if forest < 0.33:
+		return 4
+	if 0.33 <= forest < 0.66 and agri < 0.33:
+		return 2
+	if 0.33 <= forest < 0.66 and agri >= 0.33:
+		return 3
+	if 0.66 <= forest < 0.90:
+		return 1
+	return 0
+
+
+def baseline_a2(watershed_area, dam_area):
+	if watershed_area == 0:
+		return None
+	dams = (dam_area or 0) / watershed_area
+	if dams < 0.05:
+		return 0
+	if dams < 0.33:
+		return 2
+	if dams < 0.66:
+		return 3
+	return 4
+
+
+def baseline_a3(dam_count, forest_area, agri_area, anthro_area):
+	penalty = 2 if dam_count == 1 else 4 if dam_count > 1 else 0
+	land_area = forest_area + agri_area + anthro_area
+	if land_area == 0:
+		return penalty + 2
+	altered = (anthro_area + agri_area) / land_area
+	if altered >= 0.9:
+		return penalty + 4
+	if altered >= 0.66:
+		return penalty + 3
+	if altered >= 0.33:
+		return penalty + 2
+	if altered >= 0.1:
+		return penalty + 1
+	return penalty
+
+
+def baseline_a4(sinuosity):
+	if sinuosity >= 1.5:
+		return 0
+	if sinuosity >= 1.25:
+		return 2
+	if sinuosity >= 1.05:
+		return 4
+	return 6
+
+
+def baseline_f1(struct_count):
+	if struct_count == 0:
+		return 0
+	if struct_count <= 1:
+		return 2
+	return 4
+
+
+def baseline_f2(median_length):
+	if median_length > 50:
+		return 0
+	if 30 <= median_length <= 50:
+		return 2
+	if 15 <= median_length < 30:
+		return 3
+	if median_length < 15:
+		return 5
+	return None
+
+
+def baseline_f3(intersect_perc):
+	if intersect_perc > 0.9:
+		return 0
+	if 0.66 < intersect_perc <= 0.9:
+		return 2
+	if 0.33 < intersect_perc <= 0.66:
+		return 3
+	return 5
+
+
+def baseline_f4(ratio):
+	if ratio >= 0.9:
+		return 0
+	if ratio >= 0.66:
+		return 1
+	if ratio >= 0.33:
+		return 2
+	return 3
+
+
+def baseline_f5(p30, p15to30):
+	if p30 > 0.90:
+		return 0
+	if p30 > 0.66:
+		return 1
+	if p15to30 > 0.66 or 0.33 <= p30 <= 0.66:
+		return 2
+	if 0.33 <= p15to30 <= 0.66 and p30 < 0.33:
+		return 3
+	return 4
+
+
+def as_scores(scores):
+	return [None if np.isnan(s) else int(s) for s in scores]
+
+
+def test_a1():
+	cases = [[100.0, 100.0 * forest, 100.0 * agri] for forest, agri in itertools.product(RATIOS, RATIOS) if forest + agri <= 1.0]
+	cases.append([0.0, 0.0, 0.0])
+	assert as_scores(scoring.score_a1(*zip(*cases))) == [baseline_a1(*case) for case in cases]
+
+
+def test_a2():
+	cases = [[100.0, 100.0 * dams] for dams in RATIOS] + [[0.0, 0.0], [100.0, None]]
+	expected = [baseline_a2(*case) for case in cases]
+	dam_area = [np.nan if dams is None else dams for _, dams in cases]
+	assert as_scores(scoring.score_a2([area for area, _ in cases], dam_area)) == expected
+
+
+def test_a3():
+	cases = [[dams, 100.0 * (1 - altered), 50.0 * altered, 50.0 * altered] for dams in [0, 1, 2, 5] for altered in RATIOS]
+	cases += [[dams, 0.0, 0.0, 0.0] for dams in [0, 1, 3]]
+	assert as_scores(scoring.score_a3(*zip(*cases))) == [baseline_a3(*case) for case in cases]
+
+
+@pytest.mark.parametrize('score, baseline, values', [
+	[scoring.score_a4, baseline_a4, [1.0, 1.05 - 1e-9, 1.05, 1.2, 1.25, 1.4, 1.5, 3.0]],
+	[scoring.score_f1, baseline_f1, [0, 1, 2, 10]],
+	[scoring.score_f2, baseline_f2, [0.0, 14.9, 15.0, 29.9, 30.0, 50.0, 50.0 + 1e-9, 51.0]],
+	[scoring.score_f3, baseline_f3, RATIOS],
+	[scoring.score_f4, baseline_f4, RATIOS],
+])
+def test_single_metric(score, baseline, values):
+	assert as_scores(score(values)) == [baseline(value) for value in values]
+
+
+def test_f5():
+	cases = [[p30, p15to30] for p30, p15to30 in itertools.product(RATIOS, RATIOS) if p30 + p15to30 <= 1.0]
+	assert as_scores(scoring.score_f5(*zip(*cases))) == [baseline_f5(*case) for case in cases]
+
+
+def test_null_metric_gets_default():
+	# A NULL metric fails every comparison, as in the CASE expressions
+	assert as_scores(scoring.score_f2([np.nan])) == [None]
+	assert as_scores(scoring.score_f3([np.nan])) == [5]
+	assert as_scores(scoring.score_a1([np.nan], [1.0], [0.0])) == [0]
+
+
+def test_iqm():
+	scores = np.array([[0, 0, 0, 0, 0, 0, 0, 0, 0], [5, 4, 8, 6, 4, 5, 5, 3, 0], [1, 2, 2, 0, 4, 3, 0, 1, 4]], dtype=float)
+	assert np.allclose(scoring.score_iqm(scores), 1 - scores.sum(axis=1) / 40)
+
+
+def test_score_is_fixed():
+	table = scoring.SCORE_TABLES['F3']
+	assert scoring.score_is_fixed(table, {'free_ratio': [0.91, 1.0]})
+	assert not scoring.score_is_fixed(table, {'free_ratio': [0.8, 1.0]})
+
+
+def test_tables_round_trip(tmp_path):
+	path = tmp_path / 'seuils.json'
+	scoring.save_tables(str(path))
+	assert scoring.load_tables(str(path)) == scoring.SCORE_TABLES
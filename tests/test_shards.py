@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Job queue of basin shards in a shared folder (IQM_Core.shards), with batch.run_basin stubbed.
+"""
+
+
+import os
+import time
+import threading
+
+import pytest
+
+from IQM_Core import batch, shards
+
+
+def emit(queue_dir, basin_ids):
+	# Pending shards of the basins, as written by shards.emit_shards with bundles (no QGIS needed)
+	config = {
+		'output': os.path.join(queue_dir, 'iqm.gpkg'),
+		'bundles': [{'id': basin_id, 'stream_network': f"{basin_id}.gpkg"} for basin_id in basin_ids]
+	}
+	return shards.emit_shards(config, queue_dir)
+
+
+def age(path, seconds):
+	# Sets the modification time of a file seconds in the past
+	mtime = time.time() - seconds
+	os.utime(path, (mtime, mtime))
+
+
+class Application:
+	# QGIS application of the worker, stopped at the end of shards.work and shards.collect
+	def exitQgis(self):
+		pass
+
+
+@pytest.fixture
+def queue_dir(tmp_path):
+	return str(tmp_path / 'queue')
+
+
+def test_emit(queue_dir):
+	names = emit(queue_dir, ['b/2', 'a1'])
+	assert names == ['b_2', 'a1']
+	shard = shards.read_json(os.path.join(queue_dir, 'pending', 'b_2.json'))
+	assert shard['order'] == 0 and shard['attempts'] == 0
+	assert os.path.basename(shard['output']) == 'iqm_0.gpkg'
+
+
+def test_claim_shard_single_claimant(queue_dir):
+	emit(queue_dir, [f"bassin{i}" for i in range(20)])
+	folders = shards.queue_folders(queue_dir)
+	claimed = []
+	lock = threading.Lock()
+
+	def claim(worker_id):
+		while True:
+			path = shards.claim_shard(folders, worker_id)
+			if path is None:
+				return
+			with lock:
+				claimed.append(shards.running_name(os.path.basename(path)))
+
+	workers = [threading.Thread(target=claim, args=[f"w{i}"]) for i in range(8)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	assert sorted(claimed) == sorted(f"bassin{i}.json" for i in range(20))
+	assert not os.listdir(folders['pending'])
+	assert shards.claim_shard(folders, 'w') is None
+
+
+def test_requeue_stale(queue_dir):
+	emit(queue_dir, ['a', 'b'])
+	folders = shards.queue_folders(queue_dir)
+	paths = [shards.claim_shard(folders, 'w'), shards.claim_shard(folders, 'w')]
+	# Heartbeat of the first shard fresh, of the second one older than stale
+	age(shards.heartbeat_of(paths[1]), 700)
+	assert shards.requeue_stale(queue_dir, stale=600) == ['b']
+	assert sorted(os.listdir(folders['pending'])) == ['b.json']
+	assert os.path.exists(paths[0]) and not os.path.exists(shards.heartbeat_of(paths[1]))
+	shard = shards.read_json(os.path.join(folders['pending'], 'b.json'))
+	assert shard['attempts'] == 1
+	assert os.path.basename(shard['output']) == 'iqm_1.gpkg'
+	# Not older than stale : kept running
+	age(shards.heartbeat_of(paths[0]), 500)
+	assert shards.requeue_stale(queue_dir, stale=600) == []
+	# Claimed and abandoned again
+	path = shards.claim_shard(folders, 'w')
+	age(shards.heartbeat_of(path), 700)
+	assert shards.requeue_stale(queue_dir, stale=600) == ['b']
+	shard = shards.read_json(os.path.join(folders['pending'], 'b.json'))
+	assert shard['attempts'] == 2
+	assert os.path.basename(shard['output']) == 'iqm_2.gpkg'
+
+
+def test_work_with_stubbed_run_basin(queue_dir, monkeypatch):
+	emit(queue_dir, ['a', 'b', 'c'])
+	tasks = []
+
+	def run_basin(task):
+		tasks.append(task)
+		basin_id, _, output = task
+		return {'id': basin_id, 'status': 'erreur' if basin_id == 'b' else 'ok', 'output': output, 'seconds': 0.1, 'messages': ''}
+
+	monkeypatch.setattr(batch, 'init_worker', lambda config: batch._worker.update(qgs=Application()))
+	monkeypatch.setattr(batch, 'run_basin', run_basin)
+	assert shards.work(queue_dir, heartbeat=0.01) == 3
+	assert [task[0] for task in tasks] == ['a', 'b', 'c']
+	assert all(os.path.basename(task[2]) == 'iqm_0.gpkg' for task in tasks)
+	folders = shards.queue_folders(queue_dir)
+	assert sorted(os.listdir(folders['done'])) == ['a.json', 'c.json']
+	assert os.listdir(folders['failed']) == ['b.json']
+	assert not os.listdir(folders['pending']) and not os.listdir(folders['running'])
+	assert shards.read_json(os.path.join(folders['done'], 'a.json'))['status']['status'] == 'ok'
+
+
+def test_requeued_worker_result_dropped(queue_dir, monkeypatch):
+	# The worker of a shard requeued as stale finishes after another worker claimed the shard again
+	emit(queue_dir, ['a'])
+	folders = shards.queue_folders(queue_dir)
+	claims = []
+
+	def finish(path, status):
+		# End of the new attempt, as in shards.work
+		shard = shards.read_json(path)
+		shard['status'] = status
+		shards.write_json(path, shard)
+		os.rename(path, os.path.join(folders['done'], shards.running_name(os.path.basename(path))))
+		os.remove(shards.heartbeat_of(path))
+
+	def run_basin(task):
+		basin_id, _, output = task
+		running_path = next(os.path.join(folders['running'], name) for name in os.listdir(folders['running']) if name.endswith('.json'))
+		age(shards.heartbeat_of(running_path), 700)
+		assert shards.requeue_stale(queue_dir, stale=600) == ['a']
+		claims.append(shards.claim_shard(folders, 'w2'))
+		new_output = shards.read_json(claims[0])['output']
+		assert os.path.basename(new_output) == 'iqm_1.gpkg'
+		# The new attempt is still running when the first worker finishes, it ends a moment later
+		threading.Timer(0.05, finish, [claims[0], {'id': basin_id, 'status': 'ok', 'output': new_output, 'seconds': 0.1, 'messages': '', 'worker': 'w2'}]).start()
+		return {'id': basin_id, 'status': 'ok', 'output': output, 'seconds': 0.1, 'messages': ''}
+
+	monkeypatch.setattr(batch, 'init_worker', lambda config: batch._worker.update(qgs=Application()))
+	monkeypatch.setattr(batch, 'run_basin', run_basin)
+	# The result of the first worker is dropped, it waits for the new attempt then stops
+	assert shards.work(queue_dir, heartbeat=0.01) == 0
+	assert os.listdir(folders['done']) == ['a.json']
+	status = shards.read_json(os.path.join(folders['done'], 'a.json'))['status']
+	assert status['worker'] == 'w2'
+	assert os.path.basename(status['output']) == 'iqm_1.gpkg'
+	assert not os.listdir(folders['running']) and not os.listdir(folders['pending'])
+
+
+def test_collect_order(queue_dir, monkeypatch):
+	emit(queue_dir, ['c', 'a', 'b', 'd'])
+	folders = shards.queue_folders(queue_dir)
+	# Shards left in every state : c done, a failed, b running, d pending
+	for name, state in [['c', 'done'], ['a', 'failed'], ['b', 'running']]:
+		shard = shards.read_json(os.path.join(folders['pending'], f"{name}.json"))
+		if state != 'running':
+			shard['status'] = {'id': name, 'status': 'ok' if state == 'done' else 'erreur', 'output': shard['output'], 'seconds': 1.0, 'messages': ''}
+		shards.write_json(os.path.join(folders[state], f"{name}.json"), shard)
+		os.remove(os.path.join(folders['pending'], f"{name}.json"))
+	merged = []
+	written = []
+	monkeypatch.setattr(batch, 'start_qgis', lambda *args: Application())
+	monkeypatch.setattr(batch, 'merge_outputs', lambda statuses, output: merged.append([status['id'] for status in statuses if status['status'] == 'ok']))
+	monkeypatch.setattr(batch, 'write_status', lambda statuses, path: written.append(path))
+	statuses = shards.collect(queue_dir)
+	assert [status['id'] for status in statuses] == ['c', 'a', 'b', 'd']
+	assert [status['status'] for status in statuses] == ['ok', 'erreur', 'running', 'pending']
+	assert merged == [['c']]
+	assert written == [os.path.join(queue_dir, 'iqm_status.csv')]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+*********************************************************************************
+*																				*
+*		QGIS-IQM9 is a program developed for QGIS as a tool to automatically	*
+*	calculate the Morphological Quality Index (MQI) of river systems			*
+*	Copyright (C) 2025 Laboratoire d'expertise et de recherche en géographie	*
+*	appliquée (LERGA) de l'Université du Québec à Chicoutimi (UQAC)				*
+*																				*
+*	This program is free software: you can redistribute it and/or modify		*
+*	it under the terms of the GNU Affero General Public License as published	*
+*	by the Free Software Foundation, either version 3 of the License, or		*
+*	(at your option) any later version.											*
+*																				*
+*	This program is distributed in the hope that it will be useful,				*
+*	but WITHOUT ANY WARRANTY; without even the implied warranty of				*
+*	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the				*
+*	GNU Affero General Public License for more details.							*
+*																				*
+*	You should have received a copy of the GNU Affero General Public License	*
+*	along with this program.  If not, see <https://www.gnu.org/licenses/>.		*
+*																				*
+*********************************************************************************
+"""
+
+
+"""
+Packing of the geometries and groups sent to the worker processes (IQM_Core.transport).
+"""
+
+
+import numpy as np
+import pytest
+
+from IQM_Core import transport
+
+
+def packed_lines(lines):
+	# Packed (multi)lines in the layout of transport.pack_geometries, without QGIS
+	coords = []
+	ring_offsets = [0]
+	part_offsets = [0]
+	geom_offsets = [0]
+	n_vertices = 0
+	for parts in lines:
+		for part in parts:
+			coords.append(np.asarray(part, dtype=float))
+			n_vertices += len(part)
+			ring_offsets.append(n_vertices)
+			part_offsets.append(len(ring_offsets) - 1)
+		geom_offsets.append(len(part_offsets) - 1)
+	return {
+		'coords': np.concatenate(coords),
+		'ring_offsets': np.array(ring_offsets, dtype=np.int64),
+		'part_offsets': np.array(part_offsets, dtype=np.int64),
+		'geom_offsets': np.array(geom_offsets, dtype=np.int64),
+	}
+
+
+LINES = [
+	[[[0.0, 0.0], [10.0, 0.0], [10.0, 5.0]]],
+	[[[0.0, 0.0], [1.0, 1.0]], [[2.0, 2.0], [3.0, 1.0], [4.0, 4.0]]],
+	[],
+	[[[5.0, 5.0], [6.0, 6.0]]],
+]
+
+
+def test_unpack_parts():
+	packed = packed_lines(LINES)
+	for i, parts in enumerate(LINES):
+		unpacked = transport.unpack_parts(packed, i)
+		assert [part.tolist() for part in unpacked] == parts
+		# Views of the packed coordinates
+		assert all(np.shares_memory(part, packed['coords']) for part in unpacked)
+
+
+def test_pack_geometries_round_trip():
+	qgis_core = pytest.importorskip('qgis.core')
+	wkts = [
+		'LineString (0 0, 10 0, 10 5)',
+		'MultiLineString ((0 0, 1 1), (2 2, 3 1, 4 4))',
+		'Polygon ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 3 2, 3 3, 2 2))',
+		'MultiPolygon (((0 0, 1 0, 1 1, 0 0)), ((5 5, 6 5, 6 6, 5 5)))',
+	]
+	geoms = [qgis_core.QgsGeometry.fromWkt(wkt) for wkt in wkts] + [None]
+	packed = transport.pack_geometries(geoms)
+	assert transport.geometry_count(packed) == len(geoms)
+	for i, geom in enumerate(geoms[:-1]):
+		assert transport.unpack_geometry(packed, i).equals(geom)
+	assert [part.tolist() for part in transport.unpack_parts(packed, 1)] == LINES[1]
+	assert transport.unpack_geometry(packed, len(geoms) - 1).isNull()
+	assert np.isnan(packed['bounds'][-1]).all()
+
+
+def test_pack_groups_round_trip():
+	groups = {'a': np.array([[0.0, 1.0, 2.0]]), 'b': np.empty((0, 3)), 'c': np.array([[3.0, 4.0, 5.0], [6.0, 7.0, 8.0]])}
+	unpacked = transport.unpack_groups(transport.pack_groups(groups))
+	assert list(unpacked) == list(groups)
+	for key, values in groups.items():
+		assert np.array_equal(unpacked[key], values)
+	assert transport.unpack_keys(transport.pack_keys([3, 1, 2])) == [3, 1, 2]
+	assert transport.unpack_keys(transport.pack_keys(['UEA_2', 'UEA_1'])) == ['UEA_2', 'UEA_1']